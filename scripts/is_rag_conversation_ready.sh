@@ -1,4 +1,7 @@
-until systemctl status rag_conversation.service -n 1000 | grep -q "Application startup complete"
+# Wait until the RAG server has warmed up. When serving with --workers N,
+# /ready only reports the worker that answers the request, so the other
+# workers may still be warming up when this returns
+until curl -sf http://localhost:8050/ready > /dev/null
 do
   sleep 1
 done
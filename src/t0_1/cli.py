@@ -2,10 +2,16 @@ import logging
 import os
 from typing import Annotated
 
-import requests
 import typer
 
-from t0_1.defaults import CONDITIONS_FILE, DEFAULTS, DBChoice, LLMProvider
+from t0_1.defaults import (
+    CONDITIONS_FILE,
+    DEFAULTS,
+    DBChoice,
+    EmbeddingBackend,
+    LLMProvider,
+    RerankMethod,
+)
 from t0_1.utils import load_env_file
 
 cli = typer.Typer(context_settings={"help_option_names": ["-h", "--help"]})
@@ -13,6 +19,12 @@ cli = typer.Typer(context_settings={"help_option_names": ["-h", "--help"]})
 HELP_TEXT = {
     "conditions_file": "Path to the conditions file.",
     "embedding_model_name": "Name of the embedding model.",
+    "split_cache_dir": "Directory of a cache of the chunks of split pages, keyed by the hash of the page, the embedding model and the chunk overlap. Rebuilding an index only splits new or changed pages.",
+    "embedding_cache_dir": "Directory of a cache of the embeddings of document chunks, keyed by the embedding model, its backend and the hash of the chunk. Rebuilding an index (with either database) only embeds new chunks.",
+    "bm25": "Whether to build (or load) a BM25 index of the chunks next to the index and fuse its results with the dense results by reciprocal rank fusion.",
+    "hybrid_fetch_k": "Number of dense and BM25 results to fuse (with --bm25).",
+    "rrf_k": "Rank offset of the reciprocal rank fusion (with --bm25).",
+    "embedding_backend": "Backend running the embedding model: torch, onnx (ONNX Runtime) or onnx-int8 (ONNX Runtime with int8 dynamically quantised weights). The ONNX backends need sentence-transformers[onnx]. Check them with `t0-1 check-embedding-parity`.",
     "chunk_overlap": "Chunk overlap for the text splitter.",
     "db_choice": "Database choice.",
     "persist_directory": "Path to the directory where the database is (or will be) stored.",
@@ -26,6 +38,7 @@ HELP_TEXT = {
     "llm_provider": "Service provider for the LLM.",
     "llm_model_name": "Name of the LLM model.",
     "extra_body": "Extra body to pass to the LLM if using OpenAI as service provider.",
+    "llm_base_urls": "Comma separated base URLs of replicas of the OpenAI compatible endpoint serving the model (e.g. vLLM servers). Requests are balanced over the healthy replicas with the fewest outstanding requests. If not set, OPENAI_BASE_URL is used, which can also be comma separated.",
     "conversational": "If True, use the LLM in conversational mode.",
     "conversational_agent_llm_provider": "Service provider for the conversational retriever agent LLM.",
     "conversational_agent_llm_model_name": "Name of the conversational retriever agent LLM model.",
@@ -48,6 +61,29 @@ HELP_TEXT = {
     "rerank_llm_model_name": "Name of the reranking LLM model.",
     "rerank_extra_body": "Extra body to pass to the reranking LLM if using OpenAI as service provider.",
     "rerank_k": "Number of results to return from the reranking LLM.",
+    "rerank_method": "Method to use for reranking the retrieved documents: 'llm' prompts the reranking LLM, 'cross_encoder' scores them locally with a cross-encoder model.",
+    "cross_encoder_model_name": "Name of the cross-encoder model to use when rerank_method is 'cross_encoder'.",
+    "rerank_skip_gap": "Skip reranking when the retrieval distance of the first document outside the top rerank_k exceeds that of the last document inside it by at least this gap. If not set, reranking is not skipped on the gap. Not supported with --bm25, whose scores are fused ranks rather than distances.",
+    "rerank_skip_ratio": "Skip reranking when the ratio of the retrieval distances of the first document outside the top rerank_k and the last document inside it is at least this ratio. If not set, reranking is not skipped on the ratio. Not supported with --bm25, whose scores are fused ranks rather than distances.",
+    "context_max_tokens": "Maximum number of tokens of retrieved content to pass to the model. If set, only the lines of each retrieved page around its matching chunks (with their section headers) are used instead of the full pages.",
+    "context_neighbour_lines": "Number of lines around each matching chunk to include when context_max_tokens is set.",
+    "max_context_tokens": "Maximum number of tokens of the messages sent to the model. Older messages of the conversation are trimmed to fit. Tokens are counted with the model's tokenizer (or the /tokenize endpoint of a vLLM server).",
+    "conversational_agent_max_context_tokens": "Maximum number of tokens of the messages sent to the conversational agent model. If not set, the messages are not trimmed.",
+    "http_pool_kwargs": "Keyword arguments for the HTTP connection pools shared by the LLM clients (e.g. max_connections, max_keepalive_connections, keepalive_expiry, http2, connect_timeout, read_timeout, per_host_max_connections). Should be a JSON string.",
+    "max_concurrent_queries": "Maximum number of /query requests executed at once. Requests over the limit wait in a queue. If not set, requests are not limited.",
+    "max_concurrent_streams": "Maximum number of /query_stream requests executed at once. Requests over the limit wait in a queue. If not set, requests are not limited.",
+    "max_queued_requests": "Maximum number of /query (and, separately, /query_stream) requests waiting to be executed. Requests arriving when the queue is full get a 429 response with a Retry-After header.",
+    "queue_timeout": "Maximum number of seconds a request waits in the queue before getting a 429 response.",
+    "coalesce_queries": "Whether identical concurrent queries (same query, demographics and configuration) share one graph execution and its response or stream. Only used when not conversational.",
+    "warm_up": "Whether to warm up the RAG (retrieval, tokenizers, LLM connections) after the server starts. GET /ready returns 503 until the warm up has finished.",
+    "warm_up_kwargs": "Keyword arguments for the warm up (queries, tokenizers, connections, prefix_cache). Set prefix_cache to true to send the system prompts to the LLM endpoints to prime their prefix cache. Should be a JSON string.",
+    "workers": "Number of worker processes of the server. Several workers need --shared-state-path. Admission control and query coalescing apply per worker.",
+    "shared_state_path": "Path to a SQLite database storing the conversation state and active thread IDs, shared by the workers of the server. If not set, they are kept in memory.",
+    "mmap_index": "Whether to memory-map the FAISS index read-only instead of reading it into memory, so that the workers of the server share its pages. Requires --trust-source.",
+    "profile_output_file": "Path to a JSON file to save the start up timings to. If not set, they are only logged.",
+    "response_cache_path": "Path to a SQLite database to cache the LLM responses in, so reruns with the same prompts and sampling parameters do not call the LLMs again. If not set, responses are not cached.",
+    "response_cache_only": "Whether to only serve the LLM responses from the cache (see --response-cache-path), failing on a cache miss.",
+    "retrieval_snapshot": "Path to a retrieval snapshot (see export-retrieval-snapshot) to read the retrieved documents of each query from instead of running the retriever. The documents are read from the --local-file-store the snapshot was exported with. Not supported in conversational mode.",
     "max_queries_per_minute": "Number of queries per minute to send to the model. Used to help avoid rate limits.",
     "logging_level": "Logging level. 10 = DEBUG, 20 = INFO, 30 = WARNING, 40 = ERROR, 50 = CRITICAL.",
     "seed": "Random seed.",
@@ -72,6 +108,16 @@ def serve_vector_store(
     embedding_model_name: Annotated[
         str, typer.Option(help=HELP_TEXT["embedding_model_name"])
     ] = DEFAULTS["embedding_model_name"],
+    embedding_backend: Annotated[
+        EmbeddingBackend, typer.Option(help=HELP_TEXT["embedding_backend"])
+    ] = DEFAULTS["embedding_backend"],
+    split_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["split_cache_dir"])
+    ] = None,
+    embedding_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["embedding_cache_dir"])
+    ] = None,
+    bm25: Annotated[bool, typer.Option(help=HELP_TEXT["bm25"])] = DEFAULTS["bm25"],
     chunk_overlap: Annotated[
         int, typer.Option(help=HELP_TEXT["chunk_overlap"])
     ] = DEFAULTS["chunk_overlap"],
@@ -114,6 +160,10 @@ def serve_vector_store(
         conditions_file=conditions_file,
         config=VectorStoreConfig(
             embedding_model_name=embedding_model_name,
+            embedding_backend=embedding_backend,
+            split_cache_dir=split_cache_dir,
+            embedding_cache_dir=embedding_cache_dir,
+            bm25=bm25,
             chunk_overlap=chunk_overlap,
             db_choice=db_choice,
             persist_directory=persist_directory,
@@ -148,6 +198,8 @@ def query_vector_store(
     logging.info("Querying vector store...")
     logging.info(f"Query: {query}")
 
+    import requests
+
     req = requests.get(
         f"http://{host}:{port}/query",
         params={"query": query, "k": k, "with_score": with_score},
@@ -180,6 +232,16 @@ def evaluate_vector_store(
     embedding_model_name: Annotated[
         str, typer.Option(help=HELP_TEXT["embedding_model_name"])
     ] = DEFAULTS["embedding_model_name"],
+    embedding_backend: Annotated[
+        EmbeddingBackend, typer.Option(help=HELP_TEXT["embedding_backend"])
+    ] = DEFAULTS["embedding_backend"],
+    split_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["split_cache_dir"])
+    ] = None,
+    embedding_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["embedding_cache_dir"])
+    ] = None,
+    bm25: Annotated[bool, typer.Option(help=HELP_TEXT["bm25"])] = DEFAULTS["bm25"],
     chunk_overlap: Annotated[
         int, typer.Option(help=HELP_TEXT["chunk_overlap"])
     ] = DEFAULTS["chunk_overlap"],
@@ -199,6 +261,23 @@ def evaluate_vector_store(
         typer.Option(help=HELP_TEXT["trust_source"]),
     ] = DEFAULTS["trust_source"],
     k: Annotated[int, typer.Option(help=HELP_TEXT["k"])] = DEFAULTS["k"],
+    fetch_k: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["hybrid_fetch_k"]),
+    ] = DEFAULTS["hybrid_fetch_k"],
+    rrf_k: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["rrf_k"]),
+    ] = DEFAULTS["rrf_k"],
+    ks: Annotated[
+        str | None,
+        typer.Option(
+            help="Comma separated values of k (e.g. 1,3,5,10). If set, recall@k, nDCG@k and MRR are computed for all of them in one pass, with the queries embedded in batches, and --output-file can be a JSONL or Parquet file."
+        ),
+    ] = None,
+    batch_size: Annotated[
+        int, typer.Option(help="Number of queries to embed at once (with --ks).")
+    ] = 64,
     logging_level: Annotated[
         int,
         typer.Option(help=HELP_TEXT["logging_level"]),
@@ -223,6 +302,10 @@ def evaluate_vector_store(
         conditions_file=conditions_file,
         config=VectorStoreConfig(
             embedding_model_name=embedding_model_name,
+            embedding_backend=embedding_backend,
+            split_cache_dir=split_cache_dir,
+            embedding_cache_dir=embedding_cache_dir,
+            bm25=bm25,
             chunk_overlap=chunk_overlap,
             db_choice=db_choice,
             persist_directory=persist_directory,
@@ -230,6 +313,134 @@ def evaluate_vector_store(
         force_create=force_create,
         trust_source=trust_source,
         k=k,
+        fetch_k=fetch_k,
+        rrf_k=rrf_k,
+        ks=ks,
+        batch_size=batch_size,
+    )
+
+
+@cli.command()
+def check_embedding_parity(
+    input_file: Annotated[str, typer.Argument(help="Path to the input file.")],
+    query_field: Annotated[
+        str, typer.Option(help="Field name for the query in the input file.")
+    ] = "symptoms_description",
+    embedding_model_name: Annotated[
+        str, typer.Option(help=HELP_TEXT["embedding_model_name"])
+    ] = DEFAULTS["embedding_model_name"],
+    embedding_backend: Annotated[
+        EmbeddingBackend, typer.Option(help=HELP_TEXT["embedding_backend"])
+    ] = EmbeddingBackend.onnx_int8,
+    reference_backend: Annotated[
+        EmbeddingBackend,
+        typer.Option(help="Backend to compare the embeddings against."),
+    ] = EmbeddingBackend.torch,
+    max_texts: Annotated[
+        int, typer.Option(help="Maximum number of queries to embed.")
+    ] = 500,
+    min_similarity: Annotated[
+        float,
+        typer.Option(
+            help="Minimum cosine similarity of every query embedding to pass the check."
+        ),
+    ] = 0.99,
+    output_file: Annotated[
+        str | None, typer.Option(help="Path to a JSON file to save the results to.")
+    ] = None,
+    logging_level: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["logging_level"]),
+    ] = DEFAULTS["logging_level"],
+):
+    """
+    Check that an embedding backend gives the same query embeddings as another.
+    """
+    set_up_logging_config(level=logging_level)
+    if not os.path.exists(input_file):
+        raise FileNotFoundError(f"Input file {input_file} does not exist.")
+
+    from t0_1.query_vector_store.embedding_parity import main
+
+    main(
+        input_file=input_file,
+        query_field=query_field,
+        model_name=embedding_model_name,
+        backend=embedding_backend,
+        reference_backend=reference_backend,
+        max_texts=max_texts,
+        min_similarity=min_similarity,
+        output_file=output_file,
+    )
+
+
+@cli.command()
+def sweep_retriever(
+    grid_file: Annotated[
+        str,
+        typer.Argument(
+            help='Path to a JSON file with the grid of the sweep, mapping any of "embedding_model_name", "chunk_overlap", "db_choice", "search_type" and "k" to a list of values.'
+        ),
+    ],
+    input_file: Annotated[str, typer.Argument(help="Path to the input file.")],
+    output_dir: Annotated[
+        str,
+        typer.Option(
+            help="Directory of the indexes, caches and results of the sweep. Indexes already in it are reused."
+        ),
+    ] = "./data/evaluation/sweep-retriever",
+    query_field: Annotated[
+        str, typer.Option(help="Field name for the query in the input file.")
+    ] = "symptoms_description",
+    target_document_field: Annotated[
+        str,
+        typer.Option(help="Field name for the target document in the input file."),
+    ] = "conditions_title",
+    conditions_file: Annotated[
+        str,
+        typer.Option(envvar="T0_CONDITIONS_FILE", help=HELP_TEXT["conditions_file"]),
+    ] = CONDITIONS_FILE,
+    embedding_backend: Annotated[
+        EmbeddingBackend, typer.Option(help=HELP_TEXT["embedding_backend"])
+    ] = DEFAULTS["embedding_backend"],
+    fetch_k: Annotated[
+        int, typer.Option(help="Number of candidates of MMR searches.")
+    ] = DEFAULTS["hybrid_fetch_k"],
+    batch_size: Annotated[
+        int, typer.Option(help="Number of queries to embed at once.")
+    ] = 64,
+    max_workers: Annotated[
+        int,
+        typer.Option(
+            help="Number of processes evaluating embedding models at once. Configurations of the same embedding model are evaluated in the same process."
+        ),
+    ] = 1,
+    logging_level: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["logging_level"]),
+    ] = DEFAULTS["logging_level"],
+):
+    """
+    Evaluate the recall and latency of a grid of retriever configurations.
+    """
+    set_up_logging_config(level=logging_level)
+    for file in (grid_file, input_file):
+        if not os.path.exists(file):
+            raise FileNotFoundError(f"File {file} does not exist.")
+
+    from t0_1.query_vector_store.sweep import sweep_retriever
+
+    sweep_retriever(
+        grid=grid_file,
+        conditions_file=conditions_file,
+        input_file=input_file,
+        output_dir=output_dir,
+        query_field=query_field,
+        target_document_field=target_document_field,
+        embedding_backend=embedding_backend,
+        fetch_k=fetch_k,
+        batch_size=batch_size,
+        max_workers=max_workers,
     )
 
 
@@ -242,6 +453,20 @@ def serve_retriever(
     embedding_model_name: Annotated[
         str, typer.Option(help=HELP_TEXT["embedding_model_name"])
     ] = DEFAULTS["embedding_model_name"],
+    embedding_backend: Annotated[
+        EmbeddingBackend, typer.Option(help=HELP_TEXT["embedding_backend"])
+    ] = DEFAULTS["embedding_backend"],
+    split_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["split_cache_dir"])
+    ] = None,
+    embedding_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["embedding_cache_dir"])
+    ] = None,
+    bm25: Annotated[bool, typer.Option(help=HELP_TEXT["bm25"])] = DEFAULTS["bm25"],
+    hybrid_fetch_k: Annotated[
+        int, typer.Option(help=HELP_TEXT["hybrid_fetch_k"])
+    ] = DEFAULTS["hybrid_fetch_k"],
+    rrf_k: Annotated[int, typer.Option(help=HELP_TEXT["rrf_k"])] = DEFAULTS["rrf_k"],
     chunk_overlap: Annotated[
         int, typer.Option(help=HELP_TEXT["chunk_overlap"])
     ] = DEFAULTS["chunk_overlap"],
@@ -292,6 +517,12 @@ def serve_retriever(
         conditions_file=conditions_file,
         config=RetrieverConfig(
             embedding_model_name=embedding_model_name,
+            embedding_backend=embedding_backend,
+            split_cache_dir=split_cache_dir,
+            embedding_cache_dir=embedding_cache_dir,
+            bm25=bm25,
+            rrf_k=rrf_k,
+            hybrid_fetch_k=hybrid_fetch_k,
             chunk_overlap=chunk_overlap,
             db_choice=db_choice,
             persist_directory=persist_directory,
@@ -325,6 +556,8 @@ def query_retriever(
     logging.info("Querying retriever...")
     logging.info(f"Query: {query}")
 
+    import requests
+
     req = requests.get(f"http://{host}:{port}/query", params={"query": query})
 
     if req.status_code != 200:
@@ -343,6 +576,20 @@ def serve_rag(
     embedding_model_name: Annotated[
         str, typer.Option(help=HELP_TEXT["embedding_model_name"])
     ] = DEFAULTS["embedding_model_name"],
+    embedding_backend: Annotated[
+        EmbeddingBackend, typer.Option(help=HELP_TEXT["embedding_backend"])
+    ] = DEFAULTS["embedding_backend"],
+    split_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["split_cache_dir"])
+    ] = None,
+    embedding_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["embedding_cache_dir"])
+    ] = None,
+    bm25: Annotated[bool, typer.Option(help=HELP_TEXT["bm25"])] = DEFAULTS["bm25"],
+    hybrid_fetch_k: Annotated[
+        int, typer.Option(help=HELP_TEXT["hybrid_fetch_k"])
+    ] = DEFAULTS["hybrid_fetch_k"],
+    rrf_k: Annotated[int, typer.Option(help=HELP_TEXT["rrf_k"])] = DEFAULTS["rrf_k"],
     chunk_overlap: Annotated[
         int, typer.Option(help=HELP_TEXT["chunk_overlap"])
     ] = DEFAULTS["chunk_overlap"],
@@ -379,6 +626,10 @@ def serve_rag(
         str | None,
         typer.Option(help=HELP_TEXT["extra_body"]),
     ] = None,  # TODO: Decide whhether to add this to defaults
+    llm_base_urls: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["llm_base_urls"]),
+    ] = None,
     conversational: Annotated[
         bool,
         typer.Option(help=HELP_TEXT["conversational"]),
@@ -442,6 +693,82 @@ def serve_rag(
         int,
         typer.Option(help=HELP_TEXT["rerank_k"]),
     ] = 5,
+    rerank_method: Annotated[
+        RerankMethod,
+        typer.Option(help=HELP_TEXT["rerank_method"]),
+    ] = DEFAULTS["rerank_method"],
+    cross_encoder_model_name: Annotated[
+        str,
+        typer.Option(help=HELP_TEXT["cross_encoder_model_name"]),
+    ] = DEFAULTS["cross_encoder_model_name"],
+    rerank_skip_gap: Annotated[
+        float | None,
+        typer.Option(help=HELP_TEXT["rerank_skip_gap"]),
+    ] = None,
+    rerank_skip_ratio: Annotated[
+        float | None,
+        typer.Option(help=HELP_TEXT["rerank_skip_ratio"]),
+    ] = None,
+    context_max_tokens: Annotated[
+        int | None,
+        typer.Option(help=HELP_TEXT["context_max_tokens"]),
+    ] = None,
+    context_neighbour_lines: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["context_neighbour_lines"]),
+    ] = 1,
+    max_context_tokens: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["max_context_tokens"]),
+    ] = DEFAULTS["max_context_tokens"],
+    conversational_agent_max_context_tokens: Annotated[
+        int | None,
+        typer.Option(help=HELP_TEXT["conversational_agent_max_context_tokens"]),
+    ] = None,
+    http_pool_kwargs: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["http_pool_kwargs"]),
+    ] = None,
+    max_concurrent_queries: Annotated[
+        int | None,
+        typer.Option(help=HELP_TEXT["max_concurrent_queries"]),
+    ] = None,
+    max_concurrent_streams: Annotated[
+        int | None,
+        typer.Option(help=HELP_TEXT["max_concurrent_streams"]),
+    ] = None,
+    max_queued_requests: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["max_queued_requests"]),
+    ] = DEFAULTS["max_queued_requests"],
+    queue_timeout: Annotated[
+        float,
+        typer.Option(help=HELP_TEXT["queue_timeout"]),
+    ] = DEFAULTS["queue_timeout"],
+    coalesce_queries: Annotated[
+        bool,
+        typer.Option(help=HELP_TEXT["coalesce_queries"]),
+    ] = False,
+    warm_up: Annotated[
+        bool,
+        typer.Option(help=HELP_TEXT["warm_up"]),
+    ] = True,
+    warm_up_kwargs: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["warm_up_kwargs"]),
+    ] = None,
+    workers: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["workers"]),
+    ] = DEFAULTS["workers"],
+    shared_state_path: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["shared_state_path"]),
+    ] = None,
+    mmap_index: Annotated[
+        bool,
+        typer.Option(help=HELP_TEXT["mmap_index"]),
+    ] = False,
     host: Annotated[str, typer.Option(help=HELP_TEXT["host_serve"])] = DEFAULTS["host"],
     port: Annotated[int, typer.Option(help=HELP_TEXT["port_serve"])] = DEFAULTS["port"],
     logging_level: Annotated[
@@ -471,6 +798,12 @@ def serve_rag(
         conditions_file=conditions_file,
         config=RetrieverConfig(
             embedding_model_name=embedding_model_name,
+            embedding_backend=embedding_backend,
+            split_cache_dir=split_cache_dir,
+            embedding_cache_dir=embedding_cache_dir,
+            bm25=bm25,
+            rrf_k=rrf_k,
+            hybrid_fetch_k=hybrid_fetch_k,
             chunk_overlap=chunk_overlap,
             db_choice=db_choice,
             persist_directory=persist_directory,
@@ -484,6 +817,7 @@ def serve_rag(
         llm_provider=llm_provider,
         llm_model_name=llm_model_name,
         extra_body=extra_body,
+        llm_base_urls=llm_base_urls,
         conversational=conversational,
         conversational_agent_llm_provider=conversational_agent_llm_provider,
         conversational_agent_llm_model_name=conversational_agent_llm_model_name,
@@ -499,12 +833,130 @@ def serve_rag(
         rerank_llm_model_name=rerank_llm_model_name,
         rerank_extra_body=rerank_extra_body,
         rerank_k=rerank_k,
+        rerank_method=rerank_method,
+        cross_encoder_model_name=cross_encoder_model_name,
+        rerank_skip_gap=rerank_skip_gap,
+        rerank_skip_ratio=rerank_skip_ratio,
+        context_max_tokens=context_max_tokens,
+        context_neighbour_lines=context_neighbour_lines,
+        max_context_tokens=max_context_tokens,
+        conversational_agent_max_context_tokens=conversational_agent_max_context_tokens,
+        http_pool_kwargs=http_pool_kwargs,
+        max_concurrent_queries=max_concurrent_queries,
+        max_concurrent_streams=max_concurrent_streams,
+        max_queued_requests=max_queued_requests,
+        queue_timeout=queue_timeout,
+        coalesce_queries=coalesce_queries,
+        warm_up=warm_up,
+        warm_up_kwargs=warm_up_kwargs,
+        workers=workers,
+        shared_state_path=shared_state_path,
+        mmap_index=mmap_index,
         host=host,
         port=port,
         seed=seed,
     )
 
 
+@cli.command()
+def profile_startup(
+    embedding_model_name: Annotated[
+        str, typer.Option(help=HELP_TEXT["embedding_model_name"])
+    ] = DEFAULTS["embedding_model_name"],
+    embedding_backend: Annotated[
+        EmbeddingBackend, typer.Option(help=HELP_TEXT["embedding_backend"])
+    ] = DEFAULTS["embedding_backend"],
+    chunk_overlap: Annotated[
+        int, typer.Option(help=HELP_TEXT["chunk_overlap"])
+    ] = DEFAULTS["chunk_overlap"],
+    db_choice: Annotated[
+        DBChoice, typer.Option(help=HELP_TEXT["db_choice"])
+    ] = DEFAULTS["db_choice"],
+    persist_directory: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["persist_directory"]),
+    ] = DEFAULTS["persist_directory"],
+    local_file_store: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["local_file_store"]),
+    ] = DEFAULTS["local_file_store"],
+    search_type: Annotated[str, typer.Option(help=HELP_TEXT["search_type"])] = DEFAULTS[
+        "search_type"
+    ],
+    k: Annotated[int, typer.Option(help=HELP_TEXT["k"])] = DEFAULTS["k"],
+    trust_source: Annotated[
+        bool,
+        typer.Option(help=HELP_TEXT["trust_source"]),
+    ] = DEFAULTS["trust_source"],
+    mmap_index: Annotated[
+        bool,
+        typer.Option(help=HELP_TEXT["mmap_index"]),
+    ] = False,
+    llm_provider: Annotated[
+        LLMProvider, typer.Option(help=HELP_TEXT["llm_provider"])
+    ] = DEFAULTS["llm_provider"],
+    llm_model_name: Annotated[
+        str, typer.Option(help=HELP_TEXT["llm_model_name"])
+    ] = DEFAULTS["llm_model_name"],
+    llm_base_urls: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["llm_base_urls"]),
+    ] = None,
+    prompt_template_path: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["prompt_template_path"]),
+    ] = DEFAULTS["prompt_template_path"],
+    system_prompt_path: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["system_prompt_path"]),
+    ] = DEFAULTS["system_prompt_path"],
+    env_file: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["env_file"]),
+    ] = DEFAULTS["env_file"],
+    output_file: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["profile_output_file"]),
+    ] = None,
+    logging_level: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["logging_level"]),
+    ] = DEFAULTS["logging_level"],
+):
+    """
+    Profile the start up of the RAG server: imports, embedding model load,
+    index load and LLM client set up.
+    """
+    set_up_logging_config(level=logging_level)
+    load_env_file(env_file)
+    logging.info("Profiling RAG server start up...")
+
+    from t0_1.query_vector_store.build_retriever import RetrieverConfig
+    from t0_1.rag.profile_startup import main
+
+    main(
+        config=RetrieverConfig(
+            embedding_model_name=embedding_model_name,
+            embedding_backend=embedding_backend,
+            chunk_overlap=chunk_overlap,
+            db_choice=db_choice,
+            persist_directory=persist_directory,
+            local_file_store=local_file_store,
+            search_type=search_type,
+            k=k,
+            search_kwargs={},
+        ),
+        trust_source=trust_source,
+        mmap_index=mmap_index,
+        llm_provider=llm_provider,
+        llm_model_name=llm_model_name,
+        llm_base_urls=llm_base_urls,
+        prompt_template_path=prompt_template_path,
+        system_prompt_path=system_prompt_path,
+        output_file=output_file,
+    )
+
+
 @cli.command()
 def query_rag(
     query: Annotated[str, typer.Argument(help=HELP_TEXT["query"])],
@@ -533,6 +985,8 @@ def query_rag(
     else:
         extra_body = {}
 
+    import requests
+
     req = requests.post(
         f"http://{host}:{port}/query", json={"query": query} | extra_body
     )
@@ -544,6 +998,110 @@ def query_rag(
     logging.info(f"Response: {req.json()}")
 
 
+@cli.command()
+def export_retrieval_snapshot(
+    input_file: Annotated[str, typer.Argument(help="Path to the input file.")],
+    output_file: Annotated[
+        str, typer.Option(help="Path to the JSONL file to save the snapshot to.")
+    ] = "./data/evaluation/retrieval_snapshot.jsonl",
+    query_field: Annotated[
+        str, typer.Option(help="Field name for the query in the input file.")
+    ] = "symptoms_description",
+    conditions_file: Annotated[
+        str,
+        typer.Option(envvar="T0_CONDITIONS_FILE", help=HELP_TEXT["conditions_file"]),
+    ] = CONDITIONS_FILE,
+    embedding_model_name: Annotated[
+        str, typer.Option(help=HELP_TEXT["embedding_model_name"])
+    ] = DEFAULTS["embedding_model_name"],
+    embedding_backend: Annotated[
+        EmbeddingBackend, typer.Option(help=HELP_TEXT["embedding_backend"])
+    ] = DEFAULTS["embedding_backend"],
+    split_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["split_cache_dir"])
+    ] = None,
+    embedding_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["embedding_cache_dir"])
+    ] = None,
+    bm25: Annotated[bool, typer.Option(help=HELP_TEXT["bm25"])] = DEFAULTS["bm25"],
+    hybrid_fetch_k: Annotated[
+        int, typer.Option(help=HELP_TEXT["hybrid_fetch_k"])
+    ] = DEFAULTS["hybrid_fetch_k"],
+    rrf_k: Annotated[int, typer.Option(help=HELP_TEXT["rrf_k"])] = DEFAULTS["rrf_k"],
+    chunk_overlap: Annotated[
+        int, typer.Option(help=HELP_TEXT["chunk_overlap"])
+    ] = DEFAULTS["chunk_overlap"],
+    db_choice: Annotated[
+        DBChoice, typer.Option(help=HELP_TEXT["db_choice"])
+    ] = DEFAULTS["db_choice"],
+    persist_directory: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["persist_directory"]),
+    ] = DEFAULTS["persist_directory"],
+    local_file_store: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["local_file_store"]),
+    ] = DEFAULTS["local_file_store"],
+    search_type: Annotated[str, typer.Option(help=HELP_TEXT["search_type"])] = DEFAULTS[
+        "search_type"
+    ],
+    k: Annotated[int, typer.Option(help=HELP_TEXT["k"])] = DEFAULTS["k"],
+    force_create: Annotated[
+        bool,
+        typer.Option(help=HELP_TEXT["force_create"]),
+    ] = DEFAULTS["force_create"],
+    trust_source: Annotated[
+        bool,
+        typer.Option(help=HELP_TEXT["trust_source"]),
+    ] = DEFAULTS["trust_source"],
+    max_concurrency: Annotated[
+        int, typer.Option(help="Number of queries to retrieve at once.")
+    ] = 16,
+    logging_level: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["logging_level"]),
+    ] = DEFAULTS["logging_level"],
+):
+    """
+    Save the documents retrieved for each query of the input file, to evaluate
+    the RAG with --retrieval-snapshot without running the retriever.
+    """
+    set_up_logging_config(level=logging_level)
+    if not os.path.exists(input_file):
+        raise FileNotFoundError(f"Input file {input_file} does not exist.")
+
+    logging.info("Exporting retrieval snapshot...")
+
+    from t0_1.query_vector_store.build_retriever import RetrieverConfig
+    from t0_1.rag.retrieval_snapshot import main
+
+    main(
+        input_file=input_file,
+        output_file=output_file,
+        query_field=query_field,
+        conditions_file=conditions_file,
+        config=RetrieverConfig(
+            embedding_model_name=embedding_model_name,
+            embedding_backend=embedding_backend,
+            split_cache_dir=split_cache_dir,
+            embedding_cache_dir=embedding_cache_dir,
+            bm25=bm25,
+            rrf_k=rrf_k,
+            hybrid_fetch_k=hybrid_fetch_k,
+            chunk_overlap=chunk_overlap,
+            db_choice=db_choice,
+            persist_directory=persist_directory,
+            local_file_store=local_file_store,
+            search_type=search_type,
+            k=k,
+            search_kwargs={},
+        ),
+        force_create=force_create,
+        trust_source=trust_source,
+        max_concurrency=max_concurrency,
+    )
+
+
 @cli.command()
 def evaluate_rag(
     input_file: Annotated[str, typer.Argument(help="Path to the input file.")],
@@ -568,6 +1126,20 @@ def evaluate_rag(
     embedding_model_name: Annotated[
         str, typer.Option(help=HELP_TEXT["embedding_model_name"])
     ] = DEFAULTS["embedding_model_name"],
+    embedding_backend: Annotated[
+        EmbeddingBackend, typer.Option(help=HELP_TEXT["embedding_backend"])
+    ] = DEFAULTS["embedding_backend"],
+    split_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["split_cache_dir"])
+    ] = None,
+    embedding_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["embedding_cache_dir"])
+    ] = None,
+    bm25: Annotated[bool, typer.Option(help=HELP_TEXT["bm25"])] = DEFAULTS["bm25"],
+    hybrid_fetch_k: Annotated[
+        int, typer.Option(help=HELP_TEXT["hybrid_fetch_k"])
+    ] = DEFAULTS["hybrid_fetch_k"],
+    rrf_k: Annotated[int, typer.Option(help=HELP_TEXT["rrf_k"])] = DEFAULTS["rrf_k"],
     chunk_overlap: Annotated[
         int, typer.Option(help=HELP_TEXT["chunk_overlap"])
     ] = DEFAULTS["chunk_overlap"],
@@ -604,6 +1176,10 @@ def evaluate_rag(
         str | None,
         typer.Option(help=HELP_TEXT["extra_body"]),
     ] = None,  # TODO: Decide whether to add this to defaults
+    llm_base_urls: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["llm_base_urls"]),
+    ] = None,
     conversational: Annotated[
         bool,
         typer.Option(help=HELP_TEXT["conversational"]),
@@ -673,10 +1249,62 @@ def evaluate_rag(
         int,
         typer.Option(help=HELP_TEXT["rerank_k"]),
     ] = 5,
+    rerank_method: Annotated[
+        RerankMethod,
+        typer.Option(help=HELP_TEXT["rerank_method"]),
+    ] = DEFAULTS["rerank_method"],
+    cross_encoder_model_name: Annotated[
+        str,
+        typer.Option(help=HELP_TEXT["cross_encoder_model_name"]),
+    ] = DEFAULTS["cross_encoder_model_name"],
+    rerank_skip_gap: Annotated[
+        float | None,
+        typer.Option(help=HELP_TEXT["rerank_skip_gap"]),
+    ] = None,
+    rerank_skip_ratio: Annotated[
+        float | None,
+        typer.Option(help=HELP_TEXT["rerank_skip_ratio"]),
+    ] = None,
+    context_max_tokens: Annotated[
+        int | None,
+        typer.Option(help=HELP_TEXT["context_max_tokens"]),
+    ] = None,
+    context_neighbour_lines: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["context_neighbour_lines"]),
+    ] = 1,
+    max_context_tokens: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["max_context_tokens"]),
+    ] = DEFAULTS["max_context_tokens"],
+    conversational_agent_max_context_tokens: Annotated[
+        int | None,
+        typer.Option(help=HELP_TEXT["conversational_agent_max_context_tokens"]),
+    ] = None,
+    http_pool_kwargs: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["http_pool_kwargs"]),
+    ] = None,
+    response_cache_path: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["response_cache_path"]),
+    ] = None,
+    response_cache_only: Annotated[
+        bool,
+        typer.Option(help=HELP_TEXT["response_cache_only"]),
+    ] = False,
+    coalesce_queries: Annotated[
+        bool,
+        typer.Option(help=HELP_TEXT["coalesce_queries"]),
+    ] = False,
     max_queries_per_minute: Annotated[
         int,
         typer.Option(help=HELP_TEXT["max_queries_per_minute"]),
     ] = DEFAULTS["max_queries_per_minute"],
+    retrieval_snapshot: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["retrieval_snapshot"]),
+    ] = None,
     logging_level: Annotated[
         int,
         typer.Option(help=HELP_TEXT["logging_level"]),
@@ -711,6 +1339,12 @@ def evaluate_rag(
         generate_only=generate_only,
         config=RetrieverConfig(
             embedding_model_name=embedding_model_name,
+            embedding_backend=embedding_backend,
+            split_cache_dir=split_cache_dir,
+            embedding_cache_dir=embedding_cache_dir,
+            bm25=bm25,
+            rrf_k=rrf_k,
+            hybrid_fetch_k=hybrid_fetch_k,
             chunk_overlap=chunk_overlap,
             db_choice=db_choice,
             persist_directory=persist_directory,
@@ -724,6 +1358,7 @@ def evaluate_rag(
         llm_provider=llm_provider,
         llm_model_name=llm_model_name,
         extra_body=extra_body,
+        llm_base_urls=llm_base_urls,
         conversational=conversational,
         conversational_agent_llm_provider=conversational_agent_llm_provider,
         conversational_agent_llm_model_name=conversational_agent_llm_model_name,
@@ -741,6 +1376,120 @@ def evaluate_rag(
         rerank_llm_model_name=rerank_llm_model_name,
         rerank_extra_body=rerank_extra_body,
         rerank_k=rerank_k,
+        rerank_method=rerank_method,
+        cross_encoder_model_name=cross_encoder_model_name,
+        rerank_skip_gap=rerank_skip_gap,
+        rerank_skip_ratio=rerank_skip_ratio,
+        context_max_tokens=context_max_tokens,
+        context_neighbour_lines=context_neighbour_lines,
+        max_context_tokens=max_context_tokens,
+        conversational_agent_max_context_tokens=conversational_agent_max_context_tokens,
+        http_pool_kwargs=http_pool_kwargs,
+        response_cache_path=response_cache_path,
+        response_cache_only=response_cache_only,
+        coalesce_queries=coalesce_queries,
+        seed=seed,
+        retrieval_snapshot=retrieval_snapshot,
+    )
+
+
+@cli.command()
+def replay_generation(
+    input_file: Annotated[
+        str,
+        typer.Argument(
+            help="Path to the results of evaluate-rag, with the system_prompt and rag_message of each query."
+        ),
+    ],
+    output_file: Annotated[
+        str, typer.Option(help="Path to the output file.")
+    ] = "./data/evaluation/replay_generation_results.jsonl",
+    llm_provider: Annotated[
+        LLMProvider, typer.Option(help=HELP_TEXT["llm_provider"])
+    ] = DEFAULTS["llm_provider"],
+    llm_model_name: Annotated[
+        str, typer.Option(help=HELP_TEXT["llm_model_name"])
+    ] = DEFAULTS["llm_model_name"],
+    extra_body: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["extra_body"]),
+    ] = None,
+    llm_base_urls: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["llm_base_urls"]),
+    ] = None,
+    http_pool_kwargs: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["http_pool_kwargs"]),
+    ] = None,
+    generate_only: Annotated[
+        bool,
+        typer.Option(help=HELP_TEXT["generate_only"]),
+    ] = False,
+    deepseek_r1: Annotated[
+        bool,
+        typer.Option(
+            help="If True, evaluating deepseek-R1 responses which requires parsing the response."
+        ),
+    ] = False,
+    s1: Annotated[
+        bool,
+        typer.Option(
+            help="If True, evaluating s1 responses which requires parsing the response."
+        ),
+    ] = False,
+    env_file: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["env_file"]),
+    ] = DEFAULTS["env_file"],
+    max_concurrency: Annotated[
+        int, typer.Option(help="Maximum number of requests to the model at once.")
+    ] = 64,
+    max_queries_per_minute: Annotated[
+        int | None,
+        typer.Option(
+            help="Maximum number of requests to the model per minute. If not set, requests are only limited by --max-concurrency."
+        ),
+    ] = None,
+    logging_level: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["logging_level"]),
+    ] = DEFAULTS["logging_level"],
+    seed: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["seed"]),
+    ] = DEFAULTS["seed"],
+):
+    """
+    Regenerate and score the responses of an evaluate-rag run from its stored
+    prompts, without running the retriever.
+    """
+    set_up_logging_config(level=logging_level)
+    load_env_file(env_file)
+    if not os.path.exists(input_file):
+        raise FileNotFoundError(f"Input file {input_file} does not exist.")
+
+    logging.info("Replaying generation...")
+
+    from t0_1.rag.replay import main
+    from t0_1.utils import set_seed
+
+    if seed:
+        set_seed(seed)
+
+    main(
+        input_file=input_file,
+        output_file=output_file,
+        llm_provider=llm_provider,
+        llm_model_name=llm_model_name,
+        extra_body=extra_body,
+        llm_base_urls=llm_base_urls,
+        http_pool_kwargs=http_pool_kwargs,
+        generate_only=generate_only,
+        deepseek_r1=deepseek_r1,
+        s1=s1,
+        max_concurrency=max_concurrency,
+        max_queries_per_minute=max_queries_per_minute,
         seed=seed,
     )
 
@@ -799,6 +1548,20 @@ def rag_chat(
     embedding_model_name: Annotated[
         str, typer.Option(help=HELP_TEXT["embedding_model_name"])
     ] = DEFAULTS["embedding_model_name"],
+    embedding_backend: Annotated[
+        EmbeddingBackend, typer.Option(help=HELP_TEXT["embedding_backend"])
+    ] = DEFAULTS["embedding_backend"],
+    split_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["split_cache_dir"])
+    ] = None,
+    embedding_cache_dir: Annotated[
+        str | None, typer.Option(help=HELP_TEXT["embedding_cache_dir"])
+    ] = None,
+    bm25: Annotated[bool, typer.Option(help=HELP_TEXT["bm25"])] = DEFAULTS["bm25"],
+    hybrid_fetch_k: Annotated[
+        int, typer.Option(help=HELP_TEXT["hybrid_fetch_k"])
+    ] = DEFAULTS["hybrid_fetch_k"],
+    rrf_k: Annotated[int, typer.Option(help=HELP_TEXT["rrf_k"])] = DEFAULTS["rrf_k"],
     chunk_overlap: Annotated[
         int, typer.Option(help=HELP_TEXT["chunk_overlap"])
     ] = DEFAULTS["chunk_overlap"],
@@ -835,6 +1598,10 @@ def rag_chat(
         str | None,
         typer.Option(help=HELP_TEXT["extra_body"]),
     ] = None,  # TODO: Decide whether to add this to defaults
+    llm_base_urls: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["llm_base_urls"]),
+    ] = None,
     conversational: Annotated[
         bool,
         typer.Option(help=HELP_TEXT["conversational"]),
@@ -898,6 +1665,42 @@ def rag_chat(
         int,
         typer.Option(help=HELP_TEXT["rerank_k"]),
     ] = 5,
+    rerank_method: Annotated[
+        RerankMethod,
+        typer.Option(help=HELP_TEXT["rerank_method"]),
+    ] = DEFAULTS["rerank_method"],
+    cross_encoder_model_name: Annotated[
+        str,
+        typer.Option(help=HELP_TEXT["cross_encoder_model_name"]),
+    ] = DEFAULTS["cross_encoder_model_name"],
+    rerank_skip_gap: Annotated[
+        float | None,
+        typer.Option(help=HELP_TEXT["rerank_skip_gap"]),
+    ] = None,
+    rerank_skip_ratio: Annotated[
+        float | None,
+        typer.Option(help=HELP_TEXT["rerank_skip_ratio"]),
+    ] = None,
+    context_max_tokens: Annotated[
+        int | None,
+        typer.Option(help=HELP_TEXT["context_max_tokens"]),
+    ] = None,
+    context_neighbour_lines: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["context_neighbour_lines"]),
+    ] = 1,
+    max_context_tokens: Annotated[
+        int,
+        typer.Option(help=HELP_TEXT["max_context_tokens"]),
+    ] = DEFAULTS["max_context_tokens"],
+    conversational_agent_max_context_tokens: Annotated[
+        int | None,
+        typer.Option(help=HELP_TEXT["conversational_agent_max_context_tokens"]),
+    ] = None,
+    http_pool_kwargs: Annotated[
+        str | None,
+        typer.Option(help=HELP_TEXT["http_pool_kwargs"]),
+    ] = None,
     logging_level: Annotated[
         int,
         typer.Option(help=HELP_TEXT["logging_level"]),
@@ -928,6 +1731,12 @@ def rag_chat(
             conditions_file=conditions_file,
             config=RetrieverConfig(
                 embedding_model_name=embedding_model_name,
+                embedding_backend=embedding_backend,
+                split_cache_dir=split_cache_dir,
+                embedding_cache_dir=embedding_cache_dir,
+                bm25=bm25,
+                rrf_k=rrf_k,
+                hybrid_fetch_k=hybrid_fetch_k,
                 chunk_overlap=chunk_overlap,
                 db_choice=db_choice,
                 persist_directory=persist_directory,
@@ -941,6 +1750,7 @@ def rag_chat(
             llm_provider=llm_provider,
             llm_model_name=llm_model_name,
             extra_body=extra_body,
+            llm_base_urls=llm_base_urls,
             conversational=conversational,
             conversational_agent_llm_provider=conversational_agent_llm_provider,
             conversational_agent_llm_model_name=conversational_agent_llm_model_name,
@@ -956,6 +1766,15 @@ def rag_chat(
             rerank_llm_model_name=rerank_llm_model_name,
             rerank_extra_body=rerank_extra_body,
             rerank_k=rerank_k,
+            rerank_method=rerank_method,
+            cross_encoder_model_name=cross_encoder_model_name,
+            rerank_skip_gap=rerank_skip_gap,
+            rerank_skip_ratio=rerank_skip_ratio,
+            context_max_tokens=context_max_tokens,
+            context_neighbour_lines=context_neighbour_lines,
+            max_context_tokens=max_context_tokens,
+            conversational_agent_max_context_tokens=conversational_agent_max_context_tokens,
+            http_pool_kwargs=http_pool_kwargs,
             seed=seed,
         )
     )
@@ -7,6 +7,12 @@ class DBChoice(str, Enum):
     faiss = "faiss"
 
 
+class EmbeddingBackend(str, Enum):
+    torch = "torch"
+    onnx = "onnx"
+    onnx_int8 = "onnx-int8"
+
+
 class LLMProvider(str, Enum):
     huggingface = "huggingface"
     azure_openai = "azure_openai"
@@ -15,16 +21,25 @@ class LLMProvider(str, Enum):
     openai_completion = "openai_completion"
 
 
+class RerankMethod(str, Enum):
+    llm = "llm"
+    cross_encoder = "cross_encoder"
+
+
 CONDITIONS_FILE: Final[str] = "./data/nhs-conditions/v4/conditions.jsonl"
 
 DEFAULTS = {
     "embedding_model_name": "sentence-transformers/all-mpnet-base-v2",
+    "embedding_backend": EmbeddingBackend.torch,
     "chunk_overlap": 50,
     "db_choice": DBChoice.chroma,
     "persist_directory": None,
     "local_file_store": None,
     "search_type": "similarity",
     "k": 4,
+    "bm25": False,
+    "hybrid_fetch_k": 20,
+    "rrf_k": 60,
     "with_score": False,
     "llm_provider": LLMProvider.huggingface,
     "llm_model_name": "Qwen/Qwen2.5-1.5B-Instruct",
@@ -44,6 +59,12 @@ DEFAULTS = {
     "rerank_prompt_template_path": None,
     "rerank_llm_provider": LLMProvider.huggingface,
     "rerank_llm_model_name": "Qwen/Qwen2.5-1.5B-Instruct",
+    "rerank_method": RerankMethod.llm,
+    "cross_encoder_model_name": "cross-encoder/ms-marco-MiniLM-L-6-v2",
+    "max_context_tokens": 128000,
+    "max_queued_requests": 100,
+    "queue_timeout": 30.0,
+    "workers": 1,
     "max_queries_per_minute": 60,
     "logging_level": 20,
     "seed": None,
@@ -0,0 +1,285 @@
+import json
+import math
+import re
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+from langchain_core.documents import Document
+
+BM25_DIRECTORY_NAME = "bm25"
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def bm25_directory(persist_directory: str | Path) -> Path:
+    """The directory of the BM25 index of the index at `persist_directory`."""
+    return Path(persist_directory) / BM25_DIRECTORY_NAME
+
+
+class BM25Index:
+    def __init__(
+        self,
+        documents: list[Document],
+        vocab: dict[str, int],
+        indptr: np.ndarray,
+        doc_ids: np.ndarray,
+        term_freqs: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        """
+        In-process BM25 index of document chunks, with the postings of each
+        term stored in compressed sparse row (CSR) arrays: the postings of the
+        term with id `t` are `doc_ids[indptr[t]:indptr[t + 1]]` and
+        `term_freqs[indptr[t]:indptr[t + 1]]`.
+
+        Use `BM25Index.from_documents` to build the index.
+
+        Parameters
+        ----------
+        documents : list[Document]
+            The indexed chunks.
+        vocab : dict[str, int]
+            Map of the terms to their ids.
+        indptr : np.ndarray
+            Offsets of the postings of each term.
+        doc_ids : np.ndarray
+            The chunks of the postings.
+        term_freqs : np.ndarray
+            The frequencies of the terms in the chunks of the postings.
+        doc_lengths : np.ndarray
+            The number of tokens of each chunk.
+        k1 : float, optional
+            BM25 term frequency saturation. By default 1.5.
+        b : float, optional
+            BM25 length normalisation. By default 0.75.
+        """
+        self.documents: list[Document] = documents
+        self.vocab: dict[str, int] = vocab
+        self.indptr: np.ndarray = indptr
+        self.doc_ids: np.ndarray = doc_ids
+        self.term_freqs: np.ndarray = term_freqs
+        self.doc_lengths: np.ndarray = doc_lengths
+        self.k1: float = k1
+        self.b: float = b
+
+        # the length normalisation of each chunk does not depend on the query
+        avg_length = float(doc_lengths.mean()) if len(doc_lengths) else 1.0
+        self._norms: np.ndarray = k1 * (1 - b + b * doc_lengths / max(avg_length, 1e-9))
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @classmethod
+    def from_documents(
+        cls, documents: list[Document], k1: float = 1.5, b: float = 0.75
+    ) -> "BM25Index":
+        """Build a BM25 index of `documents`."""
+        vocab: dict[str, int] = {}
+        term_ids, doc_ids, term_freqs = [], [], []
+        doc_lengths = np.zeros(len(documents), dtype=np.float32)
+        for i, doc in enumerate(documents):
+            counts = Counter(tokenize(doc.page_content))
+            doc_lengths[i] = sum(counts.values())
+            for term, freq in counts.items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(i)
+                term_freqs.append(freq)
+
+        # group the postings by term, keeping the chunks of each term in order
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind="stable")
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=indptr[1:])
+
+        return cls(
+            documents=list(documents),
+            vocab=vocab,
+            indptr=indptr,
+            doc_ids=np.asarray(doc_ids, dtype=np.int32)[order],
+            term_freqs=np.asarray(term_freqs, dtype=np.float32)[order],
+            doc_lengths=doc_lengths,
+            k1=k1,
+            b=b,
+        )
+
+    def scores(self, query: str) -> np.ndarray:
+        """The BM25 score of each chunk for `query`."""
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        n_docs = len(self.documents)
+        for term in set(tokenize(query)):
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            ids = self.doc_ids[start:end]
+            freqs = self.term_freqs[start:end]
+            idf = math.log(1 + (n_docs - (end - start) + 0.5) / (end - start + 0.5))
+            scores[ids] += idf * freqs * (self.k1 + 1) / (freqs + self._norms[ids])
+
+        return scores
+
+    def search(self, query: str, k: int = 4) -> list[tuple[Document, float]]:
+        """
+        Return the `k` chunks with the highest BM25 scores for `query` (higher
+        scores are better). Chunks without any term of the query are not
+        returned.
+        """
+        scores = self.scores(query)
+        candidates = np.flatnonzero(scores > 0)
+        top = candidates[np.argsort(-scores[candidates], kind="stable")[:k]]
+
+        # return copies, as the metadata of retrieved chunks is updated
+        return [
+            (
+                Document(
+                    page_content=self.documents[i].page_content,
+                    metadata=dict(self.documents[i].metadata),
+                ),
+                float(scores[i]),
+            )
+            for i in top
+        ]
+
+    def save(self, directory: str | Path) -> None:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in ("indptr", "doc_ids", "term_freqs", "doc_lengths"):
+            np.save(directory / f"{name}.npy", getattr(self, name))
+        with open(directory / "index.json", "w") as f:
+            json.dump(
+                {
+                    "k1": self.k1,
+                    "b": self.b,
+                    "vocab": sorted(self.vocab, key=self.vocab.get),
+                },
+                f,
+            )
+        with open(directory / "documents.jsonl", "w") as f:
+            for doc in self.documents:
+                json.dump(
+                    {"page_content": doc.page_content, "metadata": doc.metadata}, f
+                )
+                f.write("\n")
+
+    @classmethod
+    def load(cls, directory: str | Path) -> "BM25Index":
+        """Load a BM25 index saved with `save`, memory-mapping its postings."""
+        directory = Path(directory)
+        if not (directory / "index.json").exists():
+            raise FileNotFoundError(
+                f"BM25 index not found at '{directory}'. "
+                "Create the index with the BM25 index enabled first."
+            )
+
+        with open(directory / "index.json") as f:
+            index = json.load(f)
+        with open(directory / "documents.jsonl") as f:
+            documents = [Document(**json.loads(line)) for line in f]
+        arrays = {
+            name: np.load(directory / f"{name}.npy", mmap_mode="r")
+            for name in ("indptr", "doc_ids", "term_freqs", "doc_lengths")
+        }
+
+        return cls(
+            documents=documents,
+            vocab={term: i for i, term in enumerate(index["vocab"])},
+            k1=index["k1"],
+            b=index["b"],
+            **arrays,
+        )
+
+
+def _chunk_key(doc: Document) -> tuple[str | None, str]:
+    return (
+        doc.metadata.get("doc_id", doc.metadata.get("source")),
+        doc.page_content,
+    )
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[tuple[Document, float]]], k: int = 60
+) -> list[tuple[Document, float]]:
+    """
+    Fuse rankings of chunks with reciprocal rank fusion: each chunk scores
+    the sum of 1 / (k + rank) over the rankings it is in. Chunks are matched
+    across rankings by their parent document and content.
+
+    Parameters
+    ----------
+    rankings : list[list[tuple[Document, float]]]
+        The ranked (chunk, score) pairs of each retriever, best first.
+    k : int, optional
+        The rank offset, damping the weight of the top ranks. By default 60.
+
+    Returns
+    -------
+    list[tuple[Document, float]]
+        The chunks (from the first ranking they are in) and their fused
+        scores, best first.
+    """
+    fused: dict[tuple[str | None, str], list] = {}
+    for ranking in rankings:
+        for rank, (doc, _) in enumerate(ranking, start=1):
+            entry = fused.setdefault(_chunk_key(doc), [doc, 0.0])
+            entry[1] += 1 / (k + rank)
+
+    return sorted(
+        ((doc, score) for doc, score in fused.values()),
+        key=lambda x: x[1],
+        reverse=True,
+    )
+
+
+def hybrid_search(
+    dense: list[tuple[Document, float]],
+    bm25_index: BM25Index,
+    query: str,
+    k: int = 4,
+    fetch_k: int = 20,
+    rrf_k: int = 60,
+) -> list[tuple[Document, float]]:
+    """
+    Fuse dense search results with the BM25 results for the same query.
+
+    The returned scores are the reciprocals of the fused scores, so that like
+    the distances of a similarity search lower is better and they follow the
+    order of the results. A chunk ranked r-th by only one of the searches
+    scores `rrf_k + r`. The fused scores are added to the metadata of the
+    chunks as "rrf_score".
+
+    Parameters
+    ----------
+    dense : list[tuple[Document, float]]
+        The (chunk, distance) pairs of the dense search, best first. These
+        should be fetched with a larger `k` (e.g. `fetch_k`).
+    bm25_index : BM25Index
+        The BM25 index of the chunks.
+    query : str
+        The query.
+    k : int, optional
+        The number of chunks to return. By default 4.
+    fetch_k : int, optional
+        The number of BM25 results to fuse. By default 20.
+    rrf_k : int, optional
+        The rank offset of the reciprocal rank fusion. By default 60.
+
+    Returns
+    -------
+    list[tuple[Document, float]]
+        The top `k` fused chunks with the reciprocals of their fused scores.
+    """
+    lexical = bm25_index.search(query, k=max(k, fetch_k))
+
+    results = []
+    for doc, rrf_score in reciprocal_rank_fusion([dense, lexical], k=rrf_k)[:k]:
+        doc.metadata["rrf_score"] = rrf_score
+        results.append((doc, 1 / rrf_score))
+
+    return results
@@ -1,6 +1,8 @@
 import logging
 import os
-from dataclasses import dataclass
+import platform
+import threading
+from dataclasses import dataclass, field
 from pathlib import Path
 
 from langchain_core.documents import Document
@@ -10,11 +12,27 @@ from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_text_splitters import SentenceTransformersTokenTextSplitter
 from langchain_text_splitters.base import TextSplitter
 
+from t0_1.query_vector_store.bm25 import BM25Index, bm25_directory
+from t0_1.query_vector_store.embedding_cache import (
+    CachedEmbeddings,
+    get_cached_embeddings,
+)
+from t0_1.query_vector_store.split_cache import (
+    CachedTextSplitter,
+    get_cached_text_splitter,
+)
 from t0_1.query_vector_store.utils import (
     load_conditions_jsonl,
     remove_saved_directory,
 )
 
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+# where ONNX models quantised locally are saved, for models without
+# quantised ONNX files on the Hugging Face Hub
+ONNX_EXPORT_DIR = Path(
+    os.environ.get("T0_ONNX_EXPORT_DIR", Path.home() / ".cache" / "t0_1" / "onnx")
+)
+
 
 @dataclass
 class VectorStoreConfig:
@@ -22,6 +40,10 @@ class VectorStoreConfig:
     chunk_overlap: int
     db_choice: str
     persist_directory: str | Path | None
+    embedding_backend: str = field(default="torch", kw_only=True)
+    split_cache_dir: str | Path | None = field(default=None, kw_only=True)
+    embedding_cache_dir: str | Path | None = field(default=None, kw_only=True)
+    bm25: bool = field(default=False, kw_only=True)
 
 
 DEFAULT_VECTOR_STORE_CONFIG = VectorStoreConfig(
@@ -32,8 +54,43 @@ DEFAULT_VECTOR_STORE_CONFIG = VectorStoreConfig(
 )
 
 
+def _onnx_quantization_config() -> str:
+    """The ONNX Runtime dynamic quantisation configuration for this CPU."""
+    return (
+        "arm64" if platform.machine().lower() in ("arm64", "aarch64") else "avx512_vnni"
+    )
+
+
+def _setup_onnx_int8_embedding_model(model_name: str) -> HuggingFaceEmbeddings:
+    quantization_config = _onnx_quantization_config()
+    file_name = f"onnx/model_qint8_{quantization_config}.onnx"
+    model_kwargs = {"backend": "onnx", "model_kwargs": {"file_name": file_name}}
+    try:
+        return HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs)
+    except Exception as e:
+        logging.info(f"No quantised ONNX model {file_name} for {model_name} ({e})")
+
+    # export and quantise the model locally, once
+    export_dir = ONNX_EXPORT_DIR / model_name.replace("/", "--")
+    if not (export_dir / file_name).exists():
+        from sentence_transformers import (
+            SentenceTransformer,
+            export_dynamic_quantized_onnx_model,
+        )
+
+        logging.info(f"Exporting {model_name} to a quantised ONNX model...")
+        model = SentenceTransformer(model_name, backend="onnx")
+        model.save(str(export_dir))
+        export_dynamic_quantized_onnx_model(
+            model, quantization_config, str(export_dir), push_to_hub=False
+        )
+
+    return HuggingFaceEmbeddings(model_name=str(export_dir), model_kwargs=model_kwargs)
+
+
 def setup_embedding_model(
     model_name: str = "sentence-transformers/all-mpnet-base-v2",
+    backend: str = "torch",
 ) -> HuggingFaceEmbeddings:
     """
     Set up the embedding model using HuggingFaceEmbeddings.
@@ -42,14 +99,32 @@ def setup_embedding_model(
     ----------
     model_name : str
         The name of the model to use. Default is "sentence-transformers/all-mpnet-base-v2".
+    backend : str
+        The backend running the model: "torch", "onnx" (ONNX Runtime) or
+        "onnx-int8" (ONNX Runtime with the weights dynamically quantised to
+        int8). The ONNX backends need `sentence-transformers[onnx]`.
+        Default is "torch".
 
     Returns
     -------
     Embeddings
         An instance of HuggingFaceEmbeddings.
     """
-    logging.info(f"Setting up embedding model: {model_name}")
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(
+            f"Unknown embedding backend '{backend}'. "
+            f"Use one of {', '.join(EMBEDDING_BACKENDS)}."
+        )
+
+    logging.info(f"Setting up embedding model: {model_name} ({backend} backend)")
     logging.info("Loading embedding model...")
+    if backend == "onnx":
+        return HuggingFaceEmbeddings(
+            model_name=model_name, model_kwargs={"backend": "onnx"}
+        )
+    if backend == "onnx-int8":
+        return _setup_onnx_int8_embedding_model(model_name)
+
     return HuggingFaceEmbeddings(model_name=model_name)
 
 
@@ -78,6 +153,46 @@ def setup_text_splitter(
     )
 
 
+class LazyTextSplitter(TextSplitter):
+    def __init__(
+        self,
+        model_name: str = "sentence-transformers/all-mpnet-base-v2",
+        chunk_overlap: int = 50,
+    ):
+        """
+        Text splitter that only sets up the splitter of `setup_text_splitter`,
+        loading its SentenceTransformer model, the first time a text is split.
+
+        A loaded retriever only splits documents when new ones are added to it,
+        so serving a retriever does not load the model.
+
+        Parameters
+        ----------
+        model_name : str
+            The name of the model to use. Default is "sentence-transformers/all-mpnet-base-v2".
+        chunk_overlap : int
+            The chunk overlap of the text splitter. Default is 50.
+        """
+        super().__init__(chunk_overlap=chunk_overlap)
+        self.model_name: str = model_name
+        self.chunk_overlap: int = chunk_overlap
+        self._text_splitter: TextSplitter | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def text_splitter(self) -> TextSplitter:
+        with self._lock:
+            if self._text_splitter is None:
+                self._text_splitter = setup_text_splitter(
+                    self.model_name, self.chunk_overlap
+                )
+
+            return self._text_splitter
+
+    def split_text(self, text: str) -> list[str]:
+        return self.text_splitter.split_text(text)
+
+
 def create_vector_store(
     conditions_file: str,
     config: VectorStoreConfig = DEFAULT_VECTOR_STORE_CONFIG,
@@ -103,7 +218,9 @@ def create_vector_store(
     """
     logging.info(f"Creating vector store with {config.db_choice} database...")
     conditions = load_conditions_jsonl(conditions_file)
-    embedding_model = setup_embedding_model(config.embedding_model_name)
+    embedding_model = setup_embedding_model(
+        config.embedding_model_name, config.embedding_backend
+    )
     text_splitter = setup_text_splitter(
         config.embedding_model_name, config.chunk_overlap
     )
@@ -145,7 +262,9 @@ def load_vector_store(
     logging.info(
         f"Loading vector store with {config.db_choice} database at '{config.persist_directory}'..."
     )
-    embedding_model = setup_embedding_model(config.embedding_model_name)
+    embedding_model = setup_embedding_model(
+        config.embedding_model_name, config.embedding_backend
+    )
     index_creator = VectorStoreCreator(embedding_model, text_splitter=None)
     index_creator.load_index(config=config, trust_source=trust_source)
 
@@ -231,6 +350,7 @@ class VectorStoreCreator:
         self.documents: list[Document] = []
         self.db_choice: str | None = None
         self.db: VectorStore | None = None
+        self.bm25_index: BM25Index | None = None
 
     def create_index(
         self,
@@ -282,13 +402,29 @@ class VectorStoreCreator:
             )
         logging.info(f"Number of documents: {len(documents)}")
         logging.info("Creating documents...")
-        self.documents: list[Document] = self.text_splitter.create_documents(
+        # reuse the chunks of pages split before with the same configuration
+        text_splitter = get_cached_text_splitter(
+            self.text_splitter,
+            config.split_cache_dir,
+            model_name=config.embedding_model_name,
+            chunk_overlap=config.chunk_overlap,
+        )
+        self.documents: list[Document] = text_splitter.create_documents(
             texts=documents, metadatas=metadatas
         )
         logging.info(
             f"Number of documents created after splitting: {len(self.documents)}"
         )
-
+        if isinstance(text_splitter, CachedTextSplitter):
+            logging.info(f"Split cache: {text_splitter.cache.stats()}")
+
+        # reuse the embeddings of chunks embedded before by the same model
+        embedding_model = get_cached_embeddings(
+            self.embedding_model,
+            config.embedding_cache_dir,
+            model_name=config.embedding_model_name,
+            backend=config.embedding_backend,
+        )
         logging.info("Creating vector store...")
         self.db_choice: str = config.db_choice
         if self.db_choice == "chroma":
@@ -302,7 +438,7 @@ class VectorStoreCreator:
 
             self.db: VectorStore = Chroma.from_documents(
                 self.documents,
-                self.embedding_model,
+                embedding_model,
                 persist_directory=config.persist_directory,
             )
         elif self.db_choice == "faiss":
@@ -311,7 +447,7 @@ class VectorStoreCreator:
             logging.info("Creating FAISS database...")
             self.db: VectorStore = FAISS.from_documents(
                 self.documents,
-                self.embedding_model,
+                embedding_model,
             )
 
             if config.persist_directory is not None:
@@ -322,6 +458,18 @@ class VectorStoreCreator:
         else:
             raise ValueError(f"Unsupported database type: {self.db_choice}")
 
+        if isinstance(embedding_model, CachedEmbeddings):
+            logging.info(f"Embedding cache: {embedding_model.cache.stats()}")
+
+        if config.bm25:
+            logging.info("Creating BM25 index...")
+            self.bm25_index = BM25Index.from_documents(self.documents)
+            if config.persist_directory is not None:
+                logging.info(
+                    f"Persisting BM25 index to '{bm25_directory(config.persist_directory)}'"
+                )
+                self.bm25_index.save(bm25_directory(config.persist_directory))
+
         logging.info("Index created successfully!")
         return self.db
 
@@ -374,5 +522,11 @@ class VectorStoreCreator:
         else:
             raise ValueError(f"Unsupported database type: {self.db_choice}")
 
+        if config.bm25:
+            logging.info(
+                f"Loading BM25 index from '{bm25_directory(config.persist_directory)}'"
+            )
+            self.bm25_index = BM25Index.load(bm25_directory(config.persist_directory))
+
         logging.info("Index loaded successfully!")
         return self.db
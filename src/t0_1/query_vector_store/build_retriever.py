@@ -1,6 +1,6 @@
 import logging
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 
 from langchain.storage import InMemoryStore, LocalFileStore, create_kv_docstore
@@ -8,7 +8,9 @@ from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 from langchain_text_splitters.base import TextSplitter
 
+from t0_1.query_vector_store.bm25 import BM25Index, bm25_directory
 from t0_1.query_vector_store.build_index import (
+    LazyTextSplitter,
     VectorStoreConfig,
     load_conditions_jsonl,
     setup_embedding_model,
@@ -17,7 +19,15 @@ from t0_1.query_vector_store.build_index import (
 from t0_1.query_vector_store.custom_parent_document_retriever import (
     CustomParentDocumentRetriever,
 )
-from t0_1.query_vector_store.utils import remove_saved_directory
+from t0_1.query_vector_store.embedding_cache import (
+    CachedEmbeddings,
+    get_cached_embeddings,
+)
+from t0_1.query_vector_store.split_cache import (
+    CachedTextSplitter,
+    get_cached_text_splitter,
+)
+from t0_1.query_vector_store.utils import load_faiss_mmap, remove_saved_directory
 
 
 @dataclass
@@ -26,6 +36,9 @@ class RetrieverConfig(VectorStoreConfig):
     search_type: str
     k: int
     search_kwargs: dict
+    # reciprocal rank fusion of the dense and BM25 results (with `bm25`)
+    rrf_k: int = field(default=60, kw_only=True)
+    hybrid_fetch_k: int = field(default=20, kw_only=True)
 
 
 DEFAULT_RETRIEVER_CONFIG = RetrieverConfig(
@@ -69,7 +82,9 @@ def create_parent_doc_retriever(
     """
     logging.info(f"Creating retriever with {config.db_choice} database...")
     conditions = load_conditions_jsonl(conditions_file)
-    embedding_model = setup_embedding_model(config.embedding_model_name)
+    embedding_model = setup_embedding_model(
+        config.embedding_model_name, config.embedding_backend
+    )
     text_splitter = setup_text_splitter(
         config.embedding_model_name, config.chunk_overlap
     )
@@ -89,6 +104,9 @@ def create_parent_doc_retriever(
 def load_parent_doc_retriever(
     config: RetrieverConfig = DEFAULT_RETRIEVER_CONFIG,
     trust_source: bool = False,
+    embedding_model: Embeddings | None = None,
+    text_splitter: TextSplitter | None = None,
+    mmap_index: bool = False,
 ) -> CustomParentDocumentRetriever:
     """
     Load the retriever with the specified configuration.
@@ -104,6 +122,15 @@ def load_parent_doc_retriever(
     trust_source : bool, optional
         If True, trust the source of the data index. This is needed for loading in FAISS databases.
         Default is False.
+    embedding_model : Embeddings | None, optional
+        An already loaded embedding model to reuse. If None, the embedding model
+        in the config is loaded. Default is None.
+    text_splitter : TextSplitter | None, optional
+        An already loaded text splitter to reuse. If None, a text splitter
+        that loads its model the first time it is used is set up from the
+        config. Default is None.
+    mmap_index : bool, optional
+        If True, memory-map a FAISS index read-only. Default is False.
 
     Returns
     -------
@@ -113,10 +140,16 @@ def load_parent_doc_retriever(
     logging.info(
         f"Loading retriever with {config.db_choice} database at {config.persist_directory} and {config.local_file_store}..."
     )
-    embedding_model = setup_embedding_model(config.embedding_model_name)
-    text_splitter = setup_text_splitter(
-        config.embedding_model_name, config.chunk_overlap
-    )
+    if embedding_model is None:
+        embedding_model = setup_embedding_model(
+            config.embedding_model_name, config.embedding_backend
+        )
+    if text_splitter is None:
+        # the child splitter is only used to add documents, so its model is
+        # not loaded unless documents are added to the loaded retriever
+        text_splitter = LazyTextSplitter(
+            config.embedding_model_name, config.chunk_overlap
+        )
     retriever_creator = ParentDocumentRetrieverCreator(
         embedding_model=embedding_model,
         text_splitter=text_splitter,
@@ -124,6 +157,7 @@ def load_parent_doc_retriever(
     retriever = retriever_creator.load_retriever(
         config=config,
         trust_source=trust_source,
+        mmap_index=mmap_index,
     )
 
     return retriever
@@ -134,6 +168,7 @@ def get_parent_doc_retriever(
     config: RetrieverConfig = DEFAULT_RETRIEVER_CONFIG,
     force_create: bool = False,
     trust_source: bool = False,
+    mmap_index: bool = False,
 ) -> CustomParentDocumentRetriever:
     """
     Get the retriever with the specified conditions folder and configuration.
@@ -157,6 +192,9 @@ def get_parent_doc_retriever(
     trust_source : bool, optional
         If True, trust the source of the data index. This is needed for loading in FAISS databases.
         Default is False.
+    mmap_index : bool, optional
+        If True, memory-map a FAISS index read-only when loading it, so the
+        worker processes of a server share its pages. Default is False.
     """
     if (
         not force_create
@@ -170,6 +208,7 @@ def get_parent_doc_retriever(
         retriever = load_parent_doc_retriever(
             config=config,
             trust_source=trust_source,
+            mmap_index=mmap_index,
         )
     else:
         remove_saved_directory(config.persist_directory, "persist_directory")
@@ -267,6 +306,13 @@ class ParentDocumentRetrieverCreator:
             fs = LocalFileStore(config.local_file_store)
             store = create_kv_docstore(fs)
 
+        # reuse the embeddings of chunks embedded before by the same model
+        embedding_model = get_cached_embeddings(
+            self.embedding_model,
+            config.embedding_cache_dir,
+            model_name=config.embedding_model_name,
+            backend=config.embedding_backend,
+        )
         self.db_choice: str = config.db_choice
         if self.db_choice == "chroma":
             from langchain_chroma import Chroma
@@ -278,7 +324,7 @@ class ParentDocumentRetrieverCreator:
 
             vectorstore = Chroma(
                 collection_name="full_documents",
-                embedding_function=self.embedding_model,
+                embedding_function=embedding_model,
                 persist_directory=config.persist_directory,
             )
         elif self.db_choice == "faiss":
@@ -287,7 +333,7 @@ class ParentDocumentRetrieverCreator:
             from langchain_community.vectorstores import FAISS
 
             vectorstore = FAISS(
-                embedding_function=self.embedding_model,
+                embedding_function=embedding_model,
                 index=IndexFlatL2(len(self.embedding_model.embed_query("d"))),
                 docstore=InMemoryDocstore(),
                 index_to_docstore_id={},
@@ -295,19 +341,38 @@ class ParentDocumentRetrieverCreator:
         else:
             raise ValueError(f"Unsupported database type: {self.db_choice}")
 
+        # reuse the chunks of pages split before with the same configuration
+        child_splitter = get_cached_text_splitter(
+            self.text_splitter,
+            config.split_cache_dir,
+            model_name=config.embedding_model_name,
+            chunk_overlap=config.chunk_overlap,
+        )
         retriever = CustomParentDocumentRetriever(
             vectorstore=vectorstore,
             docstore=store,
-            child_splitter=self.text_splitter,
+            child_splitter=child_splitter,
             search_type=config.search_type,
             search_kwargs=config.search_kwargs | {"k": config.k},
+            bm25_index=BM25Index.from_documents([]) if config.bm25 else None,
+            rrf_k=config.rrf_k,
+            hybrid_fetch_k=config.hybrid_fetch_k,
         )
 
         retriever.add_documents(self.documents)
+        if isinstance(child_splitter, CachedTextSplitter):
+            logging.info(f"Split cache: {child_splitter.cache.stats()}")
+        if isinstance(embedding_model, CachedEmbeddings):
+            logging.info(f"Embedding cache: {embedding_model.cache.stats()}")
 
         if self.db_choice == "faiss" and config.persist_directory is not None:
             logging.info(f"Persisting FAISS database to '{config.persist_directory}'")
             retriever.vectorstore.save_local(folder_path=config.persist_directory)
+        if retriever.bm25_index is not None and config.persist_directory is not None:
+            logging.info(
+                f"Persisting BM25 index to '{bm25_directory(config.persist_directory)}'"
+            )
+            retriever.bm25_index.save(bm25_directory(config.persist_directory))
 
         return retriever
 
@@ -315,6 +380,7 @@ class ParentDocumentRetrieverCreator:
         self,
         config: RetrieverConfig = DEFAULT_RETRIEVER_CONFIG,
         trust_source: bool = False,
+        mmap_index: bool = False,
     ) -> CustomParentDocumentRetriever:
         """
         Load a retriever from the specified configuration.
@@ -326,6 +392,10 @@ class ParentDocumentRetrieverCreator:
         trust_source : bool
             If True, trust the source of the data index. This is needed for loading in FAISS databases.
             Default is False.
+        mmap_index : bool, optional
+            If True, memory-map a FAISS index read-only instead of reading it
+            into memory, so processes loading the same index share its pages.
+            Default is False.
 
         Returns
         -------
@@ -363,14 +433,28 @@ class ParentDocumentRetrieverCreator:
             from langchain_community.vectorstores import FAISS
 
             logging.info(f"Loading FAISS database from '{config.persist_directory}'")
-            vectorstore = FAISS.load_local(
-                folder_path=config.persist_directory,
-                embeddings=self.embedding_model,
-                allow_dangerous_deserialization=trust_source,
-            )
+            if mmap_index:
+                vectorstore = load_faiss_mmap(
+                    folder_path=config.persist_directory,
+                    embeddings=self.embedding_model,
+                    allow_dangerous_deserialization=trust_source,
+                )
+            else:
+                vectorstore = FAISS.load_local(
+                    folder_path=config.persist_directory,
+                    embeddings=self.embedding_model,
+                    allow_dangerous_deserialization=trust_source,
+                )
         else:
             raise ValueError(f"Unsupported database type: {self.db_choice}")
 
+        bm25_index = None
+        if config.bm25:
+            logging.info(
+                f"Loading BM25 index from '{bm25_directory(config.persist_directory)}'"
+            )
+            bm25_index = BM25Index.load(bm25_directory(config.persist_directory))
+
         fs = LocalFileStore(config.local_file_store)
         store = create_kv_docstore(fs)
 
@@ -380,6 +464,9 @@ class ParentDocumentRetrieverCreator:
             child_splitter=self.text_splitter,
             search_type=config.search_type,
             search_kwargs=config.search_kwargs | {"k": config.k},
+            bm25_index=bm25_index,
+            rrf_k=config.rrf_k,
+            hybrid_fetch_k=config.hybrid_fetch_k,
         )
 
         return retriever
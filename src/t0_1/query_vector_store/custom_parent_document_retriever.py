@@ -9,16 +9,59 @@ from langchain_core.callbacks import (
     CallbackManagerForRetrieverRun,
 )
 from langchain_core.documents import Document
+from langchain_core.runnables.config import run_in_executor
+from pydantic import model_validator
 from tqdm import tqdm
 
+from t0_1.query_vector_store.bm25 import BM25Index, hybrid_search
+from t0_1.query_vector_store.mmr import mmr_search_with_score
+
 
 class CustomParentDocumentRetriever(ParentDocumentRetriever):
     """
     Custom Retriever class to propagate similarity scores through the
     MultiVectorRetriever (as described in
     https://python.langchain.com/v0.3/docs/how_to/add_scores_retriever/).
+
+    Maximal marginal relevance search also keeps the scores of the chunks
+    (see `mmr_search_with_score`).
+
+    If `bm25_index` is set, similarity search results are fused with the BM25
+    results of the query by reciprocal rank fusion (with rank offset `rrf_k`),
+    fetching `hybrid_fetch_k` chunks from each. Hybrid search is only
+    supported for the similarity search type.
     """
 
+    bm25_index: Optional[BM25Index] = None
+    rrf_k: int = 60
+    hybrid_fetch_k: int = 20
+
+    @model_validator(mode="after")
+    def _check_hybrid_search_type(self) -> "CustomParentDocumentRetriever":
+        if self.bm25_index is not None and self.search_type != SearchType.similarity:
+            raise ValueError(
+                "Hybrid search with BM25 is only supported for the 'similarity' "
+                f"search type, not '{self.search_type.value}'."
+            )
+        return self
+
+    def _hybrid_search_kwargs(self) -> dict:
+        # fetch more dense results to fuse with the BM25 results
+        k = self.search_kwargs.get("k", 4)
+        return self.search_kwargs | {"k": max(k, self.hybrid_fetch_k)}
+
+    def _hybrid_search(
+        self, query: str, dense: list[tuple[Document, float]]
+    ) -> list[tuple[Document, float]]:
+        return hybrid_search(
+            dense,
+            self.bm25_index,
+            query,
+            k=self.search_kwargs.get("k", 4),
+            fetch_k=self.hybrid_fetch_k,
+            rrf_k=self.rrf_k,
+        )
+
     def _get_relevant_documents(
         self, query: str, *, run_manager: CallbackManagerForRetrieverRun
     ) -> list[Document]:
@@ -26,22 +69,20 @@ class CustomParentDocumentRetriever(ParentDocumentRetriever):
         Get documents relevant to a query.
         """
         if self.search_type == SearchType.mmr:
-            sub_docs = self.vectorstore.max_marginal_relevance_search(
-                query, **self.search_kwargs
+            sub_docs = mmr_search_with_score(
+                self.vectorstore, query, **self.search_kwargs
             )
-
-            # We do this to maintain the order of the ids that are returned
-            ids = []
-            for d in sub_docs:
-                if self.id_key in d.metadata and d.metadata[self.id_key] not in ids:
-                    ids.append(d.metadata[self.id_key])
-            docs = self.docstore.mget(ids)
-
-            return [d for d in docs if d is not None]
         elif self.search_type == SearchType.similarity_score_threshold:
             sub_docs = self.vectorstore.similarity_search_with_relevance_scores(
                 query, **self.search_kwargs
             )
+        elif self.bm25_index is not None:
+            sub_docs = self._hybrid_search(
+                query,
+                self.vectorstore.similarity_search_with_score(
+                    query, **self._hybrid_search_kwargs()
+                ),
+            )
         else:
             sub_docs = self.vectorstore.similarity_search_with_score(
                 query, **self.search_kwargs
@@ -73,22 +114,24 @@ class CustomParentDocumentRetriever(ParentDocumentRetriever):
         Asynchronously get documents relevant to a query.
         """
         if self.search_type == SearchType.mmr:
-            sub_docs = await self.vectorstore.amax_marginal_relevance_search(
-                query, **self.search_kwargs
+            sub_docs = await run_in_executor(
+                None,
+                mmr_search_with_score,
+                self.vectorstore,
+                query,
+                **self.search_kwargs,
             )
-
-            # We do this to maintain the order of the ids that are returned
-            ids = []
-            for d in sub_docs:
-                if self.id_key in d.metadata and d.metadata[self.id_key] not in ids:
-                    ids.append(d.metadata[self.id_key])
-            docs = await self.docstore.amget(ids)
-
-            return [d for d in docs if d is not None]
         elif self.search_type == SearchType.similarity_score_threshold:
             sub_docs = await self.vectorstore.asimilarity_search_with_relevance_scores(
                 query, **self.search_kwargs
             )
+        elif self.bm25_index is not None:
+            sub_docs = self._hybrid_search(
+                query,
+                await self.vectorstore.asimilarity_search_with_score(
+                    query, **self._hybrid_search_kwargs()
+                ),
+            )
         else:
             sub_docs = await self.vectorstore.asimilarity_search_with_score(
                 query, **self.search_kwargs
@@ -143,6 +186,14 @@ class CustomParentDocumentRetriever(ParentDocumentRetriever):
         ):
             self.vectorstore.add_documents(docs_chunk, **kwargs)
 
+        if self.bm25_index is not None:
+            logging.info("Adding documents to BM25 index...")
+            self.bm25_index = BM25Index.from_documents(
+                self.bm25_index.documents + docs,
+                k1=self.bm25_index.k1,
+                b=self.bm25_index.b,
+            )
+
         logging.info("Adding full documents to docstore...")
 
         if add_to_docstore:
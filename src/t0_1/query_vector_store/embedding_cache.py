@@ -0,0 +1,204 @@
+import fcntl
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from t0_1.query_vector_store.split_cache import content_hash
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: str | Path, model_key: str):
+        """
+        On-disk cache of the embeddings of document chunks computed by one
+        model, keyed by the hash of the chunk. Embeddings are stored as rows
+        of a float32 memmap, with a JSON index of the chunk hashes of the rows.
+
+        Updates hold an exclusive lock on a file in the directory of the cache
+        and first read the rows added by other processes, so concurrent builds
+        can share a cache directory.
+
+        Parameters
+        ----------
+        cache_dir : str | Path
+            Directory of the cache. Each model has its own subdirectory,
+            which is created if it does not exist.
+        model_key : str
+            The key of the model computing the embeddings, e.g. its name and
+            backend.
+        """
+        self.model_key: str = model_key
+        self.directory: Path = Path(cache_dir) / content_hash(model_key)[:16]
+        self.embeddings_path: Path = self.directory / "embeddings.f32"
+        self.index_path: Path = self.directory / "index.json"
+        self.lock_path: Path = self.directory / "update.lock"
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = threading.Lock()
+        self._matrix: np.memmap | None = None
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.dim: int | None = None
+        self._hashes: list[str] = []
+        self._rows: dict[str, int] = {}
+        self._read_index()
+
+    def _read_index(self) -> None:
+        if not self.index_path.exists():
+            return
+
+        with open(self.index_path) as f:
+            index = json.load(f)
+        if index["model_key"] != self.model_key:
+            raise ValueError(
+                f"Embedding cache at {self.directory} is for model "
+                f"'{index['model_key']}', not '{self.model_key}'."
+            )
+        if len(index["hashes"]) != len(self._hashes):
+            self.dim = index["dim"]
+            self._hashes = index["hashes"]
+            self._rows = {h: i for i, h in enumerate(self._hashes)}
+            self._matrix = None
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def _read_matrix(self) -> np.memmap:
+        if self._matrix is None:
+            self._matrix = np.memmap(
+                self.embeddings_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(len(self._hashes), self.dim),
+            )
+        return self._matrix
+
+    def lookup(self, chunk_hashes: list[str]) -> list[np.ndarray | None]:
+        """Return the cached embedding of each chunk, or None if not cached."""
+        with self._lock:
+            rows = [self._rows.get(h) for h in chunk_hashes]
+            matrix = self._read_matrix() if self._hashes else None
+            found = sum(row is not None for row in rows)
+            self.hits += found
+            self.misses += len(rows) - found
+
+            return [None if row is None else np.array(matrix[row]) for row in rows]
+
+    def update(self, chunk_hashes: list[str], embeddings: np.ndarray) -> None:
+        """Append the embeddings of chunks not yet in the cache."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or len(embeddings) != len(chunk_hashes):
+            raise ValueError(
+                "Expected one embedding per chunk hash, got "
+                f"{embeddings.shape} for {len(chunk_hashes)} hashes."
+            )
+
+        with self._lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # other processes may have added rows since the index was read
+            self._read_index()
+
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(
+                    f"Embedding dimension {embeddings.shape[1]} does not match "
+                    f"the dimension {self.dim} of the cache."
+                )
+
+            new = {}
+            for chunk_hash, embedding in zip(chunk_hashes, embeddings):
+                if chunk_hash not in self._rows and chunk_hash not in new:
+                    new[chunk_hash] = embedding
+            if not new:
+                return
+
+            # drop rows of an interrupted update that were never indexed
+            size = len(self._hashes) * self.dim * 4
+            if self.embeddings_path.exists():
+                os.truncate(self.embeddings_path, size)
+            with open(self.embeddings_path, "ab") as f:
+                f.write(np.stack(list(new.values())).tobytes())
+
+            hashes = self._hashes + list(new)
+            tmp_path = self.index_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {"model_key": self.model_key, "dim": self.dim, "hashes": hashes},
+                    f,
+                )
+            os.replace(tmp_path, self.index_path)
+
+            self._rows.update({h: len(self._hashes) + i for i, h in enumerate(new)})
+            self._hashes = hashes
+            self._matrix = None
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        """
+        Embeddings that reuse the cached embeddings of document chunks and
+        only embed the chunks not in the cache. Queries are not cached.
+
+        Parameters
+        ----------
+        embeddings : Embeddings
+            The embedding model to use on a cache miss.
+        cache : EmbeddingCache
+            The cache of the embeddings of the model.
+        """
+        self.embeddings: Embeddings = embeddings
+        self.cache: EmbeddingCache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        chunk_hashes = [content_hash(text) for text in texts]
+        cached = self.cache.lookup(chunk_hashes)
+
+        missing = {}
+        for text, chunk_hash, embedding in zip(texts, chunk_hashes, cached):
+            if embedding is None:
+                missing.setdefault(chunk_hash, text)
+        if missing:
+            embeddings = np.asarray(
+                self.embeddings.embed_documents(list(missing.values())),
+                dtype=np.float32,
+            )
+            self.cache.update(list(missing), embeddings)
+            computed = dict(zip(missing, embeddings))
+            cached = [
+                computed[chunk_hash] if embedding is None else embedding
+                for chunk_hash, embedding in zip(chunk_hashes, cached)
+            ]
+
+        # new embeddings are returned as stored, so rebuilds give the same index
+        return [embedding.tolist() for embedding in cached]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
+
+
+def get_cached_embeddings(
+    embeddings: Embeddings,
+    embedding_cache_dir: str | Path | None,
+    model_name: str,
+    backend: str,
+) -> Embeddings:
+    """
+    Wrap an embedding model with an embedding cache in `embedding_cache_dir`,
+    or return it unchanged if `embedding_cache_dir` is None. The embeddings
+    are keyed by the model and the backend running it.
+    """
+    if embedding_cache_dir is None:
+        return embeddings
+
+    # the CLI passes the backend as an `EmbeddingBackend`
+    backend = getattr(backend, "value", backend)
+    return CachedEmbeddings(
+        embeddings, EmbeddingCache(embedding_cache_dir, f"{model_name}|{backend}")
+    )
@@ -0,0 +1,121 @@
+import json
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+
+from t0_1.query_vector_store.build_index import setup_embedding_model
+from t0_1.utils import read_jsonl
+
+
+def cosine_similarities(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Cosine similarity between the corresponding rows of `a` and `b`."""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+
+    return np.einsum("ij,ij->i", a, b) / np.maximum(norms, 1e-12)
+
+
+def _embed(embedding_model, texts: list[str]) -> tuple[np.ndarray, float]:
+    # embed the queries one at a time, as when serving
+    start = time.perf_counter()
+    embeddings = np.array([embedding_model.embed_query(text) for text in texts])
+
+    return embeddings, (time.perf_counter() - start) / len(texts)
+
+
+def check_embedding_parity(
+    texts: list[str],
+    model_name: str,
+    backend: str,
+    reference_backend: str = "torch",
+    min_similarity: float = 0.99,
+) -> dict:
+    """
+    Compare the embeddings of a model run with `backend` to those of the
+    model run with `reference_backend`.
+
+    Parameters
+    ----------
+    texts : list[str]
+        The texts to embed.
+    model_name : str
+        The name of the embedding model.
+    backend : str
+        The backend to check, e.g. "onnx-int8".
+    reference_backend : str, optional
+        The backend to compare against. Default is "torch".
+    min_similarity : float, optional
+        The minimum cosine similarity of every text for the check to pass.
+        Default is 0.99.
+
+    Returns
+    -------
+    dict
+        The summary of the cosine similarities and the mean latency of
+        embedding a query with each backend.
+    """
+    if not texts:
+        raise ValueError("At least one text is needed to check the embeddings.")
+
+    reference, reference_latency = _embed(
+        setup_embedding_model(model_name, reference_backend), texts
+    )
+    candidate, latency = _embed(setup_embedding_model(model_name, backend), texts)
+    similarities = cosine_similarities(reference, candidate)
+
+    return {
+        "model_name": model_name,
+        "backend": backend,
+        "reference_backend": reference_backend,
+        "n_texts": len(texts),
+        "mean_similarity": float(similarities.mean()),
+        "min_similarity": float(similarities.min()),
+        "p01_similarity": float(np.quantile(similarities, 0.01)),
+        "latency": latency,
+        "reference_latency": reference_latency,
+        "passed": bool(similarities.min() >= min_similarity),
+    }
+
+
+def main(
+    input_file: str | Path,
+    query_field: str = "symptoms_description",
+    model_name: str = "sentence-transformers/all-mpnet-base-v2",
+    backend: str = "onnx-int8",
+    reference_backend: str = "torch",
+    max_texts: int | None = 500,
+    min_similarity: float = 0.99,
+    output_file: str | Path | None = None,
+) -> dict:
+    """
+    Check the parity of the embeddings of the queries in a JSONL file (e.g.
+    the input of `evaluate-vector-store`) between two backends.
+    """
+    texts = [item[query_field] for item in read_jsonl(input_file)][:max_texts]
+    logging.info(
+        f"Comparing the {backend} and {reference_backend} embeddings of "
+        f"{len(texts)} queries..."
+    )
+    result = check_embedding_parity(
+        texts,
+        model_name=model_name,
+        backend=backend,
+        reference_backend=reference_backend,
+        min_similarity=min_similarity,
+    )
+
+    logging.info(f"Embedding parity: {result}")
+    if not result["passed"]:
+        logging.warning(
+            f"The minimum cosine similarity {result['min_similarity']:.4f} "
+            f"is below {min_similarity}"
+        )
+    if output_file is not None:
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(output_file, "w") as f:
+            json.dump(result, f, indent=2)
+
+    return result
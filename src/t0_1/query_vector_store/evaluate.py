@@ -1,15 +1,20 @@
 import json
 import logging
+import time
 from pathlib import Path
 
+import numpy as np
 from langchain_core.vectorstores import VectorStore
 from tqdm import tqdm
 
+from t0_1.query_vector_store.bm25 import BM25Index, bm25_directory, hybrid_search
 from t0_1.query_vector_store.build_index import (
     DEFAULT_VECTOR_STORE_CONFIG,
     VectorStoreConfig,
     get_vector_store,
 )
+from t0_1.query_vector_store.embedding_cache import CachedEmbeddings
+from t0_1.query_vector_store.mmr import mmr_search_with_score
 from t0_1.utils import read_jsonl, timestamp_file_name
 
 
@@ -20,6 +25,9 @@ def evaluate_query_store(
     target_document_field: str,
     vector_store: VectorStore,
     k: int = 4,
+    bm25_index: BM25Index | None = None,
+    fetch_k: int = 20,
+    rrf_k: int = 60,
 ) -> list[dict]:
     """
     Evaluate the query store by comparing the query results with the target documents.
@@ -36,6 +44,15 @@ def evaluate_query_store(
         The field name in the JSONL file that contains the target document.
     vector_store : VectorStore
         The vector store to use for querying.
+    k : int, optional
+        The number of documents to retrieve. Default is 4.
+    bm25_index : BM25Index | None, optional
+        If passed, the dense results are fused with the BM25 results by
+        reciprocal rank fusion. Default is None.
+    fetch_k : int, optional
+        The number of dense and BM25 results to fuse. Default is 20.
+    rrf_k : int, optional
+        The rank offset of the reciprocal rank fusion. Default is 60.
 
     Returns
     -------
@@ -48,48 +65,299 @@ def evaluate_query_store(
     data = read_jsonl(input_file)
     results = []
     sum = 0
+    latencies = []
     output_file = timestamp_file_name(output_file)
 
     logging.info(f"Writing results to {output_file}...")
     logging.info(f"Query field: {query_field}")
     logging.info(f"Target document field: {target_document_field}")
 
-    for item in tqdm(data, desc="Evaluating Queries"):
-        query = item[query_field]
-        target_document = item[target_document_field]
-
-        # obtain the top k documents from the vector store
-        retrieved_docs = vector_store.similarity_search_with_score(query=query, k=k)
-
-        # create dictionary to store the results
-        res = item | {
-            "query_field": query_field,
-            "target_document_field": target_document_field,
-            "k": k,
-            "retrieved_documents": [doc.page_content for doc, _ in retrieved_docs],
-            "retrieved_documents_scores": [float(score) for _, score in retrieved_docs],
-            "retrieved_documents_sources": [
-                doc.metadata["source"] for doc, _ in retrieved_docs
-            ],
-        }
-
-        # check for match between the source of the retrieved documents and the target document source
-        res["match"] = target_document in res["retrieved_documents_sources"]
-        sum += res["match"]
-
-        # write the results to the output file
-        with open(output_file, "a") as f:
+    with open(output_file, "a") as f:
+        for item in tqdm(data, desc="Evaluating Queries"):
+            query = item[query_field]
+            target_document = item[target_document_field]
+
+            # obtain the top k documents from the vector store
+            start = time.perf_counter()
+            if bm25_index is None:
+                retrieved_docs = vector_store.similarity_search_with_score(
+                    query=query, k=k
+                )
+            else:
+                retrieved_docs = hybrid_search(
+                    vector_store.similarity_search_with_score(
+                        query=query, k=max(k, fetch_k)
+                    ),
+                    bm25_index,
+                    query,
+                    k=k,
+                    fetch_k=fetch_k,
+                    rrf_k=rrf_k,
+                )
+            latencies.append(time.perf_counter() - start)
+
+            # create dictionary to store the results
+            res = item | {
+                "query_field": query_field,
+                "target_document_field": target_document_field,
+                "k": k,
+                "search": "dense" if bm25_index is None else "hybrid",
+                "retrieval_latency": latencies[-1],
+                "retrieved_documents": [doc.page_content for doc, _ in retrieved_docs],
+                "retrieved_documents_scores": [
+                    float(score) for _, score in retrieved_docs
+                ],
+                "retrieved_documents_sources": [
+                    doc.metadata["source"] for doc, _ in retrieved_docs
+                ],
+            }
+
+            # check for match between the source of the retrieved documents and the target document source
+            res["match"] = target_document in res["retrieved_documents_sources"]
+            sum += res["match"]
+
+            # write the results to the output file
             json.dump(res, f)
             f.write("\n")
 
-        # append the result to the results list
-        results.append(res)
+            # append the result to the results list
+            results.append(res)
 
     logging.info(f"Proportion of matches: {sum}/{len(data)} = {sum / len(data):.2%}")
+    logging.info(
+        f"Retrieval latency: mean {np.mean(latencies) * 1000:.1f}ms, "
+        f"p95 {np.percentile(latencies, 95) * 1000:.1f}ms"
+    )
 
     return results
 
 
+def parse_ks(ks: str | list[int]) -> list[int]:
+    """Parse comma separated values of k (e.g. "1,3,5,10") into sorted ints."""
+    if isinstance(ks, str):
+        ks = [int(k) for k in ks.split(",") if k.strip()]
+    if not ks or min(ks) < 1:
+        raise ValueError(f"Values of k must be positive integers, got {ks}.")
+
+    return sorted(set(ks))
+
+
+def ranking_metrics(first_hit_ranks: np.ndarray, ks: list[int]) -> dict[str, float]:
+    """
+    Compute recall@k, MRR and nDCG@k from the rank of the first chunk of the
+    target document of each query. As each query has one target document,
+    recall@k is the proportion of queries with a hit in the top k and nDCG@k
+    is the mean of 1 / log2(rank + 1) over queries with a hit in the top k.
+
+    Parameters
+    ----------
+    first_hit_ranks : np.ndarray
+        The (1-based) rank of the first hit of each query, or 0 if there is
+        no hit in the retrieved chunks.
+    ks : list[int]
+        The values of k.
+
+    Returns
+    -------
+    dict[str, float]
+        The metrics, e.g. "recall@1", "ndcg@1" and "mrr".
+    """
+    ranks = np.asarray(first_hit_ranks, dtype=np.float64)
+    hit = ranks > 0
+    reciprocal_ranks = np.divide(1.0, ranks, out=np.zeros_like(ranks), where=hit)
+    gains = np.divide(1.0, np.log2(ranks + 1), out=np.zeros_like(ranks), where=hit)
+
+    metrics = {}
+    for k in ks:
+        in_top_k = hit & (ranks <= k)
+        metrics[f"recall@{k}"] = float(in_top_k.mean())
+        metrics[f"ndcg@{k}"] = float(np.where(in_top_k, gains, 0.0).mean())
+    metrics["mrr"] = float(reciprocal_ranks.mean())
+
+    return metrics
+
+
+def _search_by_vector(
+    vector_store: VectorStore, embedding: list[float], k: int
+) -> list[tuple]:
+    if hasattr(vector_store, "similarity_search_with_score_by_vector"):
+        # FAISS
+        return vector_store.similarity_search_with_score_by_vector(embedding, k=k)
+
+    # Chroma returns the distances as for `similarity_search_with_score`
+    return vector_store.similarity_search_by_vector_with_relevance_scores(
+        embedding, k=k
+    )
+
+
+def evaluate_query_store_multi_k(
+    input_file: str | Path,
+    output_file: str | Path,
+    query_field: str,
+    target_document_field: str,
+    vector_store: VectorStore,
+    ks: list[int],
+    batch_size: int = 64,
+    bm25_index: BM25Index | None = None,
+    fetch_k: int = 20,
+    rrf_k: int = 60,
+    search_type: str = "similarity",
+) -> dict:
+    """
+    Evaluate the query store for several values of k in one pass.
+
+    The queries are embedded in batches and a single top `max(ks)` search is
+    done per query. Recall@k and nDCG@k for every k, and MRR, are computed
+    from the rank of the first chunk of the target document. The per-query
+    results are written to `output_file` (JSONL or Parquet) and the summary
+    to a JSON file next to it.
+
+    Parameters
+    ----------
+    input_file : str | Path
+        The path to the JSONL file containing the queries and target documents.
+    output_file : str | Path
+        The path to the JSONL or Parquet file where the results will be saved.
+    query_field : str
+        The field name in the JSONL file that contains the query.
+    target_document_field : str
+        The field name in the JSONL file that contains the target document.
+    vector_store : VectorStore
+        The vector store to use for querying.
+    ks : list[int]
+        The values of k to compute the metrics for.
+    batch_size : int, optional
+        The number of queries to embed at once. Default is 64.
+    bm25_index : BM25Index | None, optional
+        If passed, the dense results are fused with the BM25 results by
+        reciprocal rank fusion. Only supported for the "similarity" search
+        type. Default is None.
+    fetch_k : int, optional
+        The number of dense and BM25 results to fuse. Default is 20.
+    rrf_k : int, optional
+        The rank offset of the reciprocal rank fusion. Default is 60.
+    search_type : str, optional
+        "similarity" or "mmr". As MMR selects chunks greedily, its top k
+        chunks are the first k of its top `max(ks)`. Default is "similarity".
+
+    Returns
+    -------
+    dict
+        The summary of the evaluation.
+    """
+    output_format = Path(output_file).suffix
+    if output_format not in (".jsonl", ".parquet"):
+        raise ValueError(f"File {output_file} is not a JSONL or Parquet file.")
+    if search_type not in ("similarity", "mmr"):
+        raise ValueError(
+            f"Unsupported search type: {search_type}. "
+            "Supported options are 'similarity' and 'mmr'."
+        )
+    if search_type == "mmr" and bm25_index is not None:
+        raise ValueError("Hybrid search with BM25 is only supported for 'similarity'.")
+
+    ks = parse_ks(ks)
+    max_k = max(ks)
+    data = read_jsonl(input_file)
+    queries = [item[query_field] for item in data]
+    output_file = timestamp_file_name(str(output_file))
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+
+    logging.info(f"Writing results to {output_file}...")
+    logging.info(f"Evaluating {len(queries)} queries for k in {ks}...")
+
+    # the queries are embedded as documents, in batches, but not cached
+    embedding_model = vector_store.embeddings
+    if isinstance(embedding_model, CachedEmbeddings):
+        embedding_model = embedding_model.embeddings
+    start = time.perf_counter()
+    query_embeddings = []
+    for i in tqdm(range(0, len(queries), batch_size), desc="Embedding queries"):
+        query_embeddings += embedding_model.embed_documents(queries[i : i + batch_size])
+    embedding_latency = (time.perf_counter() - start) / max(len(queries), 1)
+
+    first_hit_ranks = np.zeros(len(data), dtype=np.int64)
+    latencies = np.zeros(len(data))
+    rows = []
+    f = open(output_file, "w") if output_format == ".jsonl" else None
+    try:
+        for i, (item, embedding) in enumerate(
+            tqdm(zip(data, query_embeddings), total=len(data), desc="Searching")
+        ):
+            start = time.perf_counter()
+            if search_type == "mmr":
+                retrieved_docs = mmr_search_with_score(
+                    vector_store,
+                    queries[i],
+                    k=max_k,
+                    fetch_k=fetch_k,
+                    query_embedding=embedding,
+                )
+            elif bm25_index is None:
+                retrieved_docs = _search_by_vector(vector_store, embedding, max_k)
+            else:
+                retrieved_docs = hybrid_search(
+                    _search_by_vector(vector_store, embedding, max(max_k, fetch_k)),
+                    bm25_index,
+                    queries[i],
+                    k=max_k,
+                    fetch_k=fetch_k,
+                    rrf_k=rrf_k,
+                )
+            latencies[i] = time.perf_counter() - start
+
+            sources = [doc.metadata["source"] for doc, _ in retrieved_docs]
+            if item[target_document_field] in sources:
+                first_hit_ranks[i] = sources.index(item[target_document_field]) + 1
+
+            row = item | {
+                "query_field": query_field,
+                "target_document_field": target_document_field,
+                "max_k": max_k,
+                "search": "dense" if bm25_index is None else "hybrid",
+                "search_type": search_type,
+                "retrieval_latency": latencies[i],
+                "retrieved_documents_scores": [float(s) for _, s in retrieved_docs],
+                "retrieved_documents_sources": sources,
+                "first_hit_rank": int(first_hit_ranks[i]),
+            }
+            if f is not None:
+                f.write(json.dumps(row) + "\n")
+            else:
+                rows.append(row)
+    finally:
+        if f is not None:
+            f.close()
+
+    if output_format == ".parquet":
+        import pandas as pd
+
+        pd.DataFrame(rows).to_parquet(output_file)
+
+    summary = {
+        "input_file": str(input_file),
+        "output_file": str(output_file),
+        "n_queries": len(data),
+        "ks": ks,
+        "search": "dense" if bm25_index is None else "hybrid",
+        "search_type": search_type,
+        **ranking_metrics(first_hit_ranks, ks),
+        "embedding_latency": embedding_latency,
+        "mean_retrieval_latency": float(latencies.mean()) if len(data) else 0.0,
+        "p95_retrieval_latency": (
+            float(np.percentile(latencies, 95)) if len(data) else 0.0
+        ),
+    }
+    summary_file = Path(output_file).with_name(f"{Path(output_file).stem}_summary.json")
+    with open(summary_file, "w") as f:
+        json.dump(summary, f, indent=2)
+
+    logging.info(f"Evaluation summary: {summary}")
+    logging.info(f"Summary saved to {summary_file}")
+
+    return summary
+
+
 def main(
     input_file: str | Path,
     output_file: str | Path,
@@ -100,7 +368,19 @@ def main(
     force_create: bool = False,
     trust_source: bool = False,
     k: int = 4,
-):
+    fetch_k: int = 20,
+    rrf_k: int = 60,
+    ks: str | list[int] | None = None,
+    batch_size: int = 64,
+) -> list[dict] | dict:
+    """
+    Evaluate the vector store on the queries of `input_file`, for `k` or, if
+    `ks` is passed, for each value of `ks` in one pass (see
+    `evaluate_query_store_multi_k`).
+    """
+    if config.bm25 and config.persist_directory is None:
+        raise ValueError("A persist directory is needed to evaluate a BM25 index.")
+
     vector_store = get_vector_store(
         conditions_file=conditions_file,
         config=config,
@@ -108,11 +388,33 @@ def main(
         trust_source=trust_source,
     )
 
-    evaluate_query_store(
+    bm25_index = (
+        BM25Index.load(bm25_directory(config.persist_directory))
+        if config.bm25
+        else None
+    )
+    if ks is not None:
+        return evaluate_query_store_multi_k(
+            input_file=input_file,
+            output_file=output_file,
+            query_field=query_field,
+            target_document_field=target_document_field,
+            vector_store=vector_store,
+            ks=parse_ks(ks),
+            batch_size=batch_size,
+            bm25_index=bm25_index,
+            fetch_k=fetch_k,
+            rrf_k=rrf_k,
+        )
+
+    return evaluate_query_store(
         input_file=input_file,
         output_file=output_file,
         query_field=query_field,
         target_document_field=target_document_field,
         vector_store=vector_store,
         k=k,
+        bm25_index=bm25_index,
+        fetch_k=fetch_k,
+        rrf_k=rrf_k,
     )
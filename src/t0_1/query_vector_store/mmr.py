@@ -0,0 +1,182 @@
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+
+def maximal_marginal_relevance(
+    query_embedding: np.ndarray,
+    embeddings: np.ndarray,
+    k: int = 4,
+    lambda_mult: float = 0.5,
+) -> list[int]:
+    """
+    Select `k` of the candidate embeddings by maximal marginal relevance,
+    i.e. trading off the cosine similarity to the query against the cosine
+    similarity to the candidates already selected.
+
+    The similarities between all candidates are computed once, and the
+    similarity of each candidate to the selected set is kept up to date with
+    a running maximum, so each selection step is a vector operation.
+
+    Parameters
+    ----------
+    query_embedding : np.ndarray
+        The embedding of the query, of shape (dim,).
+    embeddings : np.ndarray
+        The embeddings of the candidates, of shape (n, dim).
+    k : int, optional
+        The number of candidates to select. By default 4.
+    lambda_mult : float, optional
+        Between 0 and 1, with 0 for maximum diversity and 1 for minimum
+        diversity. By default 0.5.
+
+    Returns
+    -------
+    list[int]
+        The indices of the selected candidates, in the order selected.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if len(embeddings) == 0 or k <= 0:
+        return []
+
+    def _normalise(x: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(x, axis=-1, keepdims=True)
+        return x / np.maximum(norms, 1e-12)
+
+    embeddings = _normalise(embeddings)
+    query_similarity = embeddings @ _normalise(
+        np.asarray(query_embedding, dtype=np.float32)
+    )
+    pairwise_similarity = embeddings @ embeddings.T
+
+    selected = [int(np.argmax(query_similarity))]
+    max_similarity = pairwise_similarity[selected[0]].copy()
+    available = np.ones(len(embeddings), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, len(embeddings)):
+        mmr_scores = lambda_mult * query_similarity - (1 - lambda_mult) * max_similarity
+        mmr_scores[~available] = -np.inf
+        best = int(np.argmax(mmr_scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, pairwise_similarity[best], out=max_similarity)
+
+    return selected
+
+
+def _faiss_candidates(
+    vectorstore, query_embedding: list[float], fetch_k: int
+) -> tuple[list[Document], np.ndarray, np.ndarray]:
+    query = np.array([query_embedding], dtype=np.float32)
+    if vectorstore._normalize_L2:
+        import faiss
+
+        faiss.normalize_L2(query)
+
+    distances, indices = vectorstore.index.search(query, fetch_k)
+    # -1 happens when the index has fewer than fetch_k vectors
+    found = indices[0] != -1
+    ids = indices[0][found]
+    docs = [
+        vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]) for i in ids
+    ]
+    embeddings = np.array(
+        [vectorstore.index.reconstruct(int(i)) for i in ids], dtype=np.float32
+    ).reshape(len(ids), vectorstore.index.d)
+
+    return docs, distances[0][found], embeddings
+
+
+def _chroma_candidates(
+    vectorstore, query_embedding: list[float], fetch_k: int, filter: dict | None
+) -> tuple[list[Document], np.ndarray, np.ndarray]:
+    results = vectorstore._collection.query(
+        query_embeddings=[query_embedding],
+        n_results=fetch_k,
+        where=filter,
+        include=["documents", "metadatas", "distances", "embeddings"],
+    )
+    docs = [
+        Document(id=_id, page_content=text, metadata=metadata or {})
+        for _id, text, metadata in zip(
+            results["ids"][0], results["documents"][0], results["metadatas"][0]
+        )
+    ]
+
+    return (
+        docs,
+        np.asarray(results["distances"][0]),
+        np.asarray(results["embeddings"][0], dtype=np.float32).reshape(len(docs), -1),
+    )
+
+
+def mmr_search_with_score(
+    vectorstore: VectorStore,
+    query: str,
+    k: int = 4,
+    fetch_k: int = 20,
+    lambda_mult: float = 0.5,
+    query_embedding: list[float] | None = None,
+    **kwargs,
+) -> list[tuple[Document, float]]:
+    """
+    Maximal marginal relevance search that returns the chunks with their
+    similarity search scores (distances, lower is better).
+
+    The query is embedded once and the `fetch_k` nearest chunks are fetched
+    with their embeddings from FAISS and Chroma stores. For other stores, or
+    with extra search arguments (e.g. a FAISS `filter`), the candidates are
+    fetched with `similarity_search_with_score` and embedded.
+
+    Parameters
+    ----------
+    vectorstore : VectorStore
+        The vector store to search.
+    query : str
+        The query.
+    k : int, optional
+        The number of chunks to return. By default 4.
+    fetch_k : int, optional
+        The number of candidates to select from. By default 20.
+    lambda_mult : float, optional
+        Between 0 and 1, with 0 for maximum diversity and 1 for minimum
+        diversity. By default 0.5.
+    query_embedding : list[float] | None, optional
+        The embedding of the query, if already computed. By default None.
+    **kwargs
+        Other arguments of the search, e.g. a `filter`.
+
+    Returns
+    -------
+    list[tuple[Document, float]]
+        The selected chunks and their scores, in the order selected.
+    """
+    embedding_model = vectorstore.embeddings
+    if query_embedding is None:
+        query_embedding = embedding_model.embed_query(query)
+    fetch_k = max(k, fetch_k)
+
+    store = type(vectorstore).__name__
+    if store == "FAISS" and not kwargs:
+        docs, scores, embeddings = _faiss_candidates(
+            vectorstore, query_embedding, fetch_k
+        )
+    elif store == "Chroma" and set(kwargs) <= {"filter"}:
+        docs, scores, embeddings = _chroma_candidates(
+            vectorstore, query_embedding, fetch_k, kwargs.get("filter")
+        )
+    else:
+        candidates = vectorstore.similarity_search_with_score(
+            query, k=fetch_k, **kwargs
+        )
+        docs = [doc for doc, _ in candidates]
+        scores = np.array([score for _, score in candidates])
+        embeddings = np.asarray(
+            embedding_model.embed_documents([doc.page_content for doc in docs])
+        )
+
+    selected = maximal_marginal_relevance(
+        np.asarray(query_embedding), embeddings, k=k, lambda_mult=lambda_mult
+    )
+
+    return [(docs[i], float(scores[i])) for i in selected]
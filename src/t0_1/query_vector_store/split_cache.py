@@ -0,0 +1,149 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+
+from langchain_text_splitters.base import TextSplitter
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class SplitCache:
+    def __init__(self, cache_dir: str | Path):
+        """
+        On-disk (SQLite) cache of the chunks of split pages, keyed by the hash
+        of the page and the configuration of the splitter. Chunks are stored
+        as compressed JSON.
+
+        Parameters
+        ----------
+        cache_dir : str | Path
+            Directory of the cache. It is created if it does not exist.
+        """
+        self.path: Path = Path(cache_dir) / "splits.sqlite"
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS splits (
+                    page_hash TEXT NOT NULL,
+                    model_name TEXT NOT NULL,
+                    chunk_overlap INTEGER NOT NULL,
+                    chunks BLOB NOT NULL,
+                    PRIMARY KEY (page_hash, model_name, chunk_overlap)
+                )
+                """
+            )
+
+    def lookup(
+        self, page_hash: str, model_name: str, chunk_overlap: int
+    ) -> list[str] | None:
+        """Return the cached chunks of a page, or None if not cached."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT chunks FROM splits "
+                "WHERE page_hash = ? AND model_name = ? AND chunk_overlap = ?",
+                (page_hash, model_name, chunk_overlap),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return json.loads(zlib.decompress(row[0]))
+
+    def update(
+        self, page_hash: str, model_name: str, chunk_overlap: int, chunks: list[str]
+    ) -> None:
+        """Store the chunks of a page."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO splits VALUES (?, ?, ?, ?)",
+                (
+                    page_hash,
+                    model_name,
+                    chunk_overlap,
+                    zlib.compress(json.dumps(chunks).encode()),
+                ),
+            )
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class CachedTextSplitter(TextSplitter):
+    def __init__(
+        self,
+        text_splitter: TextSplitter,
+        cache: SplitCache,
+        model_name: str,
+        chunk_overlap: int,
+    ):
+        """
+        Text splitter that reuses the chunks of pages split before with the
+        same splitter configuration.
+
+        Parameters
+        ----------
+        text_splitter : TextSplitter
+            The text splitter to use on a cache miss.
+        cache : SplitCache
+            The cache of split pages.
+        model_name : str
+            The name of the model whose tokenizer `text_splitter` uses.
+        chunk_overlap : int
+            The chunk overlap of `text_splitter`.
+        """
+        super().__init__(
+            chunk_size=text_splitter._chunk_size,
+            chunk_overlap=text_splitter._chunk_overlap,
+            add_start_index=text_splitter._add_start_index,
+        )
+        self.text_splitter: TextSplitter = text_splitter
+        self.cache: SplitCache = cache
+        self.model_name: str = model_name
+        self.chunk_overlap: int = chunk_overlap
+
+    def split_text(self, text: str) -> list[str]:
+        page_hash = content_hash(text)
+        chunks = self.cache.lookup(page_hash, self.model_name, self.chunk_overlap)
+        if chunks is None:
+            chunks = self.text_splitter.split_text(text)
+            self.cache.update(page_hash, self.model_name, self.chunk_overlap, chunks)
+
+        return chunks
+
+
+def get_cached_text_splitter(
+    text_splitter: TextSplitter,
+    split_cache_dir: str | Path | None,
+    model_name: str,
+    chunk_overlap: int,
+) -> TextSplitter:
+    """
+    Wrap a text splitter with a split cache in `split_cache_dir`, or return it
+    unchanged if `split_cache_dir` is None.
+    """
+    if split_cache_dir is None:
+        return text_splitter
+
+    return CachedTextSplitter(
+        text_splitter,
+        SplitCache(split_cache_dir),
+        model_name=model_name,
+        chunk_overlap=chunk_overlap,
+    )
@@ -0,0 +1,297 @@
+import csv
+import json
+import logging
+import multiprocessing
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from t0_1.query_vector_store.build_index import (
+    VectorStoreConfig,
+    VectorStoreCreator,
+    setup_embedding_model,
+    setup_text_splitter,
+)
+from t0_1.query_vector_store.evaluate import evaluate_query_store_multi_k, parse_ks
+from t0_1.query_vector_store.utils import load_conditions_jsonl
+
+# keys of the grid of a sweep and their default values
+GRID_DEFAULTS = {
+    "embedding_model_name": ["sentence-transformers/all-mpnet-base-v2"],
+    "chunk_overlap": [50],
+    "db_choice": ["faiss"],
+    "search_type": ["similarity"],
+    "k": [4],
+}
+TABLE_COLUMNS = [
+    "embedding_model_name",
+    "chunk_overlap",
+    "db_choice",
+    "search_type",
+    "k",
+    "recall",
+    "ndcg",
+    "mrr",
+    "mean_retrieval_latency",
+    "p95_retrieval_latency",
+    "build_seconds",
+]
+
+
+def load_grid(grid: dict | str | Path) -> dict[str, list]:
+    """
+    Load the grid of a sweep from a dictionary or a JSON file, mapping each
+    key of `GRID_DEFAULTS` to a value or a list of values. Missing keys take
+    their default value.
+    """
+    if not isinstance(grid, dict):
+        with open(grid) as f:
+            grid = json.load(f)
+
+    unknown = set(grid) - set(GRID_DEFAULTS)
+    if unknown:
+        raise KeyError(
+            f"Unknown keys in the grid: {sorted(unknown)}. "
+            f"Supported keys are {list(GRID_DEFAULTS)}."
+        )
+
+    grid = GRID_DEFAULTS | {
+        key: values if isinstance(values, list) else [values]
+        for key, values in grid.items()
+    }
+    grid["k"] = parse_ks(grid["k"])
+
+    return grid
+
+
+def _slug(text: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", text)
+
+
+def sweep_embedding_model(
+    embedding_model_name: str,
+    grid: dict[str, list],
+    conditions_file: str | Path,
+    input_file: str | Path,
+    output_dir: str | Path,
+    query_field: str = "symptoms_description",
+    target_document_field: str = "conditions_title",
+    embedding_backend: str = "torch",
+    fetch_k: int = 20,
+    batch_size: int = 64,
+) -> list[dict]:
+    """
+    Evaluate the configurations of the grid for one embedding model.
+
+    The model is loaded once and an index is built (or loaded, if it was
+    completely built in `output_dir` before) for each chunk overlap and
+    database. Chunks and their
+    embeddings are cached in `output_dir`, so indexes sharing a chunk overlap
+    only split the pages once and all indexes only embed each chunk once.
+    Each index is evaluated for all search types and all values of k at once.
+
+    Returns
+    -------
+    list[dict]
+        A row of the results table for each configuration.
+    """
+    output_dir = Path(output_dir)
+    embedding_model = setup_embedding_model(embedding_model_name, embedding_backend)
+    # the CLI passes the backend as an `EmbeddingBackend`
+    backend = getattr(embedding_backend, "value", embedding_backend)
+    conditions = load_conditions_jsonl(conditions_file)
+
+    rows = []
+    for chunk_overlap in grid["chunk_overlap"]:
+        text_splitter = setup_text_splitter(embedding_model_name, chunk_overlap)
+        for db_choice in grid["db_choice"]:
+            name = (
+                f"{_slug(embedding_model_name)}-{backend}"
+                f"-overlap{chunk_overlap}-{db_choice}"
+            )
+            config = VectorStoreConfig(
+                embedding_model_name=embedding_model_name,
+                chunk_overlap=chunk_overlap,
+                db_choice=db_choice,
+                persist_directory=str(output_dir / "indexes" / name),
+                embedding_backend=embedding_backend,
+                split_cache_dir=output_dir / "cache" / "splits",
+                embedding_cache_dir=output_dir / "cache" / "embeddings",
+            )
+
+            # written once the index is built, so that an index left half
+            # built by an interrupted sweep is rebuilt rather than reused
+            complete_marker = output_dir / "indexes" / f"{name}.complete"
+
+            creator = VectorStoreCreator(embedding_model, text_splitter)
+            start = time.perf_counter()
+            if complete_marker.exists():
+                logging.info(f"Loading index '{name}'...")
+                vector_store = creator.load_index(config=config, trust_source=True)
+            else:
+                logging.info(f"Building index '{name}'...")
+                shutil.rmtree(config.persist_directory, ignore_errors=True)
+                vector_store = creator.create_index(
+                    documents=list(conditions.values()),
+                    metadatas=[{"source": k} for k in conditions.keys()],
+                    config=config,
+                )
+                complete_marker.touch()
+            build_seconds = time.perf_counter() - start
+
+            for search_type in grid["search_type"]:
+                summary = evaluate_query_store_multi_k(
+                    input_file=input_file,
+                    output_file=output_dir / "results" / f"{name}-{search_type}.jsonl",
+                    query_field=query_field,
+                    target_document_field=target_document_field,
+                    vector_store=vector_store,
+                    ks=grid["k"],
+                    batch_size=batch_size,
+                    fetch_k=fetch_k,
+                    search_type=search_type,
+                )
+                for k in grid["k"]:
+                    rows.append(
+                        {
+                            "embedding_model_name": embedding_model_name,
+                            "chunk_overlap": chunk_overlap,
+                            "db_choice": db_choice,
+                            "search_type": search_type,
+                            "k": k,
+                            "recall": summary[f"recall@{k}"],
+                            "ndcg": summary[f"ndcg@{k}"],
+                            "mrr": summary["mrr"],
+                            "mean_retrieval_latency": summary["mean_retrieval_latency"],
+                            "p95_retrieval_latency": summary["p95_retrieval_latency"],
+                            "build_seconds": build_seconds,
+                        }
+                    )
+
+    return rows
+
+
+def format_table(rows: list[dict]) -> str:
+    """Format the results of a sweep as a table, best recall first."""
+    rows = sorted(rows, key=lambda row: (-row["recall"], row["mean_retrieval_latency"]))
+    cells = [TABLE_COLUMNS] + [
+        [
+            f"{row[column]:.3f}" if isinstance(row[column], float) else str(row[column])
+            for column in TABLE_COLUMNS
+        ]
+        for row in rows
+    ]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(TABLE_COLUMNS))]
+
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+        for row in cells
+    )
+
+
+def sweep_retriever(
+    grid: dict | str | Path,
+    conditions_file: str | Path,
+    input_file: str | Path,
+    output_dir: str | Path,
+    query_field: str = "symptoms_description",
+    target_document_field: str = "conditions_title",
+    embedding_backend: str = "torch",
+    fetch_k: int = 20,
+    batch_size: int = 64,
+    max_workers: int = 1,
+) -> list[dict]:
+    """
+    Evaluate the recall and latency of the retrieval for every configuration
+    of a grid of embedding models, chunk overlaps, databases, search types
+    and values of k.
+
+    The embedding models are evaluated in parallel in a pool of processes
+    (each loading its model once), as they do not share any artefacts.
+    Configurations of the same model share the cached chunks and embeddings
+    (see `sweep_embedding_model`).
+
+    Parameters
+    ----------
+    grid : dict | str | Path
+        The grid, or the path to a JSON file with it (see `load_grid`).
+    conditions_file : str | Path
+        The file containing the conditions to be indexed.
+    input_file : str | Path
+        The JSONL file of the queries and target documents.
+    output_dir : str | Path
+        Directory of the indexes, caches and results of the sweep.
+    query_field : str, optional
+        The field of the query in `input_file`. Default is
+        "symptoms_description".
+    target_document_field : str, optional
+        The field of the target document in `input_file`. Default is
+        "conditions_title".
+    embedding_backend : str, optional
+        The backend running the embedding models. Default is "torch".
+    fetch_k : int, optional
+        The number of candidates of MMR searches. Default is 20.
+    batch_size : int, optional
+        The number of queries to embed at once. Default is 64.
+    max_workers : int, optional
+        The number of processes evaluating embedding models at once. If 1,
+        the models are evaluated in this process. Default is 1.
+
+    Returns
+    -------
+    list[dict]
+        A row of the results table for each configuration. The table is also
+        saved to `sweep_results.csv` and `sweep_results.jsonl` in
+        `output_dir`.
+    """
+    grid = load_grid(grid)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    n_configs = 1
+    for values in grid.values():
+        n_configs *= len(values)
+    logging.info(f"Sweeping {n_configs} retriever configurations: {grid}")
+
+    kwargs = dict(
+        grid=grid,
+        conditions_file=conditions_file,
+        input_file=input_file,
+        output_dir=output_dir,
+        query_field=query_field,
+        target_document_field=target_document_field,
+        embedding_backend=embedding_backend,
+        fetch_k=fetch_k,
+        batch_size=batch_size,
+    )
+    models = grid["embedding_model_name"]
+    rows = []
+    if max_workers <= 1 or len(models) == 1:
+        for model_name in models:
+            rows += sweep_embedding_model(model_name, **kwargs)
+    else:
+        # spawn rather than fork, as the models may have started threads
+        with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(models)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            futures = [
+                executor.submit(sweep_embedding_model, model_name, **kwargs)
+                for model_name in models
+            ]
+            for future in futures:
+                rows += future.result()
+
+    with open(output_dir / "sweep_results.jsonl", "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+    with open(output_dir / "sweep_results.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=TABLE_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    logging.info(f"Sweep results:\n{format_table(rows)}")
+    logging.info(f"Sweep results saved to {output_dir / 'sweep_results.csv'}")
+
+    return rows
@@ -33,6 +33,60 @@ def remove_saved_directory(path: str | Path | None, directory_name: str) -> None
         logging.info(f"Removed existing directory at '{path}'.")
 
 
+def load_faiss_mmap(
+    folder_path: str | Path,
+    embeddings,
+    allow_dangerous_deserialization: bool = False,
+    index_name: str = "index",
+):
+    """
+    Load a FAISS vector store saved with `FAISS.save_local`, memory-mapping
+    the index read-only rather than reading it into memory. Processes loading
+    the same index (e.g. the workers of a server) then share its pages.
+
+    The codes of flat indexes (as built by `create_retriever`) are mapped
+    with `IO_FLAG_MMAP_IFC` and the inverted lists of IVF indexes with
+    `IO_FLAG_MMAP`. Documents cannot be added to the mapped index.
+
+    Parameters
+    ----------
+    folder_path : str | Path
+        The folder the vector store was saved to.
+    embeddings : Embeddings
+        The embedding model of the vector store.
+    allow_dangerous_deserialization : bool, optional
+        Whether to allow unpickling the docstore, which is only safe for
+        trusted sources. Default is False.
+    index_name : str, optional
+        The name of the saved index. Default is "index".
+
+    Returns
+    -------
+    FAISS
+        The loaded vector store.
+    """
+    if not allow_dangerous_deserialization:
+        raise ValueError(
+            "Loading a FAISS index requires unpickling its docstore. "
+            "Only load indexes from trusted sources (trust_source=True)."
+        )
+
+    import pickle
+
+    import faiss
+    from langchain_community.vectorstores import FAISS
+
+    path = Path(folder_path)
+    index = faiss.read_index(
+        str(path / f"{index_name}.faiss"),
+        faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+    )
+    with open(path / f"{index_name}.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
 def load_conditions_jsonl(
     conditions_file: str | Path,
 ) -> dict[str, str]:
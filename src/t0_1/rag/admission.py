@@ -0,0 +1,163 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        """
+        Raised when a request is not admitted, either because the wait queue
+        is full or because it waited too long in the queue.
+
+        Parameters
+        ----------
+        reason : str
+            Why the request was rejected.
+        retry_after : int
+            Suggested number of seconds to wait before retrying.
+        """
+        super().__init__(reason)
+        self.reason: str = reason
+        self.retry_after: int = retry_after
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_in_flight: int | None = None,
+        max_queue: int = 100,
+        queue_timeout: float = 30.0,
+    ):
+        """
+        Limit the number of concurrent graph executions, queueing the requests
+        over the limit in a bounded queue and rejecting the rest.
+
+        Parameters
+        ----------
+        max_in_flight : int | None, optional
+            Maximum number of requests executed at once. If None, requests
+            are not limited. By default None.
+        max_queue : int, optional
+            Maximum number of requests waiting to be executed. Requests
+            arriving when the queue is full are rejected. By default 100.
+        queue_timeout : float, optional
+            Maximum number of seconds a request waits in the queue before it
+            is rejected. By default 30.0.
+        """
+        if max_in_flight is not None and max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be at least 1, got {max_in_flight}.")
+        if max_queue < 0:
+            raise ValueError(f"max_queue must be non-negative, got {max_queue}.")
+
+        self.max_in_flight: int | None = max_in_flight
+        self.max_queue: int = max_queue
+        self.queue_timeout: float = queue_timeout
+        self._semaphore = (
+            asyncio.Semaphore(max_in_flight) if max_in_flight is not None else None
+        )
+        self.in_flight: int = 0
+        self.queued: int = 0
+        self.admitted: int = 0
+        self.rejected: int = 0
+        self.timed_out: int = 0
+        self.waited: int = 0
+        self.total_wait: float = 0.0
+        self.max_wait: float = 0.0
+        # exponentially weighted mean execution time, used for Retry-After
+        self.mean_duration: float | None = None
+
+    def retry_after(self) -> int:
+        """
+        Estimate the number of seconds until a slot is likely to be free,
+        from the mean execution time and the length of the queue.
+        """
+        if self.mean_duration is None or self.max_in_flight is None:
+            return 1
+
+        rounds = (self.queued + 1) / self.max_in_flight
+        return max(1, math.ceil(self.mean_duration * rounds))
+
+    async def acquire(self) -> float:
+        """
+        Wait for a slot to execute a request.
+
+        Returns
+        -------
+        float
+            The time the request was admitted, to pass to `release`.
+
+        Raises
+        ------
+        AdmissionRejected
+            If the queue is full or the request waited longer than
+            `queue_timeout` seconds.
+        """
+        if self._semaphore is not None:
+            if self._semaphore.locked():
+                if self.queued >= self.max_queue:
+                    self.rejected += 1
+                    raise AdmissionRejected(
+                        "Too many requests queued", self.retry_after()
+                    )
+
+                self.queued += 1
+                start = time.perf_counter()
+                try:
+                    await asyncio.wait_for(
+                        self._semaphore.acquire(), self.queue_timeout
+                    )
+                except asyncio.TimeoutError as e:
+                    self.rejected += 1
+                    self.timed_out += 1
+                    raise AdmissionRejected(
+                        "Timed out waiting in the queue", self.retry_after()
+                    ) from e
+                finally:
+                    self.queued -= 1
+                    wait = time.perf_counter() - start
+                    self.waited += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+            else:
+                await self._semaphore.acquire()
+
+        self.in_flight += 1
+        self.admitted += 1
+
+        return time.perf_counter()
+
+    def release(self, start: float) -> None:
+        """Free the slot of a request admitted at `start`."""
+        duration = time.perf_counter() - start
+        self.mean_duration = (
+            duration
+            if self.mean_duration is None
+            else 0.8 * self.mean_duration + 0.2 * duration
+        )
+        self.in_flight -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def admit(self):
+        """Execute the body of the context within a slot."""
+        start = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(start)
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "mean_wait": self.total_wait / self.waited if self.waited else 0.0,
+            "max_wait": self.max_wait,
+            "mean_duration": self.mean_duration,
+        }
@@ -1,15 +1,23 @@
+import asyncio
+import gc
+import hashlib
+import json
 import logging
+import os
+import time
+import uuid
+from contextlib import aclosing, closing
+from dataclasses import replace
 from pathlib import Path
-from typing import Iterable
+from typing import AsyncIterator, Callable, Iterable
 
-from langchain import hub
 from langchain_core.documents import Document
 from langchain_core.language_models.llms import LLM
 from langchain_core.messages import HumanMessage, SystemMessage, trim_messages
 from langchain_core.messages.ai import AIMessage, AIMessageChunk
-from langchain_core.messages.utils import count_tokens_approximately
 from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.checkpoint.memory import InMemorySaver
 from langgraph.config import get_stream_writer
 from langgraph.graph import END, START, MessagesState
@@ -17,17 +25,31 @@ from langgraph.graph.state import CompiledStateGraph, StateGraph
 from langgraph.prebuilt import ToolNode, tools_condition
 from typing_extensions import TypedDict
 
+from t0_1.query_vector_store.bm25 import BM25Index
 from t0_1.query_vector_store.build_retriever import (
     DEFAULT_RETRIEVER_CONFIG,
     RetrieverConfig,
     get_parent_doc_retriever,
+    load_parent_doc_retriever,
 )
 from t0_1.query_vector_store.custom_parent_document_retriever import (
     CustomParentDocumentRetriever,
 )
+from t0_1.rag.context_assembly import assemble_context
+from t0_1.rag.cross_encoder_reranker import (
+    DEFAULT_CROSS_ENCODER_MODEL_NAME,
+    CrossEncoderReranker,
+)
+from t0_1.rag.http_pool import HTTPClientPool, HTTPPoolConfig
+from t0_1.rag.load_balancer import sticky_replica
+from t0_1.rag.response_cache import CachedLLM, ResponseCache
+from t0_1.rag.shared_state import SQLiteSaver
+from t0_1.rag.single_flight import SingleFlight, aiterate_in_thread
+from t0_1.rag.token_counting import TokenCounter, get_token_counter
 from t0_1.rag.utils import (
     NHS_RETRIEVER_TOOL_PROMPT,
     ROUTER_RESPONSE_PROMPT,
+    AnswerStopDetector,
     create_retreiver_tool,
 )
 from t0_1.utils import process_arg_to_dict
@@ -47,6 +69,10 @@ class State(TypedDict):
     - reranker_response: The response from the reranker
     - reranker_response_processed: The processed response from the reranker
     - reranker_success: Whether the reranker was successful
+    - reranker_skipped: Whether reranking was skipped as the retrieval was confident
+    - reranker_latency: The time (in seconds) spent in the reranking step
+    - context_token_stats: The token counts of the assembled context, if budgeted
+    - message_token_counts: The cached token counts of the messages
     - demographics: The demographics of the user
 
     These attributes are list of lists to conform to a similar
@@ -62,6 +88,10 @@ class State(TypedDict):
     reranker_response: list[str | None]
     reranker_response_processed: list[list[str] | None]
     reranker_success: list[bool | None]
+    reranker_skipped: list[bool | None]
+    reranker_latency: list[float | None]
+    context_token_stats: list[dict[str, int] | None]
+    message_token_counts: dict[str, int]
     demographics: str | None
 
 
@@ -79,8 +109,17 @@ class CustomMessagesState(MessagesState):
     - reranker_response: The response from the reranker
     - reranker_response_processed: The processed response from the reranker
     - reranker_success: Whether the reranker was successful
+    - reranker_skipped: Whether reranking was skipped as the retrieval was confident
+    - reranker_latency: The time (in seconds) spent in the reranking step
+    - context_token_stats: The token counts of the assembled context, if budgeted
+    - message_token_counts: The cached token counts of the messages
+    - cleaned_content: The AI messages stripped of thinking tokens, keyed by message id
     - demographics: The demographics of the user
     - messages: All messages in the conversation (system, human, AI, tool)
+    - t0_reasoning: T0's full output (thinking + answer)
+    - t0_latency: The time (in seconds) of T0's generation
+    - router_ttft: The router's time to first token (in seconds)
+    - router_latency: The router's total response time (in seconds)
     """
 
     # note there is also a messages key from the MessagesState class
@@ -96,9 +135,61 @@ class CustomMessagesState(MessagesState):
     reranker_response: list[str | None]
     reranker_response_processed: list[list[str] | None]
     reranker_success: list[bool | None]
+    reranker_skipped: list[bool | None]
+    reranker_latency: list[float | None]
+    context_token_stats: list[dict[str, int] | None]
     demographics: str | None
+    # content of the AI messages stripped of thinking tokens, keyed by message id
+    cleaned_content: dict[str, str]
+    # cached token counts of the messages, keyed by `TokenCounter.message_key`
+    message_token_counts: dict[str, int]
     # T0's full output (thinking + answer), not added to conversation messages
     t0_reasoning: list[str]
+    # time (in seconds) of T0's generation, and the router's time to first token
+    # and total time, to separate the router's latency from T0's
+    t0_latency: list[float]
+    router_ttft: list[float | None]
+    router_latency: list[float]
+
+
+def retrieval_score_margin(
+    scores: list[float], k: int
+) -> tuple[float | None, float | None]:
+    """
+    Measure how clearly the top k retrieved documents are separated from the rest.
+
+    The scores are the retrieval distances of the documents (lower is more
+    similar) in retrieval order. With hybrid search the scores are fused
+    ranks (see `hybrid_search`), so the margins are in those units instead. The margin compares the distance of the first
+    document that would be dropped by reranking to k documents with the
+    distance of the last document that would be kept: a large gap (or ratio)
+    means the top k retrieved documents leave little room for a reranker to
+    change the selection.
+
+    Parameters
+    ----------
+    scores : list[float]
+        The retrieval distances of the retrieved documents.
+    k : int
+        The number of documents reranking would select.
+
+    Returns
+    -------
+    tuple[float | None, float | None]
+        The gap (difference) and ratio between the (k+1)-th and k-th distances.
+        Both are None if there are no more than k documents.
+    """
+    if k < 1 or len(scores) <= k:
+        return None, None
+
+    kept, dropped = scores[k - 1], scores[k]
+    gap = dropped - kept
+    if kept > 0:
+        ratio = dropped / kept
+    else:
+        ratio = float("inf") if dropped > 0 else 1.0
+
+    return gap, ratio
 
 
 class RAG:
@@ -118,7 +209,22 @@ class RAG:
         rerank_prompt: str | Path | None = None,
         rerank_llm: LLM | None = None,
         rerank_k: int = 5,
+        rerank_method: str = "llm",
+        cross_encoder_reranker: CrossEncoderReranker | None = None,
+        rerank_skip_gap: float | None = None,
+        rerank_skip_ratio: float | None = None,
+        context_max_tokens: int | None = None,
+        context_neighbour_lines: int = 1,
+        token_counter: TokenCounter | None = None,
+        max_context_tokens: int = 128000,
+        conversational_agent_token_counter: TokenCounter | None = None,
+        conversational_agent_max_context_tokens: int | None = None,
+        http_pool: HTTPClientPool | None = None,
+        response_cache: ResponseCache | None = None,
+        coalesce_queries: bool = False,
+        checkpointer: BaseCheckpointSaver | None = None,
         seed: int | None = None,
+        retriever_config: RetrieverConfig | None = None,
     ):
         """
         Initialise the RAG class with the vector store, prompt, and LLM.
@@ -154,6 +260,9 @@ class RAG:
             Whether to use budget forcing. By default False.
         budget_forcing_kwargs : dict | str | None, optional
             Keyword arguments to pass to the budget forcing. By default None.
+            If "early_stop_answer" is True (the default), generation of an
+            answer that is not streamed to the user (i.e. in conversational
+            mode) stops as soon as the `(condition, severity)` tuple is emitted.
         budget_forcing_tokenizer : str | None, optional
             Tokenizer to use for the LLM if using budget forcing. By default None.
             If None, will use the LLM model name.
@@ -165,8 +274,67 @@ class RAG:
             LLM to use for reranking. By default None.
         rerank_k : int, optional
             Number of documents to rerank and filter to. By default 5.
+        rerank_method : str, optional
+            Method to use for reranking. Either "llm" to ask `rerank_llm` to
+            select the most relevant documents, or "cross_encoder" to score
+            (query, chunk) pairs with `cross_encoder_reranker`. By default "llm".
+        cross_encoder_reranker : CrossEncoderReranker | None, optional
+            The cross-encoder reranker to use if `rerank_method` is
+            "cross_encoder". By default None.
+        rerank_skip_gap : float | None, optional
+            Skip reranking when the retrieval distance of the first document
+            outside the top `rerank_k` exceeds that of the last document
+            inside it by at least this gap (see `retrieval_score_margin`).
+            Not supported with hybrid search, whose scores are in other units.
+            By default None (never skip on the gap).
+        rerank_skip_ratio : float | None, optional
+            Skip reranking when the ratio of those two retrieval distances is
+            at least this ratio. Not supported with hybrid search.
+            By default None (never skip on the ratio).
+        context_max_tokens : int | None, optional
+            Maximum number of tokens of retrieved content to pass to the LLM.
+            If set, only the lines of each retrieved page around its matching
+            chunks are used (see `assemble_context`) rather than the full pages.
+            By default None (use the full pages).
+        context_neighbour_lines : int, optional
+            Number of lines around each matching chunk to include when
+            `context_max_tokens` is set. By default 1.
+        token_counter : TokenCounter | None, optional
+            Token counter for the messages sent to the LLM. By default None.
+            If None, tokens are approximated from the number of characters.
+        max_context_tokens : int, optional
+            Maximum number of tokens of the messages sent to the LLM. Older
+            messages of the conversation are trimmed to fit. By default 128000.
+        conversational_agent_token_counter : TokenCounter | None, optional
+            Token counter for the messages sent to the conversational agent LLM.
+            By default None. If None, `token_counter` is used.
+        conversational_agent_max_context_tokens : int | None, optional
+            Maximum number of tokens of the messages sent to the conversational
+            agent LLM. By default None (no trimming).
+        http_pool : HTTPClientPool | None, optional
+            The pool of HTTP clients shared by the LLMs, used to report the
+            connection pool metrics. By default None.
+        response_cache : ResponseCache | None, optional
+            The cache of the LLM responses, used to report the cache hits.
+            By default None.
+        coalesce_queries : bool, optional
+            Whether concurrent identical queries should share one graph
+            execution (see `single_flight_key`). Only used when not
+            conversational, as the response then only depends on the query.
+            By default False.
+        checkpointer : BaseCheckpointSaver | None, optional
+            Checkpointer storing the graph state (e.g. a SQLiteSaver shared by
+            the workers of the server). It is kept when the graph is reset.
+            If None, an InMemorySaver is used. By default None.
+        seed : int | None, optional
+            Seed to pass to the LLM requests. By default None.
+        retriever_config : RetrieverConfig | None, optional
+            The configuration used to build the retriever. This is used
+            as the base configuration when hot reloading the retriever
+            index (see `reload_rag_retriever`). By default None.
         """
         self.retriever: CustomParentDocumentRetriever = retriever
+        self.retriever_config: RetrieverConfig | None = retriever_config
         self.prompt: PromptTemplate = prompt
         self.llm: LLM = llm
         self.conversational: bool = conversational
@@ -175,26 +343,109 @@ class RAG:
         if tools is not None:
             self.llm = self.llm.bind_tools(tools, **tools_kwargs)
         self.budget_forcing: bool = budget_forcing
+        if budget_forcing:
+            from langchain_openai import OpenAI
+
+            llm = self.llm.llm if isinstance(self.llm, CachedLLM) else self.llm
+            if not isinstance(llm, OpenAI):
+                raise ValueError(
+                    "Budget forcing is only supported for OpenAI completion endpoint."
+                )
         self.budget_forcing_kwargs: dict = budget_forcing_kwargs
         self.budget_forcing_tokenizer: str | None = budget_forcing_tokenizer
         self.rerank: bool = rerank
         self.rerank_prompt: PromptTemplate | None = rerank_prompt
         self.rerank_llm: LLM | None = rerank_llm
         self.rerank_k: int = rerank_k
+        self.rerank_method: str = rerank_method
+        self.cross_encoder_reranker: CrossEncoderReranker | None = (
+            cross_encoder_reranker
+        )
+        if (rerank_skip_gap is not None or rerank_skip_ratio is not None) and (
+            isinstance(getattr(retriever, "bm25_index", None), BM25Index)
+        ):
+            raise ValueError(
+                "Skipping reranking on the retrieval margin is not supported with "
+                "hybrid search, whose scores are fused ranks rather than distances."
+            )
+        self.rerank_skip_gap: float | None = rerank_skip_gap
+        self.rerank_skip_ratio: float | None = rerank_skip_ratio
+        self.context_max_tokens: int | None = context_max_tokens
+        self.context_neighbour_lines: int = context_neighbour_lines
+        self.token_counter: TokenCounter = token_counter or TokenCounter()
+        self.max_context_tokens: int = max_context_tokens
+        self.conversational_agent_token_counter: TokenCounter = (
+            conversational_agent_token_counter or self.token_counter
+        )
+        self.conversational_agent_max_context_tokens: int | None = (
+            conversational_agent_max_context_tokens
+        )
+        self.http_pool: HTTPClientPool | None = http_pool
+        self.response_cache: ResponseCache | None = response_cache
         self.seed: int | None = seed
+        self.single_flight: SingleFlight | None = (
+            SingleFlight() if coalesce_queries and not conversational else None
+        )
         self._tokenizer = None
-        self.memory: InMemorySaver = InMemorySaver()
+        self.checkpointer: BaseCheckpointSaver | None = checkpointer
+        self.memory: BaseCheckpointSaver = checkpointer or InMemorySaver()
         self.reset_graph()
 
-        self.trimmer = trim_messages(
-            max_tokens=128000,  # TODO: should this be configurable?
+    def trim_messages(
+        self,
+        messages: list,
+        state: State | CustomMessagesState,
+        conversational_agent: bool = False,
+    ) -> tuple[list, dict[str, int]]:
+        """
+        Trim the oldest messages to fit the context budget of the LLM.
+
+        Token counts of the messages are cached in the state so that only
+        the messages that are new in this turn need to be counted.
+
+        Parameters
+        ----------
+        messages : list
+            The messages to trim.
+        state : State | CustomMessagesState
+            The state, containing the cached `message_token_counts`.
+        conversational_agent : bool, optional
+            Whether the messages are sent to the conversational agent LLM
+            rather than the RAG LLM. By default False.
+
+        Returns
+        -------
+        tuple[list, dict[str, int]]
+            The trimmed messages and the updated token count cache.
+        """
+        if conversational_agent:
+            counter = self.conversational_agent_token_counter
+            max_tokens = self.conversational_agent_max_context_tokens
+        else:
+            counter = self.token_counter
+            max_tokens = self.max_context_tokens
+
+        cache = dict(state.get("message_token_counts") or {})
+        if max_tokens is None:
+            return messages, cache
+
+        trimmed_messages = trim_messages(
+            messages,
+            max_tokens=max_tokens,
             strategy="last",
-            token_counter=count_tokens_approximately,
+            token_counter=lambda msgs: counter.count_messages(msgs, cache),
             include_system=True,
             allow_partial=False,
             start_on="human",
             end_on="human",
         )
+        if len(trimmed_messages) < len(messages):
+            logging.info(
+                f"Trimmed {len(messages) - len(trimmed_messages)} messages to fit "
+                f"{max_tokens} tokens"
+            )
+
+        return trimmed_messages, cache
 
     @staticmethod
     def _strip_thinking_tokens(content: str) -> str:
@@ -204,15 +455,76 @@ class RAG:
         return content
 
     @staticmethod
-    def _clean_messages_for_context(messages):
-        """Strip thinking tokens from AI messages for use as conversation context."""
+    def _clean_messages_for_context(
+        messages, cleaned_content: dict[str, str] | None = None
+    ):
+        """
+        Strip thinking tokens from AI messages for use as conversation context.
+
+        The cleaned content of AI messages is reused from `cleaned_content`
+        (keyed by message id) where available, so long thinking traces are
+        only parsed once, when the message is added to the conversation.
+        """
+        cleaned_content = cleaned_content or {}
         return [
-            AIMessage(content=RAG._strip_thinking_tokens(m.content))
+            AIMessage(
+                content=(
+                    cleaned_content[m.id]
+                    if m.id in cleaned_content
+                    else RAG._strip_thinking_tokens(m.content)
+                )
+            )
             if m.type == "ai"
             else m
             for m in messages
         ]
 
+    @staticmethod
+    def _with_cleaned_content(
+        state: CustomMessagesState, message: AIMessage
+    ) -> dict[str, str]:
+        """
+        Give a new AI message an id and return the cleaned content cache
+        updated with its content stripped of thinking tokens.
+        """
+        if message.id is None:
+            message.id = str(uuid.uuid4())
+
+        return state.get("cleaned_content", {}) | {
+            message.id: RAG._strip_thinking_tokens(message.content)
+        }
+
+    def swap_retriever(
+        self,
+        retriever: CustomParentDocumentRetriever,
+        retriever_config: RetrieverConfig | None = None,
+    ) -> CustomParentDocumentRetriever:
+        """
+        Atomically replace the retriever used by the graph nodes.
+
+        The graph nodes look up `self.retriever` once per call, so requests
+        that are already retrieving finish on the old retriever while any
+        new retrieval uses the new one. Conversation memory is untouched.
+
+        Parameters
+        ----------
+        retriever : CustomParentDocumentRetriever
+            The new retriever to use.
+        retriever_config : RetrieverConfig | None, optional
+            The configuration used to build the new retriever. By default None,
+            in which case the stored configuration is left unchanged.
+
+        Returns
+        -------
+        CustomParentDocumentRetriever
+            The previous retriever.
+        """
+        old_retriever, self.retriever = self.retriever, retriever
+        if retriever_config is not None:
+            self.retriever_config = retriever_config
+
+        return old_retriever
+
     def reset_graph(self):
         """
         Reset the graph to a new instance of the compiled state graph.
@@ -323,9 +635,47 @@ class RAG:
 
         return serialised, {"query": query, "context": retrieved_docs}
 
+    def skip_rerank(self, gap: float | None, ratio: float | None) -> bool:
+        """
+        Whether the retrieval is confident enough to skip reranking.
+
+        Parameters
+        ----------
+        gap : float | None
+            The retrieval score gap, as returned by `retrieval_score_margin`.
+        ratio : float | None
+            The retrieval score ratio, as returned by `retrieval_score_margin`.
+
+        Returns
+        -------
+        bool
+            True if either the gap or ratio meets its configured threshold.
+        """
+        if self.rerank_skip_gap is not None and gap is not None:
+            if gap >= self.rerank_skip_gap:
+                return True
+        if self.rerank_skip_ratio is not None and ratio is not None:
+            if ratio >= self.rerank_skip_ratio:
+                return True
+
+        return False
+
     def rerank_documents(
         self,
         state: State,
+    ) -> dict[str, list[Document]]:
+        start = time.perf_counter()
+        update = self._rerank_documents(state)
+        latency = time.perf_counter() - start
+        logging.info(f"Reranking step took {latency:.3f} seconds")
+
+        return update | {
+            "reranker_latency": state.get("reranker_latency", []) + [latency],
+        }
+
+    def _rerank_documents(
+        self,
+        state: State,
     ) -> dict[str, list[Document]]:
         # rerank the documents using an LLM to select the top rerank_k documents
         logging.info(f"Reranking documents to {self.rerank_k} documents...")
@@ -354,8 +704,34 @@ class RAG:
                 )
                 + [None],
                 "reranker_success": state.get("reranker_success", []) + [None],
+                "reranker_skipped": state.get("reranker_skipped", []) + [None],
             }
 
+        gap, ratio = retrieval_score_margin(
+            [float(doc.metadata["sub_docs"][0].metadata["score"]) for doc in context],
+            k=self.rerank_k,
+        )
+        if self.skip_rerank(gap, ratio):
+            logging.info(
+                f"Skipping reranking, retrieval is confident (gap={gap:.3f}, ratio={ratio:.3f}) "
+                f"- using the top {self.rerank_k} retrieved documents"
+            )
+
+            return {
+                "reranked_context": state.get("reranked_context", [])
+                + [context[: self.rerank_k]],
+                "reranker_response": state.get("reranker_response", []) + [None],
+                "reranker_response_processed": state.get(
+                    "reranker_response_processed", []
+                )
+                + [None],
+                "reranker_success": state.get("reranker_success", []) + [None],
+                "reranker_skipped": state.get("reranker_skipped", []) + [True],
+            }
+
+        if self.rerank_method == "cross_encoder":
+            return self._cross_encoder_rerank(state, context)
+
         messages = self.rerank_prompt.invoke(
             {
                 "symptoms_description": state["retriever_queries"][-1],
@@ -410,6 +786,43 @@ class RAG:
             "reranker_response_processed": state.get("reranker_response_processed", [])
             + [reranked_docs_titles],
             "reranker_success": state.get("reranker_success", []) + [reranker_success],
+            "reranker_skipped": state.get("reranker_skipped", []) + [False],
+        }
+
+    def _cross_encoder_rerank(
+        self, state: State, context: list[Document]
+    ) -> dict[str, list[Document]]:
+        # rerank the documents by scoring (query, chunk) pairs with a cross-encoder
+        try:
+            reranked = self.cross_encoder_reranker.rerank(
+                query=state["retriever_queries"][-1],
+                documents=context,
+                k=self.rerank_k,
+            )
+            reranked_docs = [doc for doc, _ in reranked]
+            reranked_docs_titles = [doc.metadata["source"] for doc in reranked_docs]
+            reranker_response = ", ".join(
+                f"{doc.metadata['source']} ({score:.3f})" for doc, score in reranked
+            )
+            reranker_success = True
+            logging.info("Cross-encoder reranker selected the top k documents")
+        except Exception as e:
+            logging.error(f"Reranking failure: {e}")
+            logging.info(f"Falling back to the top {self.rerank_k} retrieved documents")
+
+            reranker_response = ""
+            reranked_docs_titles = []
+            reranker_success = False
+            reranked_docs = context[: self.rerank_k]
+
+        return {
+            "reranked_context": state.get("reranked_context", []) + [reranked_docs],
+            "reranker_response": state.get("reranker_response", [])
+            + [reranker_response],
+            "reranker_response_processed": state.get("reranker_response_processed", [])
+            + [reranked_docs_titles],
+            "reranker_success": state.get("reranker_success", []) + [reranker_success],
+            "reranker_skipped": state.get("reranker_skipped", []) + [False],
         }
 
     def set_up_tokenizer(self):
@@ -427,18 +840,96 @@ class RAG:
 
         return self._tokenizer
 
+    def _early_stop_answer(self, stream_answer: bool) -> bool:
+        # only stop early when the answer is not streamed to the user, i.e. when
+        # only the (condition, severity) tuple is used downstream by the router
+        return not stream_answer and self.budget_forcing_kwargs.get(
+            "early_stop_answer", True
+        )
+
+    def _stream_completion(
+        self,
+        prompt: str,
+        config: RunnableConfig,
+        writer: Callable,
+        sampling_params: dict | None = None,
+        write: bool = True,
+        early_stop: bool = False,
+    ) -> str:
+        """
+        Stream a completion from the LLM, writing the chunks to the stream writer.
+
+        Parameters
+        ----------
+        prompt : str
+            The prompt to complete.
+        config : RunnableConfig
+            The config of the graph node, used for the stream metadata.
+        writer : Callable
+            The stream writer of the graph node.
+        sampling_params : dict | None, optional
+            Sampling parameters to pass as the `extra_body` of the request.
+            By default None.
+        write : bool, optional
+            Whether to write the chunks to the stream writer. By default True.
+        early_stop : bool, optional
+            Whether to stop generating as soon as a parseable
+            `(condition, severity)` answer has been emitted. By default False.
+
+        Returns
+        -------
+        str
+            The generated completion.
+        """
+        kwargs = {} if sampling_params is None else {"extra_body": sampling_params}
+        detector = AnswerStopDetector() if early_stop else None
+
+        response = ""
+        # closing the stream closes the upstream request so the server
+        # stops generating if we stop early
+        with closing(self.llm.stream(prompt, **kwargs)) as stream:
+            for msg in stream:
+                if write:
+                    writer((AIMessageChunk(msg), config["metadata"]))
+                response += msg
+                if detector is not None and detector.update(msg):
+                    logging.info("Answer emitted, stopping generation early")
+                    break
+
+        return response
+
+    async def _astream_completion(
+        self,
+        prompt: str,
+        config: RunnableConfig,
+        writer: Callable,
+        sampling_params: dict | None = None,
+        write: bool = True,
+        early_stop: bool = False,
+    ) -> str:
+        """
+        Async version of `_stream_completion`.
+        """
+        kwargs = {} if sampling_params is None else {"extra_body": sampling_params}
+        detector = AnswerStopDetector() if early_stop else None
+
+        response = ""
+        async with aclosing(self.llm.astream(prompt, **kwargs)) as stream:
+            async for msg in stream:
+                if write:
+                    writer((AIMessageChunk(msg), config["metadata"]))
+                response += msg
+                if detector is not None and detector.update(msg):
+                    logging.info("Answer emitted, stopping generation early")
+                    break
+
+        return response
+
     def _budget_forcing_invoke(
         self, messages: list, config: RunnableConfig, stream_answer: bool = True
     ) -> AIMessage:
         logging.info("Budget forcing invoked")
 
-        from langchain_openai import OpenAI
-
-        if not isinstance(self.llm, OpenAI):
-            raise ValueError(
-                "Budget forcing is only supported for OpenAI completion endpoint."
-            )
-
         tokenizer = self.set_up_tokenizer()
 
         from langchain_openai.chat_models.base import _convert_message_to_dict
@@ -457,10 +948,12 @@ class RAG:
             prompt += answer_init
             writer((AIMessageChunk(answer_init), config["metadata"]))
 
-            response = ""
-            for msg in self.llm.stream(prompt):
-                writer((AIMessageChunk(msg), config["metadata"]))
-                response += msg
+            response = self._stream_completion(
+                prompt,
+                config=config,
+                writer=writer,
+                early_stop=self._early_stop_answer(stream_answer),
+            )
             return AIMessage(response)
 
         # otherwise we need to think and apply budget forcing
@@ -499,10 +992,9 @@ class RAG:
             logging.info(f"Thinking round {i + 1} out of {max_thinking_steps}")
             logging.info(f"Thinking tokens remaining: {thinking_tokens_remaining}")
 
-            response = ""
-            for msg in self.llm.stream(prompt, extra_body=sampling_params):
-                writer((AIMessageChunk(msg), config["metadata"]))
-                response += msg
+            response = self._stream_completion(
+                prompt, config=config, writer=writer, sampling_params=sampling_params
+            )
             output += response
             prompt += response
 
@@ -539,10 +1031,14 @@ class RAG:
         if stream_answer:
             writer((AIMessageChunk(answer_init), config["metadata"]))
 
-        for msg in self.llm.stream(prompt, extra_body=sampling_params):
-            if stream_answer:
-                writer((AIMessageChunk(msg), config["metadata"]))
-            output += msg
+        output += self._stream_completion(
+            prompt,
+            config=config,
+            writer=writer,
+            sampling_params=sampling_params,
+            write=stream_answer,
+            early_stop=self._early_stop_answer(stream_answer),
+        )
 
         if stream_answer:
             writer(
@@ -559,13 +1055,6 @@ class RAG:
     ) -> AIMessage:
         logging.info("Budget forcing invoked")
 
-        from langchain_openai import OpenAI
-
-        if not isinstance(self.llm, OpenAI):
-            raise ValueError(
-                "Budget forcing is only supported for OpenAI completion endpoint."
-            )
-
         tokenizer = self.set_up_tokenizer()
 
         from langchain_openai.chat_models.base import _convert_message_to_dict
@@ -586,10 +1075,12 @@ class RAG:
             prompt += answer_init
             writer((AIMessageChunk(answer_init), config["metadata"]))
 
-            response = ""
-            async for msg in self.llm.astream(prompt):
-                writer((AIMessageChunk(msg), config["metadata"]))
-                response += msg
+            response = await self._astream_completion(
+                prompt,
+                config=config,
+                writer=writer,
+                early_stop=self._early_stop_answer(stream_answer),
+            )
             return AIMessage(response)
 
         # otherwise we need to think and apply budget forcing
@@ -627,10 +1118,9 @@ class RAG:
 
             logging.info(f"Thinking round {i + 1} out of {max_thinking_steps}")
             logging.info(f"Thinking tokens remaining: {thinking_tokens_remaining}")
-            response = ""
-            async for msg in self.llm.astream(prompt, extra_body=sampling_params):
-                writer((AIMessageChunk(msg), config["metadata"]))
-                response += msg
+            response = await self._astream_completion(
+                prompt, config=config, writer=writer, sampling_params=sampling_params
+            )
             output += response
             prompt += response
 
@@ -667,10 +1157,14 @@ class RAG:
         if stream_answer:
             writer((AIMessageChunk(answer_init), config["metadata"]))
 
-        async for msg in self.llm.astream(prompt, extra_body=sampling_params):
-            if stream_answer:
-                writer((AIMessageChunk(msg), config["metadata"]))
-            output += msg
+        output += await self._astream_completion(
+            prompt,
+            config=config,
+            writer=writer,
+            sampling_params=sampling_params,
+            write=stream_answer,
+            early_stop=self._early_stop_answer(stream_answer),
+        )
 
         if stream_answer:
             writer(
@@ -703,14 +1197,23 @@ class RAG:
         llm_with_retrieve_tool = self.conversational_agent_llm.bind_tools(
             [create_retreiver_tool(self.retrieve_as_tool)]
         )
-        cleaned_messages = self._clean_messages_for_context(state["messages"])
+        cleaned_messages = self._clean_messages_for_context(
+            state["messages"], state.get("cleaned_content")
+        )
         system_content = NHS_RETRIEVER_TOOL_PROMPT + self._build_demographics_snippet(state)
-        logging.info(f"llm_with_retrieve_tool_message={[SystemMessage(system_content)] + cleaned_messages}")
-        response = llm_with_retrieve_tool.invoke(
+        agent_messages, message_token_counts = self.trim_messages(
             [SystemMessage(system_content)] + cleaned_messages,
+            state,
+            conversational_agent=True,
         )
+        logging.info(f"llm_with_retrieve_tool_message={agent_messages}")
+        response = llm_with_retrieve_tool.invoke(agent_messages)
 
-        return {"messages": [response]}
+        return {
+            "messages": [response],
+            "cleaned_content": self._with_cleaned_content(state, response),
+            "message_token_counts": message_token_counts,
+        }
 
     def process_tool_response(
         self, state: CustomMessagesState
@@ -739,6 +1242,12 @@ class RAG:
             "retriever_queries": state.get("retriever_queries", []) + [query],
         }
 
+    def count_text_tokens(self, text: str) -> int:
+        """
+        Count the tokens of a text with the LLM's token counter.
+        """
+        return self.token_counter.count_text(text)
+
     def obtain_context_and_sources(
         self, state: State | CustomMessagesState
     ) -> dict[str, str | list[str]]:
@@ -762,13 +1271,29 @@ class RAG:
         sources_str = (
             f"Sources and similarity scores (lower is better): {sources_and_scores}"
         )
+        if self.context_max_tokens is not None:
+            # only use the parts of the pages around the retrieved chunks
+            contents, token_stats = assemble_context(
+                context,
+                max_tokens=self.context_max_tokens,
+                count_tokens=self.count_text_tokens,
+                neighbour_lines=self.context_neighbour_lines,
+            )
+            logging.info(
+                f"Assembled context with {token_stats['assembled_tokens']} tokens, "
+                f"saving {token_stats['saved_tokens']} of {token_stats['full_tokens']} tokens"
+            )
+        else:
+            contents = [doc.page_content for doc in context]
+            token_stats = None
+
         retrieved_docs = [
             (
                 f"\nSource: {doc.metadata['source']}, "
                 f"similarity score: {round(float(doc.metadata['sub_docs'][0].metadata['score']), 3)}. "
-                f"Content:\n{doc.page_content}"
+                f"Content:\n{content}"
             )
-            for doc in context
+            for doc, content in zip(context, contents)
         ]
 
         docs_content = "\n".join(retrieved_docs + [sources_str])
@@ -776,41 +1301,85 @@ class RAG:
         return {
             "serialised_docs": docs_content,
             "sources": sources,
+            "token_stats": token_stats,
         }
 
-    def router_respond(
-        self, state: CustomMessagesState, config: RunnableConfig
-    ) -> dict:
-        """Pass T0's reasoning to the Qwen router to produce a patient-friendly response."""
-        logging.info("Router respond invoked")
-
-        writer = get_stream_writer()
-        t0_output = state["t0_reasoning"][-1]
-
+    def _router_messages(
+        self, state: CustomMessagesState
+    ) -> tuple[list, dict[str, int]]:
+        """
+        Build the router's messages from the conversation and T0's output,
+        trimmed to the conversational agent's context budget.
+        """
         # Build message list for the router (clean AI messages for context)
         conversation_history = [
             message
             for message in state["messages"]
             if message.type in ("human", "ai") and not getattr(message, "tool_calls", None)
         ]
-        conversation_history = self._clean_messages_for_context(conversation_history)
+        conversation_history = self._clean_messages_for_context(
+            conversation_history, state.get("cleaned_content")
+        )
         system_content = ROUTER_RESPONSE_PROMPT + self._build_demographics_snippet(state)
-        router_messages = (
+        return self.trim_messages(
             [SystemMessage(system_content)]
             + conversation_history
-            + [HumanMessage(content="Clinical analysis:\n\n" + t0_output)]
+            + [HumanMessage(content="Clinical analysis:\n\n" + state["t0_reasoning"][-1])],
+            state,
+            conversational_agent=True,
         )
+
+    @staticmethod
+    def _router_update(
+        state: CustomMessagesState,
+        response_content: str,
+        ttft: float | None,
+        latency: float,
+    ) -> dict:
+        """Build the state update of the router from its streamed response."""
+        logging.info(f"Router time to first token: {ttft}, total time: {latency:.3f}")
+
+        # Store full formatted content (thinking + answer) so the UI can
+        # display reasoning when loading from history
+        t0_output = state["t0_reasoning"][-1]
+        thinking_part = (
+            t0_output.split("<|im_start|>answer")[0]
+            if "<|im_start|>answer" in t0_output
+            else t0_output
+        )
+        full_content = thinking_part + "<|im_start|>answer\n" + response_content
+        message = AIMessage(content=full_content)
+        return {
+            "messages": [message],
+            "cleaned_content": RAG._with_cleaned_content(state, message),
+            "router_ttft": state.get("router_ttft", []) + [ttft],
+            "router_latency": state.get("router_latency", []) + [latency],
+        }
+
+    def router_respond(
+        self, state: CustomMessagesState, config: RunnableConfig
+    ) -> dict:
+        """Pass T0's reasoning to the Qwen router to produce a patient-friendly response."""
+        logging.info("Router respond invoked")
+
+        writer = get_stream_writer()
+        router_messages, message_token_counts = self._router_messages(state)
         logging.info(f"{router_messages=}")
 
         # Write the answer marker so the UI knows where the visible answer starts
         writer((AIMessageChunk("\n<|im_start|>answer\n"), config["metadata"]))
 
         # Stream the router's response
+        start = time.perf_counter()
+        ttft = None
         response_content = ""
         for chunk in self.conversational_agent_llm.stream(router_messages):
             token = chunk if isinstance(chunk, str) else chunk.content
+            if ttft is None and token:
+                ttft = time.perf_counter() - start
             writer((AIMessageChunk(token), config["metadata"]))
             response_content += token
+        latency = time.perf_counter() - start
 
         # Write finish signal
         writer(
@@ -820,15 +1389,9 @@ class RAG:
             )
         )
 
-        # Store full formatted content (thinking + answer) so the UI can
-        # display reasoning when loading from history
-        thinking_part = (
-            t0_output.split("<|im_start|>answer")[0]
-            if "<|im_start|>answer" in t0_output
-            else t0_output
-        )
-        full_content = thinking_part + "<|im_start|>answer\n" + response_content
-        return {"messages": [AIMessage(content=full_content)]}
+        return self._router_update(state, response_content, ttft, latency) | {
+            "message_token_counts": message_token_counts
+        }
 
     async def arouter_respond(
         self, state: CustomMessagesState, config: RunnableConfig
@@ -837,29 +1400,24 @@ class RAG:
         logging.info("Async router respond invoked")
 
         writer = get_stream_writer()
-        t0_output = state["t0_reasoning"][-1]
-
-        # Build message list for the router (clean AI messages for context)
-        conversation_history = [
-            message
-            for message in state["messages"]
-            if message.type in ("human", "ai") and not getattr(message, "tool_calls", None)
-        ]
-        conversation_history = self._clean_messages_for_context(conversation_history)
-        system_content = ROUTER_RESPONSE_PROMPT + self._build_demographics_snippet(state)
-        router_messages = (
-            [SystemMessage(system_content)]
-            + conversation_history
-            + [HumanMessage(content="Clinical analysis:\n\n" + t0_output)]
+        router_messages, message_token_counts = await asyncio.to_thread(
+            self._router_messages, state
         )
 
         # Write the answer marker
         writer((AIMessageChunk("\n<|im_start|>answer\n"), config["metadata"]))
 
-        # Get the router's response
-        response = await self.conversational_agent_llm.ainvoke(router_messages)
-        response_content = response.content
-        writer((AIMessageChunk(response_content), config["metadata"]))
+        # Stream the router's response, forwarding chunks as they arrive
+        start = time.perf_counter()
+        ttft = None
+        response_content = ""
+        async for chunk in self.conversational_agent_llm.astream(router_messages):
+            token = chunk if isinstance(chunk, str) else chunk.content
+            if ttft is None and token:
+                ttft = time.perf_counter() - start
+            writer((AIMessageChunk(token), config["metadata"]))
+            response_content += token
+        latency = time.perf_counter() - start
 
         # Write finish signal
         writer(
@@ -869,14 +1427,9 @@ class RAG:
             )
         )
 
-        # Store full formatted content (thinking + answer) for UI history
-        thinking_part = (
-            t0_output.split("<|im_start|>answer")[0]
-            if "<|im_start|>answer" in t0_output
-            else t0_output
-        )
-        full_content = thinking_part + "<|im_start|>answer\n" + response_content
-        return {"messages": [AIMessage(content=full_content)]}
+        return self._router_update(state, response_content, ttft, latency) | {
+            "message_token_counts": message_token_counts
+        }
 
     def generate(
         self, state: State | CustomMessagesState, config: RunnableConfig
@@ -932,7 +1485,7 @@ class RAG:
             ]
             # Strip thinking tokens from AI messages for clean context
             conversation_messages = self._clean_messages_for_context(
-                conversation_messages
+                conversation_messages, state.get("cleaned_content")
             )
             if messages_from_prompt.messages[0].type == "system":
                 system_message = messages_from_prompt.messages[0]
@@ -958,20 +1511,30 @@ class RAG:
                 system_message = None
 
         # trim the messages to the max length
-        trimmed_messages = self.trimmer.invoke(messages)
+        trimmed_messages, message_token_counts = self.trim_messages(messages, state)
 
+        start = time.perf_counter()
         if self.budget_forcing:
-            response = self._budget_forcing_invoke(
-                trimmed_messages, config,
-                stream_answer=not self.conversational,
-            )
+            # keep the budget forcing rounds on one replica to reuse its prefix cache
+            with sticky_replica():
+                response = self._budget_forcing_invoke(
+                    trimmed_messages,
+                    config,
+                    stream_answer=not self.conversational,
+                )
         else:
             response = self.llm.invoke(trimmed_messages)
+        t0_latency = time.perf_counter() - start
+        logging.info(f"T0 generation took {t0_latency:.3f} seconds")
 
         if self.conversational:
             return {
                 "system_messages": state.get("system_messages", []) + [system_message],
                 "t0_reasoning": state.get("t0_reasoning", []) + [response.content],
+                "t0_latency": state.get("t0_latency", []) + [t0_latency],
+                "context_token_stats": state.get("context_token_stats", [])
+                + [retriever_response["token_stats"]],
+                "message_token_counts": message_token_counts,
                 "rag_input_messages": state.get("rag_input_messages", [])
                 + [trimmed_messages[-1]],
             }
@@ -980,6 +1543,9 @@ class RAG:
                 "system_messages": state.get("system_messages", []) + [system_message],
                 "messages": state.get("messages", [])
                 + [trimmed_messages[-1], response],
+                "context_token_stats": state.get("context_token_stats", [])
+                + [retriever_response["token_stats"]],
+                "message_token_counts": message_token_counts,
             }
 
     async def agenerate(
@@ -1002,7 +1568,11 @@ class RAG:
         """
         logging.info("Generating answer...")
 
-        retriever_response = self.obtain_context_and_sources(state)
+        # token counting may load a tokenizer or send requests to the LLM
+        # endpoint, so it runs in a thread rather than on the event loop
+        retriever_response = await asyncio.to_thread(
+            self.obtain_context_and_sources, state
+        )
 
         if self.conversational:
             # get last human message
@@ -1035,7 +1605,7 @@ class RAG:
             ]
             # Strip thinking tokens from AI messages for clean context
             conversation_messages = self._clean_messages_for_context(
-                conversation_messages
+                conversation_messages, state.get("cleaned_content")
             )
             if messages_from_prompt.messages[0].type == "system":
                 system_message = messages_from_prompt.messages[0]
@@ -1061,20 +1631,31 @@ class RAG:
                 system_message = None
 
         # trim the messages to the max length
-        trimmed_messages = self.trimmer.invoke(messages)
+        trimmed_messages, message_token_counts = await asyncio.to_thread(
+            self.trim_messages, messages, state
+        )
 
+        start = time.perf_counter()
         if self.budget_forcing:
-            response = await self._budget_forcing_ainvoke(
-                trimmed_messages, config,
-                stream_answer=not self.conversational,
-            )
+            with sticky_replica():
+                response = await self._budget_forcing_ainvoke(
+                    trimmed_messages,
+                    config,
+                    stream_answer=not self.conversational,
+                )
         else:
             response = await self.llm.ainvoke(trimmed_messages)
+        t0_latency = time.perf_counter() - start
+        logging.info(f"T0 generation took {t0_latency:.3f} seconds")
 
         if self.conversational:
             return {
                 "system_messages": state.get("system_messages", []) + [system_message],
                 "t0_reasoning": state.get("t0_reasoning", []) + [response.content],
+                "t0_latency": state.get("t0_latency", []) + [t0_latency],
+                "context_token_stats": state.get("context_token_stats", [])
+                + [retriever_response["token_stats"]],
+                "message_token_counts": message_token_counts,
                 "rag_input_messages": state.get("rag_input_messages", [])
                 + [trimmed_messages[-1]],
             }
@@ -1083,6 +1664,9 @@ class RAG:
                 "system_messages": state.get("system_messages", []) + [system_message],
                 "messages": state.get("messages", [])
                 + [trimmed_messages[-1], response],
+                "context_token_stats": state.get("context_token_stats", [])
+                + [retriever_response["token_stats"]],
+                "message_token_counts": message_token_counts,
             }
 
     def build_graph(self, reset: bool = False) -> CompiledStateGraph:
@@ -1105,7 +1689,7 @@ class RAG:
             )
         graph_builder.add_edge(START, "retrieve")
 
-        if reset:
+        if reset and self.checkpointer is None:
             logging.info("Resetting memory...")
             self.memory = InMemorySaver()
 
@@ -1132,7 +1716,14 @@ class RAG:
         if self.rerank:
             graph_builder.add_node(self.rerank_documents)
         graph_builder.add_node(self.generate)
-        graph_builder.add_node(self.router_respond)
+        # use the async router when the graph is run asynchronously so the
+        # router's response is streamed token by token on both paths
+        graph_builder.add_node(
+            "router_respond",
+            RunnableLambda(
+                self.router_respond, afunc=self.arouter_respond, name="router_respond"
+            ),
+        )
 
         graph_builder.add_edge(START, "query_or_respond")
         graph_builder.add_conditional_edges(
@@ -1149,7 +1740,7 @@ class RAG:
         graph_builder.add_edge("generate", "router_respond")
         graph_builder.add_edge("router_respond", END)
 
-        if reset:
+        if reset and self.checkpointer is None:
             logging.info("Resetting memory...")
             self.memory = InMemorySaver()
 
@@ -1207,13 +1798,76 @@ class RAG:
         else:
             input = {"question": question, "demographics": demographics}
 
-        response = await self.graph.ainvoke(
-            input=input,
-            config={"configurable": {"thread_id": thread_id}},
-        )
+        config = {"configurable": {"thread_id": thread_id}}
+        if self.single_flight is not None:
+            response = await self.single_flight.run(
+                self.single_flight_key(question, demographics),
+                lambda: self.graph.ainvoke(input=input, config=config),
+            )
+            # the response is shared by the coalesced queries
+            return dict(response)
+
+        response = await self.graph.ainvoke(input=input, config=config)
 
         return response
 
+    def single_flight_key(self, question: str, demographics: str | None) -> str:
+        """
+        Key identifying identical non-conversational queries, from the
+        normalised query and the configuration of the models and retriever.
+
+        Parameters
+        ----------
+        question : str
+            The question to ask the RAG.
+        demographics : str | None
+            The demographics of the user.
+
+        Returns
+        -------
+        str
+            The hash of the query and configuration.
+        """
+        data = {
+            "question": " ".join(question.split()),
+            "demographics": " ".join(demographics.split()) if demographics else None,
+            "llm": getattr(self.llm, "model_name", None),
+            "seed": self.seed,
+            "budget_forcing": self.budget_forcing,
+            "budget_forcing_kwargs": self.budget_forcing_kwargs,
+            "rerank": self.rerank,
+            "rerank_k": self.rerank_k,
+            "rerank_method": self.rerank_method,
+            "context_max_tokens": self.context_max_tokens,
+            "retriever_config": self.retriever_config,
+        }
+
+        return hashlib.sha256(
+            json.dumps(data, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def _aquery_stream(
+        self,
+        question: str,
+        thread_id: str = "0",
+        demographics: str | None = None,
+    ) -> AsyncIterator[str]:
+        """
+        Stream the response to a query without blocking the event loop,
+        attaching to an identical in-flight stream if queries are coalesced.
+        """
+        if self.single_flight is not None:
+            return self.single_flight.stream(
+                self.single_flight_key(question, demographics),
+                lambda: self._query_stream(
+                    question, thread_id=thread_id, demographics=demographics
+                ),
+            )
+
+        return aiterate_in_thread(
+            self._query_stream(question, thread_id=thread_id, demographics=demographics)
+        )
+
     def _query_stream(
         self,
         question: str,
@@ -1394,7 +2048,12 @@ class RAG:
 
 
 def load_llm(
-    llm_provider: str, llm_model_name: str, extra_body: dict | str | None = None
+    llm_provider: str,
+    llm_model_name: str,
+    extra_body: dict | str | None = None,
+    http_pool: HTTPClientPool | None = None,
+    response_cache: ResponseCache | None = None,
+    base_urls: list[str] | str | None = None,
 ) -> LLM:
     if not llm_provider:
         raise ValueError(
@@ -1404,6 +2063,10 @@ def load_llm(
         raise ValueError(
             "LLM model name is not specified. Please provide a valid LLM model name."
         )
+    if base_urls and llm_provider not in ("openai", "openai_completion"):
+        raise ValueError(
+            "Base URLs can only be set for the 'openai' and 'openai_completion' providers."
+        )
 
     if llm_provider == "huggingface":
         from t0_1.rag.chat_model import get_huggingface_chat_model
@@ -1413,7 +2076,7 @@ def load_llm(
         from t0_1.rag.chat_model import get_azure_openai_chat_model
 
         llm = get_azure_openai_chat_model(
-            model_name=llm_model_name, extra_body=extra_body
+            model_name=llm_model_name, extra_body=extra_body, http_pool=http_pool
         )
     elif llm_provider == "azure":
         from t0_1.rag.chat_model import get_azure_endpoint_chat_model
@@ -1424,12 +2087,20 @@ def load_llm(
     elif llm_provider == "openai":
         from t0_1.rag.chat_model import get_openai_chat_model
 
-        llm = get_openai_chat_model(model_name=llm_model_name, extra_body=extra_body)
+        llm = get_openai_chat_model(
+            model_name=llm_model_name,
+            extra_body=extra_body,
+            http_pool=http_pool,
+            base_urls=base_urls,
+        )
     elif llm_provider == "openai_completion":
         from t0_1.rag.chat_model import get_openai_completion_model
 
         llm = get_openai_completion_model(
-            model_name=llm_model_name, extra_body=extra_body
+            model_name=llm_model_name,
+            extra_body=extra_body,
+            http_pool=http_pool,
+            base_urls=base_urls,
         )
     else:
         raise ValueError(
@@ -1437,6 +2108,14 @@ def load_llm(
             "'azure_openai', 'azure', 'openai', or 'openai_completion'."
         )
 
+    if response_cache is not None:
+        llm = CachedLLM(
+            llm,
+            cache=response_cache,
+            llm_provider=llm_provider,
+            llm_model_name=llm_model_name,
+        )
+
     return llm
 
 
@@ -1448,6 +2127,7 @@ def build_rag(
     llm_provider: str = "huggingface",
     llm_model_name: str = "Qwen/Qwen2.5-1.5B-Instruct",
     extra_body: dict | str | None = None,
+    llm_base_urls: list[str] | str | None = None,
     conversational: bool = False,
     conversational_agent_llm_provider: str | None = None,
     conversational_agent_llm_model_name: str | None = None,
@@ -1465,24 +2145,60 @@ def build_rag(
     rerank_llm_model_name: str | None = None,
     rerank_extra_body: dict | str | None = None,
     rerank_k: int = 5,
+    rerank_method: str = "llm",
+    cross_encoder_model_name: str = DEFAULT_CROSS_ENCODER_MODEL_NAME,
+    rerank_skip_gap: float | None = None,
+    rerank_skip_ratio: float | None = None,
+    context_max_tokens: int | None = None,
+    context_neighbour_lines: int = 1,
+    max_context_tokens: int = 128000,
+    conversational_agent_max_context_tokens: int | None = None,
+    http_pool_kwargs: dict | str | None = None,
+    response_cache_path: str | Path | None = None,
+    response_cache_only: bool = False,
+    coalesce_queries: bool = False,
+    shared_state_path: str | Path | None = None,
+    mmap_index: bool = False,
     seed: int | None = None,
+    retrieval_snapshot: str | Path | None = None,
 ) -> RAG:
     if budget_forcing and llm_provider != "openai_completion":
         raise ValueError(
             "Budget forcing is only supported for OpenAI completion endpoint."
         )
+    if rerank_method not in ("llm", "cross_encoder"):
+        raise ValueError(
+            f"Unknown rerank method: {rerank_method}. Use 'llm' or 'cross_encoder'."
+        )
 
     # obtain the retriever for RAG
-    retriever = get_parent_doc_retriever(
-        conditions_file=conditions_file,
-        config=config,
-        force_create=force_create,
-        trust_source=trust_source,
-    )
+    if retrieval_snapshot is not None:
+        if conversational:
+            raise ValueError(
+                "A retrieval snapshot cannot be used in conversational mode, "
+                "as the retriever agent rewrites the queries."
+            )
+        from t0_1.rag.retrieval_snapshot import load_snapshot_retriever
+
+        # replay the retrieved documents, without loading the embedding model
+        retriever = load_snapshot_retriever(
+            snapshot_file=retrieval_snapshot,
+            local_file_store=config.local_file_store,
+        )
+    else:
+        retriever = get_parent_doc_retriever(
+            conditions_file=conditions_file,
+            config=config,
+            force_create=force_create,
+            trust_source=trust_source,
+            mmap_index=mmap_index,
+        )
 
     # obtain the prompt template for RAG
     if prompt_template_path is None:
-        prompt_template = hub.pull("rlm/rag-prompt")
+        from t0_1.rag.custom_prompt_template import default_prompt_template
+
+        prompt_template = default_prompt_template()
     else:
         from t0_1.rag.custom_prompt_template import read_prompt_template
 
@@ -1491,11 +2207,27 @@ def build_rag(
             system_prompt_path=system_prompt_path,
         )
 
+    # share pooled HTTP clients across the LLMs served from the same host
+    http_pool = HTTPClientPool(HTTPPoolConfig(**process_arg_to_dict(http_pool_kwargs)))
+
+    # cache the LLM responses on disk, e.g. for reruns of evaluations
+    if response_cache_path is not None:
+        response_cache = ResponseCache(
+            response_cache_path, cache_only=response_cache_only
+        )
+    elif response_cache_only:
+        raise ValueError("A response cache path is needed to only use the cache.")
+    else:
+        response_cache = None
+
     # obtain the LLM for RAG
     llm = load_llm(
         llm_provider=llm_provider,
         llm_model_name=llm_model_name,
         extra_body={"seed": seed} | process_arg_to_dict(extra_body),
+        http_pool=http_pool,
+        response_cache=response_cache,
+        base_urls=llm_base_urls,
     )
 
     if conversational:
@@ -1507,11 +2239,22 @@ def build_rag(
             llm_model_name=conversational_agent_llm_model_name,
             extra_body={"seed": seed}
             | process_arg_to_dict(conversational_agent_extra_body),
+            http_pool=http_pool,
+            response_cache=response_cache,
         )
     else:
         conversational_agent_llm = None
 
-    if rerank:
+    cross_encoder_reranker = None
+    if rerank and rerank_method == "cross_encoder":
+        logging.info("Building RAG with cross-encoder reranking...")
+
+        cross_encoder_reranker = CrossEncoderReranker(
+            model_name=cross_encoder_model_name
+        )
+        rerank_llm = None
+        rerank_prompt_template = None
+    elif rerank:
         logging.info("Building RAG with reranking...")
 
         # obtain the prompt template for reranking
@@ -1531,6 +2274,8 @@ def build_rag(
             llm_provider=rerank_llm_provider,
             llm_model_name=rerank_llm_model_name,
             extra_body={"seed": seed} | process_arg_to_dict(rerank_extra_body),
+            http_pool=http_pool,
+            response_cache=response_cache,
         )
     else:
         rerank_llm = None
@@ -1550,6 +2295,7 @@ def build_rag(
             "model_name": llm_model_name,
             "max_tokens_thinking": 1024,
             "num_stop_skips": 3,
+            "early_stop_answer": True,
         }
         | process_arg_to_dict(budget_forcing_kwargs),
         budget_forcing_tokenizer=budget_forcing_tokenizer,
@@ -1557,7 +2303,124 @@ def build_rag(
         rerank_prompt=rerank_prompt_template,
         rerank_llm=rerank_llm,
         rerank_k=rerank_k,
+        rerank_method=rerank_method,
+        cross_encoder_reranker=cross_encoder_reranker,
+        rerank_skip_gap=rerank_skip_gap,
+        rerank_skip_ratio=rerank_skip_ratio,
+        context_max_tokens=context_max_tokens,
+        context_neighbour_lines=context_neighbour_lines,
+        token_counter=get_token_counter(
+            llm_provider=llm_provider,
+            llm_model_name=llm_model_name,
+            llm=llm,
+            tokenizer_name=budget_forcing_tokenizer,
+        ),
+        max_context_tokens=max_context_tokens,
+        conversational_agent_token_counter=(
+            get_token_counter(
+                llm_provider=conversational_agent_llm_provider,
+                llm_model_name=conversational_agent_llm_model_name,
+                llm=conversational_agent_llm,
+            )
+            if conversational
+            else None
+        ),
+        conversational_agent_max_context_tokens=conversational_agent_max_context_tokens,
+        http_pool=http_pool,
+        response_cache=response_cache,
+        coalesce_queries=coalesce_queries,
+        checkpointer=(
+            SQLiteSaver(shared_state_path) if shared_state_path is not None else None
+        ),
         seed=seed,
+        retriever_config=config,
     )
 
     return rag
+
+
+def reload_rag_retriever(
+    rag: RAG,
+    persist_directory: str | Path,
+    local_file_store: str | Path,
+    trust_source: bool = False,
+    warm_up_query: str = "I have a headache and a high temperature",
+) -> RetrieverConfig:
+    """
+    Load a new retriever index and swap it into a running RAG without downtime.
+
+    The new `persist_directory`/`local_file_store` pair is loaded using the
+    remaining settings of the RAG's current retriever configuration, reusing
+    the already loaded embedding model and text splitter. The new retriever is warmed
+    with a synthetic query before it is swapped in, so the first user request
+    does not pay for cold index and docstore reads. Requests that are
+    already retrieving finish on the old index, after which its memory is
+    released.
+
+    Parameters
+    ----------
+    rag : RAG
+        The RAG whose retriever should be replaced.
+    persist_directory : str | Path
+        Path to the directory where the new vector store is stored.
+    local_file_store : str | Path
+        Path to the directory where the new local file store is stored.
+    trust_source : bool, optional
+        If True, trust the source of the data index. This is needed for loading in FAISS databases.
+        Default is False.
+    warm_up_query : str, optional
+        The query used to warm the new retriever before swapping it in.
+
+    Returns
+    -------
+    RetrieverConfig
+        The configuration of the newly loaded retriever.
+
+    Raises
+    ------
+    FileNotFoundError
+        If either the persist directory or the local file store does not exist.
+    """
+    for path, name in [
+        (persist_directory, "persist_directory"),
+        (local_file_store, "local_file_store"),
+    ]:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"The {name} at '{path}' does not exist.")
+
+    base_config = rag.retriever_config or DEFAULT_RETRIEVER_CONFIG
+    config = replace(
+        base_config,
+        persist_directory=str(persist_directory),
+        local_file_store=str(local_file_store),
+    )
+
+    # only the paths change, so the loaded embedding model and text splitter
+    # can be reused (unless the RAG was built without a known configuration)
+    embedding_model, text_splitter = None, None
+    if rag.retriever_config is not None:
+        embedding_model = rag.retriever.vectorstore.embeddings
+        text_splitter = rag.retriever.child_splitter
+
+    logging.info(
+        f"Hot reloading retriever from '{persist_directory}' and '{local_file_store}'..."
+    )
+    new_retriever = load_parent_doc_retriever(
+        config=config,
+        trust_source=trust_source,
+        embedding_model=embedding_model,
+        text_splitter=text_splitter,
+    )
+
+    logging.info("Warming up the new retriever...")
+    new_retriever.invoke(input=warm_up_query)
+
+    old_retriever = rag.swap_retriever(new_retriever, retriever_config=config)
+    logging.info("Swapped in the new retriever, releasing the old one...")
+
+    # in-flight requests hold their own reference to the old retriever,
+    # so it is only freed once they have finished
+    del old_retriever
+    gc.collect()
+
+    return config
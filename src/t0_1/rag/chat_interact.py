@@ -1,6 +1,7 @@
 from pathlib import Path
 
 from t0_1.rag.build_rag import DEFAULT_RETRIEVER_CONFIG, RetrieverConfig, build_rag
+from t0_1.rag.cross_encoder_reranker import DEFAULT_CROSS_ENCODER_MODEL_NAME
 
 INPUT_PROMPT: str = ">>> "
 EXIT_STRS: set[str] = {"exit", "exit()", "quit()", "bye"}
@@ -20,6 +21,7 @@ async def run_chat_interact(
     prompt_template_path: str | None = None,
     system_prompt_path: str | None = None,
     extra_body: dict | str | None = None,
+    llm_base_urls: list[str] | str | None = None,
     budget_forcing: bool = False,
     budget_forcing_kwargs: dict | str | None = None,
     budget_forcing_tokenizer: str | None = None,
@@ -29,6 +31,15 @@ async def run_chat_interact(
     rerank_llm_model_name: str | None = None,
     rerank_extra_body: dict | str | None = None,
     rerank_k: int = 5,
+    rerank_method: str = "llm",
+    cross_encoder_model_name: str = DEFAULT_CROSS_ENCODER_MODEL_NAME,
+    rerank_skip_gap: float | None = None,
+    rerank_skip_ratio: float | None = None,
+    context_max_tokens: int | None = None,
+    context_neighbour_lines: int = 1,
+    max_context_tokens: int = 128000,
+    conversational_agent_max_context_tokens: int | None = None,
+    http_pool_kwargs: dict | str | None = None,
     seed: int | None = None,
 ):
     rag = build_rag(
@@ -39,6 +50,7 @@ async def run_chat_interact(
         llm_provider=llm_provider,
         llm_model_name=llm_model_name,
         extra_body=extra_body,
+        llm_base_urls=llm_base_urls,
         conversational=conversational,
         conversational_agent_llm_provider=conversational_agent_llm_provider,
         conversational_agent_llm_model_name=conversational_agent_llm_model_name,
@@ -54,6 +66,15 @@ async def run_chat_interact(
         rerank_llm_model_name=rerank_llm_model_name,
         rerank_extra_body=rerank_extra_body,
         rerank_k=rerank_k,
+        rerank_method=rerank_method,
+        cross_encoder_model_name=cross_encoder_model_name,
+        rerank_skip_gap=rerank_skip_gap,
+        rerank_skip_ratio=rerank_skip_ratio,
+        context_max_tokens=context_max_tokens,
+        context_neighbour_lines=context_neighbour_lines,
+        max_context_tokens=max_context_tokens,
+        conversational_agent_max_context_tokens=conversational_agent_max_context_tokens,
+        http_pool_kwargs=http_pool_kwargs,
         seed=seed,
     )
     thread_id = "command_line_chat"
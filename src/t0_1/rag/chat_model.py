@@ -3,9 +3,51 @@ import logging
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.language_models.llms import BaseLLM
 
+from t0_1.rag.load_balancer import parse_base_urls
 from t0_1.utils import get_environment_variable, process_arg_to_dict
 
 
+def http_client_kwargs(http_pool, base_url: str | list[str] | None) -> dict:
+    """
+    Keyword arguments to make an OpenAI client use the shared HTTP clients
+    (and timeouts) of the pool for the host of the base URL.
+
+    If several base URLs are given, the clients balance the requests over
+    them (see `LoadBalancer`) and the OpenAI client should use the first
+    base URL.
+
+    Parameters
+    ----------
+    http_pool : HTTPClientPool | None
+        The pool of shared HTTP clients. If None, the client's own
+        HTTP clients are used.
+    base_url : str | list[str] | None
+        The base URL of the endpoint, or the base URLs of its replicas.
+
+    Returns
+    -------
+    dict
+        The `http_client`, `http_async_client` and `timeout` arguments.
+    """
+    if http_pool is None or base_url is None:
+        return {}
+
+    if isinstance(base_url, list):
+        if len(base_url) > 1:
+            return {
+                "http_client": http_pool.get_load_balanced_client(base_url),
+                "http_async_client": http_pool.get_load_balanced_async_client(base_url),
+                "timeout": http_pool.timeout,
+            }
+        base_url = base_url[0]
+
+    return {
+        "http_client": http_pool.get_client(base_url),
+        "http_async_client": http_pool.get_async_client(base_url),
+        "timeout": http_pool.timeout,
+    }
+
+
 def get_huggingface_chat_model(
     method: str, model_name: str, task: str = "text-generation", **kwargs
 ) -> BaseChatModel:
@@ -59,6 +101,7 @@ def get_azure_openai_chat_model(
     model_name: str,
     api_version: str = "2025-01-01-preview",
     extra_body: dict | str | None = None,
+    http_pool=None,
 ) -> BaseChatModel:
     """
     Get an Azure OpenAI chat model based on the specified model name and API version.
@@ -77,6 +120,8 @@ def get_azure_openai_chat_model(
     extra_body : dict | str | None, optional
         Additional body parameters to pass to the chat completions API.
         If a string is provided, it will be converted to a dictionary.
+    http_pool : HTTPClientPool | None, optional
+        The pool of shared HTTP clients to use. Default is None.
 
     Returns
     -------
@@ -98,6 +143,7 @@ def get_azure_openai_chat_model(
         azure_endpoint=azure_openai_endpoint,
         api_version=api_version,
         extra_body=process_arg_to_dict(extra_body),
+        **http_client_kwargs(http_pool, azure_openai_endpoint),
     )
 
     return llm
@@ -145,6 +191,8 @@ def get_azure_endpoint_chat_model(
 def get_openai_chat_model(
     model_name: str,
     extra_body: dict | str | None = None,
+    http_pool=None,
+    base_urls: list[str] | str | None = None,
 ) -> BaseChatModel:
     from langchain_openai import ChatOpenAI
 
@@ -152,12 +200,19 @@ def get_openai_chat_model(
     logging.info(f"Extra body to pass to chat/completions: {extra_body}")
 
     api_key = get_environment_variable("OPENAI_API_KEY", model_name)
-    base_url = get_environment_variable("OPENAI_BASE_URL", model_name)
+    base_urls = parse_base_urls(
+        base_urls or get_environment_variable("OPENAI_BASE_URL", model_name)
+    )
+    if len(base_urls) > 1 and http_pool is None:
+        from t0_1.rag.http_pool import HTTPClientPool
+
+        http_pool = HTTPClientPool()
     llm = ChatOpenAI(
         model=model_name,
         api_key=api_key,
-        base_url=base_url,
+        base_url=base_urls[0],
         extra_body=process_arg_to_dict(extra_body),
+        **http_client_kwargs(http_pool, base_urls),
     )
 
     return llm
@@ -166,6 +221,8 @@ def get_openai_chat_model(
 def get_openai_completion_model(
     model_name: str,
     extra_body: dict | str | None = None,
+    http_pool=None,
+    base_urls: list[str] | str | None = None,
 ) -> BaseLLM:
     from langchain_openai import OpenAI
 
@@ -173,12 +230,19 @@ def get_openai_completion_model(
     logging.info(f"Extra body to pass to completions: {extra_body}")
 
     api_key = get_environment_variable("OPENAI_API_KEY", model_name)
-    base_url = get_environment_variable("OPENAI_BASE_URL", model_name)
+    base_urls = parse_base_urls(
+        base_urls or get_environment_variable("OPENAI_BASE_URL", model_name)
+    )
+    if len(base_urls) > 1 and http_pool is None:
+        from t0_1.rag.http_pool import HTTPClientPool
+
+        http_pool = HTTPClientPool()
     llm = OpenAI(
         model=model_name,
         api_key=api_key,
-        base_url=base_url,
+        base_url=base_urls[0],
         extra_body=process_arg_to_dict(extra_body),
+        **http_client_kwargs(http_pool, base_urls),
     )
 
     return llm
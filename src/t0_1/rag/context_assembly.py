@@ -0,0 +1,192 @@
+import logging
+import re
+from typing import Callable
+
+from langchain_core.documents import Document
+
+# number of consecutive words used to locate a chunk in its parent page
+ANCHOR_SIZE = 5
+# lines with at most this many words and no terminal punctuation are
+# treated as section headers of the NHS pages, unless they are list items
+MAX_HEADER_WORDS = 10
+_LIST_MARKER = re.compile(r"^([-*+•]|\d+[.)])\s")
+
+
+def _words(text: str) -> list[str]:
+    # the chunks are decoded from the text splitter's tokens, so compare on
+    # lowercased alphanumeric words rather than the raw text
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def _is_header(line: str) -> bool:
+    line = line.strip()
+    return (
+        0 < len(line.split()) <= MAX_HEADER_WORDS
+        and not line.endswith((".", ",", ";", "!", "?"))
+        and not _LIST_MARKER.match(line)
+    )
+
+
+def match_chunk_lines(page_lines: list[str], chunk: str) -> list[int]:
+    """
+    Find the lines of a parent page that a retrieved chunk was split from.
+
+    The chunk is located by matching runs of its words against the words of
+    the page, as the chunk text is not an exact substring of the page
+    (the text splitter decodes it from tokens).
+
+    Parameters
+    ----------
+    page_lines : list[str]
+        The lines of the parent page.
+    chunk : str
+        The text of the retrieved chunk.
+
+    Returns
+    -------
+    list[int]
+        The indices of the lines covered by the chunk, or an empty list
+        if the chunk could not be located in the page.
+    """
+    page_words, word_lines = [], []
+    for i, line in enumerate(page_lines):
+        line_words = _words(line)
+        page_words += line_words
+        word_lines += [i] * len(line_words)
+
+    chunk_words = _words(chunk)
+    size = min(ANCHOR_SIZE, len(chunk_words))
+    if size == 0:
+        return []
+
+    anchors = {}
+    for pos in range(len(page_words) - size + 1):
+        anchors.setdefault(tuple(page_words[pos : pos + size]), pos)
+
+    # try anchors along the chunk in case the start was decoded differently
+    for offset in range(0, len(chunk_words) - size + 1, size):
+        pos = anchors.get(tuple(chunk_words[offset : offset + size]))
+        if pos is not None:
+            start = max(pos - offset, 0)
+            end = min(start + len(chunk_words), len(page_words))
+            return sorted(set(word_lines[start:end]))
+
+    return []
+
+
+def assemble_context(
+    documents: list[Document],
+    max_tokens: int,
+    count_tokens: Callable[[str], int],
+    neighbour_lines: int = 1,
+    section_headers: bool = True,
+) -> tuple[list[str], dict[str, int]]:
+    """
+    Assemble the content of the retrieved documents within a token budget.
+
+    Rather than using the full parent pages, the lines of each page covered by
+    its retrieved chunks (the `sub_docs` attached by the
+    CustomParentDocumentRetriever) are selected, best scoring chunks first
+    (lower scores are better), along with their neighbouring lines and the
+    section header they fall under, until the budget is used up.
+
+    Parameters
+    ----------
+    documents : list[Document]
+        The retrieved (parent) documents.
+    max_tokens : int
+        The maximum number of tokens of the assembled content of all documents.
+    count_tokens : Callable[[str], int]
+        Function to count the tokens of a text.
+    neighbour_lines : int, optional
+        Number of lines before and after each chunk to include. By default 1.
+    section_headers : bool, optional
+        Whether to include the section header above each chunk. By default True.
+
+    Returns
+    -------
+    tuple[list[str], dict[str, int]]
+        The assembled content of each document and the token statistics
+        ("full_tokens", "assembled_tokens" and "saved_tokens").
+    """
+    pages = [doc.page_content.split("\n") for doc in documents]
+    line_tokens = [[None] * len(lines) for lines in pages]
+    selected = [set() for _ in documents]
+    # chunks that could not be located in their page are used as they are
+    unmatched = [[] for _ in documents]
+
+    def _cost(doc_idx: int, lines: set[int]) -> int:
+        cost = 0
+        for i in lines - selected[doc_idx]:
+            if line_tokens[doc_idx][i] is None:
+                line_tokens[doc_idx][i] = count_tokens(pages[doc_idx][i])
+            cost += line_tokens[doc_idx][i]
+        return cost
+
+    chunks = sorted(
+        [
+            (float(sub_doc.metadata.get("score", 0.0)), doc_idx, sub_doc.page_content)
+            for doc_idx, doc in enumerate(documents)
+            for sub_doc in doc.metadata.get("sub_docs", [])
+        ],
+        key=lambda x: x[0],
+    )
+
+    remaining = max_tokens
+    for _, doc_idx, chunk in chunks:
+        lines = pages[doc_idx]
+        chunk_lines = match_chunk_lines(lines, chunk)
+        if not chunk_lines:
+            logging.debug(
+                f"Could not locate chunk in {documents[doc_idx].metadata.get('source')}"
+            )
+            cost = count_tokens(chunk)
+            if cost <= remaining:
+                unmatched[doc_idx].append(chunk)
+                remaining -= cost
+            continue
+
+        core = set(chunk_lines)
+        # the first line of the chunk is already included, so look above it
+        # unless the chunk starts with its own header
+        if section_headers and not _is_header(lines[chunk_lines[0]]):
+            header = next(
+                (i for i in range(chunk_lines[0] - 1, -1, -1) if _is_header(lines[i])),
+                None,
+            )
+            if header is not None:
+                core.add(header)
+        extended = core | {
+            i
+            for line in chunk_lines
+            for i in range(line - neighbour_lines, line + neighbour_lines + 1)
+            if 0 <= i < len(lines)
+        }
+
+        # fall back to the chunk without its neighbours if it does not fit
+        for candidate in (extended, core):
+            cost = _cost(doc_idx, candidate)
+            if cost <= remaining:
+                selected[doc_idx] |= candidate
+                remaining -= cost
+                break
+
+    contents = []
+    for doc_idx, lines in enumerate(pages):
+        excerpt, previous = [], None
+        for i in sorted(selected[doc_idx]):
+            if previous is not None and i > previous + 1:
+                excerpt.append("...")
+            excerpt.append(lines[i])
+            previous = i
+        contents.append("\n".join(excerpt + unmatched[doc_idx]))
+
+    full_tokens = sum(count_tokens(doc.page_content) for doc in documents)
+    assembled_tokens = max_tokens - remaining
+    stats = {
+        "full_tokens": full_tokens,
+        "assembled_tokens": assembled_tokens,
+        "saved_tokens": full_tokens - assembled_tokens,
+    }
+
+    return contents, stats
@@ -0,0 +1,146 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from langchain_core.documents import Document
+
+DEFAULT_CROSS_ENCODER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+class CrossEncoderReranker:
+    def __init__(
+        self,
+        model_name: str = DEFAULT_CROSS_ENCODER_MODEL_NAME,
+        batch_size: int = 32,
+        device: str = "cpu",
+        max_cache_size: int = 10000,
+        model=None,
+    ):
+        """
+        Rerank retrieved documents by scoring (query, chunk) pairs with a
+        sentence-transformers cross-encoder.
+
+        Each parent document is scored by the best scoring of its retrieved
+        chunks (the `sub_docs` attached by the CustomParentDocumentRetriever).
+        Scores are cached per (query, doc_id) so repeated queries (e.g. in
+        evaluation reruns or conversational follow ups) are not re-scored.
+
+        Parameters
+        ----------
+        model_name : str, optional
+            The name of the cross-encoder model to use.
+            Default is "cross-encoder/ms-marco-MiniLM-L-6-v2".
+        batch_size : int, optional
+            The number of (query, chunk) pairs to score per forward pass.
+            Default is 32.
+        device : str, optional
+            The device to run the cross-encoder on. Default is "cpu".
+        max_cache_size : int, optional
+            The maximum number of (query, doc_id) scores to keep in the cache.
+            Default is 10000.
+        model : optional
+            An already loaded model with a `predict` method. If None, the model
+            is loaded lazily on first use. Default is None.
+        """
+        self.model_name: str = model_name
+        self.batch_size: int = batch_size
+        self.device: str = device
+        self.max_cache_size: int = max_cache_size
+        self._model = model
+        self._cache: OrderedDict[tuple[str, str], float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            from sentence_transformers import CrossEncoder
+
+            logging.info(f"Loading cross-encoder model: {self.model_name}")
+            self._model = CrossEncoder(self.model_name, device=self.device)
+
+        return self._model
+
+    @staticmethod
+    def _doc_id(document: Document) -> str:
+        sub_docs = document.metadata.get("sub_docs") or []
+        if sub_docs and sub_docs[0].metadata.get("doc_id"):
+            return sub_docs[0].metadata["doc_id"]
+
+        return document.metadata["source"]
+
+    @staticmethod
+    def _chunks(document: Document) -> list[str]:
+        sub_docs = document.metadata.get("sub_docs") or []
+        return [sub_doc.page_content for sub_doc in sub_docs] or [document.page_content]
+
+    def score_documents(self, query: str, documents: list[Document]) -> list[float]:
+        """
+        Score the documents for the query, using cached scores where available.
+
+        Parameters
+        ----------
+        query : str
+            The query to score the documents against.
+        documents : list[Document]
+            The retrieved (parent) documents to score.
+
+        Returns
+        -------
+        list[float]
+            The score of each document (higher is more relevant).
+        """
+        keys = [(query, self._doc_id(doc)) for doc in documents]
+        with self._lock:
+            scores = {key: self._cache[key] for key in keys if key in self._cache}
+
+        # batch all the chunks of the uncached documents into a single predict call
+        pairs, owners = [], []
+        for key, doc in zip(keys, documents):
+            if key in scores:
+                continue
+            for chunk in self._chunks(doc):
+                pairs.append((query, chunk))
+                owners.append(key)
+
+        if pairs:
+            logging.info(
+                f"Scoring {len(pairs)} (query, chunk) pairs with cross-encoder"
+            )
+            pair_scores = self.model.predict(pairs, batch_size=self.batch_size)
+            for key, score in zip(owners, pair_scores):
+                scores[key] = max(float(score), scores.get(key, float("-inf")))
+
+            with self._lock:
+                for key in set(owners):
+                    self._cache[key] = scores[key]
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.max_cache_size:
+                    self._cache.popitem(last=False)
+
+        return [scores[key] for key in keys]
+
+    def rerank(
+        self, query: str, documents: list[Document], k: int
+    ) -> list[tuple[Document, float]]:
+        """
+        Rerank the documents for the query and return the top k.
+
+        Parameters
+        ----------
+        query : str
+            The query to rerank the documents for.
+        documents : list[Document]
+            The retrieved (parent) documents to rerank.
+        k : int
+            The number of documents to return.
+
+        Returns
+        -------
+        list[tuple[Document, float]]
+            The top k documents and their cross-encoder scores,
+            ordered from most to least relevant.
+        """
+        scores = self.score_documents(query, documents)
+        ranked = sorted(zip(documents, scores), key=lambda x: x[1], reverse=True)
+
+        return ranked[:k]
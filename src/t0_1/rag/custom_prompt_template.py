@@ -8,6 +8,31 @@ from langchain_core.prompts import (
     PromptTemplate,
 )
 
+# the "rlm/rag-prompt" prompt of the LangChain hub, vendored so that building
+# the RAG does not pull it over the network
+DEFAULT_RAG_PROMPT = (
+    "You are an assistant for question-answering tasks. Use the following pieces "
+    "of retrieved context to answer the question. If you don't know the answer, "
+    "just say that you don't know. Use three sentences maximum and keep the "
+    "answer concise.\nQuestion: {question} \nContext: {context} \nAnswer:"
+)
+
+
+def default_prompt_template() -> ChatPromptTemplate:
+    """
+    Return the default RAG prompt template, used when no prompt template
+    file is given.
+
+    Returns
+    -------
+    ChatPromptTemplate
+        The prompt template.
+    """
+    message = HumanMessagePromptTemplate(
+        prompt=PromptTemplate.from_template(DEFAULT_RAG_PROMPT)
+    )
+    return ChatPromptTemplate.from_messages([message])
+
 
 def read_prompt_template(
     prompt_template_path: str | Path, system_prompt_path: str | Path | None = None
@@ -4,6 +4,7 @@ import logging
 import uuid
 from pathlib import Path
 
+from langchain_core.messages import BaseMessage
 from langchain_core.tools import tool
 from tqdm.asyncio import tqdm_asyncio
 
@@ -12,7 +13,10 @@ from t0_1.rag.build_rag import (
     RAG,
     RetrieverConfig,
     build_rag,
+    retrieval_score_margin,
 )
+from t0_1.rag.cross_encoder_reranker import DEFAULT_CROSS_ENCODER_MODEL_NAME
+from t0_1.rag.utils import S1_ANSWER_DELIMITER, S1_ANSWER_PATTERN
 from t0_1.utils import read_jsonl, timestamp_file_name
 
 FILE_WRITE_LOCK = asyncio.Lock()
@@ -97,13 +101,11 @@ def parse_s1(string: str) -> tuple[str]:
     tuple[str]
         A tuple containing the condition and severity level.
     """
-    import re
-
     # split the string into two parts: before and after the reasoning
-    string_after_answer = string.split("<|im_start|>answer")[-1]
+    string_after_answer = string.split(S1_ANSWER_DELIMITER)[-1]
 
     # extract the condition and severity level using regex
-    match = re.search(r"\(([^)]*), ([^)]+)\)", string_after_answer)
+    match = S1_ANSWER_PATTERN.search(string_after_answer)
     if match:
         condition = match.group(1).strip().strip('"')
         severity_level = match.group(2).strip().strip('"')
@@ -112,6 +114,115 @@ def parse_s1(string: str) -> tuple[str]:
         return "", ""
 
 
+def parse_response(
+    message: BaseMessage, deepseek_r1: bool = False, s1: bool = False
+) -> tuple[str, str]:
+    """
+    Extract the predicted condition and severity level from the response of
+    the model, using the deepseek-R1 or s1 parsers, or the arguments of its
+    `submit_condition_recommendation` tool call otherwise.
+
+    Parameters
+    ----------
+    message : BaseMessage
+        The response of the model.
+    deepseek_r1 : bool, optional
+        If True, parse the response with `parse_deepseek_r1`. By default False.
+    s1 : bool, optional
+        If True, parse the response with `parse_s1`. By default False.
+
+    Returns
+    -------
+    tuple[str, str]
+        The condition and severity level, or empty strings if they could not
+        be extracted.
+    """
+    if deepseek_r1:
+        logging.info("Using deepseek-r1 parser for evaluation.")
+        return parse_deepseek_r1(message.content)
+    if s1:
+        logging.info("Using s1 parser for evaluation.")
+        return parse_s1(message.content)
+
+    logging.info("Using tool calls for evaluation.")
+    tool_calls = message.additional_kwargs.get("tool_calls")
+    if tool_calls is None or len(tool_calls) != 1:
+        return "", ""
+
+    arguments = json.loads(tool_calls[0]["function"]["arguments"])
+    return arguments.get("condition") or "", arguments.get("severity_level") or ""
+
+
+def score_response(
+    res: dict,
+    parsed_condition: str,
+    parsed_severity_level: str,
+    target_document: str,
+    target_severity_level: str,
+) -> dict:
+    """
+    Score the parsed prediction of a query against its target condition and
+    severity level, and the retrieved documents against the target document.
+
+    Parameters
+    ----------
+    res : dict
+        The results of the query, with the "retrieved_documents_sources" and
+        "reranked_documents_sources".
+    parsed_condition : str
+        The predicted condition (see `parse_response`).
+    parsed_severity_level : str
+        The predicted severity level (see `parse_response`).
+    target_document : str
+        The target condition.
+    target_severity_level : str
+        The target severity level.
+
+    Returns
+    -------
+    dict
+        The match fields of the results of the query.
+    """
+    scores = {
+        "conditions_match": bool(parsed_condition)
+        and remove_dash_and_spaces(parsed_condition)
+        == remove_dash_and_spaces(target_document),
+        "severity_match": bool(parsed_severity_level)
+        and parsed_severity_level.lower() == target_severity_level.lower(),
+        # check for match between the source of the retrieved documents and the target document source
+        "retriever_match": target_document in set(res["retrieved_documents_sources"]),
+        "reranked_retriever_match": target_document
+        in set(res["reranked_documents_sources"]),
+        "parsed_condition": parsed_condition,
+        "parsed_severity_level": parsed_severity_level,
+    }
+
+    if parsed_condition == "inconclusive":
+        # if model said inconclusive, then it is correct if the target document
+        # is not in the retrieved documents
+        if res["reranked_documents_sources"]:
+            # we used reranking so need to check the reranked documents
+            scores["conditions_match"] = not scores["reranked_retriever_match"]
+        else:
+            scores["conditions_match"] = not scores["retriever_match"]
+
+    return scores
+
+
+def log_match_proportions(results: list[dict]) -> None:
+    """Log the proportions of retriever, condition and severity matches."""
+    for name, field in [
+        ("retriever matches", "retriever_match"),
+        ("reranked retriever matches", "reranked_retriever_match"),
+        ("condition matches", "conditions_match"),
+        ("severity matches", "severity_match"),
+    ]:
+        match_sum = sum([res[field] for res in results])
+        logging.info(
+            f"Proportion of {name}: {match_sum}/{len(results)} = {match_sum / len(results):.2%}"
+        )
+
+
 async def process_query(
     item: dict,
     query_field: str,
@@ -148,69 +259,9 @@ async def process_query(
             logging.info(f"Deleted thread_id {thread_id} after query")
 
         if not generate_only:
-            if deepseek_r1:
-                logging.info("Using deepseek-r1 parser for evaluation.")
-                # extract condition and severity level from the response
-                parsed_condition, parsed_severity_level = parse_deepseek_r1(
-                    response["messages"][-1].content
-                )
-                prediction_condition = remove_dash_and_spaces(parsed_condition)
-                target_condition = remove_dash_and_spaces(target_document)
-                conditions_match = prediction_condition == target_condition
-                severity_match = (
-                    parsed_severity_level.lower() == item["severity_level"].lower()
-                )
-            elif s1:
-                logging.info("Using s1 parser for evaluation.")
-                # extract condition and severity level from the response
-                parsed_condition, parsed_severity_level = parse_s1(
-                    response["messages"][-1].content
-                )
-                prediction_condition = remove_dash_and_spaces(parsed_condition)
-                target_condition = remove_dash_and_spaces(target_document)
-                conditions_match = prediction_condition == target_condition
-                severity_match = (
-                    parsed_severity_level.lower() == item["severity_level"].lower()
-                )
-            else:
-                logging.info("Using tool calls for evaluation.")
-                if (
-                    response["messages"][-1].additional_kwargs.get("tool_calls")
-                    is not None
-                    and len(response["messages"][-1].additional_kwargs["tool_calls"])
-                    == 1
-                ):
-                    arguments = json.loads(
-                        response["messages"][-1].additional_kwargs["tool_calls"][0][
-                            "function"
-                        ]["arguments"]
-                    )
-
-                    if arguments.get("condition") is not None:
-                        parsed_condition = arguments["condition"]
-                        prediction_condition = remove_dash_and_spaces(
-                            arguments["condition"]
-                        )
-                        target_condition = remove_dash_and_spaces(target_document)
-                        conditions_match = prediction_condition == target_condition
-                    else:
-                        parsed_condition = ""
-                        conditions_match = False
-
-                    if arguments.get("severity_level") is not None:
-                        parsed_severity_level = arguments["severity_level"]
-                        severity_match = (
-                            arguments["severity_level"].lower()
-                            == item["severity_level"].lower()
-                        )
-                    else:
-                        parsed_severity_level = ""
-                        severity_match = False
-                else:
-                    conditions_match = False
-                    severity_match = False
-                    parsed_condition = ""
-                    parsed_severity_level = ""
+            parsed_condition, parsed_severity_level = parse_response(
+                response["messages"][-1], deepseek_r1=deepseek_r1, s1=s1
+            )
 
         # create dictionary to store the results
         retrieved_docs_scores = [
@@ -246,6 +297,9 @@ async def process_query(
                 "reranker_response_processed", [[]]
             )[-1],
             "reranker_success": response.get("reranker_success", [[]])[-1],
+            "reranker_skipped": response.get("reranker_skipped", [None])[-1],
+            "reranker_latency": response.get("reranker_latency", [None])[-1],
+            "context_token_stats": response.get("context_token_stats", [None])[-1],
             "system_prompt": response["system_messages"][0].content,
             "rag_message": (
                 response["rag_input_messages"][0].content
@@ -287,39 +341,28 @@ async def process_query(
             "reranker_response": None,
             "reranker_response_processed": None,
             "reranker_success": None,
+            "reranker_skipped": None,
+            "reranker_latency": None,
             "error": error_as_str,
         }
 
-        conditions_match = False
-        severity_match = False
         parsed_condition = ""
         parsed_severity_level = ""
 
-    if not generate_only:
-        res["conditions_match"] = conditions_match
-        res["severity_match"] = severity_match
-
-        # check for match between the source of the retrieved documents and the target document source
-        res["retriever_match"] = target_document in set(
-            res["retrieved_documents_sources"]
-        )
-        res["reranked_retriever_match"] = target_document in set(
-            res["reranked_documents_sources"]
+    # record how confident the retrieval was to allow simulating reranker skipping
+    if rag.rerank:
+        res["retrieval_score_gap"], res["retrieval_score_ratio"] = (
+            retrieval_score_margin(res["retrieved_documents_scores"], k=rag.rerank_k)
         )
 
-        res["parsed_condition"] = parsed_condition
-        res["parsed_severity_level"] = parsed_severity_level
-
-        if parsed_condition == "inconclusive":
-            # if model said inconclusive, then it is correct if the target document
-            # is not in the retrieved documents
-            if res["reranked_documents_sources"]:
-                # we used reranking so need to check the reranked documents
-                res["conditions_match"] = not res[
-                    "reranked_retriever_match"
-                ]  # i.e. False if res["reranked_retreiver_match"] else True
-            else:
-                res["conditions_match"] = not res["retriever_match"]
+    if not generate_only:
+        res |= score_response(
+            res,
+            parsed_condition=parsed_condition,
+            parsed_severity_level=parsed_severity_level,
+            target_document=target_document,
+            target_severity_level=item["severity_level"],
+        )
 
     # write the results to the output file
     async with FILE_WRITE_LOCK:
@@ -331,6 +374,95 @@ async def process_query(
     return res
 
 
+def rerank_skip_tradeoff(
+    results: list[dict],
+    k: int,
+    metric: str = "gap",
+    thresholds: list[float] | None = None,
+) -> list[dict]:
+    """
+    Simulate the accuracy and latency of skipping the reranker at different
+    confidence thresholds from the results of a single evaluation run.
+
+    A query is simulated as skipped if its retrieval score `metric` (see
+    `retrieval_score_margin`) is at least the threshold, or if reranking was
+    already skipped during the run. Skipped queries use the top k retrieved
+    documents and no reranker latency; the others use the recorded reranker
+    output and latency. The baseline (a threshold of None) skips no queries:
+    queries skipped during the run have no reranker output, so they keep
+    their top k retrieved documents.
+
+    Parameters
+    ----------
+    results : list[dict]
+        The evaluation results, as returned by `process_query`.
+    k : int
+        The number of documents selected by the reranker.
+    metric : str, optional
+        The retrieval score margin to threshold, either "gap" or "ratio".
+        By default "gap".
+    thresholds : list[float] | None, optional
+        The thresholds to simulate. If None, uses the 10th, 25th, 50th, 75th
+        and 90th percentiles of the observed values. By default None.
+
+    Returns
+    -------
+    list[dict]
+        For each threshold (None meaning never skip), the skip rate, the rate of
+        the target document being in the selected documents, the rate of the
+        reranker agreeing with the top k retrieved documents on skipped queries,
+        and the mean reranker latency per query.
+    """
+    if metric not in ("gap", "ratio"):
+        raise ValueError(f"Unknown metric: {metric}. Use 'gap' or 'ratio'.")
+
+    key = f"retrieval_score_{metric}"
+    if thresholds is None:
+        values = sorted(res[key] for res in results if res.get(key) is not None)
+        thresholds = sorted(
+            {values[int(q * (len(values) - 1))] for q in [0.1, 0.25, 0.5, 0.75, 0.9]}
+            if values
+            else set()
+        )
+
+    tradeoff = []
+    for threshold in [None] + list(thresholds):
+        skipped, matches, agreements, latency = 0, 0, 0, 0.0
+        for res in results:
+            value = res.get(key)
+            top_k = res["retrieved_documents_sources"][:k]
+            # the baseline never skips, so queries skipped during the run count
+            # as reranked, keeping their top k retrieved documents
+            skip = threshold is not None and (
+                bool(res.get("reranker_skipped"))
+                or (value is not None and value >= threshold)
+            )
+            if skip:
+                skipped += 1
+                selected = top_k
+                agreements += set(res["reranked_documents_sources"] or top_k) == set(
+                    top_k
+                )
+            else:
+                selected = res["reranked_documents_sources"] or top_k
+                latency += res.get("reranker_latency") or 0.0
+
+            matches += res[res["target_document_field"]] in set(selected)
+
+        tradeoff.append(
+            {
+                "metric": metric,
+                "threshold": threshold,
+                "skip_rate": skipped / len(results) if results else 0.0,
+                "retriever_match_rate": matches / len(results) if results else 0.0,
+                "skip_agreement_rate": agreements / skipped if skipped else 0.0,
+                "mean_reranker_latency": latency / len(results) if results else 0.0,
+            }
+        )
+
+    return tradeoff
+
+
 async def evaluate_rag(
     input_file: str | Path,
     output_file: str | Path,
@@ -390,6 +522,9 @@ async def evaluate_rag(
     logging.info(f"Target document field: {target_document_field}")
 
     request_interval = 60 / max_queries_per_minute
+    if rag.response_cache is not None and rag.response_cache.cache_only:
+        # responses are served from the cache so no requests are sent to the LLMs
+        request_interval = 0
     logging.info(f"Request interval: {request_interval} seconds")
 
     tasks = []
@@ -425,27 +560,31 @@ async def evaluate_rag(
     logging.info("All tasks completed.")
 
     if not generate_only:
-        # calculate sums
-        retriever_match_sum = sum([res["retriever_match"] for res in results])
-        reranked_retriever_match_sum = sum(
-            [res["reranked_retriever_match"] for res in results]
-        )
-        conditions_sum = sum([res["conditions_match"] for res in results])
-        severity_sum = sum([res["severity_match"] for res in results])
+        log_match_proportions(results)
 
+        if rag.rerank:
+            skipped_sum = sum([bool(res.get("reranker_skipped")) for res in results])
+            logging.info(
+                f"Proportion of queries where reranking was skipped: {skipped_sum}/{len(data)} = {skipped_sum / len(data):.2%}"
+            )
+            for metric in ["gap", "ratio"]:
+                for row in rerank_skip_tradeoff(results, k=rag.rerank_k, metric=metric):
+                    logging.info(
+                        f"Rerank skip {metric} >= {row['threshold']}: "
+                        f"skipped {row['skip_rate']:.2%}, "
+                        f"reranked retriever matches {row['retriever_match_rate']:.2%}, "
+                        f"reranker agreement on skipped {row['skip_agreement_rate']:.2%}, "
+                        f"mean reranker latency {row['mean_reranker_latency']:.3f}s"
+                    )
+
+    if rag.response_cache is not None:
+        cache_stats = rag.response_cache.stats()
         logging.info(
-            f"Proportion of retriever matches: {retriever_match_sum}/{len(data)} = {retriever_match_sum / len(data):.2%}"
-        )
-        logging.info(
-            f"Proportion of reranked retriever matches: {reranked_retriever_match_sum}/{len(data)} = {reranked_retriever_match_sum / len(data):.2%}"
-        )
-        logging.info(
-            f"Proportion of condition matches: {conditions_sum}/{len(data)} = {conditions_sum / len(data):.2%}"
-        )
-        logging.info(
-            f"Proportion of severity matches: {severity_sum}/{len(data)} = {severity_sum / len(data):.2%}"
+            f"LLM response cache hits: {cache_stats['hits']}, misses: {cache_stats['misses']}"
         )
 
+    return results
+
 
 def main(
     input_file: str | Path,
@@ -460,6 +599,7 @@ def main(
     llm_provider: str = "huggingface",
     llm_model_name: str = "Qwen/Qwen2.5-1.5B-Instruct",
     extra_body: dict | str | None = None,
+    llm_base_urls: list[str] | str | None = None,
     conversational: bool = False,
     conversational_agent_llm_provider: str | None = None,
     conversational_agent_llm_model_name: str | None = None,
@@ -476,8 +616,21 @@ def main(
     rerank_llm_model_name: str | None = None,
     rerank_extra_body: dict | str | None = None,
     rerank_k: int = 5,
+    rerank_method: str = "llm",
+    cross_encoder_model_name: str = DEFAULT_CROSS_ENCODER_MODEL_NAME,
+    rerank_skip_gap: float | None = None,
+    rerank_skip_ratio: float | None = None,
+    context_max_tokens: int | None = None,
+    context_neighbour_lines: int = 1,
+    max_context_tokens: int = 128000,
+    conversational_agent_max_context_tokens: int | None = None,
+    http_pool_kwargs: dict | str | None = None,
+    response_cache_path: str | Path | None = None,
+    response_cache_only: bool = False,
+    coalesce_queries: bool = False,
     seed: int | None = None,
     max_queries_per_minute: int = 60,
+    retrieval_snapshot: str | Path | None = None,
 ):
     rag = build_rag(
         conditions_file=conditions_file,
@@ -487,6 +640,7 @@ def main(
         llm_provider=llm_provider,
         llm_model_name=llm_model_name,
         extra_body=extra_body,
+        llm_base_urls=llm_base_urls,
         conversational=conversational,
         conversational_agent_llm_provider=conversational_agent_llm_provider,
         conversational_agent_llm_model_name=conversational_agent_llm_model_name,
@@ -507,7 +661,20 @@ def main(
         rerank_llm_model_name=rerank_llm_model_name,
         rerank_extra_body=rerank_extra_body,
         rerank_k=rerank_k,
+        rerank_method=rerank_method,
+        cross_encoder_model_name=cross_encoder_model_name,
+        rerank_skip_gap=rerank_skip_gap,
+        rerank_skip_ratio=rerank_skip_ratio,
+        context_max_tokens=context_max_tokens,
+        context_neighbour_lines=context_neighbour_lines,
+        max_context_tokens=max_context_tokens,
+        conversational_agent_max_context_tokens=conversational_agent_max_context_tokens,
+        http_pool_kwargs=http_pool_kwargs,
+        response_cache_path=response_cache_path,
+        response_cache_only=response_cache_only,
+        coalesce_queries=coalesce_queries,
         seed=seed,
+        retrieval_snapshot=retrieval_snapshot,
     )
 
     asyncio.run(
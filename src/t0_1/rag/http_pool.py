@@ -0,0 +1,414 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+
+import httpx
+
+from t0_1.rag.load_balancer import (
+    AsyncLoadBalancedTransport,
+    LoadBalancedTransport,
+    LoadBalancer,
+    _AsyncClosingStream,
+    _ClosingStream,
+)
+
+
+@dataclass
+class HTTPPoolConfig:
+    """
+    Configuration of the HTTP connection pools shared by the LLM clients.
+
+    The defaults match the defaults of the OpenAI client.
+    """
+
+    max_connections: int = 1000
+    max_keepalive_connections: int = 100
+    keepalive_expiry: float = 5.0
+    http2: bool = False
+    connect_timeout: float = 5.0
+    read_timeout: float = 600.0
+    write_timeout: float = 600.0
+    pool_timeout: float = 600.0
+    # maximum number of connections for specific hosts ("host" or "host:port")
+    per_host_max_connections: dict[str, int] = field(default_factory=dict)
+    # health checks of the replicas of load balanced endpoints
+    health_check_interval: float = 5.0
+    max_replica_failures: int = 3
+
+    def __post_init__(self):
+        if self.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError as e:
+                raise ImportError(
+                    "HTTP/2 connection pools need the h2 package. "
+                    'Install it with `pip install "httpx[http2]"`.'
+                ) from e
+
+
+class PoolStats:
+    def __init__(self, max_connections: int):
+        """
+        Track how saturated the connection pool of a client is.
+
+        A request is in flight from when it is sent until its response is closed
+        (i.e. including the time spent streaming the response).
+
+        Parameters
+        ----------
+        max_connections : int
+            The maximum number of connections of the pool.
+        """
+        self.max_connections: int = max_connections
+        self.in_flight: int = 0
+        self.peak_in_flight: int = 0
+        self.requests: int = 0
+        self.saturated_requests: int = 0
+        self.errors: int = 0
+        self.total_time: float = 0.0
+        self._lock = threading.Lock()
+
+    def start(self) -> float:
+        with self._lock:
+            self.requests += 1
+            if self.in_flight >= self.max_connections:
+                # the request has to wait for a connection to be released
+                self.saturated_requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+        return time.perf_counter()
+
+    def finish(self, start: float, error: bool = False) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.total_time += time.perf_counter() - start
+            if error:
+                self.errors += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            finished = self.requests - self.in_flight
+            return {
+                "max_connections": self.max_connections,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "utilisation": self.in_flight / self.max_connections,
+                "peak_utilisation": self.peak_in_flight / self.max_connections,
+                "requests": self.requests,
+                "saturated_requests": self.saturated_requests,
+                "errors": self.errors,
+                "mean_request_time": self.total_time / finished if finished else None,
+            }
+
+
+class InstrumentedTransport(httpx.BaseTransport):
+    def __init__(self, transport: httpx.BaseTransport, stats: PoolStats):
+        """Transport recording the pool saturation of the wrapped transport."""
+        self._transport = transport
+        self.stats = stats
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        start = self.stats.start()
+        try:
+            response = self._transport.handle_request(request)
+        except Exception:
+            self.stats.finish(start, error=True)
+            raise
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ClosingStream(response.stream, lambda: self.stats.finish(start)),
+            extensions=response.extensions,
+        )
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncInstrumentedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport, stats: PoolStats):
+        """Async transport recording the pool saturation of the wrapped transport."""
+        self._transport = transport
+        self.stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = self.stats.start()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            self.stats.finish(start, error=True)
+            raise
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_AsyncClosingStream(
+                response.stream, lambda: self.stats.finish(start)
+            ),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class HTTPClientPool:
+    def __init__(self, config: HTTPPoolConfig | None = None):
+        """
+        Shared HTTP clients for the LLMs, with one connection pool per host.
+
+        LLMs served from the same host (e.g. T0, the conversational agent and
+        the reranker on one vLLM server) share the same connections, limits
+        and timeouts.
+
+        Parameters
+        ----------
+        config : HTTPPoolConfig | None, optional
+            The configuration of the connection pools. If None, the default
+            configuration is used. By default None.
+        """
+        self.config: HTTPPoolConfig = config or HTTPPoolConfig()
+        self._transports: dict[str, InstrumentedTransport] = {}
+        self._async_transports: dict[str, AsyncInstrumentedTransport] = {}
+        self._clients: dict[str, httpx.Client] = {}
+        self._async_clients: dict[str, httpx.AsyncClient] = {}
+        self._load_balancers: dict[tuple[str, ...], LoadBalancer] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(
+            connect=self.config.connect_timeout,
+            read=self.config.read_timeout,
+            write=self.config.write_timeout,
+            pool=self.config.pool_timeout,
+        )
+
+    @staticmethod
+    def _host(base_url: str) -> str:
+        url = httpx.URL(base_url)
+        port = url.port or (443 if url.scheme == "https" else 80)
+        return f"{url.scheme}://{url.host}:{port}"
+
+    def _limits(self, host: str) -> httpx.Limits:
+        host_and_port = host.split("://", 1)[-1]
+        per_host = self.config.per_host_max_connections
+        max_connections = per_host.get(
+            host_and_port,
+            per_host.get(host_and_port.rsplit(":", 1)[0], self.config.max_connections),
+        )
+
+        return httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(
+                self.config.max_keepalive_connections, max_connections
+            ),
+            keepalive_expiry=self.config.keepalive_expiry,
+        )
+
+    def get_transport(self, base_url: str) -> InstrumentedTransport:
+        """Get the shared transport (connection pool) for the host of the base URL."""
+        host = self._host(base_url)
+        with self._lock:
+            if host not in self._transports:
+                limits = self._limits(host)
+                logging.info(
+                    f"Creating HTTP client pool for {host} with {limits.max_connections} connections"
+                )
+                self._transports[host] = InstrumentedTransport(
+                    httpx.HTTPTransport(limits=limits, http2=self.config.http2),
+                    PoolStats(limits.max_connections),
+                )
+
+            return self._transports[host]
+
+    def get_async_transport(self, base_url: str) -> AsyncInstrumentedTransport:
+        """Get the shared async transport (connection pool) for the host of the base URL."""
+        host = self._host(base_url)
+        with self._lock:
+            if host not in self._async_transports:
+                limits = self._limits(host)
+                logging.info(
+                    f"Creating async HTTP client pool for {host} with {limits.max_connections} connections"
+                )
+                self._async_transports[host] = AsyncInstrumentedTransport(
+                    httpx.AsyncHTTPTransport(limits=limits, http2=self.config.http2),
+                    PoolStats(limits.max_connections),
+                )
+
+            return self._async_transports[host]
+
+    def get_client(self, base_url: str) -> httpx.Client:
+        """
+        Get the shared client for the host of the base URL.
+
+        Parameters
+        ----------
+        base_url : str
+            The base URL of the LLM endpoint.
+
+        Returns
+        -------
+        httpx.Client
+            The shared client for the host.
+        """
+        host = self._host(base_url)
+        with self._lock:
+            if host not in self._clients:
+                self._clients[host] = httpx.Client(
+                    transport=self.get_transport(base_url),
+                    timeout=self.timeout,
+                    follow_redirects=True,
+                )
+
+            return self._clients[host]
+
+    def get_async_client(self, base_url: str) -> httpx.AsyncClient:
+        """
+        Get the shared async client for the host of the base URL.
+
+        Parameters
+        ----------
+        base_url : str
+            The base URL of the LLM endpoint.
+
+        Returns
+        -------
+        httpx.AsyncClient
+            The shared async client for the host.
+        """
+        host = self._host(base_url)
+        with self._lock:
+            if host not in self._async_clients:
+                self._async_clients[host] = httpx.AsyncClient(
+                    transport=self.get_async_transport(base_url),
+                    timeout=self.timeout,
+                    follow_redirects=True,
+                )
+
+            return self._async_clients[host]
+
+    def get_load_balancer(self, base_urls: list[str]) -> LoadBalancer:
+        """
+        Get the shared load balancer over the replicas at the base URLs,
+        starting its health checks.
+
+        Parameters
+        ----------
+        base_urls : list[str]
+            The base URLs of the replicas.
+
+        Returns
+        -------
+        LoadBalancer
+            The load balancer, shared by all LLMs served by the replicas.
+        """
+        key = tuple(base_urls)
+        with self._lock:
+            if key not in self._load_balancers:
+                logging.info(f"Load balancing over replicas: {', '.join(base_urls)}")
+                balancer = LoadBalancer(
+                    base_urls,
+                    health_check_interval=self.config.health_check_interval,
+                    health_check_timeout=self.config.connect_timeout,
+                    max_failures=self.config.max_replica_failures,
+                )
+                balancer.start()
+                self._load_balancers[key] = balancer
+
+            return self._load_balancers[key]
+
+    def get_load_balanced_client(self, base_urls: list[str]) -> httpx.Client:
+        """
+        Get the shared client routing requests over the replicas at the base URLs.
+        Requests should be made against the first base URL.
+        """
+        key = ",".join(base_urls)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = httpx.Client(
+                    transport=LoadBalancedTransport(
+                        self.get_load_balancer(base_urls), self.get_transport
+                    ),
+                    timeout=self.timeout,
+                    follow_redirects=True,
+                )
+
+            return self._clients[key]
+
+    def get_load_balanced_async_client(self, base_urls: list[str]) -> httpx.AsyncClient:
+        """
+        Get the shared async client routing requests over the replicas at the
+        base URLs. Requests should be made against the first base URL.
+        """
+        key = ",".join(base_urls)
+        with self._lock:
+            if key not in self._async_clients:
+                self._async_clients[key] = httpx.AsyncClient(
+                    transport=AsyncLoadBalancedTransport(
+                        self.get_load_balancer(base_urls), self.get_async_transport
+                    ),
+                    timeout=self.timeout,
+                    follow_redirects=True,
+                )
+
+            return self._async_clients[key]
+
+    def stats(self) -> dict[str, dict[str, dict]]:
+        """
+        Get the saturation metrics of the connection pools.
+
+        Returns
+        -------
+        dict[str, dict[str, dict]]
+            For each host, the metrics of its sync and async pools.
+        """
+        with self._lock:
+            stats = {}
+            for kind, transports in [
+                ("sync", self._transports),
+                ("async", self._async_transports),
+            ]:
+                for host, transport in transports.items():
+                    stats.setdefault(host, {})[kind] = transport.stats.as_dict()
+
+            return dict(sorted(stats.items()))
+
+    def load_balancer_stats(self) -> dict[str, list[dict]]:
+        """
+        Get the state of the replicas of each load balancer.
+
+        Returns
+        -------
+        dict[str, list[dict]]
+            For each load balancer (by its comma separated base URLs),
+            the health and load of its replicas.
+        """
+        with self._lock:
+            return {
+                ",".join(key): balancer.stats()
+                for key, balancer in self._load_balancers.items()
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            for balancer in self._load_balancers.values():
+                balancer.stop()
+            for client in self._clients.values():
+                client.close()
+            for transport in self._transports.values():
+                transport.close()
+            self._clients = {}
+            self._transports = {}
+
+    async def aclose(self) -> None:
+        with self._lock:
+            clients, self._async_clients = self._async_clients, {}
+            transports, self._async_transports = self._async_transports, {}
+        for client in clients.values():
+            await client.aclose()
+        for transport in transports.values():
+            await transport.aclose()
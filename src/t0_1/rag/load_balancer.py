@@ -0,0 +1,316 @@
+import contextvars
+import logging
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable
+
+import httpx
+
+# replicas pinned by `sticky_replica` in the current context, by load balancer
+_sticky_replicas: contextvars.ContextVar[dict | None] = contextvars.ContextVar(
+    "sticky_replicas", default=None
+)
+
+
+@contextmanager
+def sticky_replica():
+    """
+    Route all requests made within this context to the same replica of each
+    load balancer, e.g. the rounds of a budget forcing request, so that the
+    prefix cache of the replica is reused. Nested contexts share the replicas
+    of the outermost one.
+    """
+    if _sticky_replicas.get() is not None:
+        yield
+        return
+
+    token = _sticky_replicas.set({})
+    try:
+        yield
+    finally:
+        _sticky_replicas.reset(token)
+
+
+def parse_base_urls(base_urls: list[str] | str | None) -> list[str]:
+    """
+    Parse a list of base URLs, or a comma separated string of base URLs.
+    """
+    if base_urls is None:
+        return []
+    if isinstance(base_urls, str):
+        base_urls = base_urls.split(",")
+
+    return [url.strip().rstrip("/") for url in base_urls if url.strip()]
+
+
+@dataclass
+class Replica:
+    base_url: str
+    outstanding: int = 0
+    healthy: bool = True
+    failures: int = 0
+    requests: int = 0
+
+
+class LoadBalancer:
+    def __init__(
+        self,
+        base_urls: list[str] | str,
+        health_path: str = "/health",
+        health_check_interval: float = 5.0,
+        health_check_timeout: float = 2.0,
+        max_failures: int = 3,
+    ):
+        """
+        Balance requests over replicas of an OpenAI compatible endpoint
+        (e.g. vLLM servers), routing each request to the healthy replica with
+        the fewest outstanding requests.
+
+        Replicas are ejected after `max_failures` consecutive failed requests
+        or health checks, and re-admitted once their health check succeeds.
+
+        Parameters
+        ----------
+        base_urls : list[str] | str
+            The base URLs of the replicas, or a comma separated string of them.
+            Requests are made against the first base URL and routed to the
+            chosen replica.
+        health_path : str, optional
+            The path of the health check endpoint, relative to the base URL
+            without its `/v1` suffix. By default "/health".
+        health_check_interval : float, optional
+            Number of seconds between health checks. If 0, health checks are
+            not run in the background. By default 5.0.
+        health_check_timeout : float, optional
+            Timeout (in seconds) of the health checks. By default 2.0.
+        max_failures : int, optional
+            Number of consecutive failures after which a replica is ejected.
+            By default 3.
+        """
+        self.base_urls: list[str] = parse_base_urls(base_urls)
+        if not self.base_urls:
+            raise ValueError("At least one base URL is needed for load balancing.")
+
+        self.replicas: list[Replica] = [Replica(url) for url in self.base_urls]
+        self.health_path: str = health_path
+        self.health_check_interval: float = health_check_interval
+        self.health_check_timeout: float = health_check_timeout
+        self.max_failures: int = max_failures
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        return self.base_urls[0]
+
+    def acquire(self) -> Replica:
+        """
+        Choose the replica for a request and count it as outstanding.
+        If all replicas are ejected, all of them are considered.
+        """
+        sticky = _sticky_replicas.get()
+        with self._lock:
+            replica = sticky.get(id(self)) if sticky is not None else None
+            if replica is None or not replica.healthy:
+                candidates = [r for r in self.replicas if r.healthy] or self.replicas
+                replica = min(candidates, key=lambda r: r.outstanding)
+                if sticky is not None:
+                    sticky[id(self)] = replica
+            replica.outstanding += 1
+            replica.requests += 1
+
+        return replica
+
+    def release(self, replica: Replica, error: bool = False) -> None:
+        """Mark a request to the replica as finished."""
+        with self._lock:
+            replica.outstanding -= 1
+            if error:
+                self._record_failure(replica)
+            else:
+                replica.failures = 0
+
+    def _record_failure(self, replica: Replica) -> None:
+        replica.failures += 1
+        if replica.healthy and replica.failures >= self.max_failures:
+            replica.healthy = False
+            logging.warning(
+                f"Ejecting replica {replica.base_url} after {replica.failures} failures"
+            )
+
+    def route(self, request: httpx.Request, replica: Replica) -> None:
+        """Point a request made against the first base URL to the replica."""
+        url = str(request.url)
+        if replica.base_url != self.base_url and url.startswith(self.base_url):
+            request.url = httpx.URL(replica.base_url + url[len(self.base_url) :])
+            request.headers["Host"] = request.url.netloc.decode("ascii")
+
+    def health_url(self, replica: Replica) -> str:
+        return replica.base_url.removesuffix("/v1") + self.health_path
+
+    def check_health(self, client: httpx.Client | None = None) -> None:
+        """Run the health checks of all replicas once."""
+        if client is None:
+            with httpx.Client(timeout=self.health_check_timeout) as client:
+                return self.check_health(client)
+
+        for replica in self.replicas:
+            try:
+                healthy = client.get(self.health_url(replica)).status_code == 200
+            except httpx.HTTPError:
+                healthy = False
+
+            with self._lock:
+                if healthy:
+                    if not replica.healthy:
+                        logging.info(f"Re-admitting replica {replica.base_url}")
+                    replica.healthy = True
+                    replica.failures = 0
+                else:
+                    self._record_failure(replica)
+
+    def _run_health_checks(self) -> None:
+        with httpx.Client(timeout=self.health_check_timeout) as client:
+            while not self._stop.is_set():
+                self.check_health(client)
+                self._stop.wait(self.health_check_interval)
+
+    def start(self) -> None:
+        """Start the health checks in a background thread."""
+        if self.health_check_interval <= 0 or self._thread is not None:
+            return
+
+        self._thread = threading.Thread(
+            target=self._run_health_checks, name="load-balancer-health", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background health checks."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.health_check_timeout)
+            self._thread = None
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            return [
+                {
+                    "base_url": replica.base_url,
+                    "healthy": replica.healthy,
+                    "outstanding": replica.outstanding,
+                    "requests": replica.requests,
+                    "failures": replica.failures,
+                }
+                for replica in self.replicas
+            ]
+
+
+class _ClosingStream(httpx.SyncByteStream):
+    def __init__(self, stream: httpx.SyncByteStream, on_close: Callable[[], None]):
+        self._stream = stream
+        self._on_close = on_close
+        self._closed = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            try:
+                self._stream.close()
+            finally:
+                self._on_close()
+
+
+class _AsyncClosingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable[[], None]):
+        self._stream = stream
+        self._on_close = on_close
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        if not self._closed:
+            self._closed = True
+            try:
+                await self._stream.aclose()
+            finally:
+                self._on_close()
+
+
+class LoadBalancedTransport(httpx.BaseTransport):
+    def __init__(
+        self,
+        balancer: LoadBalancer,
+        get_transport: Callable[[str], httpx.BaseTransport],
+    ):
+        """
+        Transport routing requests to the replicas of a load balancer.
+
+        Parameters
+        ----------
+        balancer : LoadBalancer
+            The load balancer choosing the replicas.
+        get_transport : Callable[[str], httpx.BaseTransport]
+            Function returning the transport for the base URL of a replica.
+        """
+        self.balancer = balancer
+        self._get_transport = get_transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        replica = self.balancer.acquire()
+        self.balancer.route(request, replica)
+        try:
+            response = self._get_transport(replica.base_url).handle_request(request)
+        except Exception:
+            self.balancer.release(replica, error=True)
+            raise
+
+        error = response.status_code >= 500
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ClosingStream(
+                response.stream, lambda: self.balancer.release(replica, error=error)
+            ),
+            extensions=response.extensions,
+        )
+
+
+class AsyncLoadBalancedTransport(httpx.AsyncBaseTransport):
+    def __init__(
+        self,
+        balancer: LoadBalancer,
+        get_transport: Callable[[str], httpx.AsyncBaseTransport],
+    ):
+        """Async transport routing requests to the replicas of a load balancer."""
+        self.balancer = balancer
+        self._get_transport = get_transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        replica = self.balancer.acquire()
+        self.balancer.route(request, replica)
+        try:
+            response = await self._get_transport(replica.base_url).handle_async_request(
+                request
+            )
+        except Exception:
+            self.balancer.release(replica, error=True)
+            raise
+
+        error = response.status_code >= 500
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_AsyncClosingStream(
+                response.stream, lambda: self.balancer.release(replica, error=error)
+            ),
+            extensions=response.extensions,
+        )
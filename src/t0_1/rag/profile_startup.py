@@ -0,0 +1,173 @@
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# modules imported when serving the RAG, in the order they are timed. Modules
+# imported by an earlier entry are counted towards that entry
+STARTUP_IMPORTS = [
+    "langchain_core.runnables",
+    "langgraph.graph",
+    "t0_1.query_vector_store.build_retriever",
+    "t0_1.rag.build_rag",
+    "fastapi",
+    "uvicorn",
+    "t0_1.rag.rag_endpoint",
+]
+
+
+class StartupProfile:
+    def __init__(self):
+        """Wall-clock time of the stages of starting the RAG service."""
+        self.timings: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the body of the context as the stage `name`."""
+        logging.info(f"Profiling stage '{name}'...")
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.perf_counter() - start
+
+    @property
+    def total(self) -> float:
+        return sum(self.timings.values())
+
+    def report(self) -> str:
+        """Format the timings as a table, with the share of the total time."""
+        width = max(len(name) for name in [*self.timings, "total"])
+        lines = [f"{'stage':<{width}}  {'seconds':>8}  {'share':>6}"]
+        for name, seconds in self.timings.items():
+            share = seconds / self.total if self.total else 0.0
+            lines.append(f"{name:<{width}}  {seconds:>8.3f}  {share:>6.1%}")
+        lines.append(f"{'total':<{width}}  {self.total:>8.3f}  {1:>6.0%}")
+
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {"timings": self.timings, "total": self.total}
+
+
+def profile_imports(profile: StartupProfile) -> None:
+    """Time the import of each module in `STARTUP_IMPORTS` not yet imported."""
+    for module in STARTUP_IMPORTS:
+        if module in sys.modules:
+            logging.info(f"Module '{module}' is already imported, skipping")
+            continue
+
+        with profile.stage(f"import {module}"):
+            importlib.import_module(module)
+
+
+def main(
+    config,
+    trust_source: bool = False,
+    mmap_index: bool = False,
+    llm_provider: str = "huggingface",
+    llm_model_name: str = "Qwen/Qwen2.5-1.5B-Instruct",
+    llm_base_urls: list[str] | str | None = None,
+    prompt_template_path: str | Path | None = None,
+    system_prompt_path: str | Path | None = None,
+    output_file: str | Path | None = None,
+) -> StartupProfile:
+    """
+    Profile the cold start of the RAG service, timing the imports, the loading
+    of the embedding model and of the index and the set up of the LLM client.
+
+    Parameters
+    ----------
+    config : RetrieverConfig
+        Configuration of the retriever. The index at `persist_directory` and
+        `local_file_store` must already exist.
+    trust_source : bool, optional
+        If True, trust the source of the data index. This is needed for
+        loading in FAISS databases. By default False.
+    mmap_index : bool, optional
+        If True, memory-map a FAISS index read-only. By default False.
+    llm_provider : str, optional
+        The provider of the LLM. By default "huggingface".
+    llm_model_name : str, optional
+        The name of the LLM. By default "Qwen/Qwen2.5-1.5B-Instruct".
+    llm_base_urls : list[str] | str | None, optional
+        Base URLs of the replicas serving the LLM. By default None.
+    prompt_template_path : str | Path | None, optional
+        Path to the prompt template. If None, the default prompt template is
+        used. By default None.
+    system_prompt_path : str | Path | None, optional
+        Path to the system prompt. By default None.
+    output_file : str | Path | None, optional
+        Path to a JSON file to save the timings to. By default None.
+
+    Returns
+    -------
+    StartupProfile
+        The timings of the stages.
+    """
+    for directory in (config.persist_directory, config.local_file_store):
+        if directory is None or not os.path.exists(directory):
+            raise FileNotFoundError(
+                f"Index directory {directory} does not exist. "
+                "Create the index before profiling the start up."
+            )
+
+    profile = StartupProfile()
+    profile_imports(profile)
+
+    from t0_1.query_vector_store.build_index import (
+        setup_embedding_model,
+        setup_text_splitter,
+    )
+    from t0_1.query_vector_store.build_retriever import load_parent_doc_retriever
+    from t0_1.rag.build_rag import load_llm
+    from t0_1.rag.custom_prompt_template import (
+        default_prompt_template,
+        read_prompt_template,
+    )
+
+    with profile.stage("embedding model"):
+        embedding_model = setup_embedding_model(
+            config.embedding_model_name, config.embedding_backend
+        )
+        text_splitter = setup_text_splitter(
+            config.embedding_model_name, config.chunk_overlap
+        )
+
+    with profile.stage("index"):
+        load_parent_doc_retriever(
+            config=config,
+            trust_source=trust_source,
+            embedding_model=embedding_model,
+            text_splitter=text_splitter,
+            mmap_index=mmap_index,
+        )
+
+    with profile.stage("prompt"):
+        if prompt_template_path is None:
+            default_prompt_template()
+        else:
+            read_prompt_template(
+                prompt_template_path=prompt_template_path,
+                system_prompt_path=system_prompt_path,
+            )
+
+    with profile.stage("llm client"):
+        load_llm(
+            llm_provider=llm_provider,
+            llm_model_name=llm_model_name,
+            base_urls=llm_base_urls,
+        )
+
+    logging.info(f"Start up profile:\n{profile.report()}")
+    if output_file is not None:
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(output_file, "w") as f:
+            json.dump(profile.to_dict(), f, indent=2)
+        logging.info(f"Start up profile saved to {output_file}")
+
+    return profile
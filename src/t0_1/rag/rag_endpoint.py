@@ -1,20 +1,38 @@
+import asyncio
+import gc
+import json
+import logging
 import os
 import random
+from contextlib import asynccontextmanager
+from dataclasses import asdict
 from pathlib import Path
 
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 
+from t0_1.query_vector_store.build_retriever import get_parent_doc_retriever
+from t0_1.rag.admission import AdmissionController, AdmissionRejected
 from t0_1.rag.build_rag import (
     DEFAULT_RETRIEVER_CONFIG,
     RAG,
     RetrieverConfig,
     build_rag,
+    reload_rag_retriever,
 )
-from t0_1.rag.request_logger import logged_stream
+from t0_1.rag.cross_encoder_reranker import DEFAULT_CROSS_ENCODER_MODEL_NAME
+from t0_1.rag.request_logger import alogged_stream
+from t0_1.rag.shared_state import ThreadRegistry
+from t0_1.rag.warm_up import WarmUpConfig, awarm_up_rag
+from t0_1.utils import process_arg_to_dict
+
+# environment variable passing the arguments of `build_rag` and
+# `create_rag_app` to the worker processes of the server
+SERVE_KWARGS_ENV = "T0_RAG_SERVE_KWARGS"
 
 
 class QueryRequest(BaseModel):
@@ -27,15 +45,67 @@ class ClearHistoryRequest(BaseModel):
     thread_id: str | None = "0"
 
 
-def create_rag_app(rag: RAG) -> FastAPI:
-    app = FastAPI()
-    app.state.active_thread_ids = set()
+class ReloadRetrieverRequest(BaseModel):
+    persist_directory: str
+    local_file_store: str
+
+
+def create_rag_app(
+    rag: RAG,
+    trust_source: bool = False,
+    query_admission: AdmissionController | None = None,
+    stream_admission: AdmissionController | None = None,
+    thread_registry: ThreadRegistry | None = None,
+    warm_up: WarmUpConfig | None = None,
+    workers: int = 1,
+) -> FastAPI:
+    async def _warm_up():
+        app.state.warm_up = {"status": "warming"}
+        try:
+            profile = await awarm_up_rag(rag, warm_up)
+        except Exception as e:
+            logging.error(f"Warm up failed: {e}")
+            app.state.warm_up = {
+                "status": "failed",
+                "error": f"{type(e).__name__} - {e}",
+            }
+        else:
+            app.state.warm_up = {"status": "ready"} | profile.to_dict()
+
+    # warm up in the background once the server has started, so that /ready
+    # can report the progress. The warm up runs on the loop of the server so
+    # that it opens the connections of the async clients used by the requests
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        if warm_up is not None:
+            app.state.warm_up_task = asyncio.create_task(_warm_up())
+        yield
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.warm_up = {"status": "pending" if warm_up is not None else "ready"}
+    # shared by the workers of the server if backed by a database
+    app.state.active_thread_ids = thread_registry or ThreadRegistry()
+    # limit the concurrent graph executions of /query and /query_stream
+    app.state.admission = {
+        "query": query_admission or AdmissionController(),
+        "query_stream": stream_admission or AdmissionController(),
+    }
+    app.state.retriever_reload = {"status": "idle"}
     log_dir = os.environ.get("T0_LOG_DIR", "./logs")
+    admin_token = os.environ.get("T0_ADMIN_TOKEN")
 
     @app.get("/")
     async def root():
         return {"message": "Hello World"}
 
+    # Ready to serve once the warm up has finished. With several workers, this
+    # only reports the worker that answers the request
+    @app.get("/ready")
+    async def ready():
+        if app.state.warm_up["status"] != "ready":
+            raise HTTPException(status_code=503, detail=app.state.warm_up)
+        return app.state.warm_up
+
     @app.get("/new_thread_id")
     async def new_thread_id():
         ADJECTIVES = [
@@ -120,17 +190,31 @@ def create_rag_app(rag: RAG) -> FastAPI:
                 f"-{random.randint(0, 99):02}"
             )
 
-        while (new_random_thread_id := _generate()) in app.state.active_thread_ids:
+        registry = app.state.active_thread_ids
+        while not await registry.aadd(new_random_thread_id := _generate()):
             pass
-        app.state.active_thread_ids.add(new_random_thread_id)
         return {"thread_id": new_random_thread_id}
 
+    async def _admit(kind: str) -> float:
+        try:
+            return await app.state.admission[kind].acquire()
+        except AdmissionRejected as e:
+            raise HTTPException(
+                status_code=429,
+                detail=e.reason,
+                headers={"Retry-After": str(e.retry_after)},
+            ) from e
+
     @app.post("/query")
     async def query_endpoint(req: QueryRequest):
-        app.state.active_thread_ids.add(req.thread_id)
-        response = await rag._aquery(
-            req.query, thread_id=req.thread_id, demographics=req.demographics
-        )
+        start = await _admit("query")
+        try:
+            await app.state.active_thread_ids.aadd(req.thread_id)
+            response = await rag._aquery(
+                req.query, thread_id=req.thread_id, demographics=req.demographics
+            )
+        finally:
+            app.state.admission["query"].release(start)
         return {
             "response": response,
             "thread_id": req.thread_id,
@@ -139,21 +223,55 @@ def create_rag_app(rag: RAG) -> FastAPI:
 
     @app.post("/query_stream")
     async def query_stream_endpoint(req: QueryRequest):
-        app.state.active_thread_ids.add(req.thread_id)
-        stream = rag._query_stream(
-            req.query,
-            thread_id=req.thread_id,
-            demographics=req.demographics,
-        )
+        start = await _admit("query_stream")
+        released = False
+
+        async def _release():
+            nonlocal released
+            if not released:
+                released = True
+                app.state.admission["query_stream"].release(start)
+
+        try:
+            await app.state.active_thread_ids.aadd(req.thread_id)
+            stream = rag._aquery_stream(
+                req.query,
+                thread_id=req.thread_id,
+                demographics=req.demographics,
+            )
+        except BaseException:
+            await _release()
+            raise
+
+        # hold the slot until the stream has finished
+        async def _admitted_stream():
+            try:
+                async for chunk in alogged_stream(
+                    stream, req.model_dump(), req.thread_id, log_dir
+                ):
+                    yield chunk
+            finally:
+                await _release()
+
+        # the background task also releases the slot if the stream is never
+        # iterated (e.g. the client disconnected before the body was sent)
         return StreamingResponse(
-            logged_stream(stream, req.model_dump(), req.thread_id, log_dir),
+            _admitted_stream(), background=BackgroundTask(_release)
         )
 
+    # Queue depth and wait times of the admission control
+    @app.get("/admission_stats")
+    async def admission_stats():
+        stats = {kind: c.stats() for kind, c in app.state.admission.items()}
+        if rag.single_flight is not None:
+            stats["coalescing"] = rag.single_flight.stats()
+        return stats
+
     # Delete history
     @app.post("/clear_history")
     async def clear_history_endpoint(req: ClearHistoryRequest):
-        rag.clear_history(thread_id=req.thread_id)
-        app.state.active_thread_ids.discard(req.thread_id)
+        await rag.aclear_history(thread_id=req.thread_id)
+        await app.state.active_thread_ids.adiscard(req.thread_id)
         return {"status": "success", "thread_id": req.thread_id}
 
     @app.get("/get_history")
@@ -169,6 +287,63 @@ def create_rag_app(rag: RAG) -> FastAPI:
     async def get_thread_ids():
         return {"thread_ids": rag.get_thread_ids()}
 
+    # Saturation of the HTTP connection pools shared by the LLM clients
+    @app.get("/http_pool_stats")
+    async def http_pool_stats():
+        if rag.http_pool is None:
+            return {"pools": {}, "load_balancers": {}}
+        return {
+            "pools": rag.http_pool.stats(),
+            "load_balancers": rag.http_pool.load_balancer_stats(),
+        }
+
+    def _reload_retriever(req: ReloadRetrieverRequest):
+        try:
+            reload_rag_retriever(
+                rag,
+                persist_directory=req.persist_directory,
+                local_file_store=req.local_file_store,
+                trust_source=trust_source,
+            )
+        except Exception as e:
+            logging.error(f"Retriever reload failed: {e}")
+            app.state.retriever_reload = req.model_dump() | {
+                "status": "failed",
+                "error": f"{type(e).__name__} - {e}",
+            }
+        else:
+            app.state.retriever_reload = req.model_dump() | {"status": "ready"}
+
+    # Load a new index in the background and swap it in once it is warm
+    @app.post("/reload_retriever", status_code=202)
+    async def reload_retriever_endpoint(
+        req: ReloadRetrieverRequest,
+        background_tasks: BackgroundTasks,
+        x_admin_token: str | None = Header(default=None),
+    ):
+        if admin_token is not None and x_admin_token != admin_token:
+            raise HTTPException(status_code=403, detail="Invalid admin token")
+        if workers > 1:
+            # the request only reaches one worker, which would then serve a
+            # different index from the others
+            raise HTTPException(
+                status_code=409,
+                detail="Retriever reloads are not supported with several workers. "
+                "Restart the server with the new index instead.",
+            )
+        if app.state.retriever_reload["status"] == "loading":
+            raise HTTPException(
+                status_code=409, detail="A retriever reload is already in progress"
+            )
+
+        app.state.retriever_reload = req.model_dump() | {"status": "loading"}
+        background_tasks.add_task(_reload_retriever, req)
+        return app.state.retriever_reload
+
+    @app.get("/reload_retriever_status")
+    async def reload_retriever_status():
+        return app.state.retriever_reload
+
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
@@ -180,6 +355,32 @@ def create_rag_app(rag: RAG) -> FastAPI:
     return app
 
 
+def create_app_from_env() -> FastAPI:
+    """
+    Build the RAG and its app from the arguments in the `T0_RAG_SERVE_KWARGS`
+    environment variable. Used as the app factory of each worker process
+    when serving with several workers.
+    """
+    kwargs = json.loads(os.environ[SERVE_KWARGS_ENV])
+    app_kwargs = kwargs.pop("app")
+    kwargs["config"] = RetrieverConfig(**kwargs["config"])
+
+    rag = build_rag(**kwargs)
+    return create_rag_app(
+        rag,
+        trust_source=kwargs["trust_source"],
+        query_admission=AdmissionController(**app_kwargs["query_admission"]),
+        stream_admission=AdmissionController(**app_kwargs["stream_admission"]),
+        thread_registry=ThreadRegistry(app_kwargs["shared_state_path"]),
+        warm_up=(
+            WarmUpConfig(**app_kwargs["warm_up"])
+            if app_kwargs.get("warm_up") is not None
+            else None
+        ),
+        workers=app_kwargs["workers"],
+    )
+
+
 def main(
     conditions_file: str,
     config: RetrieverConfig = DEFAULT_RETRIEVER_CONFIG,
@@ -188,6 +389,7 @@ def main(
     llm_provider: str = "huggingface",
     llm_model_name: str = "Qwen/Qwen2.5-1.5B-Instruct",
     extra_body: dict | str | None = None,
+    llm_base_urls: list[str] | str | None = None,
     conversational: bool = False,
     conversational_agent_llm_provider: str | None = None,
     conversational_agent_llm_model_name: str | None = None,
@@ -203,11 +405,42 @@ def main(
     rerank_llm_model_name: str | None = None,
     rerank_extra_body: dict | str | None = None,
     rerank_k: int = 5,
+    rerank_method: str = "llm",
+    cross_encoder_model_name: str = DEFAULT_CROSS_ENCODER_MODEL_NAME,
+    rerank_skip_gap: float | None = None,
+    rerank_skip_ratio: float | None = None,
+    context_max_tokens: int | None = None,
+    context_neighbour_lines: int = 1,
+    max_context_tokens: int = 128000,
+    conversational_agent_max_context_tokens: int | None = None,
+    http_pool_kwargs: dict | str | None = None,
+    max_concurrent_queries: int | None = None,
+    max_concurrent_streams: int | None = None,
+    max_queued_requests: int = 100,
+    queue_timeout: float = 30.0,
+    coalesce_queries: bool = False,
+    warm_up: bool = True,
+    warm_up_kwargs: dict | str | None = None,
+    workers: int = 1,
+    shared_state_path: str | Path | None = None,
+    mmap_index: bool = False,
     host: str = "0.0.0.0",
     port: int = 8000,
     seed: int | None = None,
 ):
-    rag = build_rag(
+    if workers > 1 and shared_state_path is None:
+        raise ValueError(
+            "A shared state path is needed to serve the RAG with several workers."
+        )
+    if workers > 1 and (
+        config.persist_directory is None or config.local_file_store is None
+    ):
+        raise ValueError(
+            "A persist directory and local file store are needed to serve the RAG "
+            "with several workers, so that every worker loads the same index."
+        )
+
+    build_kwargs = dict(
         conditions_file=conditions_file,
         config=config,
         force_create=force_create,
@@ -215,6 +448,7 @@ def main(
         llm_provider=llm_provider,
         llm_model_name=llm_model_name,
         extra_body=extra_body,
+        llm_base_urls=llm_base_urls,
         conversational=conversational,
         conversational_agent_llm_provider=conversational_agent_llm_provider,
         conversational_agent_llm_model_name=conversational_agent_llm_model_name,
@@ -230,7 +464,86 @@ def main(
         rerank_llm_model_name=rerank_llm_model_name,
         rerank_extra_body=rerank_extra_body,
         rerank_k=rerank_k,
+        rerank_method=rerank_method,
+        cross_encoder_model_name=cross_encoder_model_name,
+        rerank_skip_gap=rerank_skip_gap,
+        rerank_skip_ratio=rerank_skip_ratio,
+        context_max_tokens=context_max_tokens,
+        context_neighbour_lines=context_neighbour_lines,
+        max_context_tokens=max_context_tokens,
+        conversational_agent_max_context_tokens=conversational_agent_max_context_tokens,
+        http_pool_kwargs=http_pool_kwargs,
+        coalesce_queries=coalesce_queries,
+        shared_state_path=(
+            str(shared_state_path) if shared_state_path is not None else None
+        ),
+        mmap_index=mmap_index,
         seed=seed,
     )
-    app = create_rag_app(rag)
+    query_admission_kwargs = dict(
+        max_in_flight=max_concurrent_queries,
+        max_queue=max_queued_requests,
+        queue_timeout=queue_timeout,
+    )
+    stream_admission_kwargs = dict(
+        max_in_flight=max_concurrent_streams,
+        max_queue=max_queued_requests,
+        queue_timeout=queue_timeout,
+    )
+    warm_up_config = (
+        WarmUpConfig(**process_arg_to_dict(warm_up_kwargs)) if warm_up else None
+    )
+
+    if workers > 1:
+        if force_create or not (
+            os.path.exists(config.persist_directory)
+            and os.path.exists(config.local_file_store)
+        ):
+            # build the index once here, so the workers only load it rather
+            # than racing to rebuild it and to append to the embedding cache
+            get_parent_doc_retriever(
+                conditions_file=conditions_file,
+                config=config,
+                force_create=True,
+                trust_source=trust_source,
+            )
+            gc.collect()
+
+        # each worker builds its own RAG, sharing the conversation state and
+        # active thread IDs through the database at `shared_state_path`
+        os.environ[SERVE_KWARGS_ENV] = json.dumps(
+            build_kwargs
+            | {
+                "force_create": False,
+                "config": asdict(config),
+                "app": {
+                    "query_admission": query_admission_kwargs,
+                    "stream_admission": stream_admission_kwargs,
+                    "shared_state_path": str(shared_state_path),
+                    "workers": workers,
+                    "warm_up": (
+                        asdict(warm_up_config) if warm_up_config is not None else None
+                    ),
+                },
+            },
+            default=str,
+        )
+        uvicorn.run(
+            "t0_1.rag.rag_endpoint:create_app_from_env",
+            factory=True,
+            workers=workers,
+            host=host,
+            port=port,
+        )
+        return
+
+    rag = build_rag(**build_kwargs)
+    app = create_rag_app(
+        rag,
+        trust_source=trust_source,
+        query_admission=AdmissionController(**query_admission_kwargs),
+        stream_admission=AdmissionController(**stream_admission_kwargs),
+        thread_registry=ThreadRegistry(shared_state_path),
+        warm_up=warm_up_config,
+    )
     uvicorn.run(app, host=host, port=port)
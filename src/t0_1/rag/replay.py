@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+import time
+from pathlib import Path
+
+from langchain_core.language_models.llms import LLM
+from langchain_core.messages import HumanMessage, SystemMessage
+from tqdm.asyncio import tqdm_asyncio
+
+from t0_1.rag.build_rag import load_llm
+from t0_1.rag.evaluate import (
+    log_match_proportions,
+    parse_response,
+    score_response,
+    submit_condition_recommendation,
+)
+from t0_1.rag.http_pool import HTTPClientPool, HTTPPoolConfig
+from t0_1.utils import process_arg_to_dict, read_jsonl, timestamp_file_name
+
+# fields of the results of `process_query` that depend on the response
+SCORE_FIELDS = [
+    "conditions_match",
+    "severity_match",
+    "parsed_condition",
+    "parsed_severity_level",
+]
+
+
+def replay_messages(row: dict) -> list:
+    """The messages sent to the model for a row of the `evaluate-rag` results."""
+    messages = [HumanMessage(row["rag_message"])]
+    if row.get("system_prompt") is not None:
+        messages = [SystemMessage(row["system_prompt"])] + messages
+
+    return messages
+
+
+async def replay_row(
+    row: dict,
+    llm: LLM,
+    generate_only: bool = False,
+    deepseek_r1: bool = False,
+    s1: bool = False,
+) -> dict:
+    """
+    Send the stored prompts of a row of the `evaluate-rag` results to the
+    model and score its new response.
+    """
+    # drop the results of the previous response
+    res = {key: value for key, value in row.items() if key not in SCORE_FIELDS}
+    res.pop("error", None)
+
+    start = time.perf_counter()
+    try:
+        response = await llm.ainvoke(replay_messages(row))
+    except Exception as err:
+        error_as_str = f"{type(err).__name__} - {err}"
+        logging.error(f"Error replaying the generation: {error_as_str}")
+
+        res |= {
+            "rag_answer": None,
+            "rag_reasoning_content": None,
+            "rag_tool_calls": None,
+            "error": error_as_str,
+        }
+    else:
+        res |= {
+            "rag_answer": response.content,
+            "rag_reasoning_content": response.additional_kwargs.get(
+                "reasoning_content"
+            ),
+            "rag_tool_calls": response.additional_kwargs.get("tool_calls"),
+        }
+    res["replay_latency"] = time.perf_counter() - start
+
+    parsed_condition, parsed_severity_level = "", ""
+    if not generate_only and "error" not in res:
+        try:
+            parsed_condition, parsed_severity_level = parse_response(
+                response, deepseek_r1=deepseek_r1, s1=s1
+            )
+        except Exception as err:
+            # e.g. malformed JSON arguments of the tool call
+            error_as_str = f"{type(err).__name__} - {err}"
+            logging.error(f"Error parsing the replayed response: {error_as_str}")
+            res["error"] = error_as_str
+
+    if not generate_only:
+        res |= score_response(
+            res,
+            parsed_condition=parsed_condition,
+            parsed_severity_level=parsed_severity_level,
+            target_document=row[row["target_document_field"]],
+            target_severity_level=row["severity_level"],
+        )
+
+    return res
+
+
+async def replay_generation(
+    input_file: str | Path,
+    output_file: str | Path,
+    llm: LLM,
+    generate_only: bool = False,
+    deepseek_r1: bool = False,
+    s1: bool = False,
+    max_concurrency: int = 64,
+    max_queries_per_minute: int | None = None,
+) -> list[dict]:
+    """
+    Regenerate the responses of an `evaluate-rag` run from the prompts it
+    stored, without retrieving documents or building the RAG graph.
+
+    Parameters
+    ----------
+    input_file : str | Path
+        The JSONL results of `evaluate-rag`, with the "system_prompt" and
+        "rag_message" of each query. Rows without them (e.g. queries that
+        failed) are skipped.
+    output_file : str | Path
+        The path to the JSONL file where the results will be saved. A
+        timestamp is added to the file name.
+    llm : LLM
+        The model to send the prompts to.
+    generate_only : bool, optional
+        If True, only generate the responses without scoring them.
+        By default False.
+    deepseek_r1 : bool, optional
+        If True, parse the responses with `parse_deepseek_r1`. By default False.
+    s1 : bool, optional
+        If True, parse the responses with `parse_s1`. By default False.
+    max_concurrency : int, optional
+        The maximum number of requests to the model at once. By default 64.
+    max_queries_per_minute : int | None, optional
+        The maximum number of requests started per minute. If None, requests
+        are only limited by `max_concurrency`. By default None.
+
+    Returns
+    -------
+    list[dict]
+        The results of each replayed query.
+    """
+    if not str(output_file).endswith(".jsonl"):
+        raise ValueError(f"File {output_file} is not a JSONL file.")
+
+    rows = read_jsonl(input_file)
+    replayable = [row for row in rows if row.get("rag_message") is not None]
+    if len(replayable) < len(rows):
+        logging.warning(
+            f"Skipping {len(rows) - len(replayable)} rows without a stored prompt."
+        )
+
+    output_file = timestamp_file_name(output_file)
+    logging.info(f"Writing results to {output_file}...")
+
+    request_interval = 60 / max_queries_per_minute if max_queries_per_minute else 0
+    semaphore = asyncio.Semaphore(max_concurrency)
+    write_lock = asyncio.Lock()
+    next_start = time.monotonic()
+
+    async def _replay(row: dict) -> dict:
+        nonlocal next_start
+        async with semaphore:
+            # space out the requests, reserving a start time before waiting
+            now = time.monotonic()
+            wait, next_start = next_start - now, max(next_start, now) + request_interval
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            res = await replay_row(
+                row, llm, generate_only=generate_only, deepseek_r1=deepseek_r1, s1=s1
+            )
+
+        async with write_lock:
+            with open(output_file, "a") as f:
+                json.dump(res, f)
+                f.write("\n")
+
+        return res
+
+    results = await tqdm_asyncio.gather(
+        *[_replay(row) for row in replayable], desc="Replaying", unit="query"
+    )
+
+    if not generate_only and results:
+        log_match_proportions(results)
+
+    return results
+
+
+def main(
+    input_file: str | Path,
+    output_file: str | Path,
+    llm_provider: str,
+    llm_model_name: str,
+    extra_body: dict | str | None = None,
+    llm_base_urls: list[str] | str | None = None,
+    http_pool_kwargs: dict | str | None = None,
+    generate_only: bool = False,
+    deepseek_r1: bool = False,
+    s1: bool = False,
+    max_concurrency: int = 64,
+    max_queries_per_minute: int | None = None,
+    seed: int | None = None,
+) -> list[dict]:
+    if llm_provider == "openai_completion":
+        raise ValueError(
+            "Replaying generations sends chat messages, which is not supported "
+            "for the 'openai_completion' provider."
+        )
+
+    llm = load_llm(
+        llm_provider=llm_provider,
+        llm_model_name=llm_model_name,
+        extra_body={"seed": seed} | process_arg_to_dict(extra_body),
+        http_pool=HTTPClientPool(
+            HTTPPoolConfig(**process_arg_to_dict(http_pool_kwargs))
+        ),
+        base_urls=llm_base_urls,
+    )
+    if not (deepseek_r1 or s1):
+        # responses are scored from the arguments of the tool call
+        llm = llm.bind_tools([submit_condition_recommendation])
+
+    return asyncio.run(
+        replay_generation(
+            input_file=input_file,
+            output_file=output_file,
+            llm=llm,
+            generate_only=generate_only,
+            deepseek_r1=deepseek_r1,
+            s1=s1,
+            max_concurrency=max_concurrency,
+            max_queries_per_minute=max_queries_per_minute,
+        )
+    )
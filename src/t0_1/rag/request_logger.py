@@ -4,7 +4,7 @@ import re
 import time
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Iterable
+from typing import AsyncIterable, Iterable
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +29,31 @@ def write_log_entry(
         )
 
 
+def _write_stream_log_entry(
+    request_data: dict,
+    thread_id: str,
+    log_dir: str | Path,
+    chunks: list[str],
+    start_time: float,
+    status_code: int,
+    error: str | None,
+) -> None:
+    duration = time.monotonic() - start_time
+    log_entry = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "endpoint": "/query_stream",
+        "method": "POST",
+        "request": request_data,
+        "response": {
+            "body": "".join(chunks),
+            "status_code": status_code,
+        },
+        "duration_seconds": round(duration, 3),
+        "error": error,
+    }
+    write_log_entry(thread_id, log_entry, log_dir)
+
+
 def logged_stream(
     generator: Iterable[str],
     request_data: dict,
@@ -56,17 +81,34 @@ def logged_stream(
         status_code = 500
         raise
     finally:
-        duration = time.monotonic() - start_time
-        log_entry = {
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "endpoint": "/query_stream",
-            "method": "POST",
-            "request": request_data,
-            "response": {
-                "body": "".join(chunks),
-                "status_code": status_code,
-            },
-            "duration_seconds": round(duration, 3),
-            "error": error,
-        }
-        write_log_entry(thread_id, log_entry, log_dir)
+        _write_stream_log_entry(
+            request_data, thread_id, log_dir, chunks, start_time, status_code, error
+        )
+
+
+async def alogged_stream(
+    generator: AsyncIterable[str],
+    request_data: dict,
+    thread_id: str,
+    log_dir: str | Path,
+) -> AsyncIterable[str]:
+    """Async version of `logged_stream`."""
+    chunks: list[str] = []
+    start_time = time.monotonic()
+    error = None
+    status_code = 200
+
+    try:
+        async for chunk in generator:
+            chunks.append(chunk)
+            yield chunk
+    except GeneratorExit:
+        error = "client_disconnected"
+    except Exception as e:
+        error = str(e)
+        status_code = 500
+        raise
+    finally:
+        _write_stream_log_entry(
+            request_data, thread_id, log_dir, chunks, start_time, status_code, error
+        )
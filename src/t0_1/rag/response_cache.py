@@ -0,0 +1,310 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import aclosing, closing
+from pathlib import Path
+from typing import Any
+
+from langchain_core.messages import (
+    BaseMessage,
+    convert_to_messages,
+    messages_from_dict,
+    messages_to_dict,
+)
+from langchain_core.prompt_values import PromptValue
+
+
+class ResponseCache:
+    def __init__(self, path: str | Path, cache_only: bool = False):
+        """
+        On-disk (SQLite) cache of LLM responses.
+
+        Parameters
+        ----------
+        path : str | Path
+            Path to the SQLite database file. It is created if it does not exist.
+        cache_only : bool, optional
+            If True, responses are only served from the cache and a cache miss
+            raises a KeyError instead of calling the LLM. By default False.
+        """
+        self.path: Path = Path(path)
+        self.cache_only: bool = cache_only
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    complete INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+
+    @staticmethod
+    def key(data: dict) -> str:
+        """Hash the JSON serialisation of the request into a cache key."""
+        return hashlib.sha256(
+            json.dumps(data, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def lookup(self, key: str) -> tuple[Any, bool] | None:
+        """
+        Look up a response in the cache.
+
+        Parameters
+        ----------
+        key : str
+            The cache key of the request.
+
+        Returns
+        -------
+        tuple[Any, bool] | None
+            The response (a string or a message) and whether it is complete
+            (streams stopped early by the caller are stored incomplete),
+            or None if the request is not in the cache.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, complete FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        response = json.loads(row[0])
+        if response["type"] == "message":
+            value = messages_from_dict([response["value"]])[0]
+        else:
+            value = response["value"]
+
+        return value, bool(row[1])
+
+    def update(self, key: str, value: Any, complete: bool = True) -> None:
+        """
+        Store a response in the cache. A complete response is never
+        replaced by an incomplete one.
+
+        Parameters
+        ----------
+        key : str
+            The cache key of the request.
+        value : Any
+            The response, a string or a message.
+        complete : bool, optional
+            Whether the response is complete. By default True.
+        """
+        if isinstance(value, BaseMessage):
+            response = {"type": "message", "value": messages_to_dict([value])[0]}
+        else:
+            response = {"type": "str", "value": value}
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                INSERT INTO responses (key, response, complete, created_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    response = excluded.response,
+                    complete = excluded.complete,
+                    created_at = excluded.created_at
+                WHERE excluded.complete >= responses.complete
+                """,
+                (key, json.dumps(response), int(complete), time.time()),
+            )
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def _input_key_data(input: Any) -> Any:
+    # message ids differ between runs so only key on their content
+    if isinstance(input, str):
+        return input
+    if isinstance(input, PromptValue):
+        input = input.to_messages()
+
+    return [
+        {
+            "type": message.type,
+            "content": message.content,
+            "name": message.name,
+            "tool_calls": getattr(message, "tool_calls", None),
+            "tool_call_id": getattr(message, "tool_call_id", None),
+        }
+        for message in convert_to_messages(input)
+    ]
+
+
+def _remainder(full: Any, prefix: Any) -> Any:
+    if isinstance(full, str):
+        return full[len(prefix) :]
+
+    return full.model_copy(update={"content": full.content[len(prefix.content) :]})
+
+
+class CachedLLM:
+    def __init__(
+        self,
+        llm,
+        cache: ResponseCache,
+        llm_provider: str | None = None,
+        llm_model_name: str | None = None,
+        params: dict | None = None,
+    ):
+        """
+        Wrap a LLM so its `invoke`, `ainvoke`, `stream` and `astream` responses
+        are served from a ResponseCache. Other attributes are passed through to
+        the wrapped LLM.
+
+        Requests are keyed on the provider, model, parameters (including the
+        `extra_body`) of the LLM, the messages or prompt and the call's
+        keyword arguments (e.g. sampling parameters).
+
+        Parameters
+        ----------
+        llm : LLM | BaseChatModel | Runnable
+            The LLM to wrap.
+        cache : ResponseCache
+            The response cache.
+        llm_provider : str | None, optional
+            The provider of the LLM. By default None.
+        llm_model_name : str | None, optional
+            The name of the LLM. By default None.
+        params : dict | None, optional
+            The parameters identifying the LLM in the cache key. If None, they
+            are obtained from the LLM. By default None.
+        """
+        self.llm = llm
+        self.cache: ResponseCache = cache
+        if params is None:
+            params = {"provider": llm_provider, "model": llm_model_name} | (
+                llm.dict() if hasattr(llm, "dict") else {}
+            )
+        self.params: dict = params
+
+    def __getattr__(self, name: str):
+        return getattr(self.llm, name)
+
+    def bind_tools(self, tools, **kwargs) -> "CachedLLM":
+        bound = self.llm.bind_tools(tools, **kwargs)
+        return CachedLLM(
+            bound,
+            self.cache,
+            params=self.params | {"bound_kwargs": getattr(bound, "kwargs", {})},
+        )
+
+    def _key(self, input: Any, kwargs: dict) -> str:
+        return self.cache.key(
+            {
+                "llm": self.params,
+                "input": _input_key_data(input),
+                "kwargs": kwargs,
+            }
+        )
+
+    def _miss(self, key: str) -> None:
+        if self.cache.cache_only:
+            raise KeyError(
+                f"Response not in the cache {self.cache.path} (key {key}) "
+                "and the cache is set to cache only."
+            )
+
+    def invoke(self, input: Any, config=None, **kwargs) -> Any:
+        key = self._key(input, kwargs)
+        entry = self.cache.lookup(key)
+        if entry is not None and entry[1]:
+            return entry[0]
+
+        self._miss(key)
+        response = self.llm.invoke(input, config, **kwargs)
+        self.cache.update(key, response)
+
+        return response
+
+    async def ainvoke(self, input: Any, config=None, **kwargs) -> Any:
+        key = self._key(input, kwargs)
+        entry = self.cache.lookup(key)
+        if entry is not None and entry[1]:
+            return entry[0]
+
+        self._miss(key)
+        response = await self.llm.ainvoke(input, config, **kwargs)
+        self.cache.update(key, response)
+
+        return response
+
+    def stream(self, input: Any, config=None, **kwargs):
+        key = self._key(input, kwargs)
+        entry = self.cache.lookup(key)
+        prefix = None
+        if entry is not None:
+            # cached responses are replayed as a single chunk
+            prefix, complete = entry
+            yield prefix
+            if complete:
+                return
+            # the caller stopped the stream early when it was cached
+            logging.warning(
+                "Cached response is incomplete, requesting the full response"
+            )
+
+        self._miss(key)
+        response, complete = None, False
+        try:
+            with closing(self.llm.stream(input, config, **kwargs)) as stream:
+                for chunk in stream:
+                    response = chunk if response is None else response + chunk
+                    if prefix is None:
+                        yield chunk
+                complete = True
+                if prefix is not None:
+                    # requests are seeded, so continue after the replayed prefix
+                    yield _remainder(response, prefix)
+        finally:
+            # streams closed early by the caller are stored incomplete
+            if response is not None:
+                self.cache.update(key, response, complete=complete)
+
+    async def astream(self, input: Any, config=None, **kwargs):
+        key = self._key(input, kwargs)
+        entry = self.cache.lookup(key)
+        prefix = None
+        if entry is not None:
+            prefix, complete = entry
+            yield prefix
+            if complete:
+                return
+            logging.warning(
+                "Cached response is incomplete, requesting the full response"
+            )
+
+        self._miss(key)
+        response, complete = None, False
+        try:
+            async with aclosing(self.llm.astream(input, config, **kwargs)) as stream:
+                async for chunk in stream:
+                    response = chunk if response is None else response + chunk
+                    if prefix is None:
+                        yield chunk
+                complete = True
+                if prefix is not None:
+                    yield _remainder(response, prefix)
+        finally:
+            if response is not None:
+                self.cache.update(key, response, complete=complete)
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+
+from langchain.storage import LocalFileStore, create_kv_docstore
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.stores import BaseStore
+from tqdm.asyncio import tqdm_asyncio
+
+from t0_1.query_vector_store.build_retriever import (
+    DEFAULT_RETRIEVER_CONFIG,
+    RetrieverConfig,
+    get_parent_doc_retriever,
+)
+from t0_1.utils import read_jsonl
+
+
+def snapshot_documents(documents: list[Document]) -> list[dict]:
+    """
+    The snapshot of the documents retrieved for a query: the id of each
+    parent document with its scored chunks (as attached to the
+    `sub_docs` by the CustomParentDocumentRetriever).
+    """
+    return [
+        {
+            "doc_id": doc.metadata["sub_docs"][0].metadata["doc_id"],
+            "source": doc.metadata.get("source"),
+            "sub_docs": [
+                {
+                    "id": sub_doc.id,
+                    "page_content": sub_doc.page_content,
+                    "metadata": sub_doc.metadata,
+                }
+                for sub_doc in doc.metadata["sub_docs"]
+            ],
+        }
+        for doc in documents
+    ]
+
+
+async def export_retrieval_snapshot(
+    retriever: BaseRetriever,
+    queries: list[str],
+    output_file: str | Path,
+    max_concurrency: int = 16,
+) -> int:
+    """
+    Retrieve the documents of each query and save them to a snapshot file,
+    to be used with a `SnapshotRetriever`.
+
+    Parameters
+    ----------
+    retriever : BaseRetriever
+        The retriever, e.g. a CustomParentDocumentRetriever.
+    queries : list[str]
+        The queries. Duplicates are retrieved once.
+    output_file : str | Path
+        The JSONL file to save the snapshot to.
+    max_concurrency : int, optional
+        The maximum number of queries retrieved at once. By default 16.
+
+    Returns
+    -------
+    int
+        The number of queries in the snapshot.
+    """
+    queries = list(dict.fromkeys(queries))
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _retrieve(query: str) -> dict:
+        async with semaphore:
+            documents = await retriever.ainvoke(input=query)
+        return {"query": query, "documents": snapshot_documents(documents)}
+
+    snapshots = await tqdm_asyncio.gather(
+        *[_retrieve(query) for query in queries], desc="Retrieving", unit="query"
+    )
+
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(output_file, "w") as f:
+        for snapshot in snapshots:
+            f.write(json.dumps(snapshot) + "\n")
+    logging.info(f"Saved the retrieval of {len(snapshots)} queries to {output_file}")
+
+    return len(snapshots)
+
+
+class SnapshotRetriever(BaseRetriever):
+    """
+    Retriever returning the documents saved for each query in a retrieval
+    snapshot (see `export_retrieval_snapshot`), with the parent documents
+    read from the docstore and their scored chunks attached as `sub_docs`.
+    No embedding model or vector store is loaded.
+
+    Queries not in the snapshot raise a KeyError, so that runs using the same
+    snapshot are evaluated on exactly the same documents.
+    """
+
+    snapshot: dict[str, list[dict]]
+    docstore: BaseStore[str, Document]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        if query not in self.snapshot:
+            raise KeyError(f"Query not found in the retrieval snapshot: {query!r}")
+
+        entries = self.snapshot[query]
+        parents = self.docstore.mget([entry["doc_id"] for entry in entries])
+
+        docs = []
+        for entry, doc in zip(entries, parents):
+            if doc is None:
+                logging.warning(
+                    f"Document {entry['doc_id']} ({entry['source']}) of the "
+                    "retrieval snapshot is not in the docstore"
+                )
+                continue
+
+            doc.metadata["sub_docs"] = [
+                Document(
+                    id=sub_doc["id"],
+                    page_content=sub_doc["page_content"],
+                    metadata=sub_doc["metadata"],
+                )
+                for sub_doc in entry["sub_docs"]
+            ]
+            docs.append(doc)
+
+        return docs
+
+
+def load_snapshot_retriever(
+    snapshot_file: str | Path, local_file_store: str | Path | None
+) -> SnapshotRetriever:
+    """
+    Load a retrieval snapshot with the docstore at `local_file_store` (the
+    docstore of the retriever the snapshot was exported from).
+    """
+    if not os.path.exists(snapshot_file):
+        raise FileNotFoundError(f"Retrieval snapshot {snapshot_file} does not exist.")
+    if local_file_store is None or not os.path.exists(local_file_store):
+        raise FileNotFoundError(
+            f"Local file store {local_file_store} does not exist. The docstore "
+            "of the retriever is needed to use a retrieval snapshot."
+        )
+
+    snapshot = {row["query"]: row["documents"] for row in read_jsonl(snapshot_file)}
+    logging.info(
+        f"Loaded the retrieval of {len(snapshot)} queries from {snapshot_file}"
+    )
+
+    return SnapshotRetriever(
+        snapshot=snapshot,
+        docstore=create_kv_docstore(LocalFileStore(local_file_store)),
+    )
+
+
+def main(
+    input_file: str | Path,
+    output_file: str | Path,
+    query_field: str,
+    conditions_file: str,
+    config: RetrieverConfig = DEFAULT_RETRIEVER_CONFIG,
+    force_create: bool = False,
+    trust_source: bool = False,
+    max_concurrency: int = 16,
+) -> int:
+    """
+    Export the retrieval of the queries in a JSONL file (e.g. the input of
+    `evaluate-rag`) to a snapshot file.
+    """
+    if config.local_file_store is None:
+        raise ValueError(
+            "A local file store is needed so the documents of the snapshot can "
+            "be read from the docstore."
+        )
+
+    retriever = get_parent_doc_retriever(
+        conditions_file=conditions_file,
+        config=config,
+        force_create=force_create,
+        trust_source=trust_source,
+    )
+    queries = [item[query_field] for item in read_jsonl(input_file)]
+
+    return asyncio.run(
+        export_retrieval_snapshot(
+            retriever, queries, output_file, max_concurrency=max_concurrency
+        )
+    )
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Iterable
+
+_END = object()
+
+
+async def aiterate_in_thread(iterable: Iterable) -> AsyncIterator:
+    """Iterate a blocking iterable without blocking the event loop."""
+    iterator = iter(iterable)
+    while (item := await asyncio.to_thread(next, iterator, _END)) is not _END:
+        yield item
+
+
+class _Broadcast:
+    def __init__(self):
+        """Chunks of a stream shared by all its subscribers, including late ones."""
+        self.chunks: list = []
+        self.done: bool = False
+        self.error: Exception | None = None
+        self._changed = asyncio.Condition()
+
+    async def produce(self, iterable: Iterable) -> None:
+        try:
+            async for chunk in aiterate_in_thread(iterable):
+                async with self._changed:
+                    self.chunks.append(chunk)
+                    self._changed.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    async def subscribe(self) -> AsyncIterator:
+        position = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(
+                    lambda: position < len(self.chunks) or self.done
+                )
+                chunks = self.chunks[position:]
+                done = self.done
+            for chunk in chunks:
+                yield chunk
+            position += len(chunks)
+            if done and position == len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        Coalesce identical concurrent requests: while a request with a given key
+        is in flight, requests with the same key wait for its result (or attach
+        to its stream) rather than executing again.
+        """
+        self._results: dict[str, asyncio.Task] = {}
+        self._streams: dict[str, _Broadcast] = {}
+        self.executed: int = 0
+        self.coalesced: int = 0
+
+    async def run(self, key: str, execute: Callable[[], Awaitable]):
+        """
+        Run `execute`, or wait for the in-flight execution with the same key.
+
+        Parameters
+        ----------
+        key : str
+            The key identifying identical requests.
+        execute : Callable[[], Awaitable]
+            Function starting the execution of the request.
+
+        Returns
+        -------
+        Any
+            The result of the (shared) execution.
+        """
+        task = self._results.get(key)
+        if task is None:
+            self.executed += 1
+            task = asyncio.ensure_future(execute())
+            self._results[key] = task
+            task.add_done_callback(lambda _: self._results.pop(key, None))
+        else:
+            self.coalesced += 1
+            logging.info(f"Coalescing request {key[:12]} with the in-flight request")
+
+        # shield the shared execution from the cancellation of one caller
+        return await asyncio.shield(task)
+
+    def stream(self, key: str, execute: Callable[[], Iterable]) -> AsyncIterator:
+        """
+        Stream the output of `execute`, or attach to the in-flight stream with
+        the same key. Subscribers that attach late receive the chunks streamed
+        so far first.
+
+        Parameters
+        ----------
+        key : str
+            The key identifying identical requests.
+        execute : Callable[[], Iterable]
+            Function returning the (blocking) stream of the request, which is
+            iterated in a thread.
+
+        Returns
+        -------
+        AsyncIterator
+            The chunks of the (shared) stream.
+        """
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            self.executed += 1
+            broadcast = _Broadcast()
+            self._streams[key] = broadcast
+            task = asyncio.ensure_future(broadcast.produce(execute()))
+            task.add_done_callback(lambda _: self._streams.pop(key, None))
+        else:
+            self.coalesced += 1
+            logging.info(f"Coalescing stream {key[:12]} with the in-flight stream")
+
+        return broadcast.subscribe()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._results) + len(self._streams),
+        }
@@ -0,0 +1,309 @@
+import functools
+import hashlib
+import json
+import logging
+import math
+import threading
+
+from langchain_core.messages import BaseMessage
+
+TOKEN_COUNTING_METHODS = ("tokenizer", "endpoint", "tiktoken", "approximate")
+
+
+class TokenCounter:
+    def __init__(
+        self,
+        method: str = "approximate",
+        model_name: str | None = None,
+        tokenizer_name: str | None = None,
+        tokenize_url: str | None = None,
+        tokens_per_message: int = 3,
+        chars_per_token: float = 4.0,
+        timeout: float = 10.0,
+        endpoint_cache_size: int = 4096,
+    ):
+        """
+        Count tokens of messages with the tokenizer of the model they are sent to.
+
+        Parameters
+        ----------
+        method : str, optional
+            How to count the tokens:
+            - "tokenizer": use the Hugging Face tokenizer `tokenizer_name`
+            - "endpoint": use the Hugging Face tokenizer `tokenizer_name` of the
+              model served by a vLLM server if it can be loaded, else the
+              `/tokenize` endpoint of the server at `tokenize_url`
+            - "tiktoken": use the tiktoken encoding of the OpenAI model `model_name`
+            - "approximate": estimate from the number of characters
+            By default "approximate". If the tokenizer cannot be loaded, it
+            falls back to "approximate". If a request to the endpoint fails,
+            only the tokens of that text are approximated.
+        model_name : str | None, optional
+            The name of the model. Used for the vLLM and tiktoken requests
+            and to identify the counts in the cache. By default None.
+        tokenizer_name : str | None, optional
+            The name of the Hugging Face tokenizer to use if method is
+            "tokenizer". If None, `model_name` is used. By default None.
+        tokenize_url : str | None, optional
+            The URL of the `/tokenize` endpoint if method is "endpoint".
+            By default None.
+        tokens_per_message : int, optional
+            Number of tokens added per message for the chat template.
+            By default 3.
+        chars_per_token : float, optional
+            Number of characters per token for approximate counting.
+            By default 4.0.
+        timeout : float, optional
+            Timeout (in seconds) of requests to the `/tokenize` endpoint.
+            By default 10.0.
+        endpoint_cache_size : int, optional
+            Number of texts whose counts from the `/tokenize` endpoint are
+            cached, as the same pages are often retrieved. By default 4096.
+        """
+        if method not in TOKEN_COUNTING_METHODS:
+            raise ValueError(
+                f"Unknown token counting method: {method}. "
+                f"Use one of {', '.join(TOKEN_COUNTING_METHODS)}."
+            )
+        if method == "endpoint" and tokenize_url is None:
+            raise ValueError(
+                "A `tokenize_url` is needed to count tokens with an endpoint."
+            )
+
+        self.method: str = method
+        self.model_name: str | None = model_name
+        self.tokenizer_name: str | None = tokenizer_name or model_name
+        self.tokenize_url: str | None = tokenize_url
+        self.tokens_per_message: int = tokens_per_message
+        self.chars_per_token: float = chars_per_token
+        self.timeout: float = timeout
+        self._encoder = None
+        self._lock = threading.Lock()
+        self._count_with_endpoint = functools.lru_cache(maxsize=endpoint_cache_size)(
+            self._request_count
+        )
+
+    @property
+    def name(self) -> str:
+        """Identifier of the counter, used to namespace cached counts."""
+        return f"{self.method}:{self.tokenizer_name or self.model_name}"
+
+    def _fall_back(self, err: Exception) -> None:
+        logging.warning(
+            f"Could not count tokens with {self.method} ({err}), "
+            "falling back to approximate token counting"
+        )
+        self.method = "approximate"
+
+    def _load_tokenizer(self):
+        from transformers import AutoTokenizer
+
+        logging.info(f"Loading tokenizer for token counting: {self.tokenizer_name}")
+        return AutoTokenizer.from_pretrained(self.tokenizer_name)
+
+    def _load_encoder(self):
+        with self._lock:
+            if self._encoder is None:
+                if self.method == "tokenizer":
+                    self._encoder = self._load_tokenizer()
+                elif self.method == "tiktoken":
+                    import tiktoken
+
+                    try:
+                        self._encoder = tiktoken.encoding_for_model(self.model_name)
+                    except KeyError:
+                        self._encoder = tiktoken.get_encoding("o200k_base")
+                elif self.method == "endpoint":
+                    # count locally with the tokenizer of the served model
+                    # rather than sending a request for each text
+                    try:
+                        self._encoder = self._load_tokenizer()
+                    except Exception as err:
+                        import httpx
+
+                        logging.warning(
+                            f"Could not load the tokenizer {self.tokenizer_name} "
+                            f"({err}), counting tokens with {self.tokenize_url}"
+                        )
+                        self._encoder = httpx.Client(timeout=self.timeout)
+
+        return self._encoder
+
+    @property
+    def uses_endpoint(self) -> bool:
+        """Whether the tokens are counted with requests to the `/tokenize` endpoint."""
+        import httpx
+
+        return self.method == "endpoint" and isinstance(self._encoder, httpx.Client)
+
+    def _request_count(self, text: str) -> int:
+        response = self._encoder.post(
+            self.tokenize_url,
+            json={
+                "model": self.model_name,
+                "prompt": text,
+                "add_special_tokens": False,
+            },
+        )
+        response.raise_for_status()
+        return response.json()["count"]
+
+    def count_text(self, text: str) -> int:
+        """
+        Count the tokens of a text.
+
+        Parameters
+        ----------
+        text : str
+            The text to count the tokens of.
+
+        Returns
+        -------
+        int
+            The number of tokens.
+        """
+        if not text:
+            return 0
+
+        if self.method != "approximate":
+            try:
+                encoder = self._load_encoder()
+            except Exception as err:
+                # the tokenizer cannot be loaded, so approximate from now on
+                self._fall_back(err)
+            else:
+                try:
+                    if self.method == "tiktoken":
+                        return len(encoder.encode(text, disallowed_special=()))
+                    if self.uses_endpoint:
+                        return self._count_with_endpoint(text)
+                    return len(encoder.encode(text, add_special_tokens=False))
+                except Exception as err:
+                    # e.g. a timeout while the server restarts: only approximate
+                    # this text and count the next ones with the method again
+                    logging.warning(
+                        f"Could not count tokens with {self.method} ({err}), "
+                        "approximating the tokens of the text"
+                    )
+
+        return math.ceil(len(text) / self.chars_per_token)
+
+    @staticmethod
+    def _message_text(message: BaseMessage) -> str:
+        if isinstance(message.content, str):
+            text = message.content
+        else:
+            text = "".join(
+                block if isinstance(block, str) else block.get("text", "")
+                for block in message.content
+            )
+
+        tool_calls = getattr(message, "tool_calls", None)
+        if tool_calls:
+            text += json.dumps(tool_calls, default=str)
+
+        return text
+
+    def message_key(self, message: BaseMessage) -> str:
+        """
+        Key of a message in the token count cache. This depends on the
+        counter and the message's type and content only, so equal messages
+        across turns share their count.
+        """
+        digest = hashlib.sha1(
+            f"{message.type}\0{self._message_text(message)}".encode()
+        ).hexdigest()
+
+        return f"{self.name}:{digest}"
+
+    def count_message(self, message: BaseMessage) -> int:
+        """
+        Count the tokens of a message, including the chat template overhead.
+        """
+        return self.count_text(self._message_text(message)) + self.tokens_per_message
+
+    def count_messages(
+        self, messages: list[BaseMessage], cache: dict[str, int] | None = None
+    ) -> int:
+        """
+        Count the tokens of messages, only counting the messages not in the cache.
+
+        Parameters
+        ----------
+        messages : list[BaseMessage]
+            The messages to count the tokens of.
+        cache : dict[str, int] | None, optional
+            The cached per-message token counts (see `message_key`), which is
+            updated in place with the newly counted messages. By default None.
+
+        Returns
+        -------
+        int
+            The total number of tokens of the messages.
+        """
+        if cache is None:
+            return sum(self.count_message(message) for message in messages)
+
+        total = 0
+        for message in messages:
+            key = self.message_key(message)
+            if key not in cache:
+                cache[key] = self.count_message(message)
+            total += cache[key]
+
+        return total
+
+
+def get_token_counter(
+    llm_provider: str | None,
+    llm_model_name: str | None,
+    llm=None,
+    tokenizer_name: str | None = None,
+) -> TokenCounter:
+    """
+    Get the token counter matching how a LLM is served.
+
+    Hugging Face models use their tokenizer, models served with an OpenAI
+    compatible endpoint (e.g. vLLM) use its `/tokenize` endpoint, OpenAI models
+    on Azure use tiktoken and others are approximated.
+
+    Parameters
+    ----------
+    llm_provider : str | None
+        The provider of the LLM (see `load_llm`).
+    llm_model_name : str | None
+        The name of the LLM.
+    llm : optional
+        The loaded LLM, used to obtain the base URL of OpenAI compatible
+        endpoints. By default None.
+    tokenizer_name : str | None, optional
+        The name of a Hugging Face tokenizer to use instead. By default None.
+
+    Returns
+    -------
+    TokenCounter
+        The token counter for the LLM.
+    """
+    if tokenizer_name is not None or llm_provider == "huggingface":
+        return TokenCounter(
+            method="tokenizer",
+            model_name=llm_model_name,
+            tokenizer_name=tokenizer_name,
+        )
+
+    if llm_provider in ("openai", "openai_completion"):
+        base_url = getattr(llm, "openai_api_base", None)
+        if base_url:
+            tokenize_url = base_url.rstrip("/").removesuffix("/v1") + "/tokenize"
+            return TokenCounter(
+                method="endpoint",
+                model_name=llm_model_name,
+                tokenize_url=tokenize_url,
+            )
+
+        return TokenCounter(method="tiktoken", model_name=llm_model_name)
+
+    if llm_provider == "azure_openai":
+        return TokenCounter(method="tiktoken", model_name=llm_model_name)
+
+    return TokenCounter(method="approximate", model_name=llm_model_name)
@@ -1,5 +1,11 @@
+import re
 from typing import Callable
 
+# marker that starts the answer section of s1-style (budget forcing) responses
+S1_ANSWER_DELIMITER = "<|im_start|>answer"
+# structured answer of s1-style responses, i.e. (condition, severity)
+S1_ANSWER_PATTERN = re.compile(r"\(([^)]*), ([^)]+)\)")
+
 NHS_RETRIEVER_TOOL_PROMPT = """You are a helpful clinical AI assistant deployed in the United Kingdom
 
 You are provided a tool that can retrieve context from a knowledge base taken from NHS condition web pages which provide information about various medical conditions.
@@ -96,3 +102,39 @@ def create_retreiver_tool(callable: Callable):
     )
 
     return tool
+
+
+class AnswerStopDetector:
+    """
+    Detect when a streamed s1-style response has emitted its structured
+    `(condition, severity)` answer, using the same grammar as `parse_s1`.
+
+    Chunks of the response are passed to `update` as they are streamed;
+    once it returns True the rest of the generation is not needed and the
+    stream can be closed.
+    """
+
+    def __init__(self):
+        self.text: str = ""
+        self.answer_found: bool = False
+
+    def update(self, chunk: str) -> bool:
+        """
+        Add a streamed chunk and check whether the answer has been emitted.
+
+        Parameters
+        ----------
+        chunk : str
+            The next chunk of the streamed response.
+
+        Returns
+        -------
+        bool
+            True if a parseable answer tuple has been emitted.
+        """
+        if not self.answer_found:
+            self.text += chunk
+            answer = self.text.split(S1_ANSWER_DELIMITER)[-1]
+            self.answer_found = S1_ANSWER_PATTERN.search(answer) is not None
+
+        return self.answer_found
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate
+
+from t0_1.rag.build_rag import RAG
+from t0_1.rag.profile_startup import StartupProfile
+from t0_1.rag.response_cache import CachedLLM
+from t0_1.rag.utils import NHS_RETRIEVER_TOOL_PROMPT, ROUTER_RESPONSE_PROMPT
+
+DEFAULT_WARM_UP_QUERIES = [
+    "I have a headache and a high temperature",
+    "I have had a sore throat and a cough for a week",
+]
+
+
+@dataclass
+class WarmUpConfig:
+    """
+    Configuration of the warm up of the RAG before it is reported ready.
+
+    - queries: synthetic queries to retrieve (and rerank) documents for, which
+      runs the embedding model and reads the index and docstore.
+    - tokenizers: whether to load the tokenizers (budget forcing and token
+      counting).
+    - connections: whether to open the connections to the LLM endpoints, of
+      both the sync and the async clients.
+    - prefix_cache: whether to send the system prompts to the LLM endpoints
+      (generating a single token) so they are in the vLLM prefix cache.
+    """
+
+    queries: list[str] = field(default_factory=lambda: list(DEFAULT_WARM_UP_QUERIES))
+    tokenizers: bool = True
+    connections: bool = True
+    prefix_cache: bool = False
+
+
+class WarmUpError(Exception):
+    """Raised when a stage of the warm up needed to serve requests fails."""
+
+
+def _unwrap(llm):
+    return llm.llm if isinstance(llm, CachedLLM) else llm
+
+
+def _llms(rag: RAG) -> dict[str, object]:
+    llms = {
+        "llm": rag.llm,
+        "conversational_agent_llm": rag.conversational_agent_llm,
+        "rerank_llm": rag.rerank_llm,
+    }
+    return {name: _unwrap(llm) for name, llm in llms.items() if llm is not None}
+
+
+def _static_prefix(template: str) -> str:
+    """The part of a prompt template before its first variable."""
+    return template.split("{", 1)[0]
+
+
+def system_prompt_prefixes(rag: RAG) -> dict[str, list[str]]:
+    """
+    The fixed prefixes of the system prompts sent to each LLM of the RAG,
+    i.e. the prefixes shared by all requests.
+    """
+    prefixes = {}
+    if isinstance(rag.prompt, ChatPromptTemplate):
+        prefixes["llm"] = [
+            _static_prefix(message.prompt.template)
+            for message in rag.prompt.messages
+            if isinstance(message, SystemMessagePromptTemplate)
+        ]
+    if rag.conversational and rag.conversational_agent_llm is not None:
+        prefixes["conversational_agent_llm"] = [
+            NHS_RETRIEVER_TOOL_PROMPT,
+            ROUTER_RESPONSE_PROMPT,
+        ]
+
+    return {
+        name: [prefix for prefix in values if prefix.strip()]
+        for name, values in prefixes.items()
+    }
+
+
+def _prime_prefix_cache(rag: RAG, llm, prefix: str) -> None:
+    from langchain_core.language_models.llms import BaseLLM
+
+    if isinstance(llm, BaseLLM):
+        # completion endpoints get the prompt with the chat template applied,
+        # as in `RAG._budget_forcing_invoke`
+        if not rag.budget_forcing:
+            return
+        rendered = rag.set_up_tokenizer().apply_chat_template(
+            [{"role": "system", "content": prefix}], tokenize=False
+        )
+        llm.invoke(rendered[: rendered.index(prefix) + len(prefix)], max_tokens=1)
+    else:
+        llm.invoke([SystemMessage(prefix)], max_tokens=1)
+
+
+def _warm_up_stages(rag: RAG, config: WarmUpConfig, profile: StartupProfile) -> None:
+    with profile.stage("retrieval"):
+        for query in config.queries:
+            try:
+                docs = rag.retriever.invoke(input=query)
+                if rag.cross_encoder_reranker is not None:
+                    rag.cross_encoder_reranker.score_documents(query, docs)
+            except Exception as e:
+                raise WarmUpError(f"Warm up retrieval failed: {e}") from e
+
+    if config.tokenizers:
+        with profile.stage("tokenizers"):
+            try:
+                if rag.budget_forcing:
+                    rag.set_up_tokenizer()
+                for counter in {
+                    id(c): c
+                    for c in (rag.token_counter, rag.conversational_agent_token_counter)
+                }.values():
+                    counter.count_text("warm up")
+            except Exception as e:
+                logging.warning(f"Warm up of the tokenizers failed: {e}")
+
+    if config.connections:
+        with profile.stage("connections"):
+            for name, llm in _llms(rag).items():
+                root_client = getattr(llm, "root_client", None)
+                if root_client is None:
+                    continue
+                try:
+                    root_client.models.list()
+                except Exception as e:
+                    logging.warning(f"Warm up of the {name} connection failed: {e}")
+
+    if config.prefix_cache:
+        with profile.stage("prefix cache"):
+            llms = _llms(rag)
+            for name, prefixes in system_prompt_prefixes(rag).items():
+                for prefix in prefixes:
+                    try:
+                        _prime_prefix_cache(rag, llms[name], prefix)
+                    except Exception as e:
+                        logging.warning(
+                            f"Priming the prefix cache of the {name} failed: {e}"
+                        )
+
+
+def warm_up_rag(rag: RAG, config: WarmUpConfig | None = None) -> StartupProfile:
+    """
+    Warm up a RAG so that the first requests do not pay for loading models,
+    cold index reads or opening connections.
+
+    Retrieval failures raise a `WarmUpError` as the RAG cannot serve requests.
+    Failures of the other stages (e.g. an LLM endpoint that is still starting)
+    are logged and the warm up continues.
+
+    Parameters
+    ----------
+    rag : RAG
+        The RAG to warm up.
+    config : WarmUpConfig | None, optional
+        Configuration of the warm up. If None, the default is used.
+        By default None.
+
+    Returns
+    -------
+    StartupProfile
+        The timings of the warm up stages.
+    """
+    config = config or WarmUpConfig()
+    profile = StartupProfile()
+    _warm_up_stages(rag, config, profile)
+    logging.info(f"Warm up finished:\n{profile.report()}")
+
+    return profile
+
+
+async def awarm_up_rag(rag: RAG, config: WarmUpConfig | None = None) -> StartupProfile:
+    """
+    Warm up a RAG as `warm_up_rag`, also opening the connections of the async
+    clients of the LLMs, which serve the async endpoints (e.g. /query_stream).
+
+    The blocking stages run in a thread. The async connections are opened
+    on the running event loop, which must be the loop of the server as the
+    connections of an async client are bound to the loop that opened them.
+
+    Parameters
+    ----------
+    rag : RAG
+        The RAG to warm up.
+    config : WarmUpConfig | None, optional
+        Configuration of the warm up. If None, the default is used.
+        By default None.
+
+    Returns
+    -------
+    StartupProfile
+        The timings of the warm up stages.
+    """
+    config = config or WarmUpConfig()
+    profile = StartupProfile()
+    await asyncio.to_thread(_warm_up_stages, rag, config, profile)
+
+    if config.connections:
+        with profile.stage("async connections"):
+            for name, llm in _llms(rag).items():
+                root_async_client = getattr(llm, "root_async_client", None)
+                if root_async_client is None:
+                    continue
+                try:
+                    await root_async_client.models.list()
+                except Exception as e:
+                    logging.warning(
+                        f"Warm up of the {name} async connection failed: {e}"
+                    )
+
+    logging.info(f"Warm up finished:\n{profile.report()}")
+
+    return profile
@@ -11,7 +11,13 @@ from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 from langchain_core.documents import Document
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    HumanMessage,
+    SystemMessage,
+    ToolMessage,
+)
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
 
 from t0_1.rag.build_rag import (
@@ -58,7 +64,11 @@ def _make_fake_llm(response_text: str = "This is a test response"):
     llm.ainvoke = AsyncMock(return_value=AIMessage(content=response_text))
     # For stream, yield the response in chunks
     llm.stream.return_value = iter([response_text])
-    llm.astream = MagicMock(return_value=iter([response_text]))
+
+    async def _astream(*args, **kwargs):
+        yield response_text
+
+    llm.astream = MagicMock(side_effect=_astream)
     # Support bind_tools for conversational mode
     llm.bind_tools = MagicMock(return_value=llm)
     return llm
@@ -874,6 +884,37 @@ class TestRouterRespond:
         assert "messages" in result
         assert isinstance(result["messages"][0], AIMessage)
 
+    @patch("t0_1.rag.build_rag.get_stream_writer")
+    def test_arouter_respond_streams_tokens(self, mock_get_writer):
+        """Async arouter_respond must forward each router chunk as it arrives."""
+        import asyncio
+
+        writer = MagicMock()
+        mock_get_writer.return_value = writer
+        rag = _build_test_rag(conversational=True)
+
+        async def astream(messages):
+            for token in ["You ", "may ", "have a headache."]:
+                yield AIMessageChunk(content=token)
+
+        rag.conversational_agent_llm.astream = MagicMock(side_effect=astream)
+        state = self._make_router_state()
+        config = {"metadata": {"langgraph_node": "router_respond"}}
+        result = asyncio.run(rag.arouter_respond(state, config))
+
+        written = [call.args[0][0].content for call in writer.call_args_list]
+        assert written[1:4] == ["You ", "may ", "have a headache."]
+        assert result["messages"][0].content.endswith("You may have a headache.")
+        assert result["router_ttft"][-1] <= result["router_latency"][-1]
+        rag.conversational_agent_llm.ainvoke.assert_not_called()
+
+    def test_router_node_has_async_implementation(self):
+        """The router node should run arouter_respond when the graph runs async."""
+        rag = _build_test_rag(conversational=True)
+        node = rag.graph.nodes["router_respond"].bound
+        assert node.func == rag.router_respond
+        assert node.afunc == rag.arouter_respond
+
     @patch("t0_1.rag.build_rag.get_stream_writer")
     def test_router_respond_does_not_leak_t0_reasoning_to_messages(
         self, mock_get_writer
@@ -963,3 +1004,2729 @@ class TestStreamingFilter:
             "_query_stream must include 'router_respond' in its streaming filter "
             "so the router's tokens are yielded to the user"
         )
+
+
+# ---------------------------------------------------------------------------
+# 13. Retriever hot reload
+# ---------------------------------------------------------------------------
+
+
+class TestRetrieverHotReload:
+    """Verify the retriever can be swapped without rebuilding the RAG."""
+
+    def test_swap_retriever_returns_old_and_keeps_memory(self):
+        """swap_retriever should swap the retriever but keep the graph and memory."""
+        rag = _build_test_rag(conversational=False)
+        old_retriever = rag.retriever
+        graph, memory = rag.graph, rag.memory
+        new_retriever = _make_fake_retriever([_make_doc("flu", "Flu info", 0.1)])
+
+        returned = rag.swap_retriever(new_retriever)
+
+        assert returned is old_retriever
+        assert rag.retriever is new_retriever
+        assert rag.graph is graph
+        assert rag.memory is memory
+        result = rag.retrieve({"question": "I have a fever"})
+        assert result["context"][-1][0].metadata["source"] == "flu"
+
+    def test_reload_rag_retriever_warms_and_swaps(self, tmp_path):
+        """reload_rag_retriever should load, warm up and then swap the retriever."""
+        from t0_1.query_vector_store.build_retriever import DEFAULT_RETRIEVER_CONFIG
+        from t0_1.rag.build_rag import reload_rag_retriever
+
+        rag = _build_test_rag(conversational=False)
+        rag.retriever_config = DEFAULT_RETRIEVER_CONFIG
+        (tmp_path / "db").mkdir()
+        (tmp_path / "fs").mkdir()
+        new_retriever = _make_fake_retriever()
+
+        with patch(
+            "t0_1.rag.build_rag.load_parent_doc_retriever",
+            return_value=new_retriever,
+        ) as mock_load:
+            config = reload_rag_retriever(
+                rag, tmp_path / "db", tmp_path / "fs", warm_up_query="warm"
+            )
+
+        assert rag.retriever is new_retriever
+        assert rag.retriever_config == config
+        assert config.persist_directory == str(tmp_path / "db")
+        assert config.k == DEFAULT_RETRIEVER_CONFIG.k
+        new_retriever.invoke.assert_called_once_with(input="warm")
+        # the embedding model of the current retriever is reused
+        assert mock_load.call_args.kwargs["embedding_model"] is not None
+
+    def test_reload_rag_retriever_missing_directory(self, tmp_path):
+        """reload_rag_retriever should refuse to swap in a missing index."""
+        from t0_1.rag.build_rag import reload_rag_retriever
+
+        rag = _build_test_rag(conversational=False)
+        old_retriever = rag.retriever
+        with pytest.raises(FileNotFoundError):
+            reload_rag_retriever(rag, tmp_path / "missing-db", tmp_path / "fs")
+        assert rag.retriever is old_retriever
+
+    def test_reload_retriever_endpoint(self, tmp_path):
+        """The reload endpoint should report the status of the background reload."""
+        from fastapi.testclient import TestClient
+
+        from t0_1.rag.rag_endpoint import create_rag_app
+
+        rag = _build_test_rag(conversational=False)
+        client = TestClient(create_rag_app(rag))
+        with patch("t0_1.rag.rag_endpoint.reload_rag_retriever") as mock_reload:
+            response = client.post(
+                "/reload_retriever",
+                json={"persist_directory": "db", "local_file_store": "fs"},
+            )
+        assert response.status_code == 202
+        assert response.json()["status"] == "loading"
+        mock_reload.assert_called_once()
+        assert client.get("/reload_retriever_status").json()["status"] == "ready"
+
+    def test_reload_retriever_endpoint_rejects_several_workers(self):
+        """The reload endpoint should refuse reloads that only reach one worker."""
+        from fastapi.testclient import TestClient
+
+        from t0_1.rag.rag_endpoint import create_rag_app
+
+        rag = _build_test_rag(conversational=False)
+        client = TestClient(create_rag_app(rag, workers=2))
+        with patch("t0_1.rag.rag_endpoint.reload_rag_retriever") as mock_reload:
+            response = client.post(
+                "/reload_retriever",
+                json={"persist_directory": "db", "local_file_store": "fs"},
+            )
+        assert response.status_code == 409
+        mock_reload.assert_not_called()
+
+
+# ---------------------------------------------------------------------------
+# 14. Cross-encoder reranking
+# ---------------------------------------------------------------------------
+
+
+class TestCrossEncoderRerank:
+    """Verify the local cross-encoder reranker used instead of the LLM reranker."""
+
+    @staticmethod
+    def _make_cross_encoder(scores: dict[str, float]):
+        from t0_1.rag.cross_encoder_reranker import CrossEncoderReranker
+
+        model = MagicMock()
+        model.predict.side_effect = lambda pairs, batch_size: [
+            scores[text] for _, text in pairs
+        ]
+        return CrossEncoderReranker(model=model)
+
+    def _make_rag(self, reranker):
+        docs = [_make_doc(f"doc-{i}", f"Doc {i} info", 0.1 * i) for i in range(3)]
+        for i, doc in enumerate(docs):
+            doc.metadata["sub_docs"][0].page_content = f"chunk-{i}"
+            doc.metadata["sub_docs"][0].metadata["doc_id"] = f"id-{i}"
+
+        rag = RAG(
+            retriever=_make_fake_retriever(docs),
+            prompt=_make_prompt_template(),
+            llm=_make_fake_llm(),
+            rerank=True,
+            rerank_k=2,
+            rerank_method="cross_encoder",
+            cross_encoder_reranker=reranker,
+        )
+        return rag, docs
+
+    def test_selects_highest_scoring_documents(self):
+        """The top rerank_k documents by cross-encoder score should be kept."""
+        reranker = self._make_cross_encoder(
+            {"chunk-0": -2.0, "chunk-1": 3.0, "chunk-2": 1.0}
+        )
+        rag, docs = self._make_rag(reranker)
+
+        result = rag.rerank_documents(
+            {"retriever_queries": ["fever"], "context": [docs]}
+        )
+
+        assert result["reranked_context"][-1] == [docs[1], docs[2]]
+        assert result["reranker_response_processed"][-1] == ["doc-1", "doc-2"]
+        assert result["reranker_success"][-1] is True
+        assert result["reranker_response"][-1].startswith("doc-1 (3.000)")
+
+    def test_scores_are_cached(self):
+        """Repeated queries should not re-score already scored documents."""
+        reranker = self._make_cross_encoder(
+            {"chunk-0": 0.0, "chunk-1": 1.0, "chunk-2": 2.0}
+        )
+        rag, docs = self._make_rag(reranker)
+        state = {"retriever_queries": ["fever"], "context": [docs]}
+
+        rag.rerank_documents(state)
+        rag.rerank_documents(state)
+
+        reranker.model.predict.assert_called_once()
+
+    def test_falls_back_on_failure(self):
+        """A failing cross-encoder should fall back to the top retrieved documents."""
+        reranker = self._make_cross_encoder({})
+        rag, docs = self._make_rag(reranker)
+
+        result = rag.rerank_documents(
+            {"retriever_queries": ["fever"], "context": [docs]}
+        )
+
+        assert result["reranked_context"][-1] == docs[:2]
+        assert result["reranker_success"][-1] is False
+
+    def test_build_rag_rejects_unknown_rerank_method(self):
+        """build_rag should reject an unknown rerank method."""
+        from t0_1.rag.build_rag import build_rag
+
+        with pytest.raises(ValueError, match="Unknown rerank method"):
+            build_rag(
+                conditions_file="dummy.json",
+                llm_provider="openai",
+                llm_model_name="test",
+                rerank_method="bm25",
+            )
+
+
+# ---------------------------------------------------------------------------
+# 15. Confidence-gated reranker skipping
+# ---------------------------------------------------------------------------
+
+
+class TestRerankSkip:
+    """Verify reranking is skipped when the retrieval distances leave no doubt."""
+
+    def _make_rag(self, scores, **kwargs):
+        docs = [_make_doc(f"doc-{i}", f"Doc {i}", score) for i, score in enumerate(scores)]
+        rag = RAG(
+            retriever=_make_fake_retriever(docs),
+            prompt=_make_prompt_template(),
+            llm=_make_fake_llm(),
+            rerank=True,
+            rerank_llm=_make_fake_llm("doc-1"),
+            rerank_prompt=PromptTemplate.from_template(
+                "{symptoms_description} {document_titles} {document_text} {k}"
+            ),
+            rerank_k=1,
+            **kwargs,
+        )
+        return rag, docs
+
+    def test_retrieval_score_margin(self):
+        """The margin compares the first dropped and the last kept distances."""
+        from t0_1.rag.build_rag import retrieval_score_margin
+
+        gap, ratio = retrieval_score_margin([0.2, 0.3, 0.9], k=2)
+        assert gap == pytest.approx(0.6)
+        assert ratio == pytest.approx(3.0)
+        assert retrieval_score_margin([0.2, 0.3], k=2) == (None, None)
+
+    def test_skips_when_gap_is_large(self):
+        """A large gap should bypass the reranker and keep the top retrieved docs."""
+        rag, docs = self._make_rag([0.1, 0.8], rerank_skip_gap=0.5)
+
+        result = rag.rerank_documents(
+            {"retriever_queries": ["fever"], "context": [docs]}
+        )
+
+        rag.rerank_llm.invoke.assert_not_called()
+        assert result["reranked_context"][-1] == [docs[0]]
+        assert result["reranker_skipped"][-1] is True
+        assert result["reranker_latency"][-1] >= 0
+
+    def test_reranks_when_not_confident(self):
+        """A small ratio should still call the reranker."""
+        rag, docs = self._make_rag([0.4, 0.5], rerank_skip_ratio=2.0)
+
+        result = rag.rerank_documents(
+            {"retriever_queries": ["fever"], "context": [docs]}
+        )
+
+        rag.rerank_llm.invoke.assert_called_once()
+        assert result["reranked_context"][-1] == [docs[1]]
+        assert result["reranker_skipped"][-1] is False
+
+    def test_rerank_skip_tradeoff(self):
+        """The trade-off simulation should skip queries above each threshold."""
+        from t0_1.rag.evaluate import rerank_skip_tradeoff
+
+        results = [
+            {
+                "target_document_field": "target",
+                "target": "a",
+                "retrieved_documents_sources": ["a", "b"],
+                "reranked_documents_sources": ["a"],
+                "reranker_skipped": False,
+                "reranker_latency": 1.0,
+                "retrieval_score_gap": 0.6,
+            },
+            {
+                "target_document_field": "target",
+                "target": "d",
+                "retrieved_documents_sources": ["c", "d"],
+                "reranked_documents_sources": ["d"],
+                "reranker_skipped": False,
+                "reranker_latency": 1.0,
+                "retrieval_score_gap": 0.1,
+            },
+        ]
+
+        never, skip_one, skip_all = rerank_skip_tradeoff(
+            results, k=1, thresholds=[0.5, 0.0]
+        )
+
+        assert never["skip_rate"] == 0 and never["retriever_match_rate"] == 1
+        assert never["mean_reranker_latency"] == 1.0
+        assert skip_one["skip_rate"] == 0.5 and skip_one["retriever_match_rate"] == 1
+        assert skip_one["skip_agreement_rate"] == 1
+        assert skip_all["retriever_match_rate"] == 0.5
+        assert skip_all["mean_reranker_latency"] == 0.0
+
+    def test_rerank_skip_tradeoff_baseline_skips_nothing(self):
+        """The never-skip baseline should not count queries skipped in the run."""
+        from t0_1.rag.evaluate import rerank_skip_tradeoff
+
+        results = [
+            {
+                "target_document_field": "target",
+                "target": "a",
+                "retrieved_documents_sources": ["a", "b"],
+                "reranked_documents_sources": [],
+                "reranker_skipped": True,
+                "reranker_latency": None,
+                "retrieval_score_gap": 0.6,
+            },
+        ]
+
+        never, skip = rerank_skip_tradeoff(results, k=1, thresholds=[0.9])
+
+        assert never["skip_rate"] == 0 and never["retriever_match_rate"] == 1
+        assert skip["skip_rate"] == 1
+
+
+# ---------------------------------------------------------------------------
+# 16. Early stop of the T0 answer stream
+# ---------------------------------------------------------------------------
+
+
+class TestAnswerEarlyStop:
+    """Verify the answer stream is closed once the answer tuple is emitted."""
+
+    CHUNKS = ["<|im_start|>answer\n", "(flu, ", "Urgent)", " and more text"]
+
+    def test_answer_stop_detector(self):
+        """The detector should only fire once a complete tuple is streamed."""
+        from t0_1.rag.utils import AnswerStopDetector
+
+        detector = AnswerStopDetector()
+        assert [detector.update(chunk) for chunk in self.CHUNKS] == [
+            False,
+            False,
+            True,
+            True,
+        ]
+
+    def test_parse_s1_uses_shared_grammar(self):
+        """parse_s1 should still extract the condition and severity."""
+        from t0_1.rag.evaluate import parse_s1
+
+        assert parse_s1("think<|im_start|>answer\n(flu, Urgent)") == ("flu", "Urgent")
+
+    def test_stream_completion_stops_and_closes(self):
+        """The stream should be closed as soon as the answer is emitted."""
+        rag = _build_test_rag(conversational=False)
+        closed = []
+
+        def stream(prompt, **kwargs):
+            try:
+                yield from self.CHUNKS
+            finally:
+                closed.append(True)
+
+        rag.llm.stream = stream
+        writer = MagicMock()
+
+        response = rag._stream_completion(
+            "prompt", config={"metadata": {}}, writer=writer, early_stop=True
+        )
+
+        assert response == "".join(self.CHUNKS[:3])
+        assert closed == [True]
+        assert writer.call_count == 3
+
+    def test_astream_completion_without_early_stop(self):
+        """Without early stop the whole completion should be returned."""
+        import asyncio
+
+        rag = _build_test_rag(conversational=False)
+
+        async def astream(prompt, **kwargs):
+            for chunk in self.CHUNKS:
+                yield chunk
+
+        rag.llm.astream = astream
+
+        response = asyncio.run(
+            rag._astream_completion(
+                "prompt", config={"metadata": {}}, writer=MagicMock(), write=False
+            )
+        )
+
+        assert response == "".join(self.CHUNKS)
+
+    def test_early_stop_only_when_answer_not_streamed(self):
+        """Early stopping should be on for non-streamed answers unless disabled."""
+        rag = _build_test_rag(conversational=True)
+        rag.budget_forcing_kwargs = {}
+        assert rag._early_stop_answer(stream_answer=False)
+        assert not rag._early_stop_answer(stream_answer=True)
+        rag.budget_forcing_kwargs = {"early_stop_answer": False}
+        assert not rag._early_stop_answer(stream_answer=False)
+
+
+# ---------------------------------------------------------------------------
+# 17. Token-budgeted context assembly
+# ---------------------------------------------------------------------------
+
+
+PAGE = "\n".join(
+    [
+        "Flu",
+        "Flu is a common infectious viral illness spread by coughs and sneezes.",
+        "Symptoms of flu",
+        "A sudden high temperature of 38C or above.",
+        "An aching body and feeling tired or exhausted.",
+        "A dry cough and a sore throat.",
+        "How to treat flu yourself",
+        "Rest and sleep, keep warm and drink plenty of water.",
+        "Take paracetamol or ibuprofen to lower your temperature.",
+    ]
+)
+
+
+def _make_page_doc(chunks_and_scores):
+    sub_docs = [
+        Document(page_content=chunk, metadata={"score": score, "doc_id": "flu"})
+        for chunk, score in chunks_and_scores
+    ]
+    return Document(page_content=PAGE, metadata={"source": "flu", "sub_docs": sub_docs})
+
+
+class TestContextAssembly:
+    """Verify the retrieved pages are cut down to the lines around their chunks."""
+
+    def test_match_chunk_lines_handles_decoded_chunks(self):
+        """Chunks decoded from tokens should still be located in the page."""
+        from t0_1.rag.context_assembly import match_chunk_lines
+
+        chunk = "an aching body and feeling tired or exhausted. a dry cough"
+        assert match_chunk_lines(PAGE.split("\n"), chunk) == [4, 5]
+        assert match_chunk_lines(PAGE.split("\n"), "nothing to see here") == []
+
+    def test_assemble_context_respects_budget(self):
+        """Chunks are added best first with their header until the budget is used."""
+        from t0_1.rag.context_assembly import assemble_context
+
+        doc = _make_page_doc(
+            [
+                ("take paracetamol or ibuprofen to lower your temperature", 0.2),
+                ("a dry cough and a sore throat", 0.1),
+            ]
+        )
+        contents, stats = assemble_context(
+            [doc], max_tokens=12, count_tokens=lambda text: len(text.split())
+        )
+
+        assert contents[0] == "\n".join(
+            [
+                "Symptoms of flu",
+                "...",
+                "A dry cough and a sore throat.",
+            ]
+        )
+        assert stats["assembled_tokens"] <= 12
+        assert stats["saved_tokens"] == stats["full_tokens"] - stats["assembled_tokens"]
+
+    def test_assemble_context_skips_list_items_as_headers(self):
+        """A chunk starting at a bullet should use the section header above it."""
+        from t0_1.rag.context_assembly import assemble_context
+
+        page = "\n".join(
+            [
+                "Symptoms of flu",
+                "- a high temperature",
+                "- a dry cough",
+                "- a sore throat",
+            ]
+        )
+        doc = Document(
+            page_content=page,
+            metadata={
+                "source": "flu",
+                "sub_docs": [
+                    Document(
+                        page_content="a dry cough a sore throat",
+                        metadata={"score": 0.1},
+                    )
+                ],
+            },
+        )
+        contents, _ = assemble_context(
+            [doc],
+            max_tokens=100,
+            count_tokens=lambda text: len(text.split()),
+            neighbour_lines=0,
+        )
+
+        assert contents[0] == "\n".join(
+            ["Symptoms of flu", "...", "- a dry cough", "- a sore throat"]
+        )
+
+    def test_obtain_context_and_sources_with_budget(self):
+        """The RAG should use the assembled context and report the tokens saved."""
+        rag = _build_test_rag(conversational=False)
+        rag.context_max_tokens = 50
+        doc = _make_page_doc([("a dry cough and a sore throat", 0.1)])
+
+        result = rag.obtain_context_and_sources({"context": [[doc]]})
+
+        assert "A dry cough and a sore throat." in result["serialised_docs"]
+        assert "Rest and sleep" not in result["serialised_docs"]
+        assert result["token_stats"]["saved_tokens"] > 0
+
+    def test_obtain_context_and_sources_without_budget(self):
+        """Without a budget the full pages should be used."""
+        rag = _build_test_rag(conversational=False)
+        doc = _make_page_doc([("a dry cough and a sore throat", 0.1)])
+
+        result = rag.obtain_context_and_sources({"context": [[doc]]})
+
+        assert PAGE in result["serialised_docs"]
+        assert result["token_stats"] is None
+
+
+# ---------------------------------------------------------------------------
+# 18. Model-aware token counting for trimming
+# ---------------------------------------------------------------------------
+
+
+class TestTokenCounting:
+    """Verify message trimming counts tokens per model and caches the counts."""
+
+    def test_count_messages_only_counts_new_messages(self):
+        """Cached messages should not be counted again."""
+        from t0_1.rag.token_counting import TokenCounter
+
+        counter = TokenCounter()
+        counter.count_text = MagicMock(side_effect=lambda text: len(text.split()))
+        cache = {}
+        first = [HumanMessage("I have a headache"), AIMessage("How long for?")]
+
+        total = counter.count_messages(first, cache)
+        total_next_turn = counter.count_messages(
+            first + [HumanMessage("Two days")], cache
+        )
+
+        assert total == (4 + 3) + (3 + 3)
+        assert total_next_turn == total + 2 + 3
+        assert counter.count_text.call_count == 3
+
+    def test_endpoint_counting(self):
+        """The vLLM /tokenize endpoint should be used to count tokens."""
+        import json
+
+        import httpx
+
+        from t0_1.rag.token_counting import TokenCounter
+
+        requests = []
+
+        def handler(request):
+            requests.append(json.loads(request.content))
+            return httpx.Response(200, json={"count": 7, "tokens": [0] * 7})
+
+        counter = TokenCounter(
+            method="endpoint",
+            model_name="t0",
+            tokenize_url="http://vllm:8000/tokenize",
+        )
+        counter._encoder = httpx.Client(transport=httpx.MockTransport(handler))
+
+        assert counter.count_text("I have a headache") == 7
+        assert requests[0]["model"] == "t0"
+        assert requests[0]["prompt"] == "I have a headache"
+
+    def test_endpoint_failure_falls_back_to_approximate(self):
+        """A failed request should only approximate the count of its text."""
+        import httpx
+
+        from t0_1.rag.token_counting import TokenCounter
+
+        responses = [httpx.ConnectError("unreachable")]
+
+        def handler(request):
+            if responses:
+                raise responses.pop()
+            return httpx.Response(200, json={"count": 5})
+
+        counter = TokenCounter(method="endpoint", tokenize_url="http://vllm/tokenize")
+        counter._encoder = httpx.Client(transport=httpx.MockTransport(handler))
+
+        assert counter.count_text("a" * 8) == 2
+        assert counter.method == "endpoint"
+        assert counter.count_text("a" * 8) == 5
+
+    def test_endpoint_counts_are_cached(self):
+        """The same text should only be sent to the endpoint once."""
+        import httpx
+
+        from t0_1.rag.token_counting import TokenCounter
+
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(200, json={"count": 3})
+
+        counter = TokenCounter(method="endpoint", tokenize_url="http://vllm/tokenize")
+        counter._encoder = httpx.Client(transport=httpx.MockTransport(handler))
+
+        assert [counter.count_text("headache") for _ in range(3)] == [3, 3, 3]
+        assert len(requests) == 1
+
+    def test_endpoint_prefers_local_tokenizer(self):
+        """The tokenizer of the served model should be used if it loads."""
+        from t0_1.rag.token_counting import TokenCounter
+
+        tokenizer = MagicMock()
+        tokenizer.encode.return_value = [1, 2, 3, 4]
+        counter = TokenCounter(
+            method="endpoint", model_name="t0", tokenize_url="http://vllm/tokenize"
+        )
+
+        with patch.object(counter, "_load_tokenizer", return_value=tokenizer):
+            assert counter.count_text("I have a headache") == 4
+
+        assert not counter.uses_endpoint
+        tokenizer.encode.assert_called_once_with(
+            "I have a headache", add_special_tokens=False
+        )
+
+    def test_agenerate_counts_tokens_off_the_event_loop(self):
+        """Counting may send requests, so it should not block the event loop."""
+        import asyncio
+        import threading
+
+        rag = _build_test_rag(conversational=False)
+        rag.max_context_tokens = 1000
+        threads = []
+        rag.token_counter.count_text = MagicMock(
+            side_effect=lambda text: threads.append(threading.current_thread()) or 1
+        )
+        state = {
+            "question": "I have a headache",
+            "context": [[_make_doc("headache", "Headache info", 0.2)]],
+            "reranked_context": [None],
+            "demographics": None,
+            "system_messages": [],
+            "messages": [],
+        }
+
+        asyncio.run(
+            rag.agenerate(state, {"metadata": {"langgraph_node": "generate"}})
+        )
+
+        assert threads
+        assert threading.main_thread() not in threads
+
+    def test_get_token_counter(self):
+        """The counter should match how the LLM is served."""
+        from t0_1.rag.token_counting import get_token_counter
+
+        llm = MagicMock(openai_api_base="http://vllm:8000/v1")
+        assert get_token_counter("huggingface", "qwen").method == "tokenizer"
+        counter = get_token_counter("openai_completion", "t0", llm=llm)
+        assert counter.method == "endpoint"
+        assert counter.tokenize_url == "http://vllm:8000/tokenize"
+        assert get_token_counter("azure_openai", "gpt-4o").method == "tiktoken"
+        assert get_token_counter("azure", "deepseek-r1").method == "approximate"
+
+    def test_trim_messages_uses_budget_and_returns_cache(self):
+        """Older turns should be trimmed to the budget and counts cached."""
+        rag = _build_test_rag(conversational=False)
+        rag.max_context_tokens = 20
+        messages = [
+            SystemMessage("system"),
+            HumanMessage("first question " * 5),
+            AIMessage("first answer " * 5),
+            HumanMessage("second question"),
+        ]
+
+        trimmed, cache = rag.trim_messages(messages, {})
+
+        assert trimmed == [messages[0], messages[3]]
+        assert len(cache) == 4
+
+    def test_conversational_agent_not_trimmed_by_default(self):
+        """Without a budget the agent's messages should be left as they are."""
+        rag = _build_test_rag(conversational=True)
+        messages = [HumanMessage("question " * 1000)]
+
+        trimmed, _ = rag.trim_messages(messages, {}, conversational_agent=True)
+
+        assert trimmed == messages
+
+
+# ---------------------------------------------------------------------------
+# 19. Cleaned conversation history cache
+# ---------------------------------------------------------------------------
+
+
+class TestCleanedContentCache:
+    """Verify AI messages are stripped of thinking tokens once, when added."""
+
+    def test_clean_messages_reuses_cached_content(self):
+        """Cached cleaned content should be used instead of re-parsing."""
+        messages = [
+            HumanMessage("I have a headache"),
+            AIMessage("<|im_start|>think\nlong trace<|im_start|>answer\nRest", id="a1"),
+            AIMessage("<|im_start|>think\nother<|im_start|>answer\nDrink water", id="a2"),
+        ]
+
+        with patch.object(
+            RAG, "_strip_thinking_tokens", wraps=RAG._strip_thinking_tokens
+        ) as strip:
+            cleaned = RAG._clean_messages_for_context(messages, {"a1": "Rest"})
+
+        assert [m.content for m in cleaned] == ["I have a headache", "Rest", "Drink water"]
+        strip.assert_called_once()
+
+    @patch("t0_1.rag.build_rag.get_stream_writer")
+    def test_router_respond_caches_cleaned_content(self, mock_get_writer):
+        """The router's message should get an id and its cleaned content cached."""
+        mock_get_writer.return_value = MagicMock()
+        rag = _build_test_rag(conversational=True)
+        state = {
+            "messages": [HumanMessage(content="I have a headache")],
+            "t0_reasoning": ["<|im_start|>think\ntrace<|im_start|>answer\n(headache, Self-care)"],
+            "demographics": "30 year old male",
+            "cleaned_content": {"old": "Hello"},
+        }
+
+        result = rag.router_respond(state, {"metadata": {}})
+
+        message = result["messages"][0]
+        assert message.id is not None
+        assert result["cleaned_content"] == {
+            "old": "Hello",
+            message.id: "I'll help you with that",
+        }
+
+    def test_query_or_respond_caches_cleaned_content(self):
+        """The agent's response should be cached under its id."""
+        rag = _build_test_rag(conversational=True)
+        state = {
+            "messages": [HumanMessage(content="Hello")],
+            "demographics": "30 year old male",
+        }
+
+        result = rag.query_or_respond(state)
+
+        message = result["messages"][0]
+        assert result["cleaned_content"] == {message.id: message.content}
+
+
+# ---------------------------------------------------------------------------
+# 20. Shared HTTP connection pools
+# ---------------------------------------------------------------------------
+
+
+class TestHTTPClientPool:
+    """Verify LLM clients share pooled HTTP clients per host."""
+
+    def test_clients_are_shared_per_host(self):
+        """Endpoints on the same host should share one client."""
+        from t0_1.rag.http_pool import HTTPClientPool
+
+        pool = HTTPClientPool()
+        client = pool.get_client("http://vllm:8000/v1")
+
+        assert pool.get_client("http://vllm:8000/v1/") is client
+        assert pool.get_client("http://vllm:8010/v1") is not client
+        assert pool.get_async_client("http://vllm:8000/v1") is not client
+        pool.close()
+
+    def test_per_host_limits(self):
+        """Per-host connection limits should override the default."""
+        from t0_1.rag.http_pool import HTTPClientPool, HTTPPoolConfig
+
+        pool = HTTPClientPool(
+            HTTPPoolConfig(max_connections=50, per_host_max_connections={"vllm:8000": 4})
+        )
+        pool.get_client("http://vllm:8000/v1")
+        pool.get_client("http://other:8000/v1")
+
+        stats = pool.stats()
+        assert stats["http://vllm:8000"]["sync"]["max_connections"] == 4
+        assert stats["http://other:8000"]["sync"]["max_connections"] == 50
+        pool.close()
+
+    def test_stats_count_requests(self):
+        """Requests should be counted as in flight until their response is closed."""
+        import httpx
+
+        from t0_1.rag.http_pool import InstrumentedTransport, PoolStats
+
+        stats = PoolStats(max_connections=1)
+        transport = InstrumentedTransport(
+            httpx.MockTransport(lambda request: httpx.Response(200, text="ok")), stats
+        )
+        with httpx.Client(transport=transport) as client:
+            with client.stream("GET", "http://vllm:8000/health") as response:
+                assert stats.in_flight == 1
+                response.read()
+            client.get("http://vllm:8000/health")
+
+        result = stats.as_dict()
+        assert result["in_flight"] == 0
+        assert result["requests"] == 2
+        assert result["peak_utilisation"] == 1.0
+        assert result["errors"] == 0
+
+    @patch.dict(
+        "os.environ",
+        {"OPENAI_API_KEY": "test", "OPENAI_BASE_URL": "http://vllm:8000/v1"},
+    )
+    def test_openai_models_use_the_pool(self):
+        """OpenAI chat and completion models on one host should share clients."""
+        from t0_1.rag.chat_model import (
+            get_openai_chat_model,
+            get_openai_completion_model,
+        )
+        from t0_1.rag.http_pool import HTTPClientPool
+
+        pool = HTTPClientPool()
+        chat = get_openai_chat_model("chat-model", http_pool=pool)
+        completion = get_openai_completion_model("completion-model", http_pool=pool)
+
+        assert chat.http_client is pool.get_client("http://vllm:8000/v1")
+        assert completion.http_client is chat.http_client
+        assert completion.http_async_client is pool.get_async_client(
+            "http://vllm:8000/v1"
+        )
+        pool.close()
+
+
+# ---------------------------------------------------------------------------
+# 21. Persistent LLM response cache
+# ---------------------------------------------------------------------------
+
+
+class TestResponseCache:
+    """Verify LLM responses are served from the on-disk cache."""
+
+    def test_invoke_is_cached_on_disk(self, tmp_path):
+        """Identical requests should be served from the cache across runs."""
+        from langchain_core.language_models import FakeListLLM
+
+        from t0_1.rag.response_cache import CachedLLM, ResponseCache
+
+        path = tmp_path / "cache.sqlite"
+        llm = CachedLLM(FakeListLLM(responses=["first", "second"]), ResponseCache(path))
+        assert llm.invoke("prompt") == "first"
+        assert llm.invoke("prompt") == "first"
+        # sampling parameters are part of the key
+        assert llm.invoke("prompt", extra_body={"temperature": 0}) == "second"
+
+        inner = FakeListLLM(responses=["first", "second"])
+        rerun = CachedLLM(inner, ResponseCache(path, cache_only=True))
+        assert rerun.invoke("prompt") == "first"
+        assert rerun.cache.stats() == {"hits": 1, "misses": 0}
+        assert inner.i == 0
+
+    def test_message_ids_do_not_change_the_key(self, tmp_path):
+        """Messages should be keyed on their content, not their ids."""
+        from langchain_core.language_models import FakeListChatModel
+
+        from t0_1.rag.response_cache import CachedLLM, ResponseCache
+
+        llm = CachedLLM(
+            FakeListChatModel(responses=["Rest", "Drink water"]),
+            ResponseCache(tmp_path / "cache.sqlite"),
+        )
+        first = llm.invoke([HumanMessage("I have a headache", id="a")])
+        second = llm.invoke([HumanMessage("I have a headache", id="b")])
+
+        assert isinstance(second, AIMessage)
+        assert second.content == first.content == "Rest"
+
+    def test_cache_only_miss_raises(self, tmp_path):
+        """A cache miss should fail rather than call the LLM in cache only mode."""
+        from langchain_core.language_models import FakeListLLM
+
+        from t0_1.rag.response_cache import CachedLLM, ResponseCache
+
+        inner = FakeListLLM(responses=["response"])
+        llm = CachedLLM(inner, ResponseCache(tmp_path / "cache.sqlite", cache_only=True))
+
+        with pytest.raises(KeyError):
+            llm.invoke("prompt")
+        assert inner.i == 0
+
+    def test_stream_stopped_early_is_resumed(self, tmp_path):
+        """Streams closed early are replayed and completed if read further."""
+        from contextlib import closing
+
+        from langchain_core.language_models import FakeStreamingListLLM
+
+        from t0_1.rag.response_cache import CachedLLM, ResponseCache
+
+        cache = ResponseCache(tmp_path / "cache.sqlite")
+        llm = CachedLLM(FakeStreamingListLLM(responses=["hello world"]), cache)
+
+        with closing(llm.stream("prompt")) as stream:
+            partial = ""
+            for chunk in stream:
+                partial += chunk
+                if partial == "hello":
+                    break
+        assert cache.lookup(llm._key("prompt", {})) == ("hello", False)
+
+        with closing(llm.stream("prompt")) as stream:
+            assert next(stream) == "hello"
+        assert "".join(llm.stream("prompt")) == "hello world"
+        assert cache.lookup(llm._key("prompt", {})) == ("hello world", True)
+        assert list(llm.stream("prompt")) == ["hello world"]
+
+    def test_bind_tools_keeps_cache(self, tmp_path):
+        """Binding tools should return a cached LLM keyed on the tools."""
+        from t0_1.rag.response_cache import CachedLLM, ResponseCache
+
+        inner = MagicMock()
+        inner.dict.return_value = {"model_name": "model"}
+        inner.bind_tools.return_value = MagicMock(kwargs={"tools": ["tool"]})
+        llm = CachedLLM(inner, ResponseCache(tmp_path / "cache.sqlite"), "openai", "model")
+
+        bound = llm.bind_tools(["tool"])
+
+        assert isinstance(bound, CachedLLM)
+        assert bound.cache is llm.cache
+        assert bound.params["bound_kwargs"] == {"tools": ["tool"]}
+        assert bound._key("prompt", {}) != llm._key("prompt", {})
+
+
+# ---------------------------------------------------------------------------
+# 22. Load-balanced LLM replicas
+# ---------------------------------------------------------------------------
+
+
+class TestLoadBalancer:
+    """Verify requests are balanced over healthy replicas."""
+
+    URLS = "http://vllm-0:8000/v1, http://vllm-1:8000/v1/"
+
+    def test_parse_base_urls(self):
+        """Comma separated base URLs should be split and normalised."""
+        from t0_1.rag.load_balancer import parse_base_urls
+
+        assert parse_base_urls(self.URLS) == [
+            "http://vllm-0:8000/v1",
+            "http://vllm-1:8000/v1",
+        ]
+        assert parse_base_urls(None) == []
+
+    def test_least_outstanding_routing(self):
+        """Requests should go to the replica with the fewest outstanding requests."""
+        from t0_1.rag.load_balancer import LoadBalancer
+
+        balancer = LoadBalancer(self.URLS, health_check_interval=0)
+        first = balancer.acquire()
+        second = balancer.acquire()
+        assert first is not second
+
+        balancer.release(first)
+        assert balancer.acquire() is first
+
+    def test_eject_and_readmit(self):
+        """Failing replicas are ejected and re-admitted once healthy."""
+        import httpx
+
+        from t0_1.rag.load_balancer import LoadBalancer
+
+        balancer = LoadBalancer(self.URLS, health_check_interval=0, max_failures=2)
+        replica = balancer.replicas[0]
+        for _ in range(2):
+            assert balancer.acquire() is replica
+            balancer.release(replica, error=True)
+        assert not replica.healthy
+        assert all(balancer.acquire() is balancer.replicas[1] for _ in range(3))
+
+        client = httpx.Client(
+            transport=httpx.MockTransport(lambda request: httpx.Response(200))
+        )
+        balancer.check_health(client)
+        assert replica.healthy
+        assert balancer.acquire() is replica
+
+    def test_check_health_closes_own_client(self):
+        """A health check without a client should close the client it opens."""
+        import httpx
+
+        from t0_1.rag.load_balancer import LoadBalancer
+
+        balancer = LoadBalancer(self.URLS, health_check_interval=0)
+        with patch("t0_1.rag.load_balancer.httpx.Client") as client_cls:
+            client = client_cls.return_value.__enter__.return_value
+            client.get.return_value = httpx.Response(200)
+            balancer.check_health()
+
+        assert client.get.call_count == len(balancer.replicas)
+        client_cls.return_value.__exit__.assert_called_once()
+
+    def test_http2_needs_h2(self):
+        """HTTP/2 pools should fail early with a clear error without h2."""
+        import importlib.util
+
+        from t0_1.rag.http_pool import HTTPPoolConfig
+
+        if importlib.util.find_spec("h2") is not None:
+            pytest.skip("h2 is installed")
+        with pytest.raises(ImportError, match="httpx\\[http2\\]"):
+            HTTPPoolConfig(http2=True)
+
+    def test_sticky_replica(self):
+        """Requests within a sticky context should stay on one replica."""
+        from t0_1.rag.load_balancer import LoadBalancer, sticky_replica
+
+        balancer = LoadBalancer(self.URLS, health_check_interval=0)
+        with sticky_replica():
+            replicas = {id(balancer.acquire()) for _ in range(3)}
+        assert len(replicas) == 1
+        assert balancer.acquire() is not balancer.replicas[0]
+
+    def test_transport_routes_to_replica(self):
+        """Requests to the first base URL should be sent to the chosen replica."""
+        import httpx
+
+        from t0_1.rag.load_balancer import LoadBalancedTransport, LoadBalancer
+
+        balancer = LoadBalancer(self.URLS, health_check_interval=0)
+        transport = httpx.MockTransport(
+            lambda request: httpx.Response(
+                200, text=f"{request.headers['Host']}{request.url.path}"
+            )
+        )
+        client = httpx.Client(
+            transport=LoadBalancedTransport(balancer, lambda url: transport)
+        )
+        with client.stream("POST", "http://vllm-0:8000/v1/completions") as first:
+            second = client.post("http://vllm-0:8000/v1/completions")
+            assert first.read() == b"vllm-0:8000/v1/completions"
+        assert second.text == "vllm-1:8000/v1/completions"
+        assert [r.outstanding for r in balancer.replicas] == [0, 0]
+
+    @patch.dict(
+        "os.environ",
+        {
+            "OPENAI_API_KEY": "test",
+            "OPENAI_BASE_URL": "http://vllm-0:8000/v1,http://vllm-1:8000/v1",
+        },
+    )
+    def test_completion_model_is_load_balanced(self):
+        """Comma separated OPENAI_BASE_URL should give a load balanced client."""
+        from t0_1.rag.chat_model import get_openai_completion_model
+        from t0_1.rag.http_pool import HTTPClientPool, HTTPPoolConfig
+
+        pool = HTTPClientPool(HTTPPoolConfig(health_check_interval=0))
+        llm = get_openai_completion_model("model", http_pool=pool)
+
+        urls = ["http://vllm-0:8000/v1", "http://vllm-1:8000/v1"]
+        assert llm.openai_api_base == urls[0]
+        assert llm.http_client is pool.get_load_balanced_client(urls)
+        assert list(pool.load_balancer_stats()) == [",".join(urls)]
+        pool.close()
+
+
+# ---------------------------------------------------------------------------
+# 23. Admission control of the RAG endpoint
+# ---------------------------------------------------------------------------
+
+
+class TestAdmissionControl:
+    """Verify concurrent graph executions are limited with a bounded queue."""
+
+    def test_queue_and_reject(self):
+        """Requests over the limit should queue, and be rejected once it is full."""
+        import asyncio
+
+        from t0_1.rag.admission import AdmissionController, AdmissionRejected
+
+        async def _run():
+            controller = AdmissionController(max_in_flight=1, max_queue=1)
+            start = await controller.acquire()
+            waiting = asyncio.create_task(controller.acquire())
+            await asyncio.sleep(0)
+            assert controller.stats()["queue_depth"] == 1
+
+            with pytest.raises(AdmissionRejected):
+                await controller.acquire()
+
+            controller.release(start)
+            controller.release(await waiting)
+            return controller.stats()
+
+        stats = asyncio.run(_run())
+        assert stats["admitted"] == 2
+        assert stats["rejected"] == 1
+        assert stats["in_flight"] == 0
+        assert stats["queue_depth"] == 0
+
+    def test_queue_timeout(self):
+        """Requests waiting longer than the timeout should be rejected."""
+        import asyncio
+
+        from t0_1.rag.admission import AdmissionController, AdmissionRejected
+
+        async def _run():
+            controller = AdmissionController(max_in_flight=1, queue_timeout=0.01)
+            await controller.acquire()
+            with pytest.raises(AdmissionRejected) as e:
+                await controller.acquire()
+            return controller, e.value
+
+        controller, error = asyncio.run(_run())
+        assert controller.timed_out == 1
+        assert controller.queued == 0
+        assert error.retry_after >= 1
+
+    def test_query_endpoint_returns_429(self):
+        """A full queue should give a 429 response with Retry-After."""
+        import asyncio
+
+        from fastapi.testclient import TestClient
+
+        from t0_1.rag.admission import AdmissionController
+        from t0_1.rag.rag_endpoint import create_rag_app
+
+        rag = _build_test_rag(conversational=False)
+        controller = AdmissionController(max_in_flight=1, max_queue=0)
+        asyncio.run(controller.acquire())
+        client = TestClient(create_rag_app(rag, query_admission=controller))
+
+        response = client.post("/query", json={"query": "I have a headache"})
+
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "1"
+        stats = client.get("/admission_stats").json()
+        assert stats["query"]["rejected"] == 1
+        assert stats["query_stream"]["max_in_flight"] is None
+
+    def test_stream_releases_slot(self, tmp_path):
+        """The stream's slot should be held until the stream has finished."""
+        from fastapi.testclient import TestClient
+
+        from t0_1.rag.admission import AdmissionController
+        from t0_1.rag.rag_endpoint import create_rag_app
+
+        rag = _build_test_rag(conversational=False)
+        rag._query_stream = MagicMock(return_value=iter(["Rest ", "and sleep"]))
+        with patch.dict("os.environ", {"T0_LOG_DIR": str(tmp_path)}):
+            app = create_rag_app(
+                rag, stream_admission=AdmissionController(max_in_flight=1)
+            )
+        client = TestClient(app)
+
+        response = client.post("/query_stream", json={"query": "I have a headache"})
+
+        assert response.text == "Rest and sleep"
+        stats = client.get("/admission_stats").json()["query_stream"]
+        assert stats["admitted"] == 1
+        assert stats["in_flight"] == 0
+
+    def test_stream_releases_slot_on_error(self):
+        """The stream's slot should be released if the request fails to start."""
+        from fastapi.testclient import TestClient
+
+        from t0_1.rag.admission import AdmissionController
+        from t0_1.rag.rag_endpoint import create_rag_app
+
+        rag = _build_test_rag(conversational=False)
+        app = create_rag_app(rag, stream_admission=AdmissionController(max_in_flight=1))
+        app.state.active_thread_ids = MagicMock()
+        app.state.active_thread_ids.aadd = AsyncMock(
+            side_effect=RuntimeError("database locked")
+        )
+        client = TestClient(app, raise_server_exceptions=False)
+
+        response = client.post("/query_stream", json={"query": "I have a headache"})
+
+        assert response.status_code == 500
+        assert app.state.admission["query_stream"].in_flight == 0
+
+    def test_stream_releases_slot_if_never_iterated(self):
+        """The stream's slot should be released once even if the body is not sent."""
+        import asyncio
+
+        from t0_1.rag.admission import AdmissionController
+        from t0_1.rag.rag_endpoint import QueryRequest, create_rag_app
+
+        rag = _build_test_rag(conversational=False)
+        app = create_rag_app(rag, stream_admission=AdmissionController(max_in_flight=1))
+        endpoint = next(
+            route.endpoint for route in app.routes if route.path == "/query_stream"
+        )
+        admission = app.state.admission["query_stream"]
+
+        async def _run():
+            response = await endpoint(QueryRequest(query="I have a headache"))
+            assert admission.in_flight == 1
+            await response.background()
+            await response.background()
+
+        asyncio.run(_run())
+        assert admission.in_flight == 0
+
+
+# ---------------------------------------------------------------------------
+# 24. Coalescing identical in-flight queries
+# ---------------------------------------------------------------------------
+
+
+class TestQueryCoalescing:
+    """Verify identical concurrent queries share one graph execution."""
+
+    def test_run_coalesces_identical_keys(self):
+        """Concurrent runs with the same key should execute once."""
+        import asyncio
+
+        from t0_1.rag.single_flight import SingleFlight
+
+        calls = []
+
+        async def _execute(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value
+
+        async def _run():
+            flight = SingleFlight()
+            results = await asyncio.gather(
+                flight.run("a", lambda: _execute(1)),
+                flight.run("a", lambda: _execute(2)),
+                flight.run("b", lambda: _execute(3)),
+            )
+            return flight, results
+
+        flight, results = asyncio.run(_run())
+        assert results == [1, 1, 3]
+        assert calls == [1, 3]
+        assert flight.stats() == {"executed": 2, "coalesced": 1, "in_flight": 0}
+
+    def test_stream_is_broadcast_to_late_subscribers(self):
+        """Subscribers attaching late should receive the whole stream."""
+        import asyncio
+        import threading
+
+        from t0_1.rag.single_flight import SingleFlight
+
+        release = threading.Event()
+        calls = []
+
+        def _stream():
+            calls.append(1)
+            yield "Rest "
+            release.wait(timeout=5)
+            yield "and sleep"
+
+        async def _collect(stream):
+            return "".join([chunk async for chunk in stream])
+
+        async def _run():
+            flight = SingleFlight()
+            first = asyncio.create_task(_collect(flight.stream("a", _stream)))
+            await asyncio.sleep(0.05)
+            second = asyncio.create_task(_collect(flight.stream("a", _stream)))
+            await asyncio.sleep(0.01)
+            release.set()
+            return await asyncio.gather(first, second)
+
+        assert asyncio.run(_run()) == ["Rest and sleep", "Rest and sleep"]
+        assert calls == [1]
+
+    def test_single_flight_key_normalises_query(self):
+        """Whitespace should not change the key, the demographics should."""
+        rag = _build_test_rag(conversational=False)
+
+        key = rag.single_flight_key("I have  a headache ", "30 year old male")
+
+        assert key == rag.single_flight_key("I have a headache", "30 year old male")
+        assert key != rag.single_flight_key("I have a headache", "30 year old female")
+
+    def test_aquery_coalesces_graph_executions(self):
+        """Identical concurrent queries should get the same graph response."""
+        import asyncio
+
+        from t0_1.rag.single_flight import SingleFlight
+
+        rag = _build_test_rag(conversational=False)
+        rag.single_flight = SingleFlight()
+
+        async def _ainvoke(input, config):
+            await asyncio.sleep(0.01)
+            return {"question": input["question"], "answer": "Rest"}
+
+        rag.graph = MagicMock()
+        rag.graph.ainvoke = AsyncMock(side_effect=_ainvoke)
+
+        async def _run():
+            return await asyncio.gather(
+                rag._aquery("I have a headache", thread_id="a"),
+                rag._aquery("I have a headache ", thread_id="b"),
+            )
+
+        first, second = asyncio.run(_run())
+        assert first == second == {"question": "I have a headache", "answer": "Rest"}
+        assert first is not second
+        rag.graph.ainvoke.assert_called_once()
+
+    def test_conversational_queries_are_not_coalesced(self):
+        """Conversational responses depend on the history so are not coalesced."""
+        rag = RAG(
+            retriever=_make_fake_retriever(),
+            prompt=_make_prompt_template(),
+            llm=_make_fake_llm("Test answer from T0"),
+            conversational=True,
+            conversational_agent_llm=_make_fake_llm("Hello"),
+            coalesce_queries=True,
+        )
+
+        assert rag.single_flight is None
+
+
+# ---------------------------------------------------------------------------
+# 25. Multi-worker shared state
+# ---------------------------------------------------------------------------
+
+
+class TestSharedState:
+    """Test the state shared by the workers of the RAG server."""
+
+    def _build_conversational_rag(self, path):
+        from t0_1.rag.shared_state import SQLiteSaver
+
+        return RAG(
+            retriever=_make_fake_retriever(),
+            prompt=_make_prompt_template(),
+            llm=_make_fake_llm("Test answer from T0"),
+            conversational=True,
+            conversational_agent_llm=_make_fake_llm("Hello"),
+            checkpointer=SQLiteSaver(path),
+        )
+
+    def test_history_is_shared_across_instances(self, tmp_path):
+        """A conversation written by one worker should be visible to another."""
+        path = tmp_path / "state.db"
+        first = self._build_conversational_rag(path)
+        second = self._build_conversational_rag(path)
+
+        first._query("I have a headache", thread_id="t1")
+
+        assert second.get_thread_ids() == ["t1"]
+        messages = second.get_message_history("t1")
+        assert [m.content for m in messages] == ["I have a headache", "Hello"]
+
+        second.clear_history("t1")
+        assert first.get_thread_ids() == []
+
+    def test_reset_graph_keeps_checkpointer(self, tmp_path):
+        """Resetting the graph should not replace a shared checkpointer."""
+        rag = self._build_conversational_rag(tmp_path / "state.db")
+        checkpointer = rag.memory
+
+        rag.reset_graph()
+
+        assert rag.memory is checkpointer
+
+    def test_async_history_is_shared(self, tmp_path):
+        """The async checkpointer methods should use the same database."""
+        import asyncio
+
+        path = tmp_path / "state.db"
+        first = self._build_conversational_rag(path)
+        second = self._build_conversational_rag(path)
+
+        asyncio.run(first._aquery("I have a headache", thread_id="t1"))
+
+        assert second.get_thread_ids() == ["t1"]
+
+    def test_thread_registry_is_shared(self, tmp_path):
+        """Thread IDs registered by one worker should be taken for the others."""
+        from t0_1.rag.shared_state import ThreadRegistry
+
+        first = ThreadRegistry(tmp_path / "state.db")
+        second = ThreadRegistry(tmp_path / "state.db")
+
+        assert first.add("happy-otter-01")
+        assert not second.add("happy-otter-01")
+        assert "happy-otter-01" in second
+
+        second.discard("happy-otter-01")
+        assert "happy-otter-01" not in first
+
+    def test_thread_registry_writes_off_the_event_loop(self, tmp_path):
+        """Database writes may wait for other workers, so they run in a thread."""
+        import asyncio
+        import threading
+
+        from t0_1.rag.shared_state import ThreadRegistry
+
+        registry = ThreadRegistry(tmp_path / "state.db")
+        add = registry.add
+        threads = []
+
+        def _add(thread_id):
+            threads.append(threading.current_thread())
+            return add(thread_id)
+
+        registry.add = _add
+
+        assert asyncio.run(registry.aadd("happy-otter-01"))
+        assert threads and threads[0] is not threading.main_thread()
+        assert "happy-otter-01" in registry
+
+    def test_new_thread_id_registers_thread(self, tmp_path):
+        """/new_thread_id should register its thread ID in the registry."""
+        from fastapi.testclient import TestClient
+
+        from t0_1.rag.rag_endpoint import create_rag_app
+        from t0_1.rag.shared_state import ThreadRegistry
+
+        registry = ThreadRegistry(tmp_path / "state.db")
+        app = create_rag_app(_build_test_rag(), thread_registry=registry)
+
+        thread_id = TestClient(app).get("/new_thread_id").json()["thread_id"]
+
+        assert thread_id in ThreadRegistry(tmp_path / "state.db")
+
+    def test_mmap_faiss_index(self, tmp_path):
+        """A FAISS index should be memory-mapped and return the same results."""
+        from pathlib import Path
+
+        from langchain_community.vectorstores import FAISS
+        from langchain_core.embeddings import FakeEmbeddings
+
+        from t0_1.query_vector_store.utils import load_faiss_mmap
+
+        embeddings = FakeEmbeddings(size=8)
+        store = FAISS.from_texts(["headache", "migraine", "fever"], embeddings)
+        store.save_local(str(tmp_path))
+        vector = embeddings.embed_query("headache")
+
+        loaded = load_faiss_mmap(
+            tmp_path, embeddings, allow_dangerous_deserialization=True
+        )
+
+        expected = store.similarity_search_by_vector(vector, k=2)
+        assert loaded.similarity_search_by_vector(vector, k=2) == expected
+        maps = Path("/proc/self/maps")
+        if maps.exists():
+            # the codes of the flat index are mapped rather than read
+            assert str(tmp_path / "index.faiss") in maps.read_text()
+
+    def test_mmap_faiss_index_requires_trust(self, tmp_path):
+        """Loading the pickled docstore should require trusting the source."""
+        from t0_1.query_vector_store.utils import load_faiss_mmap
+
+        with pytest.raises(ValueError, match="trusted sources"):
+            load_faiss_mmap(tmp_path, MagicMock())
+
+    def test_several_workers_require_shared_state(self):
+        """Serving with several workers should need a shared state path."""
+        from t0_1.rag.rag_endpoint import main
+
+        with pytest.raises(ValueError, match="shared state path"):
+            main(conditions_file="conditions.jsonl", workers=2)
+
+    def test_several_workers_build_index_once(self, tmp_path, monkeypatch):
+        """The index should be built before the workers start, which only load it."""
+        import json
+        import os
+        from dataclasses import replace
+
+        from t0_1.rag import rag_endpoint
+
+        config = replace(
+            rag_endpoint.DEFAULT_RETRIEVER_CONFIG,
+            persist_directory=str(tmp_path / "db"),
+            local_file_store=str(tmp_path / "store"),
+        )
+        monkeypatch.delenv(rag_endpoint.SERVE_KWARGS_ENV, raising=False)
+        with (
+            patch.object(rag_endpoint, "get_parent_doc_retriever") as build_index,
+            patch.object(rag_endpoint.uvicorn, "run") as run,
+        ):
+            rag_endpoint.main(
+                conditions_file="conditions.jsonl",
+                config=config,
+                force_create=True,
+                workers=2,
+                shared_state_path=tmp_path / "state.db",
+            )
+
+        build_index.assert_called_once()
+        assert build_index.call_args.kwargs["force_create"] is True
+        run.assert_called_once()
+        kwargs = json.loads(os.environ[rag_endpoint.SERVE_KWARGS_ENV])
+        assert kwargs["force_create"] is False
+
+    def test_create_app_from_env(self, tmp_path, monkeypatch):
+        """Workers should build the RAG from the arguments in the environment."""
+        import json
+        from dataclasses import asdict
+
+        from t0_1.rag import rag_endpoint
+
+        kwargs = {
+            "conditions_file": "conditions.jsonl",
+            "config": asdict(rag_endpoint.DEFAULT_RETRIEVER_CONFIG),
+            "trust_source": True,
+            "app": {
+                "query_admission": {"max_in_flight": 2},
+                "stream_admission": {"max_in_flight": 1},
+                "shared_state_path": str(tmp_path / "state.db"),
+                "workers": 2,
+            },
+        }
+        monkeypatch.setenv(rag_endpoint.SERVE_KWARGS_ENV, json.dumps(kwargs))
+
+        rag = _build_test_rag()
+        with patch.object(rag_endpoint, "build_rag", return_value=rag) as build_rag:
+            app = rag_endpoint.create_app_from_env()
+
+        config = build_rag.call_args.kwargs["config"]
+        assert config == rag_endpoint.DEFAULT_RETRIEVER_CONFIG
+        assert app.state.admission["query"].max_in_flight == 2
+        assert app.state.active_thread_ids.path == tmp_path / "state.db"
+
+
+# ---------------------------------------------------------------------------
+# 26. Fast cold start
+# ---------------------------------------------------------------------------
+
+
+class TestColdStart:
+    """Test the offline default prompt and the start up profile."""
+
+    def test_default_prompt_template(self):
+        """The vendored default prompt should take the context and question."""
+        from t0_1.rag.custom_prompt_template import default_prompt_template
+
+        prompt = default_prompt_template()
+        messages = prompt.invoke(
+            {"context": "Headache info", "question": "I have a headache"}
+        ).to_messages()
+
+        assert set(prompt.input_variables) == {"context", "question"}
+        assert len(messages) == 1
+        assert "Question: I have a headache" in messages[0].content
+        assert "Context: Headache info" in messages[0].content
+
+    def test_build_rag_does_not_import_hub(self):
+        """Importing build_rag should not pull in the LangChain hub or torch."""
+        import subprocess
+        import sys
+
+        code = (
+            "import sys, t0_1.rag.build_rag; "
+            "print(any(m in sys.modules for m in ('langchain.hub', 'torch')))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+
+        assert result.stdout.strip() == "False"
+
+    def test_startup_profile_report(self):
+        """The report should list the stages with their share of the total."""
+        from t0_1.rag.profile_startup import StartupProfile
+
+        profile = StartupProfile()
+        profile.timings = {"import": 1.0, "index": 3.0}
+
+        report = profile.report()
+
+        assert profile.total == 4.0
+        assert "import     1.000   25.0%" in report
+        assert "index      3.000   75.0%" in report
+        assert report.splitlines()[-1].startswith("total")
+        assert profile.to_dict() == {"timings": profile.timings, "total": 4.0}
+
+    def test_startup_profile_stage(self):
+        """Stages should be timed even if they raise."""
+        from t0_1.rag.profile_startup import StartupProfile
+
+        profile = StartupProfile()
+        with pytest.raises(RuntimeError):
+            with profile.stage("index"):
+                raise RuntimeError("failed")
+
+        assert list(profile.timings) == ["index"]
+
+    def test_profile_startup_requires_index(self):
+        """Profiling should need an existing index rather than building one."""
+        from t0_1.query_vector_store.build_retriever import DEFAULT_RETRIEVER_CONFIG
+        from t0_1.rag.profile_startup import main
+
+        with pytest.raises(FileNotFoundError, match="does not exist"):
+            main(config=DEFAULT_RETRIEVER_CONFIG)
+
+
+# ---------------------------------------------------------------------------
+# 27. Warm up and readiness
+# ---------------------------------------------------------------------------
+
+
+class TestWarmUp:
+    """Test the warm up of the RAG and the /ready endpoint."""
+
+    def test_warm_up_runs_retrievals_and_connections(self):
+        """Warm up should retrieve for each query and open the LLM connections."""
+        from t0_1.rag.warm_up import WarmUpConfig, warm_up_rag
+
+        rag = _build_test_rag()
+        rag.token_counter = MagicMock()
+
+        profile = warm_up_rag(rag, WarmUpConfig(queries=["headache", "fever"]))
+
+        assert [c.kwargs["input"] for c in rag.retriever.invoke.call_args_list] == [
+            "headache",
+            "fever",
+        ]
+        rag.token_counter.count_text.assert_called_once()
+        rag.llm.root_client.models.list.assert_called_once()
+        assert list(profile.timings) == ["retrieval", "tokenizers", "connections"]
+
+    def test_async_warm_up_opens_async_connections(self):
+        """The async warm up should also open the connections of the async clients."""
+        import asyncio
+
+        from t0_1.rag.warm_up import WarmUpConfig, awarm_up_rag
+
+        rag = _build_test_rag()
+        rag.llm.root_async_client.models.list = AsyncMock()
+
+        profile = asyncio.run(awarm_up_rag(rag, WarmUpConfig(queries=["headache"])))
+
+        rag.llm.root_client.models.list.assert_called_once()
+        rag.llm.root_async_client.models.list.assert_awaited_once()
+        assert list(profile.timings) == [
+            "retrieval",
+            "tokenizers",
+            "connections",
+            "async connections",
+        ]
+
+    def test_warm_up_retrieval_failure_raises(self):
+        """The RAG cannot serve requests if retrieval fails."""
+        from t0_1.rag.warm_up import WarmUpError, warm_up_rag
+
+        rag = _build_test_rag()
+        rag.retriever.invoke.side_effect = RuntimeError("index missing")
+
+        with pytest.raises(WarmUpError, match="index missing"):
+            warm_up_rag(rag)
+
+    def test_warm_up_connection_failure_is_logged(self):
+        """An LLM endpoint that is still starting should not fail the warm up."""
+        from t0_1.rag.warm_up import warm_up_rag
+
+        rag = _build_test_rag()
+        rag.llm.root_client.models.list.side_effect = ConnectionError("refused")
+
+        profile = warm_up_rag(rag)
+
+        assert "connections" in profile.timings
+
+    def test_prefix_cache_primes_system_prompts(self):
+        """The fixed prefix of the system prompt should be sent to the LLM."""
+        from t0_1.rag.warm_up import WarmUpConfig, system_prompt_prefixes, warm_up_rag
+
+        rag = _build_test_rag()
+
+        assert system_prompt_prefixes(rag) == {
+            "llm": ["You are a clinical AI.\n\nContext:\n"]
+        }
+
+        warm_up_rag(rag, WarmUpConfig(queries=[], prefix_cache=True))
+
+        messages = rag.llm.invoke.call_args.args[0]
+        assert messages[0].content == "You are a clinical AI.\n\nContext:\n"
+        assert rag.llm.invoke.call_args.kwargs == {"max_tokens": 1}
+
+    def test_ready_after_warm_up(self):
+        """/ready should return 503 until the warm up has finished."""
+        import threading
+        import time
+
+        from fastapi.testclient import TestClient
+
+        from t0_1.rag.rag_endpoint import create_rag_app
+        from t0_1.rag.warm_up import WarmUpConfig
+
+        rag = _build_test_rag()
+        release = threading.Event()
+        docs = rag.retriever.invoke.return_value
+        rag.retriever.invoke.side_effect = lambda input: release.wait() and docs
+        app = create_rag_app(rag, warm_up=WarmUpConfig(connections=False))
+
+        with TestClient(app) as client:
+            response = client.get("/ready")
+            assert response.status_code == 503
+            assert response.json()["detail"]["status"] in ("pending", "warming")
+
+            release.set()
+            for _ in range(100):
+                if (response := client.get("/ready")).status_code == 200:
+                    break
+                time.sleep(0.01)
+
+        assert response.status_code == 200
+        assert "retrieval" in response.json()["timings"]
+
+    def test_ready_reports_failed_warm_up(self):
+        """/ready should stay unavailable if the warm up failed."""
+        import time
+
+        from fastapi.testclient import TestClient
+
+        from t0_1.rag.rag_endpoint import create_rag_app
+        from t0_1.rag.warm_up import WarmUpConfig
+
+        rag = _build_test_rag()
+        rag.retriever.invoke.side_effect = RuntimeError("index missing")
+        app = create_rag_app(rag, warm_up=WarmUpConfig())
+
+        with TestClient(app) as client:
+            for _ in range(100):
+                detail = client.get("/ready").json()["detail"]
+                if detail["status"] == "failed":
+                    break
+                time.sleep(0.01)
+
+        assert detail["status"] == "failed"
+        assert "index missing" in detail["error"]
+
+    def test_ready_without_warm_up(self):
+        """Without a warm up the RAG is ready straight away."""
+        from fastapi.testclient import TestClient
+
+        from t0_1.rag.rag_endpoint import create_rag_app
+
+        client = TestClient(create_rag_app(_build_test_rag()))
+
+        assert client.get("/ready").json() == {"status": "ready"}
+
+
+# ---------------------------------------------------------------------------
+# 28. ONNX embedding backends
+# ---------------------------------------------------------------------------
+
+
+class TestEmbeddingBackend:
+    """Test the selection of the embedding backend and the parity check."""
+
+    def test_config_defaults_to_torch(self):
+        """Existing configurations should keep the PyTorch backend."""
+        from t0_1.query_vector_store.build_retriever import (
+            DEFAULT_RETRIEVER_CONFIG,
+            RetrieverConfig,
+        )
+
+        assert DEFAULT_RETRIEVER_CONFIG.embedding_backend == "torch"
+        config = RetrieverConfig(
+            embedding_model_name="model",
+            chunk_overlap=50,
+            db_choice="faiss",
+            persist_directory=None,
+            local_file_store=None,
+            search_type="similarity",
+            k=4,
+            search_kwargs={},
+            embedding_backend="onnx-int8",
+        )
+        assert config.embedding_backend == "onnx-int8"
+
+    @pytest.mark.parametrize(
+        "backend, model_kwargs",
+        [
+            ("torch", None),
+            ("onnx", {"backend": "onnx"}),
+            (
+                "onnx-int8",
+                {
+                    "backend": "onnx",
+                    "model_kwargs": {"file_name": "onnx/model_qint8_avx512_vnni.onnx"},
+                },
+            ),
+        ],
+    )
+    def test_setup_embedding_model_backend(self, backend, model_kwargs):
+        """Each backend should load the model with its sentence-transformers kwargs."""
+        from t0_1.query_vector_store import build_index
+
+        with (
+            patch.object(build_index, "HuggingFaceEmbeddings") as embeddings,
+            patch.object(build_index.platform, "machine", return_value="x86_64"),
+        ):
+            build_index.setup_embedding_model("model", backend)
+
+        kwargs = embeddings.call_args.kwargs
+        assert kwargs["model_name"] == "model"
+        assert kwargs.get("model_kwargs") == model_kwargs
+
+    def test_lazy_text_splitter_loads_model_on_first_split(self):
+        """Serving a loaded retriever should not load the text splitter model."""
+        from langchain_text_splitters import CharacterTextSplitter
+
+        from t0_1.query_vector_store import build_index
+
+        splitter = CharacterTextSplitter(chunk_size=5, chunk_overlap=0, separator=" ")
+        with patch.object(
+            build_index, "setup_text_splitter", return_value=splitter
+        ) as setup_text_splitter:
+            lazy = build_index.LazyTextSplitter("model", chunk_overlap=0)
+            setup_text_splitter.assert_not_called()
+
+            assert lazy.split_text("ab cd ef") == splitter.split_text("ab cd ef")
+            lazy.split_text("gh")
+
+        setup_text_splitter.assert_called_once_with("model", 0)
+
+    def test_unknown_backend_raises(self):
+        from t0_1.query_vector_store.build_index import setup_embedding_model
+
+        with pytest.raises(ValueError, match="Unknown embedding backend"):
+            setup_embedding_model("model", "tensorrt")
+
+    def test_cosine_similarities(self):
+        import numpy as np
+
+        from t0_1.query_vector_store.embedding_parity import cosine_similarities
+
+        similarities = cosine_similarities(
+            np.array([[1.0, 0.0], [1.0, 1.0]]), np.array([[2.0, 0.0], [1.0, -1.0]])
+        )
+
+        assert similarities == pytest.approx([1.0, 0.0])
+
+    def test_check_embedding_parity(self):
+        """The check should fail if any embedding drifts too far."""
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+
+        from t0_1.query_vector_store import embedding_parity
+
+        reference = DeterministicFakeEmbedding(size=8)
+        candidate = MagicMock()
+        candidate.embed_query.side_effect = lambda text: [
+            x + 0.001 for x in reference.embed_query(text)
+        ]
+        models = {"torch": reference, "onnx-int8": candidate}
+
+        with patch.object(
+            embedding_parity,
+            "setup_embedding_model",
+            side_effect=lambda name, backend: models[backend],
+        ):
+            result = embedding_parity.check_embedding_parity(
+                ["headache", "fever"], "model", "onnx-int8"
+            )
+
+        assert result["n_texts"] == 2
+        assert result["min_similarity"] > 0.99
+        assert result["passed"]
+
+
+# ---------------------------------------------------------------------------
+# 29. Chunk-split cache
+# ---------------------------------------------------------------------------
+
+
+class TestSplitCache:
+    """Test the reuse of the chunks of split pages."""
+
+    @staticmethod
+    def _splitter():
+        splitter = MagicMock()
+        splitter._chunk_size = 100
+        splitter._chunk_overlap = 10
+        splitter._add_start_index = False
+        splitter.split_text.side_effect = lambda text: text.split(". ")
+        return splitter
+
+    def test_second_split_is_a_cache_hit(self, tmp_path):
+        from t0_1.query_vector_store.split_cache import (
+            CachedTextSplitter,
+            SplitCache,
+        )
+
+        inner = self._splitter()
+        splitter = CachedTextSplitter(inner, SplitCache(tmp_path), "model", 10)
+
+        first = splitter.create_documents(["A. B. C"], metadatas=[{"source": "x"}])
+        second = splitter.create_documents(["A. B. C"], metadatas=[{"source": "x"}])
+
+        assert inner.split_text.call_count == 1
+        assert [d.page_content for d in second] == ["A", "B", "C"]
+        assert [d.page_content for d in first] == [d.page_content for d in second]
+        assert second[0].metadata == {"source": "x"}
+        assert splitter.cache.stats() == {"hits": 1, "misses": 1}
+
+    def test_key_includes_model_and_overlap(self, tmp_path):
+        from t0_1.query_vector_store.split_cache import SplitCache, content_hash
+
+        cache = SplitCache(tmp_path)
+        page_hash = content_hash("A. B")
+        cache.update(page_hash, "model", 10, ["A", "B"])
+
+        assert cache.lookup(page_hash, "model", 10) == ["A", "B"]
+        assert cache.lookup(page_hash, "model", 20) is None
+        assert cache.lookup(page_hash, "other-model", 10) is None
+        assert cache.lookup(content_hash("A. C"), "model", 10) is None
+
+    def test_cache_persists_across_instances(self, tmp_path):
+        from t0_1.query_vector_store.split_cache import get_cached_text_splitter
+
+        first = get_cached_text_splitter(self._splitter(), tmp_path, "model", 10)
+        first.split_text("A. B")
+        first.cache.close()
+
+        inner = self._splitter()
+        second = get_cached_text_splitter(inner, tmp_path, "model", 10)
+
+        assert second.split_text("A. B") == ["A", "B"]
+        inner.split_text.assert_not_called()
+
+    def test_no_cache_dir_returns_splitter(self):
+        from t0_1.query_vector_store.split_cache import get_cached_text_splitter
+
+        splitter = self._splitter()
+
+        assert get_cached_text_splitter(splitter, None, "model", 10) is splitter
+
+
+# ---------------------------------------------------------------------------
+# 30. Chunk-embedding cache
+# ---------------------------------------------------------------------------
+
+
+class TestEmbeddingCache:
+    """Test the reuse of the embeddings of document chunks."""
+
+    @staticmethod
+    def _embeddings():
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+
+        return MagicMock(wraps=DeterministicFakeEmbedding(size=4))
+
+    def test_only_new_chunks_are_embedded(self, tmp_path):
+        from t0_1.query_vector_store.embedding_cache import get_cached_embeddings
+
+        inner = self._embeddings()
+        embeddings = get_cached_embeddings(inner, tmp_path, "model", "torch")
+
+        first = embeddings.embed_documents(["a", "b", "a"])
+        second = embeddings.embed_documents(["b", "c"])
+
+        assert inner.embed_documents.call_args_list[0].args == (["a", "b"],)
+        assert inner.embed_documents.call_args_list[1].args == (["c"],)
+        assert first[0] == first[2]
+        assert second[0] == first[1]
+        assert embeddings.cache.stats() == {"hits": 1, "misses": 4, "size": 3}
+
+    def test_cache_persists_across_instances(self, tmp_path):
+        from t0_1.query_vector_store.embedding_cache import get_cached_embeddings
+
+        first = get_cached_embeddings(self._embeddings(), tmp_path, "model", "torch")
+        expected = first.embed_documents(["a", "b"])
+
+        inner = self._embeddings()
+        second = get_cached_embeddings(inner, tmp_path, "model", "torch")
+
+        assert second.embed_documents(["b", "a"]) == expected[::-1]
+        inner.embed_documents.assert_not_called()
+
+    def test_key_includes_model_and_backend(self, tmp_path):
+        from t0_1.query_vector_store.embedding_cache import get_cached_embeddings
+
+        get_cached_embeddings(
+            self._embeddings(), tmp_path, "model", "torch"
+        ).embed_documents(["a"])
+
+        for model_name, backend in [("model", "onnx"), ("other-model", "torch")]:
+            inner = self._embeddings()
+            get_cached_embeddings(
+                inner, tmp_path, model_name, backend
+            ).embed_documents(["a"])
+            inner.embed_documents.assert_called_once_with(["a"])
+
+    def test_backend_enum_key(self, tmp_path):
+        from t0_1.defaults import EmbeddingBackend
+        from t0_1.query_vector_store.embedding_cache import get_cached_embeddings
+
+        embeddings = get_cached_embeddings(
+            self._embeddings(), tmp_path, "model", EmbeddingBackend.onnx_int8
+        )
+
+        assert embeddings.cache.model_key == "model|onnx-int8"
+
+    def test_dimension_mismatch(self, tmp_path):
+        import numpy as np
+
+        from t0_1.query_vector_store.embedding_cache import EmbeddingCache
+
+        cache = EmbeddingCache(tmp_path, "model|torch")
+        cache.update(["a"], np.ones((1, 4)))
+
+        with pytest.raises(ValueError, match="does not match"):
+            cache.update(["b"], np.ones((1, 8)))
+
+    def test_caches_sharing_a_directory(self, tmp_path):
+        """Updates should keep the rows added by another cache of the directory."""
+        import numpy as np
+
+        from t0_1.query_vector_store.embedding_cache import EmbeddingCache
+
+        first = EmbeddingCache(tmp_path, "model|torch")
+        second = EmbeddingCache(tmp_path, "model|torch")
+        first.update(["a"], np.full((1, 4), 1.0))
+        second.update(["a", "b"], np.stack([np.full(4, 3.0), np.full(4, 2.0)]))
+
+        reloaded = EmbeddingCache(tmp_path, "model|torch")
+        a, b = reloaded.lookup(["a", "b"])
+        assert len(reloaded) == 2
+        assert (a == 1.0).all() and (b == 2.0).all()
+
+    def test_create_index_uses_cache(self, tmp_path):
+        from langchain_text_splitters import CharacterTextSplitter
+
+        from t0_1.query_vector_store.build_index import (
+            VectorStoreConfig,
+            VectorStoreCreator,
+        )
+
+        inner = self._embeddings()
+        config = VectorStoreConfig(
+            embedding_model_name="model",
+            chunk_overlap=0,
+            db_choice="faiss",
+            persist_directory=None,
+            embedding_cache_dir=tmp_path,
+        )
+        for _ in range(2):
+            VectorStoreCreator(
+                inner, CharacterTextSplitter(chunk_size=10, chunk_overlap=0)
+            ).create_index(["headache", "fever"], config=config)
+
+        assert inner.embed_documents.call_count == 1
+
+
+# ---------------------------------------------------------------------------
+# 31. Hybrid BM25 + dense retrieval
+# ---------------------------------------------------------------------------
+
+
+class TestHybridRetrieval:
+    """Test the BM25 index and its fusion with dense search results."""
+
+    @staticmethod
+    def _chunks():
+        return [
+            Document(page_content=text, metadata={"doc_id": doc_id})
+            for doc_id, text in [
+                ("a", "tonsillitis sore throat"),
+                ("b", "migraine headache and nausea"),
+                ("c", "headache after a fall"),
+                ("d", "rash on the arm"),
+            ]
+        ]
+
+    def test_csr_postings(self):
+        from t0_1.query_vector_store.bm25 import BM25Index
+
+        index = BM25Index.from_documents(self._chunks())
+        term_id = index.vocab["headache"]
+        postings = index.doc_ids[index.indptr[term_id] : index.indptr[term_id + 1]]
+
+        assert postings.tolist() == [1, 2]
+        assert index.indptr[-1] == len(index.doc_ids) == len(index.term_freqs)
+
+    def test_search_ranks_exact_terms(self):
+        from t0_1.query_vector_store.bm25 import BM25Index
+
+        results = BM25Index.from_documents(self._chunks()).search("tonsillitis", k=3)
+
+        assert [doc.metadata["doc_id"] for doc, _ in results] == ["a"]
+        assert results[0][1] > 0
+
+    def test_save_and_load(self, tmp_path):
+        from t0_1.query_vector_store.bm25 import BM25Index
+
+        index = BM25Index.from_documents(self._chunks())
+        index.save(tmp_path / "bm25")
+        loaded = BM25Index.load(tmp_path / "bm25")
+
+        assert loaded.scores("headache nausea").tolist() == pytest.approx(
+            index.scores("headache nausea").tolist()
+        )
+        with pytest.raises(FileNotFoundError):
+            BM25Index.load(tmp_path / "missing")
+
+    def test_reciprocal_rank_fusion(self):
+        from t0_1.query_vector_store.bm25 import reciprocal_rank_fusion
+
+        a, b, c = self._chunks()[:3]
+        fused = reciprocal_rank_fusion([[(a, 0.1), (b, 0.2)], [(b, 3.0), (c, 1.0)]])
+
+        assert [doc.metadata["doc_id"] for doc, _ in fused] == ["b", "a", "c"]
+        assert fused[0][1] == pytest.approx(1 / 62 + 1 / 61)
+
+    def test_hybrid_search_scores_follow_fusion(self):
+        """Lower scores should be better and follow the order of the results."""
+        from t0_1.query_vector_store.bm25 import BM25Index, hybrid_search
+
+        chunks = self._chunks()
+        dense = [(chunks[3], 0.5), (chunks[1], 0.9)]
+        bm25_index = BM25Index.from_documents(chunks)
+        results = hybrid_search(dense, bm25_index, "tonsillitis", k=3)
+
+        scores = [score for _, score in results]
+        assert scores == sorted(scores)
+        for doc, score in results:
+            assert score == pytest.approx(1 / doc.metadata["rrf_score"])
+
+    def test_hybrid_search_needs_similarity_search(self):
+        from langchain.storage import InMemoryStore
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        from langchain_core.vectorstores import InMemoryVectorStore
+        from langchain_text_splitters import CharacterTextSplitter
+
+        from t0_1.query_vector_store.bm25 import BM25Index
+        from t0_1.query_vector_store.custom_parent_document_retriever import (
+            CustomParentDocumentRetriever,
+        )
+
+        with pytest.raises(ValueError, match="only supported for the 'similarity'"):
+            CustomParentDocumentRetriever(
+                vectorstore=InMemoryVectorStore(DeterministicFakeEmbedding(size=8)),
+                docstore=InMemoryStore(),
+                child_splitter=CharacterTextSplitter(),
+                search_type="mmr",
+                bm25_index=BM25Index.from_documents(self._chunks()),
+            )
+
+    def test_retriever_fuses_bm25_results(self, tmp_path):
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        from langchain_text_splitters import CharacterTextSplitter
+
+        from t0_1.query_vector_store.build_retriever import (
+            ParentDocumentRetrieverCreator,
+            RetrieverConfig,
+        )
+
+        config = RetrieverConfig(
+            embedding_model_name="model",
+            chunk_overlap=0,
+            db_choice="faiss",
+            persist_directory=str(tmp_path / "db"),
+            local_file_store=str(tmp_path / "store"),
+            search_type="similarity",
+            k=1,
+            search_kwargs={},
+            bm25=True,
+            rrf_k=10,
+            hybrid_fetch_k=4,
+        )
+        creator = ParentDocumentRetrieverCreator(
+            DeterministicFakeEmbedding(size=8),
+            CharacterTextSplitter(chunk_size=30, chunk_overlap=0),
+        )
+        retriever = creator.create_retriever(
+            [chunk.page_content for chunk in self._chunks()],
+            metadatas=[{"source": str(i)} for i in range(4)],
+            config=config,
+        )
+        docs = retriever.invoke("tonsillitis")
+        loaded = creator.load_retriever(config=config, trust_source=True)
+
+        for r in (retriever, loaded):
+            assert (r.rrf_k, r.hybrid_fetch_k) == (10, 4)
+
+        assert len(retriever.bm25_index) == 4
+        assert len(loaded.bm25_index) == 4
+        assert docs and all("sub_docs" in doc.metadata for doc in docs)
+        assert "rrf_score" in docs[0].metadata["sub_docs"][0].metadata
+
+    def test_rejects_distance_skip_thresholds(self):
+        from t0_1.query_vector_store.bm25 import BM25Index
+
+        retriever = _make_fake_retriever()
+        retriever.bm25_index = BM25Index.from_documents(self._chunks())
+
+        with pytest.raises(ValueError, match="hybrid search"):
+            RAG(
+                retriever=retriever,
+                prompt=_make_prompt_template(),
+                llm=_make_fake_llm("answer"),
+                rerank_skip_gap=0.1,
+            )
+
+
+# ---------------------------------------------------------------------------
+# 32. Vectorised maximal marginal relevance
+# ---------------------------------------------------------------------------
+
+
+class TestMMR:
+    """Test the MMR search keeping the scores and sub-documents."""
+
+    def test_matches_reference_selection(self):
+        import numpy as np
+        from langchain_community.vectorstores.utils import (
+            maximal_marginal_relevance as reference_mmr,
+        )
+
+        from t0_1.query_vector_store.mmr import maximal_marginal_relevance
+
+        rng = np.random.default_rng(0)
+        query = rng.normal(size=16)
+        embeddings = rng.normal(size=(30, 16))
+
+        for lambda_mult in (0.0, 0.5, 1.0):
+            assert maximal_marginal_relevance(
+                query, embeddings, k=5, lambda_mult=lambda_mult
+            ) == reference_mmr(query, embeddings, k=5, lambda_mult=lambda_mult)
+
+    def test_fewer_candidates_than_k(self):
+        import numpy as np
+
+        from t0_1.query_vector_store.mmr import maximal_marginal_relevance
+
+        assert maximal_marginal_relevance(np.ones(2), np.eye(2), k=4) == [0, 1]
+        assert maximal_marginal_relevance(np.ones(2), np.empty((0, 2)), k=4) == []
+
+    def test_fallback_embeds_candidates(self):
+        from t0_1.query_vector_store.mmr import mmr_search_with_score
+
+        docs = [Document(page_content=text) for text in ("a", "b", "c")]
+        vectorstore = MagicMock()
+        vectorstore.similarity_search_with_score.return_value = list(
+            zip(docs, [0.1, 0.2, 0.3])
+        )
+        vectorstore.embeddings.embed_query.return_value = [1.0, 0.0]
+        vectorstore.embeddings.embed_documents.return_value = [
+            [1.0, 0.0],
+            [1.0, 0.01],
+            [0.0, 1.0],
+        ]
+
+        results = mmr_search_with_score(
+            vectorstore, "query", k=2, fetch_k=3, lambda_mult=0.3
+        )
+
+        # the near duplicate of the best chunk is skipped for diversity
+        assert results == [(docs[0], 0.1), (docs[2], 0.3)]
+        vectorstore.embeddings.embed_query.assert_called_once_with("query")
+
+    def test_retriever_mmr_keeps_scores(self, tmp_path):
+        import asyncio
+
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        from langchain_text_splitters import CharacterTextSplitter
+
+        from t0_1.query_vector_store.build_retriever import (
+            ParentDocumentRetrieverCreator,
+            RetrieverConfig,
+        )
+
+        config = RetrieverConfig(
+            embedding_model_name="model",
+            chunk_overlap=0,
+            db_choice="faiss",
+            persist_directory=None,
+            local_file_store=None,
+            search_type="mmr",
+            k=2,
+            search_kwargs={"fetch_k": 4},
+        )
+        retriever = ParentDocumentRetrieverCreator(
+            DeterministicFakeEmbedding(size=8),
+            CharacterTextSplitter(chunk_size=20, chunk_overlap=0),
+        ).create_retriever(
+            ["sore throat", "headache", "rash", "cough"],
+            metadatas=[{"source": str(i)} for i in range(4)],
+            config=config,
+        )
+
+        for docs in (
+            retriever.invoke("headache"),
+            asyncio.run(retriever.ainvoke("headache")),
+        ):
+            sub_docs = [sub_doc for doc in docs for sub_doc in doc.metadata["sub_docs"]]
+            assert len(sub_docs) == 2
+            assert all(isinstance(d.metadata["score"], float) for d in sub_docs)
+
+
+# ---------------------------------------------------------------------------
+# 33. Multi-k retrieval evaluation
+# ---------------------------------------------------------------------------
+
+
+class TestMultiKEvaluation:
+    """Test the one-pass evaluation of the vector store for several k."""
+
+    def test_ranking_metrics(self):
+        import numpy as np
+
+        from t0_1.query_vector_store.evaluate import ranking_metrics
+
+        metrics = ranking_metrics(np.array([1, 3, 0, 2]), [1, 3])
+
+        assert metrics["recall@1"] == pytest.approx(0.25)
+        assert metrics["recall@3"] == pytest.approx(0.75)
+        assert metrics["mrr"] == pytest.approx((1 + 1 / 3 + 1 / 2) / 4)
+        assert metrics["ndcg@1"] == pytest.approx(0.25)
+        assert metrics["ndcg@3"] == pytest.approx(
+            (1 + 1 / np.log2(4) + 1 / np.log2(3)) / 4
+        )
+
+    def test_parse_ks(self):
+        from t0_1.query_vector_store.evaluate import parse_ks
+
+        assert parse_ks("10,1, 3,3") == [1, 3, 10]
+        with pytest.raises(ValueError, match="positive"):
+            parse_ks("0,5")
+
+    def test_one_pass_evaluation(self, tmp_path):
+        import json
+
+        from langchain_community.vectorstores import FAISS
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+
+        from t0_1.query_vector_store.evaluate import evaluate_query_store_multi_k
+
+        texts = ["sore throat", "headache", "rash", "cough"]
+        vector_store = FAISS.from_texts(
+            texts,
+            DeterministicFakeEmbedding(size=8),
+            metadatas=[{"source": t.title()} for t in texts],
+        )
+        input_file = tmp_path / "queries.jsonl"
+        input_file.write_text(
+            "\n".join(
+                json.dumps({"query": t, "target": t.title()}) for t in texts[:3]
+            )
+        )
+
+        with patch.object(
+            DeterministicFakeEmbedding,
+            "embed_documents",
+            autospec=True,
+            side_effect=DeterministicFakeEmbedding.embed_documents,
+        ) as embed_documents:
+            summary = evaluate_query_store_multi_k(
+                input_file=input_file,
+                output_file=tmp_path / "results.jsonl",
+                query_field="query",
+                target_document_field="target",
+                vector_store=vector_store,
+                ks=[1, 2],
+                batch_size=2,
+            )
+
+        # the queries are embedded in two batches
+        assert embed_documents.call_count == 2
+        assert summary["recall@1"] == summary["mrr"] == 1.0
+        rows = [
+            json.loads(line) for line in open(summary["output_file"]).read().splitlines()
+        ]
+        assert [row["first_hit_rank"] for row in rows] == [1, 1, 1]
+        assert all(len(row["retrieved_documents_sources"]) == 2 for row in rows)
+        assert Path(summary["output_file"]).with_name(
+            f"{Path(summary['output_file']).stem}_summary.json"
+        ).exists()
+
+
+# ---------------------------------------------------------------------------
+# 34. Retriever configuration sweep
+# ---------------------------------------------------------------------------
+
+
+class TestSweepRetriever:
+    """Test the sweep of retriever configurations."""
+
+    def test_load_grid(self, tmp_path):
+        import json
+
+        from t0_1.query_vector_store.sweep import GRID_DEFAULTS, load_grid
+
+        grid_file = tmp_path / "grid.json"
+        grid_file.write_text(json.dumps({"chunk_overlap": 0, "k": [5, 1]}))
+        grid = load_grid(grid_file)
+
+        assert grid["chunk_overlap"] == [0]
+        assert grid["k"] == [1, 5]
+        assert grid["db_choice"] == GRID_DEFAULTS["db_choice"]
+        with pytest.raises(KeyError, match="Unknown keys"):
+            load_grid({"reranker": ["cross-encoder"]})
+
+    def test_sweep_shares_artefacts(self, tmp_path):
+        import json
+
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        from langchain_text_splitters import CharacterTextSplitter
+
+        from t0_1.query_vector_store import sweep
+
+        conditions = {"Sore throat": "sore throat", "Headache": "headache"}
+        conditions_file = tmp_path / "conditions.jsonl"
+        conditions_file.write_text(
+            "\n".join(
+                json.dumps({"condition_title": k, "condition_content": v})
+                for k, v in conditions.items()
+            )
+        )
+        input_file = tmp_path / "queries.jsonl"
+        input_file.write_text(
+            "\n".join(
+                json.dumps({"query": v, "target": k}) for k, v in conditions.items()
+            )
+        )
+
+        with (
+            patch.object(
+                sweep,
+                "setup_embedding_model",
+                return_value=DeterministicFakeEmbedding(size=8),
+            ) as setup_embedding_model,
+            patch.object(
+                sweep,
+                "setup_text_splitter",
+                side_effect=lambda name, overlap: CharacterTextSplitter(
+                    chunk_size=20, chunk_overlap=overlap
+                ),
+            ),
+            patch.object(
+                DeterministicFakeEmbedding,
+                "embed_documents",
+                autospec=True,
+                side_effect=DeterministicFakeEmbedding.embed_documents,
+            ) as embed_documents,
+        ):
+            rows = sweep.sweep_retriever(
+                grid={
+                    "embedding_model_name": "model",
+                    "chunk_overlap": [0, 1],
+                    "search_type": ["similarity", "mmr"],
+                    "k": [1, 2],
+                },
+                conditions_file=conditions_file,
+                input_file=input_file,
+                output_dir=tmp_path / "sweep",
+                query_field="query",
+                target_document_field="target",
+            )
+
+        assert len(rows) == 2 * 2 * 2
+        assert all(row["recall"] == 1.0 for row in rows)
+        # the model is loaded once and the chunks are embedded once for both
+        # indexes, while the queries are embedded for each search type
+        setup_embedding_model.assert_called_once()
+        embedded = [
+            text for call in embed_documents.call_args_list for text in call.args[1]
+        ]
+        assert embedded.count("sore throat") == 1 + 2 * 2
+        assert (tmp_path / "sweep" / "sweep_results.csv").exists()
+        assert "recall" in sweep.format_table(rows).splitlines()[0]
+
+
+    def test_sweep_rebuilds_incomplete_index(self, tmp_path):
+        """An index left without its completion marker should be rebuilt."""
+        import json
+
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        from langchain_text_splitters import CharacterTextSplitter
+
+        from t0_1.query_vector_store import sweep
+
+        conditions_file = tmp_path / "conditions.jsonl"
+        conditions_file.write_text(
+            json.dumps({"condition_title": "Headache", "condition_content": "headache"})
+        )
+        input_file = tmp_path / "queries.jsonl"
+        input_file.write_text(json.dumps({"query": "headache", "target": "Headache"}))
+        index_dir = tmp_path / "sweep" / "indexes" / "model-onnx-overlap0-faiss"
+        index_dir.mkdir(parents=True)
+        (index_dir / "index.faiss").write_text("interrupted")
+
+        with (
+            patch.object(
+                sweep,
+                "setup_embedding_model",
+                return_value=DeterministicFakeEmbedding(size=8),
+            ),
+            patch.object(
+                sweep,
+                "setup_text_splitter",
+                return_value=CharacterTextSplitter(chunk_size=20, chunk_overlap=0),
+            ),
+        ):
+            rows = sweep.sweep_embedding_model(
+                "model",
+                grid=sweep.load_grid({"chunk_overlap": 0, "k": 1}),
+                conditions_file=conditions_file,
+                input_file=input_file,
+                output_dir=tmp_path / "sweep",
+                query_field="query",
+                target_document_field="target",
+                embedding_backend="onnx",
+            )
+
+        assert rows[0]["recall"] == 1.0
+        assert index_dir.with_name(f"{index_dir.name}.complete").exists()
+
+
+# ---------------------------------------------------------------------------
+# 35. Retrieval snapshots
+# ---------------------------------------------------------------------------
+
+
+class TestRetrievalSnapshot:
+    """Test exporting retrievals to a snapshot and replaying them."""
+
+    def _retrieved_doc(self, doc_id: str, source: str) -> Document:
+        sub_doc = Document(
+            id=f"{doc_id}-0",
+            page_content=f"chunk of {source}",
+            metadata={"doc_id": doc_id, "source": source, "score": 0.25},
+        )
+        return Document(
+            page_content=f"page of {source}",
+            metadata={"source": source, "sub_docs": [sub_doc]},
+        )
+
+    def _snapshot(self, tmp_path):
+        import asyncio
+
+        from langchain.storage import LocalFileStore, create_kv_docstore
+
+        from t0_1.rag.retrieval_snapshot import export_retrieval_snapshot
+
+        docstore = create_kv_docstore(LocalFileStore(tmp_path / "docstore"))
+        docstore.mset(
+            [
+                ("id-a", Document(page_content="page of A", metadata={"source": "A"})),
+                ("id-b", Document(page_content="page of B", metadata={"source": "B"})),
+            ]
+        )
+
+        retriever = MagicMock()
+        retriever.ainvoke = AsyncMock(
+            side_effect=lambda input: [
+                self._retrieved_doc("id-b", "B"),
+                self._retrieved_doc("id-a", "A"),
+            ]
+        )
+        n_queries = asyncio.run(
+            export_retrieval_snapshot(
+                retriever, ["headache", "fever", "headache"], tmp_path / "snap.jsonl"
+            )
+        )
+
+        return n_queries, retriever
+
+    def test_export_deduplicates_queries(self, tmp_path):
+        from t0_1.utils import read_jsonl
+
+        n_queries, retriever = self._snapshot(tmp_path)
+
+        assert n_queries == 2
+        assert retriever.ainvoke.await_count == 2
+        rows = read_jsonl(tmp_path / "snap.jsonl")
+        assert [row["query"] for row in rows] == ["headache", "fever"]
+        assert [doc["doc_id"] for doc in rows[0]["documents"]] == ["id-b", "id-a"]
+        assert rows[0]["documents"][0]["sub_docs"][0]["id"] == "id-b-0"
+
+    def test_replay_reads_documents_from_docstore(self, tmp_path):
+        from t0_1.rag.retrieval_snapshot import load_snapshot_retriever
+
+        self._snapshot(tmp_path)
+        retriever = load_snapshot_retriever(
+            tmp_path / "snap.jsonl", tmp_path / "docstore"
+        )
+        docs = retriever.invoke("headache")
+
+        assert [doc.page_content for doc in docs] == ["page of B", "page of A"]
+        sub_doc = docs[0].metadata["sub_docs"][0]
+        assert sub_doc.id == "id-b-0"
+        assert sub_doc.metadata["score"] == 0.25
+        with pytest.raises(KeyError, match="not found in the retrieval snapshot"):
+            retriever.invoke("rash")
+
+    def test_missing_docstore(self, tmp_path):
+        from t0_1.rag.retrieval_snapshot import load_snapshot_retriever
+
+        self._snapshot(tmp_path)
+        with pytest.raises(FileNotFoundError, match="Local file store"):
+            load_snapshot_retriever(tmp_path / "snap.jsonl", None)
+
+    def test_build_rag_rejects_conversational(self, tmp_path):
+        from t0_1.rag.build_rag import build_rag
+
+        with pytest.raises(ValueError, match="conversational mode"):
+            build_rag(
+                conditions_file="conditions.jsonl",
+                conversational=True,
+                retrieval_snapshot=tmp_path / "snap.jsonl",
+            )
+
+
+# ---------------------------------------------------------------------------
+# 36. Replaying generations from stored prompts
+# ---------------------------------------------------------------------------
+
+
+class TestReplayGeneration:
+    """Test scoring responses and replaying the stored prompts of evaluations."""
+
+    def _tool_call_message(self, condition: str, severity_level: str) -> AIMessage:
+        import json
+
+        arguments = {"condition": condition, "severity_level": severity_level}
+        return AIMessage(
+            content="",
+            additional_kwargs={
+                "tool_calls": [
+                    {
+                        "id": "call-0",
+                        "type": "function",
+                        "function": {
+                            "name": "submit_condition_recommendation",
+                            "arguments": json.dumps(arguments),
+                        },
+                    }
+                ]
+            },
+        )
+
+    def test_parse_response(self):
+        from t0_1.rag.evaluate import parse_response
+
+        assert parse_response(self._tool_call_message("Flu", "Urgent")) == (
+            "Flu",
+            "Urgent",
+        )
+        assert parse_response(AIMessage(content="no tool call")) == ("", "")
+        assert parse_response(
+            AIMessage(content="<think>hmm</think>(Flu, Urgent)"), deepseek_r1=True
+        ) == ("Flu", "Urgent")
+
+    def test_score_response_inconclusive(self):
+        from t0_1.rag.evaluate import score_response
+
+        res = {"retrieved_documents_sources": ["Cold"], "reranked_documents_sources": []}
+        scores = score_response(
+            res,
+            parsed_condition="inconclusive",
+            parsed_severity_level="",
+            target_document="Flu",
+            target_severity_level="Urgent",
+        )
+
+        # inconclusive is correct when the target was not retrieved
+        assert scores["conditions_match"] is True
+        assert scores["severity_match"] is False
+        assert scores["retriever_match"] is False
+
+    def test_replay_generation(self, tmp_path):
+        import asyncio
+        import json
+
+        from t0_1.rag.replay import replay_generation
+        from t0_1.utils import read_jsonl
+
+        row = {
+            "symptoms_description": "fever and aches",
+            "conditions_title": "Flu",
+            "severity_level": "Urgent",
+            "target_document_field": "conditions_title",
+            "retrieved_documents_sources": ["Flu"],
+            "reranked_documents_sources": [],
+            "system_prompt": "You are a doctor.",
+            "rag_message": "fever and aches",
+            "conditions_match": False,
+            "parsed_condition": "Cold",
+        }
+        failed = {"conditions_title": "Flu", "error": "Timeout"}
+        input_file = tmp_path / "results.jsonl"
+        input_file.write_text(json.dumps(row) + "\n" + json.dumps(failed) + "\n")
+
+        llm = MagicMock()
+        llm.ainvoke = AsyncMock(
+            return_value=self._tool_call_message("Flu", "Urgent")
+        )
+        results = asyncio.run(
+            replay_generation(
+                input_file, tmp_path / "replay.jsonl", llm, max_concurrency=4
+            )
+        )
+
+        # rows without a stored prompt are skipped
+        assert len(results) == 1
+        messages = llm.ainvoke.await_args.args[0]
+        assert [m.type for m in messages] == ["system", "human"]
+        assert messages[0].content == "You are a doctor."
+        assert results[0]["conditions_match"] is True
+        assert results[0]["severity_match"] is True
+        assert results[0]["parsed_condition"] == "Flu"
+        (output_file,) = tmp_path.glob("replay_*.jsonl")
+        assert read_jsonl(output_file) == results
+
+    def test_replay_row_records_parse_errors(self):
+        import asyncio
+
+        from t0_1.rag.replay import replay_row
+
+        response = self._tool_call_message("Flu", "Urgent")
+        response.additional_kwargs["tool_calls"][0]["function"]["arguments"] = (
+            '{"condition": "Flu'
+        )
+        llm = MagicMock()
+        llm.ainvoke = AsyncMock(return_value=response)
+        row = {
+            "conditions_title": "Flu",
+            "severity_level": "Urgent",
+            "target_document_field": "conditions_title",
+            "retrieved_documents_sources": ["Flu"],
+            "reranked_documents_sources": [],
+            "rag_message": "fever and aches",
+        }
+
+        res = asyncio.run(replay_row(row, llm))
+
+        assert res["error"].startswith("JSONDecodeError")
+        assert res["parsed_condition"] == ""
+        assert res["conditions_match"] is False
+
+    def test_replay_rejects_completion_provider(self, tmp_path):
+        from t0_1.rag.replay import main
+
+        with pytest.raises(ValueError, match="openai_completion"):
+            main(
+                input_file=tmp_path / "results.jsonl",
+                output_file=tmp_path / "replay.jsonl",
+                llm_provider="openai_completion",
+                llm_model_name="model",
+            )